@@ -0,0 +1,87 @@
+"""
+Measures what recording an audit event costs the request that records it,
+how fast each sink drains the queue, and how much of a file trail a
+filtered query reads compared with scanning it all.
+
+    python -m benchmarks.audit [--events N] [--users N]
+"""
+
+import argparse
+import datetime
+import os
+import tempfile
+import time
+import uuid
+
+from .context import lobbyist
+from lobbyist.library import audit
+from lobbyist.storage import audit as audit_storage
+
+
+def fill(sink, events: int, users: int) -> float:
+    trail = audit.Audit()
+    trail.start(sink, 1000, datetime.timedelta(milliseconds=200), events)
+
+    ids = [uuid.uuid4() for _ in range(users)]
+    start_ts = datetime.datetime(2026, 1, 1)
+    start = time.perf_counter()
+    for i in range(events):
+        trail.record(
+            audit.TOKEN_ISSUED,
+            start_ts + datetime.timedelta(seconds=i),
+            user_id=ids[i % users],
+            name=f"user{i % users}",
+            secret_id=ids[(i + 1) % users],
+            access_token_id=uuid.uuid4(),
+        )
+    record_us = (time.perf_counter() - start) / events * 1e6
+    trail.stop()
+    return record_us
+
+
+def timed_query(kind: str, path: str, **filters) -> str:
+    start = time.perf_counter()
+    count = sum(1 for _ in audit_storage.read_events(kind, path, **filters))
+    elapsed_ms = (time.perf_counter() - start) * 1e3
+    return f"{count:>7} events {elapsed_ms:>8.1f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=200000)
+    parser.add_argument("--users", type=int, default=5000)
+    args = parser.parse_args()
+
+    # A user's events are spread evenly over the trail; the time range
+    # covers 1% of it.
+    since = datetime.datetime(2026, 1, 1) + datetime.timedelta(
+        seconds=args.events // 2
+    )
+    until = since + datetime.timedelta(seconds=args.events // 100)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for kind, path in (
+            ("file", os.path.join(directory, "audit")),
+            ("sqlite", os.path.join(directory, "audit.db")),
+        ):
+            sink = audit_storage.open_sink(kind, path)
+            start = time.perf_counter()
+            record_us = fill(sink, args.events, args.users)
+            drain_s = time.perf_counter() - start
+            print(
+                f"{kind}: record {record_us:.2f} us/event, "
+                f"{args.events / drain_s:,.0f} events/s written"
+            )
+            print(f"  {'all':<12}", timed_query(kind, path))
+            print(
+                f"  {'user':<12}",
+                timed_query(kind, path, user="user7"),
+            )
+            print(
+                f"  {'time range':<12}",
+                timed_query(kind, path, since=since, until=until),
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+Generates a synthetic dataset of realistic volume into a SQLite database,
+for evaluating index and query changes, eg:
+
+    python -m benchmarks.dataset --db big.db --users 1000000
+    LOBBYIST_PLANS_DB=big.db pytest tests/test_query_plans.py -v
+
+Rows are bulk inserted, bypassing the engine. Every secret shares one hash
+of "password", made once at the minimum bcrypt cost, so no time goes to
+hashing. Tokens all land in the primary database; spread them with the
+rebalance-shards command.
+
+Distributions, relative to --now:
+
+- users are created uniformly over the past two years. 5% have since been
+  deleted (expired), and 2% are set to expire within 90 days.
+- each user has its password secret, plus on average --extra-secrets
+  others (geometric), which expire 1 to 365 days after creation.
+- each secret has on average --tokens-per-secret access tokens
+  (geometric), issued over the 30 days up to now, or up to the secret's or
+  user's expiry. 90% live the default day, the rest 1 to 72 hours. Each has
+  one refresh token that lives a week.
+"""
+
+import argparse
+import base64
+import datetime
+import random
+import time
+import uuid
+from typing import Any, Dict, Iterator, List, Optional
+
+import peewee
+
+from .context import lobbyist
+from .fixtures import BCRYPT_COST
+from lobbyist.library import crypto
+from lobbyist.library.config import config
+from lobbyist.library.db import db, pragmas
+from lobbyist.models import AccessToken, RefreshToken, Secret, User
+
+BATCH_ROWS = 4000
+DAY = datetime.timedelta(days=1)
+
+
+class Generator:
+    def __init__(self, rng: random.Random, now: datetime.datetime):
+        self.rng = rng
+        self.now = now
+        self.hash = crypto.hash_secret("password", BCRYPT_COST).decode()
+        self.counts = dict.fromkeys(
+            ("users", "secrets", "access", "refresh"),
+            0,
+        )
+
+    def token_value(self, entropy: int) -> str:
+        # The same length as crypto.make_secret_string, so indexes are
+        # realistically sized.
+        return base64.urlsafe_b64encode(
+            self.rng.randbytes(entropy)
+        ).rstrip(b"=").decode()
+
+    def geometric(self, mean: float) -> int:
+        return int(self.rng.expovariate(1 / mean)) if mean > 0 else 0
+
+    def user(self, index: int) -> Dict[str, Any]:
+        create_ts = self.now - self.rng.random() * 730 * DAY
+        expire_ts = None
+        draw = self.rng.random()
+        if draw < 0.05:
+            expire_ts = create_ts + self.rng.random() * (self.now - create_ts)
+        elif draw < 0.07:
+            expire_ts = self.now + self.rng.random() * 90 * DAY
+        self.counts["users"] += 1
+        return {
+            "id": uuid.UUID(int=self.rng.getrandbits(128), version=4),
+            "name": f"user{index}",
+            "create_ts": create_ts,
+            "expire_ts": expire_ts,
+            "modify_ts": expire_ts if expire_ts and expire_ts < self.now
+            else None,
+        }
+
+    def secrets(self, user: Dict[str, Any], extra: float) -> List[Dict]:
+        rows = [self._secret(user, user["name"], user["create_ts"], None)]
+        for _ in range(self.geometric(extra)):
+            create_ts = user["create_ts"] + self.rng.random() * (
+                (user["expire_ts"] or self.now) - user["create_ts"]
+            )
+            rows.append(
+                self._secret(
+                    user,
+                    self.token_value(config().secret_name_entropy),
+                    create_ts,
+                    create_ts + self.rng.uniform(1, 365) * DAY,
+                )
+            )
+        return rows
+
+    def tokens(
+        self,
+        user: Dict[str, Any],
+        secret: Dict[str, Any],
+        mean: float,
+    ) -> Iterator[Any]:
+        end = min(
+            filter(None, (self.now, secret["expire_ts"], user["expire_ts"]))
+        )
+        start = max(secret["create_ts"], end - 30 * DAY)
+        if start >= end:
+            return
+        for _ in range(self.geometric(mean)):
+            create_ts = start + self.rng.random() * (end - start)
+            lifetime = DAY
+            if self.rng.random() < 0.1:
+                lifetime = self.rng.uniform(1, 72) * datetime.timedelta(
+                    hours=1
+                )
+            access_token = {
+                "id": uuid.UUID(int=self.rng.getrandbits(128), version=4),
+                "value": self.token_value(config().access_token_entropy),
+                "create_ts": create_ts,
+                "expire_ts": create_ts + lifetime,
+                "secret": secret["id"],
+            }
+            self.counts["access"] += 1
+            self.counts["refresh"] += 1
+            yield AccessToken, access_token
+            yield RefreshToken, {
+                "id": uuid.UUID(int=self.rng.getrandbits(128), version=4),
+                "value": self.token_value(config().refresh_token_entropy),
+                "create_ts": create_ts,
+                "expire_ts": create_ts + 7 * DAY,
+                "access_token": access_token["id"],
+            }
+
+    def _secret(
+        self,
+        user: Dict[str, Any],
+        name: str,
+        create_ts: datetime.datetime,
+        expire_ts: Optional[datetime.datetime],
+    ) -> Dict[str, Any]:
+        self.counts["secrets"] += 1
+        return {
+            "id": uuid.UUID(int=self.rng.getrandbits(128), version=4),
+            "name": name,
+            "hash": self.hash,
+            "create_ts": create_ts,
+            "expire_ts": expire_ts,
+            "user": user["id"],
+        }
+
+
+def insert(model: peewee.ModelBase, rows: List[Dict[str, Any]]) -> None:
+    # A prepared executemany; building the statement through insert_many
+    # costs several times what SQLite takes to run it.
+    fields = model._meta.sorted_fields
+    defaults = {
+        field.name: field.default() if callable(field.default)
+        else field.default
+        for field in fields
+    }
+    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+        model._meta.table_name,
+        ", ".join(field.column_name for field in fields),
+        ", ".join("?" for _ in fields),
+    )
+    db().cursor().executemany(
+        sql,
+        [
+            [
+                field.db_value(row.get(field.name, defaults[field.name]))
+                for field in fields
+            ]
+            for row in rows
+        ],
+    )
+
+
+def generate(
+    generator: Generator,
+    users: int,
+    extra_secrets: float,
+    tokens_per_secret: float,
+) -> None:
+    batches: Dict[peewee.ModelBase, List[Dict[str, Any]]] = {
+        model: [] for model in (User, Secret, AccessToken, RefreshToken)
+    }
+
+    def flush() -> None:
+        # Parents go first, so foreign keys hold after every batch.
+        for model, rows in batches.items():
+            if rows:
+                insert(model, rows)
+                rows.clear()
+
+    with db().atomic():
+        for index in range(users):
+            user = generator.user(index)
+            batches[User].append(user)
+            for secret in generator.secrets(user, extra_secrets):
+                batches[Secret].append(secret)
+                for model, row in generator.tokens(
+                    user,
+                    secret,
+                    tokens_per_secret,
+                ):
+                    batches[model].append(row)
+            if any(len(rows) >= BATCH_ROWS for rows in batches.values()):
+                flush()
+        flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", required=True)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--extra-secrets", type=float, default=1.0)
+    parser.add_argument("--tokens-per-secret", type=float, default=3.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--now",
+        type=datetime.datetime.fromisoformat,
+        default=datetime.datetime.utcnow(),
+    )
+    args = parser.parse_args()
+
+    db().initialize(
+        peewee.SqliteDatabase(args.db, pragmas=pragmas("throughput"))
+    )
+    db().connect()
+    db().create_tables([User, Secret, AccessToken, RefreshToken])
+
+    generator = Generator(random.Random(args.seed), args.now)
+    start = time.perf_counter()
+    generate(generator, args.users, args.extra_secrets, args.tokens_per_secret)
+    elapsed_s = time.perf_counter() - start
+
+    # Gives the planner statistics to go on, as a long-lived database has.
+    db().execute_sql("ANALYZE")
+    rows = sum(generator.counts.values())
+    print(
+        f"{generator.counts} in {elapsed_s:.1f}s "
+        f"({rows / elapsed_s:,.0f} rows/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
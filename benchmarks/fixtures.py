@@ -0,0 +1,78 @@
+import datetime
+import uuid
+from typing import List
+
+import peewee
+
+from .context import lobbyist
+from lobbyist.library import crypto
+from lobbyist.library.db import db
+from lobbyist.models import AccessToken, RefreshToken, Secret, User
+from lobbyist.storage.engine import storage
+from lobbyist.storage.sqlite import SqliteEngine
+
+# The minimum bcrypt cost; fixtures are about row counts, not hash strength.
+BCRYPT_COST = 4
+
+
+def open_memory_db() -> None:
+    db().initialize(
+        peewee.SqliteDatabase(":memory:", pragmas={"foreign_keys": 1})
+    )
+    db().connect(reuse_if_open=True)
+    db().create_tables([User, Secret, AccessToken, RefreshToken])
+    storage().initialize(SqliteEngine())
+
+
+def seed(
+    server_ts: datetime.datetime,
+    users: int,
+    secrets_per_user: int = 1,
+    access_tokens_per_secret: int = 1,
+    password: str = "password",
+) -> List[str]:
+    """
+    Creates `users` users named user0, user1, ... Each has a password secret
+    of the same name, `secrets_per_user - 1` further secrets, and
+    `access_tokens_per_secret` access tokens with one refresh token each for
+    every secret. Returns one valid access token value per user.
+    """
+    hash = crypto.hash_secret(password, BCRYPT_COST).decode()
+    lifetime = datetime.timedelta(days=1)
+    token_values = []
+
+    with db().atomic():
+        for user_index in range(users):
+            user = User.create(
+                id=uuid.uuid4(),
+                name=f"user{user_index}",
+                create_ts=server_ts,
+            )
+            for secret_index in range(secrets_per_user):
+                secret = Secret.create(
+                    id=uuid.uuid4(),
+                    name=user.name if secret_index == 0 else
+                    f"{user.name}.{secret_index}",
+                    hash=hash,
+                    create_ts=server_ts,
+                    user=user,
+                )
+                for token_index in range(access_tokens_per_secret):
+                    access_token = AccessToken.create(
+                        id=uuid.uuid4(),
+                        value=f"{secret.name}.a{token_index}",
+                        create_ts=server_ts,
+                        expire_ts=server_ts + lifetime,
+                        secret=secret,
+                    )
+                    RefreshToken.create(
+                        id=uuid.uuid4(),
+                        value=f"{secret.name}.r{token_index}",
+                        create_ts=server_ts,
+                        expire_ts=server_ts + lifetime,
+                        access_token=access_token,
+                    )
+                    if secret_index == 0 and token_index == 0:
+                        token_values.append(access_token.value)
+
+    return token_values
@@ -0,0 +1,126 @@
+"""
+Compares token issuance with and without group commit.
+
+    python -m benchmarks.group_commit [--threads N] [--tokens N] [--profile P]
+
+Each row issues `--tokens` access and refresh token pairs from `--threads`
+threads into a fresh database, and reports requests and commits per second.
+Rates count the tokens found committed afterwards; a worker that fails
+stops the benchmark with its error.
+"""
+
+import argparse
+import datetime
+import tempfile
+import threading
+import time
+import uuid
+from typing import List, Tuple
+
+import peewee
+
+from .context import lobbyist
+from lobbyist.controllers import auth
+from lobbyist.library.config import config
+from lobbyist.library.db import db, pragmas
+from lobbyist.library.metrics import metrics
+from lobbyist.models import AccessToken, RefreshToken, Secret, User
+from lobbyist.storage.engine import storage
+from lobbyist.storage.sqlite import SqliteEngine
+
+
+def issue(threads: int, tokens: int) -> Tuple[float, int]:
+    server_ts = datetime.datetime.utcnow()
+    lifetime = datetime.timedelta(hours=1)
+    secrets = []
+    with storage().atomic():
+        for index in range(threads):
+            user = storage().create_user(
+                uuid.uuid4(),
+                f"user{index}",
+                server_ts,
+            )
+            secrets.append(
+                storage().create_secret(
+                    uuid.uuid4(), user.name, "hash", server_ts, None, user.id
+                )
+            )
+
+    errors: List[BaseException] = []
+
+    def work(secret):
+        try:
+            for _ in range(tokens // threads):
+                auth._write(
+                    lambda: auth._create_tokens(
+                        server_ts,
+                        secret.id,
+                        secret.user_id,
+                        lifetime,
+                        lifetime,
+                    )
+                )
+        except BaseException as error:
+            errors.append(error)
+
+    workers = [
+        threading.Thread(target=work, args=(secret, ))
+        for secret in secrets
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed_s = time.perf_counter() - start
+    if errors:
+        raise RuntimeError(
+            f"{len(errors)} of {threads} workers failed"
+        ) from errors[0]
+    return elapsed_s, AccessToken.select().count()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--profile", default="durable")
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-wait-ms", type=float, default=2.0)
+    args = parser.parse_args()
+
+    auth.writer().max_batch = args.max_batch
+    auth.writer().max_wait_s = args.max_wait_ms / 1e3
+
+    print(f"{'mode':<14} {'requests/s':>10} {'commits/s':>10}")
+    for group_commit in (False, True):
+        config().group_commit = group_commit
+        with tempfile.TemporaryDirectory() as directory:
+            db().initialize(
+                peewee.SqliteDatabase(
+                    f"{directory}/bench.db",
+                    pragmas=pragmas(args.profile),
+                )
+            )
+            db().create_tables([User, Secret, AccessToken, RefreshToken])
+            storage().initialize(SqliteEngine())
+
+            auth.writer().report()
+            elapsed_s, issued = issue(args.threads, args.tokens)
+            if group_commit:
+                commits = metrics().snapshot()["counters"][
+                    "group_commit.writer.commits"]
+            else:
+                commits = issued
+            auth.writer().stop()
+            db().close()
+
+        label = "group commit" if group_commit else "per request"
+        print(
+            f"{label:<14} {issued / elapsed_s:>10.0f} "
+            f"{commits / elapsed_s:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
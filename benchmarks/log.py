@@ -0,0 +1,67 @@
+"""
+Measures what a log call costs the thread that makes it: a disabled debug
+call, a synchronous stream handler, the queued handler, and debug sampled
+at 1%. Output goes to /dev/null so only the logging path is measured.
+
+    python -m benchmarks.log [--calls N]
+"""
+
+import argparse
+import logging
+import os
+import time
+
+from .context import lobbyist
+from lobbyist.library import log
+
+LOG = log.logger("benchmarks.log")
+
+
+def run(calls: int) -> float:
+    start = time.perf_counter()
+    for i in range(calls):
+        LOG.debug("benchmarks.log.run %d %s", i, "value")
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def synchronous(stream, format: str) -> None:
+    log.stop()
+    handler = logging.StreamHandler(stream)
+    if format == "json":
+        handler.setFormatter(log.JsonFormatter())
+    handler.addFilter(log.RequestContextFilter())
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=100000)
+    parser.add_argument("--format", choices=["json", "text"], default="json")
+    args = parser.parse_args()
+
+    # The listener writes to sys.stderr; point it at /dev/null.
+    devnull = open(os.devnull, "w")
+    os.dup2(devnull.fileno(), 2)
+
+    cases = (
+        ("debug disabled", "INFO", 1.0, None),
+        ("synchronous StreamHandler", "DEBUG", 1.0, "sync"),
+        ("queued handler", "DEBUG", 1.0, None),
+        ("queued, debug sampled 1%", "DEBUG", 0.01, None),
+    )
+
+    print(f"{'case':<30} {'us/call':>8}")
+    for label, level, rate, mode in cases:
+        log.configure(level, {}, args.format, rate, 1.0, args.calls)
+        if mode == "sync":
+            synchronous(devnull, args.format)
+        elapsed_us = run(args.calls)
+        log.stop()
+        print(f"{label:<30} {elapsed_us:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Compares the model-hydration lookups against the projected record lookups.
+
+    python -m benchmarks.lookup [--users N] [--iterations N]
+"""
+
+import argparse
+import datetime
+import time
+import tracemalloc
+from typing import Any, Callable, List, Tuple
+
+from .fixtures import open_memory_db, seed
+from lobbyist.models import AccessToken, Secret, User
+
+
+def measure(fn: Callable[[int], Any], iterations: int) -> Tuple[float, ...]:
+    # Latency is measured with tracing off; tracemalloc slows allocation.
+    start = time.perf_counter()
+    for index in range(iterations):
+        fn(index)
+    latency_us = (time.perf_counter() - start) / iterations * 1e6
+
+    # Keeping every result alive makes the net block count the number of
+    # allocations that survive a lookup, ie: the result object graph.
+    results: List[Any] = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    for index in range(iterations):
+        results.append(fn(index))
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    blocks = sum(
+        stat.count_diff for stat in after.compare_to(before, "filename")
+    )
+    return (latency_us, blocks / iterations, peak / iterations)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    server_ts = datetime.datetime.utcnow()
+    open_memory_db()
+    tokens = seed(server_ts - datetime.timedelta(minutes=1), args.users)
+
+    def token(index):
+        return tokens[index % len(tokens)]
+
+    def name(index):
+        return f"user{index % len(tokens)}"
+
+    cases = (
+        (
+            "AccessToken.select_valid_by_value",
+            lambda i: AccessToken.select_valid_by_value(server_ts, token(i)),
+        ),
+        (
+            "AccessToken.select_valid_record_by_value",
+            lambda i: AccessToken.
+            select_valid_record_by_value(server_ts, token(i)),
+        ),
+        (
+            "Secret.select_valid_by_name",
+            lambda i: Secret.select_valid_by_name(server_ts, name(i)),
+        ),
+        (
+            "Secret.select_valid_record_by_name",
+            lambda i: Secret.select_valid_record_by_name(server_ts, name(i)),
+        ),
+        ("User.select_by_name", lambda i: User.select_by_name(name(i))),
+        (
+            "User.select_record_by_name",
+            lambda i: User.select_record_by_name(name(i)),
+        ),
+    )
+
+    print(f"{'lookup':<42} {'us/op':>8} {'blocks/op':>10} {'peak B/op':>10}")
+    for label, fn in cases:
+        assert fn(0) is not None, label
+        latency_us, blocks, peak = measure(fn, args.iterations)
+        print(f"{label:<42} {latency_us:>8.1f} {blocks:>10.1f} {peak:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
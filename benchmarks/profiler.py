@@ -0,0 +1,88 @@
+"""
+Measures what sampling costs the requests sampled: access token
+validations on several threads, each wrapped as a request, with the
+profiler off, capturing the slowest requests, and capturing them while a
+profile of every thread runs.
+
+    python -m benchmarks.profiler [--threads N] [--iterations N]
+"""
+
+import argparse
+import datetime
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+import peewee
+
+from .fixtures import seed
+from lobbyist.controllers import auth
+from lobbyist.library.db import db
+from lobbyist.library.profiler import profiler
+from lobbyist.models import AccessToken, RefreshToken, Secret, User
+from lobbyist.storage.engine import storage
+from lobbyist.storage.sqlite import SqliteEngine
+
+
+def run(tokens, threads: int, iterations: int) -> float:
+    server_ts = datetime.datetime.utcnow()
+
+    def work():
+        for index in range(iterations):
+            profiler().begin_request(uuid.uuid4().hex, "validate")
+            start = time.perf_counter()
+            auth._validate_access_token(server_ts, tokens[index % len(tokens)])
+            profiler().end_request(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / (threads * iterations) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--interval-ms", type=float, default=10.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # A file, rather than :memory:, so that the threads share it.
+        db().initialize(
+            peewee.SqliteDatabase(
+                os.path.join(directory, "bench.db"),
+                pragmas={"foreign_keys": 1, "journal_mode": "wal"},
+            )
+        )
+        db().create_tables([User, Secret, AccessToken, RefreshToken])
+        storage().initialize(SqliteEngine())
+        tokens = seed(
+            datetime.datetime.utcnow() - datetime.timedelta(minutes=1),
+            args.users,
+        )
+        profiler().interval_s = args.interval_ms / 1e3
+
+        print(f"{'profiler':<12} {'us/request':>10}")
+        for label in ("off", "slowest", "+ profile"):
+            if label == "slowest":
+                profiler().enabled = True
+                profiler().capture_slowest(10)
+            elif label == "+ profile":
+                threading.Thread(
+                    target=profiler().profile,
+                    args=(3600, True),
+                    daemon=True,
+                ).start()
+            elapsed_us = run(tokens, args.threads, args.iterations)
+            print(f"{label:<12} {elapsed_us:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
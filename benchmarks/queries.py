@@ -0,0 +1,54 @@
+"""
+Measures what timing and accounting every statement costs, by validating
+access tokens against a plain peewee database and an instrumented one.
+
+    python -m benchmarks.queries [--users N] [--iterations N]
+"""
+
+import argparse
+import datetime
+import time
+
+import peewee
+
+from .fixtures import seed
+from lobbyist.controllers import auth
+from lobbyist.library import db as db_library
+from lobbyist.library.db import db
+from lobbyist.library.queries import queries
+from lobbyist.models import AccessToken, RefreshToken, Secret, User
+from lobbyist.storage.engine import storage
+from lobbyist.storage.sqlite import SqliteEngine
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    server_ts = datetime.datetime.utcnow()
+    storage().initialize(SqliteEngine())
+    print(f"{'database':<14} {'us/validation':>14}")
+    for label, cls in (
+        ("peewee", peewee.SqliteDatabase),
+        ("instrumented", db_library.SqliteDatabase),
+    ):
+        db().initialize(cls(":memory:", pragmas={"foreign_keys": 1}))
+        db().connect()
+        db().create_tables([User, Secret, AccessToken, RefreshToken])
+        tokens = seed(server_ts - datetime.timedelta(minutes=1), args.users)
+
+        start = time.perf_counter()
+        for index in range(args.iterations):
+            auth._validate_access_token(server_ts, tokens[index % len(tokens)])
+        elapsed_us = (time.perf_counter() - start) / args.iterations * 1e6
+        print(f"{label:<14} {elapsed_us:>14.1f}")
+        db().close()
+
+    for query in queries().top(3):
+        print(query.into_dict())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Compares encoding a large PrivateUserResponse through nested `into_dict`
+results and Flask's default JSON provider against the compiled model
+encoders and the streaming encoder, in JSON and in CBOR.
+
+    python -m benchmarks.serialization [--secrets N] [--tokens N]
+"""
+
+import argparse
+import datetime
+import time
+
+import flask
+import flask.json.provider
+
+from .fixtures import open_memory_db, seed
+from lobbyist.controllers.user import PrivateUserResponse
+from lobbyist.library import serialization
+from lobbyist.models import User
+
+
+def nested_dicts(response: PrivateUserResponse):
+    return {
+        key: value.into_dict() if isinstance(value, User) else
+        [item.into_dict() for item in value]
+        for key, value in response.into_dict().items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--secrets", type=int, default=100)
+    parser.add_argument("--tokens", type=int, default=20)
+    parser.add_argument("--iterations", type=int, default=10)
+    args = parser.parse_args()
+
+    server_ts = datetime.datetime.utcnow()
+    open_memory_db()
+    seed(
+        server_ts - datetime.timedelta(minutes=1),
+        users=1,
+        secrets_per_user=args.secrets,
+        access_tokens_per_secret=args.tokens,
+    )
+    response = PrivateUserResponse(server_ts, User.select_by_name("user0"))
+    default_provider = flask.json.provider.DefaultJSONProvider(
+        flask.Flask(__name__)
+    )
+
+    # The same payload with rows already hydrated isolates encoding cost
+    # from query cost.
+    loaded = {
+        key: value if isinstance(value, User) else list(value)
+        for key, value in response.into_dict().items()
+    }
+
+    cases = (
+        (
+            "into_dict + DefaultJSONProvider",
+            lambda: default_provider.dumps(nested_dicts(response)),
+        ),
+        (
+            "compiled encoders + iter_encode",
+            lambda: serialization.encode(response.into_dict()),
+        ),
+        (
+            "(loaded) into_dict + Default",
+            lambda: default_provider.dumps({
+                key: value.into_dict() if isinstance(value, User) else
+                [item.into_dict() for item in value]
+                for key, value in loaded.items()
+            }),
+        ),
+        (
+            "(loaded) compiled + iter_encode",
+            lambda: serialization.encode(loaded),
+        ),
+        (
+            "compiled + iter_encode_cbor",
+            lambda: serialization.encode_cbor(response.into_dict()),
+        ),
+        (
+            "(loaded) compiled + iter_encode_cbor",
+            lambda: serialization.encode_cbor(loaded),
+        ),
+    )
+
+    print(f"{'encoder':<38} {'ms/op':>8} {'bytes':>10}")
+    for label, fn in cases:
+        size = len(fn())
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            fn()
+        elapsed_ms = (time.perf_counter() - start) / args.iterations * 1e3
+        print(f"{label:<38} {elapsed_ms:>8.1f} {size:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Measures concurrent access token issuance against 1..n token shards.
+
+    python -m benchmarks.sharding [--threads N] [--tokens N] [--profile P]
+
+Each row issues `--tokens` tokens from `--threads` threads into a fresh set
+of files. The "0" row is the unsharded layout, with every write in the
+primary database.
+"""
+
+import argparse
+import datetime
+import tempfile
+import threading
+import time
+import uuid
+
+import peewee
+
+from .context import lobbyist
+from lobbyist.library import crypto
+from lobbyist.library.db import db, pragmas
+from lobbyist.models import AccessToken, RefreshToken, Secret, User
+from lobbyist.storage import sharded
+from lobbyist.storage.engine import Engine
+from lobbyist.storage.sqlite import SqliteEngine
+
+
+def open_engine(path: str, shards: int, profile: str) -> Engine:
+    db().initialize(peewee.SqliteDatabase(path, pragmas=pragmas(profile)))
+    db().connect()
+    db().create_tables([User, Secret, AccessToken, RefreshToken])
+    if not shards:
+        return SqliteEngine()
+    return sharded.ShardedSqliteEngine(
+        sharded.open_shards(path, shards, profile)
+    )
+
+
+def issue(engine: Engine, threads: int, tokens: int) -> float:
+    server_ts = datetime.datetime.utcnow()
+    secret_ids = []
+    with engine.atomic():
+        for index in range(threads):
+            user = engine.create_user(uuid.uuid4(), f"user{index}", server_ts)
+            secret_ids.append(
+                engine.create_secret(
+                    uuid.uuid4(), user.name, "hash", server_ts, None, user.id
+                ).id
+            )
+
+    def work(secret_id):
+        for _ in range(tokens // threads):
+            with engine.atomic():
+                engine.create_access_token(
+                    uuid.uuid4(),
+                    crypto.make_secret_string(32),
+                    server_ts,
+                    server_ts + datetime.timedelta(hours=1),
+                    secret_id,
+                )
+
+    workers = [
+        threading.Thread(target=work, args=(secret_id, ))
+        for secret_id in secret_ids
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return tokens / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--tokens", type=int, default=4000)
+    parser.add_argument("--profile", default="durable")
+    parser.add_argument("--shards", type=int, nargs="+", default=[0, 1, 2, 4])
+    args = parser.parse_args()
+
+    print(f"{'shards':>6} {'tokens/s':>10}")
+    for shards in args.shards:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = open_engine(f"{directory}/bench.db", shards, args.profile)
+            rate = issue(engine, args.threads, args.tokens)
+            engine.close()
+        print(f"{shards:>6} {rate:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Compares validating opaque access tokens, which takes a lookup, against
+validating signed ones, which takes an HMAC and a revocation check.
+
+    python -m benchmarks.signing [--users N] [--iterations N]
+"""
+
+import argparse
+import datetime
+import time
+import uuid
+
+from .fixtures import open_memory_db, seed
+from lobbyist.controllers import auth
+from lobbyist.library import signing
+from lobbyist.library.config import config
+from lobbyist.storage.engine import storage
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    server_ts = datetime.datetime.utcnow()
+    open_memory_db()
+    opaque = seed(server_ts - datetime.timedelta(minutes=1), args.users)
+
+    keyring = signing.Keyring(None, {})
+    keyring.rotate("bench")
+    signing.signer().keyring = keyring
+    config().access_token_format = "signed"
+    config().access_token_quota_per_secret = 0
+    signed = []
+    for index in range(args.users):
+        secret = storage().select_valid_secret_record_by_name(
+            server_ts,
+            f"user{index}",
+        )
+        with storage().atomic():
+            signed.append(
+                auth._create_tokens(
+                    server_ts - datetime.timedelta(minutes=1),
+                    secret.id,
+                    secret.user_id,
+                    datetime.timedelta(hours=1),
+                    datetime.timedelta(hours=1),
+                ).value
+            )
+
+    # Revocations of other users, as a busy server would hold.
+    for _ in range(args.users):
+        signing.signer().revocations.revoke(uuid.uuid4(), server_ts)
+
+    print(f"{'token':<10} {'us/validation':>14}")
+    for label, tokens in (("opaque", opaque), ("signed", signed)):
+        assert auth._validate_access_token(server_ts, tokens[0]), label
+        start = time.perf_counter()
+        for index in range(args.iterations):
+            auth._validate_access_token(server_ts, tokens[index % len(tokens)])
+        elapsed_us = (time.perf_counter() - start) / args.iterations * 1e6
+        print(f"{label:<10} {elapsed_us:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Measures how long `serve` takes to start: until its imports are done, and
+until it answers its first request. Covers the source tree, and, with
+--frozen, a pyinstaller build of it.
+
+    python -m benchmarks.startup [--runs N] [--frozen dist/lobbyist/lobbyist]
+
+Every run restarts the server on the database the first run created (and
+which that run migrated, so it is left out), as a rolling deploy does.
+
+Imports are over when __main__ logs its first record, as it starts to open
+storage, once `serve` has imported the app and its views; that record's
+"ts" is compared with when the process was started. The first request is a GET /user/<name>,
+retried every millisecond until something answers.
+
+--importtime also lists the modules that took longest to import in one
+source run, as reported by `python -X importtime`.
+"""
+
+import argparse
+import datetime
+import http.client
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Optional, Tuple
+
+MAIN = os.path.join(os.path.dirname(__file__), "..", "src", "__main__.py")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_response(port: int, timeout_s: float = 30.0) -> float:
+    """When a request was first answered, by time.time()."""
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        try:
+            connection.request("GET", "/user/startup")
+            connection.getresponse().read()
+            return time.time()
+        except ConnectionRefusedError:
+            time.sleep(0.001)
+        finally:
+            connection.close()
+    raise RuntimeError(f"nothing answered on port {port}")
+
+
+def first_record_ts(log_path: str) -> float:
+    # The listener thread may not have written it yet.
+    for _ in range(100):
+        with open(log_path) as file:
+            for line in file:
+                if line.startswith("{"):
+                    ts = datetime.datetime.strptime(
+                        json.loads(line)["ts"],
+                        "%Y-%m-%dT%H:%M:%S.%fZ",
+                    )
+                    return ts.replace(tzinfo=datetime.timezone.utc).timestamp()
+        time.sleep(0.01)
+    raise RuntimeError(f"no log records in {log_path}")
+
+
+def start(
+    command: List[str],
+    directory: str,
+    storage: str,
+    env: Optional[dict] = None,
+) -> Tuple[float, float, str]:
+    """Seconds to import and to the first response, and the log."""
+    port = free_port()
+    log_path = os.path.join(directory, "serve.log")
+    with open(log_path, "w") as log:
+        start_ts = time.time()
+        process = subprocess.Popen(
+            [
+                *command,
+                "--log-level",
+                "INFO",
+                "--log-format",
+                "json",
+                "--port",
+                str(port),
+                "--storage",
+                storage,
+                "--db",
+                os.path.join(directory, "lobbyist.db"),
+                "--memory-path",
+                os.path.join(directory, "lobbyist.memory"),
+                "serve",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=log,
+            env=env,
+        )
+        try:
+            response_ts = wait_for_response(port)
+            imported_ts = first_record_ts(log_path)
+        finally:
+            process.terminate()
+            process.wait()
+    with open(log_path) as file:
+        output = file.read()
+    return imported_ts - start_ts, response_ts - start_ts, output
+
+
+def measure(
+    command: List[str],
+    storage: str,
+    runs: int,
+) -> Tuple[List[float], List[float]]:
+    imports, responses = [], []
+    with tempfile.TemporaryDirectory() as directory:
+        # Creates and migrates the database.
+        start(command, directory, storage)
+        for _ in range(runs):
+            import_s, response_s, _ = start(command, directory, storage)
+            imports.append(import_s)
+            responses.append(response_s)
+    return imports, responses
+
+
+def importtime(storage: str, limit: int) -> List[Tuple[int, str]]:
+    """The `limit` slowest modules to import, with cumulative µs."""
+    with tempfile.TemporaryDirectory() as directory:
+        start([sys.executable, MAIN], directory, storage)
+        _, _, output = start(
+            [sys.executable, MAIN],
+            directory,
+            storage,
+            env=dict(os.environ, PYTHONPROFILEIMPORTTIME="1"),
+        )
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.append((int(cumulative), name.strip()))
+    modules.sort(reverse=True)
+    return modules[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--storage", default="sqlite")
+    parser.add_argument("--frozen", help="path to a pyinstaller build")
+    parser.add_argument("--importtime", type=int, default=0, metavar="N")
+    args = parser.parse_args()
+
+    builds = [("source", [sys.executable, MAIN])]
+    if args.frozen:
+        builds.append(("frozen", [os.path.abspath(args.frozen)]))
+
+    print(
+        f"{'build':<8} {'storage':<8} {'imports ms':>11} "
+        f"{'first request ms':>17} {'min':>7}"
+    )
+    for name, command in builds:
+        imports, responses = measure(command, args.storage, args.runs)
+        print(
+            f"{name:<8} {args.storage:<8} "
+            f"{statistics.median(imports) * 1e3:>11.0f} "
+            f"{statistics.median(responses) * 1e3:>17.0f} "
+            f"{min(responses) * 1e3:>7.0f}"
+        )
+
+    if args.importtime:
+        print("\nslowest imports, source, cumulative:")
+        for cumulative_us, module in importtime(
+            args.storage,
+            args.importtime,
+        ):
+            print(f"{cumulative_us / 1e3:>8.1f} ms  {module}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Compares the validity lookups of the SQLite and in-memory storage engines.
+
+    python -m benchmarks.storage [--users N] [--iterations N]
+"""
+
+import argparse
+import datetime
+
+from .fixtures import open_memory_db, seed
+from .lookup import measure
+from lobbyist.models import AccessToken, RefreshToken, Secret, User
+from lobbyist.storage.memory import MemoryEngine
+from lobbyist.storage.sqlite import SqliteEngine
+
+
+def copy_into(engine: MemoryEngine) -> None:
+    with engine.atomic():
+        for user in User.select():
+            engine.create_user(user.id, user.name, user.create_ts)
+        for secret in Secret.select():
+            engine.create_secret(
+                secret.id,
+                secret.name,
+                secret.hash,
+                secret.create_ts,
+                secret.expire_ts,
+                secret.user_id,
+            )
+        for access_token in AccessToken.select():
+            engine.create_access_token(
+                access_token.id,
+                access_token.value,
+                access_token.create_ts,
+                access_token.expire_ts,
+                access_token.secret_id,
+            )
+        for refresh_token in RefreshToken.select():
+            engine.create_refresh_token(
+                refresh_token.id,
+                refresh_token.value,
+                refresh_token.create_ts,
+                refresh_token.expire_ts,
+                refresh_token.access_token_id,
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    server_ts = datetime.datetime.utcnow()
+    open_memory_db()
+    tokens = seed(server_ts - datetime.timedelta(minutes=1), args.users)
+    memory = MemoryEngine()
+    copy_into(memory)
+
+    def token(index):
+        return tokens[index % len(tokens)]
+
+    def name(index):
+        return f"user{index % len(tokens)}"
+
+    print(f"{'lookup':<58} {'us/op':>8} {'blocks/op':>10} {'peak B/op':>10}")
+    for engine in (SqliteEngine(), memory):
+        for label, fn in (
+            (
+                "select_valid_access_token_record_by_value",
+                lambda i: engine.
+                select_valid_access_token_record_by_value(server_ts, token(i)),
+            ),
+            (
+                "select_valid_secret_record_by_name",
+                lambda i: engine.
+                select_valid_secret_record_by_name(server_ts, name(i)),
+            ),
+            (
+                "select_user_by_name",
+                lambda i: engine.select_user_by_name(name(i)),
+            ),
+        ):
+            label = f"{type(engine).__name__}.{label}"
+            assert fn(0) is not None, label
+            latency_us, blocks, peak = measure(fn, args.iterations)
+            print(
+                f"{label:<58} {latency_us:>8.1f} {blocks:>10.1f} {peak:>10.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Compares validating access tokens over HTTP with the Unix socket protocol.
+
+    python -m benchmarks.wire [--users N] [--validations N] [--batch N]
+
+The HTTP row reads each user's private view with a kept-alive connection,
+which is how co-located services validate a bearer token today. The wire
+rows validate the same tokens one per request, batched into requests of
+`--batch` tokens, and pipelined as `--batch` single-token requests per
+write.
+"""
+
+import argparse
+import datetime
+import http.client
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import peewee
+import werkzeug.serving
+
+from .fixtures import seed
+from lobbyist.library import wire
+from lobbyist.library.app import app
+from lobbyist.library.db import db
+from lobbyist.models import AccessToken, RefreshToken, Secret, User
+from lobbyist.storage.engine import storage
+from lobbyist.storage.sqlite import SqliteEngine
+from lobbyist.views.wire import WireServer
+import lobbyist.views
+
+
+def measure(validations: int, fn) -> float:
+    start = time.perf_counter()
+    done = 0
+    while done < validations:
+        done += fn(done)
+    return (time.perf_counter() - start) / done * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--validations", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=64)
+    args = parser.parse_args()
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # A file, rather than :memory:, so that server threads share it.
+        db().initialize(
+            peewee.SqliteDatabase(
+                os.path.join(directory, "bench.db"),
+                pragmas={"foreign_keys": 1, "journal_mode": "wal"},
+            )
+        )
+        db().create_tables([User, Secret, AccessToken, RefreshToken])
+        storage().initialize(SqliteEngine())
+        tokens = seed(
+            datetime.datetime.utcnow() - datetime.timedelta(minutes=1),
+            args.users,
+        )
+
+        http_server = werkzeug.serving.make_server(
+            "127.0.0.1",
+            0,
+            app(),
+            threaded=True,
+        )
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        wire_server = WireServer(os.path.join(directory, "wire.sock"))
+        wire_server.start()
+
+        connection = http.client.HTTPConnection(
+            "127.0.0.1",
+            http_server.server_port,
+        )
+        client = wire.Client(wire_server.server_address)
+
+        def over_http(index):
+            user = index % len(tokens)
+            connection.request(
+                "GET",
+                f"/user/user{user}",
+                headers={
+                    "Accept-Encoding": "identity, gzip",
+                    "Authorization": f"Bearer {tokens[user]}",
+                },
+            )
+            response = connection.getresponse()
+            response.read()
+            assert response.status == 200, response.status
+            return 1
+
+        def batch(index):
+            return [
+                tokens[(index + offset) % len(tokens)]
+                for offset in range(args.batch)
+            ]
+
+        def single(index):
+            assert client.validate([tokens[index % len(tokens)]]) == [True]
+            return 1
+
+        def batched(index):
+            assert all(client.validate(batch(index)))
+            return args.batch
+
+        def pipelined(index):
+            results = client.pipeline(
+                wire.OP_VALIDATE,
+                [[token] for token in batch(index)],
+            )
+            assert all(result == [True] for result in results)
+            return args.batch
+
+        def introspected(index):
+            assert all(client.introspect(batch(index)))
+            return args.batch
+
+        print(f"{'path':<24} {'us/validation':>14} {'validations/s':>14}")
+        for name, fn in (
+            ("http", over_http),
+            ("wire", single),
+            (f"wire batch={args.batch}", batched),
+            (f"wire pipeline={args.batch}", pipelined),
+            (f"wire introspect={args.batch}", introspected),
+        ):
+            latency_us = measure(args.validations, fn)
+            print(f"{name:<24} {latency_us:>14.1f} {1e6 / latency_us:>14.0f}")
+
+        client.close()
+        connection.close()
+        wire_server.stop()
+        http_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,532 @@
 #!/usr/bin/env python3
 
-import logging
+import argparse
+import atexit
+import datetime
+import json
+import os
+import sys
 
-import peewee
+from lobbyist.library import log
+from lobbyist.library.config import config
+from lobbyist.library.db import SqliteDatabase, db, pragmas
+from lobbyist.storage.engine import storage
 
-from lobbyist.library.app import app
-from lobbyist.library.db import db
-from lobbyist.models import AccessToken, RefreshToken, User, Secret
-from lobbyist.views import *
+# Modules only some commands or deployments use (other engines, replication,
+# auditing, signing, backups) are imported where they are needed, to keep
+# them out of startup.
 
-logger = logging.basicConfig(level=logging.DEBUG)
+LOG = log.logger("lobbyist.main")
 
-logging.info("creating db...")
-db().initialize(
-    peewee.SqliteDatabase(
-        "testing.db",
-        pragmas={
-            "journal_mode": "wal",
-            "cache_size": -1 * 64000,
-            "foreign_keys": 1,
-            "ignore_check_constraints": 0,
-            "synchronous": 0,
-        }
+
+def open_db(path: str, profile: str):
+    from lobbyist.storage import migrations
+
+    LOG.info("opening db...")
+    db().initialize(SqliteDatabase(path, pragmas=pragmas(profile)))
+    db().connect()
+    try:
+        version = migrations.migrate(db(), migrations.MIGRATIONS)
+    except ValueError as error:
+        sys.exit(str(error))
+    LOG.info("db at schema version %d", version)
+
+
+def open_storage(args):
+    if args.storage == "memory":
+        from lobbyist.storage.memory import MemoryEngine
+    else:
+        from lobbyist.storage import sharded
+        from lobbyist.storage.sqlite import SqliteEngine
+    if args.changelog or args.follow:
+        from lobbyist.storage import replication
+
+    if args.storage == "memory" and args.follow:
+        # Nothing to recover: the follower replays the change log instead.
+        engine = MemoryEngine()
+    elif args.storage == "memory":
+        LOG.info("loading memory storage...")
+        engine = MemoryEngine(args.memory_path, config().memory_storage_fsync)
+    else:
+        open_db(args.db, args.db_profile)
+        try:
+            sharded.check_layout(args.db, args.token_shards)
+        except ValueError as error:
+            sys.exit(str(error))
+        if args.token_shards:
+            engine = sharded.ShardedSqliteEngine(
+                sharded.open_shards(
+                    args.db,
+                    args.token_shards,
+                    args.db_profile,
+                )
+            )
+        else:
+            engine = SqliteEngine()
+
+    if args.changelog:
+        log = replication.ChangeLog(
+            args.changelog,
+            config().changelog_segment_bytes,
+            config().changelog_fsync,
+        )
+        engine = replication.CapturingEngine(engine, log)
+        engine.recover()
+        engine.bootstrap()
+        replication.replication().log = log
+    elif args.follow:
+        positions = {}
+        if args.storage == "sqlite":
+            positions = {
+                "load_position": replication.load_position,
+                "save_position": replication.save_position,
+            }
+        replication.replication().follower = replication.Follower(
+            args.follow,
+            engine,
+            config().follower_max_batch,
+            **positions,
+        )
+        engine = replication.ReadOnlyEngine(engine)
+    storage().initialize(engine)
+
+
+def serve(args):
+    from lobbyist.controllers import auth, reaper, user
+    from lobbyist.library.app import app
+    from lobbyist.library.checkpoint import Checkpointer
+    from lobbyist.library.idempotency import idempotency
+    from lobbyist.library.worker import PeriodicWorker
+    import lobbyist.views
+
+    open_storage(args)
+
+    if args.access_token_keys:
+        from lobbyist.library.signing import signer
+
+        signer().open(args.access_token_keys)
+        PeriodicWorker(
+            "token-keys",
+            config().access_token_keys_reload_interval,
+            signer().reload,
+        ).start()
+        auth.refresh_revocations(datetime.datetime.utcnow())
+        PeriodicWorker(
+            "revocations",
+            config().access_token_revocation_interval,
+            lambda: auth.refresh_revocations(datetime.datetime.utcnow()),
+        ).start()
+
+    if config().reaper_interval:
+        PeriodicWorker(
+            "reaper",
+            config().reaper_interval,
+            lambda: reaper.reap(datetime.datetime.utcnow()),
+        ).start()
+
+    PeriodicWorker(
+        "idempotency-sweep",
+        config().idempotency_sweep_interval,
+        idempotency().sweep,
+    ).start()
+
+    if args.storage == "sqlite" and config().db_checkpoint_interval:
+        PeriodicWorker(
+            "checkpoint",
+            config().db_checkpoint_interval,
+            Checkpointer().tick,
+        ).start()
+
+    if args.follow:
+        from lobbyist.storage import replication
+
+        follower = replication.replication().follower
+        follower.on_user_change = user.PUBLIC_USERS.invalidate
+        LOG.info("catching up with %s...", args.follow)
+        follower.tick()
+        PeriodicWorker(
+            "follower",
+            config().follower_poll_interval,
+            follower.tick,
+        ).start()
+
+    if config().group_commit:
+        PeriodicWorker(
+            "group-commit-report",
+            config().group_commit_report_interval,
+            lambda: LOG.info("group commit: %s", auth.writer().report()),
+        ).start()
+
+    if args.storage == "memory" and config().memory_storage_snapshot_interval:
+        PeriodicWorker(
+            "snapshot",
+            config().memory_storage_snapshot_interval,
+            storage().snapshot,
+        ).start()
+
+    if args.audit:
+        from lobbyist.library.audit import audit
+        from lobbyist.storage.audit import open_sink
+
+        LOG.info("auditing to %s...", args.audit)
+        audit().start(
+            open_sink(args.audit_sink, args.audit),
+            config().audit_max_batch,
+            config().audit_flush_interval,
+            config().audit_queue_size,
+        )
+        atexit.register(audit().stop)
+
+    if args.admin_token_file:
+        from lobbyist.library.profiler import profiler
+        from lobbyist.views.admin import load_token
+
+        try:
+            load_token(args.admin_token_file)
+        except (OSError, ValueError) as error:
+            sys.exit(str(error))
+        profiler().interval_s = config().profile_interval.total_seconds()
+        if args.profile_slowest:
+            profiler().capture_slowest(args.profile_slowest)
+
+    if args.wire_socket:
+        from lobbyist.views.wire import WireServer
+
+        LOG.info("listening on %s...", args.wire_socket)
+        WireServer(args.wire_socket).start()
+
+    LOG.info("starting app...")
+    app().run(port=args.port)
+
+
+def reap(args):
+    from lobbyist.controllers import reaper
+
+    open_storage(args)
+    response = reaper.reap(
+        datetime.datetime.utcnow(),
+        grace_period=datetime.timedelta(seconds=args.grace_period_s),
+        batch_size=args.batch_size,
+        vacuum_pages=args.vacuum_pages,
     )
-)
-db().connect()
-db().create_tables([User, Secret, AccessToken, RefreshToken])
+    json.dump(response.into_dict(), sys.stdout)
+    sys.stdout.write("\n")
+
+
+def query_audit(args):
+    from lobbyist.storage.audit import read_events
+
+    if not args.audit:
+        sys.exit("--audit is required")
+    for event in read_events(
+        args.audit_sink,
+        args.audit,
+        user=args.user,
+        since=args.since,
+        until=args.until,
+        kinds=set(args.kind),
+    ):
+        json.dump(event, sys.stdout)
+        sys.stdout.write("\n")
+
+
+def rotate_token_keys(args):
+    from lobbyist.library.signing import Keyring
+
+    if not args.access_token_keys:
+        sys.exit("--access-token-keys is required")
+    path = args.access_token_keys
+    keyring = Keyring.load(path) if os.path.exists(path) else Keyring(None, {})
+    try:
+        key_id = keyring.rotate(args.key_id, activate=not args.stage)
+        for retired in args.retire:
+            keyring.retire(retired)
+    except ValueError as error:
+        sys.exit(str(error))
+    keyring.save(path)
+    json.dump(
+        {
+            "added": key_id,
+            "active": keyring.active,
+            "keys": sorted(keyring.keys),
+        },
+        sys.stdout,
+    )
+    sys.stdout.write("\n")
+
+
+def rebalance_shards(args):
+    from lobbyist.storage import sharded
+
+    open_db(args.db, args.db_profile)
+    report = sharded.rebalance(args.db, args.to, args.db_profile)
+    json.dump(report, sys.stdout)
+    sys.stdout.write("\n")
+
+
+def backup(args):
+    import tempfile
+
+    from lobbyist.storage import backup
+
+    if args.storage != "sqlite":
+        sys.exit("only sqlite storage is backed up this way")
+    directory = tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(args.db))
+    )
+    with directory:
+        try:
+            files = backup.snapshot(
+                args.db,
+                directory.name,
+                args.step_pages,
+                datetime.timedelta(milliseconds=args.step_pause_ms),
+            )
+        except ValueError as error:
+            sys.exit(str(error))
+        chunks = backup.iter_archive(
+            files,
+            config().db_backup_compress_level if args.compress else 0,
+            config().stream_chunk_size,
+        )
+        if args.out == "-":
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+        else:
+            # A partial archive never takes the name of a whole one.
+            with open(args.out + ".tmp", "wb") as file:
+                for chunk in chunks:
+                    file.write(chunk)
+            os.replace(args.out + ".tmp", args.out)
+
+
+def restore(args):
+    from lobbyist.storage import backup
+
+    if args.storage != "sqlite":
+        sys.exit("only sqlite storage is restored this way")
+    if os.path.exists(args.db) and not args.force:
+        sys.exit(f"{args.db} exists; pass --force to replace it")
+    try:
+        if args.source == "-":
+            names = backup.restore(sys.stdin.buffer, args.db)
+        else:
+            with open(args.source, "rb") as file:
+                names = backup.restore(file, args.db)
+    except (OSError, ValueError) as error:
+        sys.exit(str(error))
+    json.dump({"restored": names}, sys.stdout)
+    sys.stdout.write("\n")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="lobbyist")
+    parser.add_argument("--log-level", default=config().log_level)
+    parser.add_argument(
+        "--log",
+        metavar="LOGGER=LEVEL",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--log-format",
+        choices=["json", "text"],
+        default=config().log_format,
+    )
+    parser.add_argument(
+        "--log-debug-sample-rate",
+        type=float,
+        default=config().log_debug_sample_rate,
+    )
+    parser.add_argument(
+        "--log-access-sample-rate",
+        type=float,
+        default=config().log_access_sample_rate,
+    )
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--db", default=config().db_path)
+    parser.add_argument("--db-profile", choices=config().db_pragma_profiles)
+    parser.add_argument(
+        "--storage",
+        choices=["sqlite", "memory"],
+        default=config().storage_engine,
+    )
+    parser.add_argument("--memory-path", default=config().memory_storage_path)
+    parser.add_argument(
+        "--token-shards",
+        type=int,
+        default=config().db_token_shards,
+    )
+    parser.add_argument(
+        "--group-commit",
+        action="store_true",
+        default=config().group_commit,
+    )
+    parser.add_argument(
+        "--wire-socket",
+        metavar="PATH",
+        default=config().wire_socket_path,
+    )
+    parser.add_argument("--audit", metavar="PATH", default=config().audit_path)
+    parser.add_argument(
+        "--audit-sink",
+        choices=["file", "sqlite"],
+        default=config().audit_sink,
+    )
+    parser.add_argument(
+        "--access-token-format",
+        choices=["opaque", "signed"],
+        default=config().access_token_format,
+    )
+    parser.add_argument(
+        "--access-token-keys",
+        metavar="PATH",
+        default=config().access_token_keys_path,
+    )
+    parser.add_argument(
+        "--access-token-quota",
+        type=int,
+        metavar="N",
+        default=config().access_token_quota_per_secret,
+        help="valid access tokens per secret, or 0 for no quota",
+    )
+    parser.add_argument(
+        "--db-query-headers",
+        action="store_true",
+        default=config().db_query_headers,
+        help="report each response's statement count and time in headers",
+    )
+    parser.add_argument(
+        "--db-slow-query-ms",
+        type=float,
+        default=config().db_slow_query_threshold.total_seconds() * 1e3,
+    )
+    parser.add_argument(
+        "--admin-token-file",
+        metavar="PATH",
+        default=config().admin_token_path,
+    )
+    parser.add_argument(
+        "--profile-slowest",
+        metavar="K",
+        type=int,
+        default=config().profile_slowest_requests,
+        help="keep profiles of the K slowest requests",
+    )
+    roles = parser.add_mutually_exclusive_group()
+    roles.add_argument("--changelog", metavar="DIR")
+    roles.add_argument("--follow", metavar="DIR")
+    parser.set_defaults(command=serve)
+    subparsers = parser.add_subparsers()
 
-logging.info("starting app...")
-app.app().run()
+    serve_parser = subparsers.add_parser("serve")
+    serve_parser.set_defaults(command=serve)
+
+    reap_parser = subparsers.add_parser("reap")
+    reap_parser.add_argument(
+        "--grace-period-s",
+        type=float,
+        default=config().reaper_grace_period.total_seconds(),
+    )
+    reap_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=config().reaper_batch_size,
+    )
+    reap_parser.add_argument(
+        "--vacuum-pages",
+        type=int,
+        default=config().reaper_vacuum_pages,
+    )
+    reap_parser.set_defaults(command=reap)
+
+    audit_parser = subparsers.add_parser("audit")
+    audit_parser.add_argument("--user", help="a user id or name")
+    audit_parser.add_argument(
+        "--since",
+        type=datetime.datetime.fromisoformat,
+    )
+    audit_parser.add_argument(
+        "--until",
+        type=datetime.datetime.fromisoformat,
+    )
+    audit_parser.add_argument("--kind", action="append", default=[])
+    audit_parser.set_defaults(command=query_audit)
+
+    rotate_parser = subparsers.add_parser("rotate-token-keys")
+    rotate_parser.add_argument("--key-id")
+    rotate_parser.add_argument(
+        "--stage",
+        action="store_true",
+        help="add the key without signing with it yet",
+    )
+    rotate_parser.add_argument(
+        "--retire",
+        metavar="KEY_ID",
+        action="append",
+        default=[],
+    )
+    rotate_parser.set_defaults(command=rotate_token_keys)
+
+    rebalance_parser = subparsers.add_parser("rebalance-shards")
+    rebalance_parser.add_argument("--to", type=int, required=True)
+    rebalance_parser.set_defaults(command=rebalance_shards)
+
+    backup_parser = subparsers.add_parser("backup")
+    backup_parser.add_argument("--out", metavar="PATH", default="-")
+    backup_parser.add_argument("--compress", action="store_true")
+    backup_parser.add_argument(
+        "--step-pages",
+        type=int,
+        default=config().db_backup_step_pages,
+    )
+    backup_parser.add_argument(
+        "--step-pause-ms",
+        type=float,
+        default=config().db_backup_step_pause.total_seconds() * 1e3,
+    )
+    backup_parser.set_defaults(command=backup)
+
+    restore_parser = subparsers.add_parser("restore")
+    restore_parser.add_argument(
+        "--from",
+        dest="source",
+        metavar="PATH",
+        default="-",
+    )
+    restore_parser.add_argument("--force", action="store_true")
+    restore_parser.set_defaults(command=restore)
+
+    return parser.parse_args()
+
+
+args = parse_args()
+try:
+    log_levels = {**config().log_levels, **log.parse_levels(args.log)}
+except ValueError as error:
+    sys.exit(str(error))
+log.configure(
+    args.log_level,
+    log_levels,
+    args.log_format,
+    args.log_debug_sample_rate,
+    args.log_access_sample_rate,
+    config().log_queue_size,
+)
+config().group_commit = args.group_commit
+config().db_query_headers = args.db_query_headers
+config().db_slow_query_threshold = datetime.timedelta(
+    milliseconds=args.db_slow_query_ms
+)
+config().access_token_format = args.access_token_format
+config().access_token_quota_per_secret = args.access_token_quota
+if args.access_token_format == "signed" and not args.access_token_keys:
+    sys.exit("signed access tokens need --access-token-keys")
+if args.access_token_format == "signed" and args.access_token_quota:
+    # Evicting a token only expires its row, which signed tokens are not
+    # checked against.
+    sys.exit("signed access tokens need --access-token-quota 0")
+if args.profile_slowest and not args.admin_token_file:
+    sys.exit("--profile-slowest needs --admin-token-file to read them")
+args.command(args)
@@ -1,37 +1,64 @@
 import base64
-import bcrypt
 import datetime
-import logging
+import hashlib
 import uuid
-from typing import Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
-import peewee
-
-from ..library import crypto, db
+from ..library import crypto, log, singleflight
 from ..library.config import config
-from ..library.error import UnauthorizedError
-from ..models.secret import Secret
+from ..library.error import ConflictError, ForbiddenError, UnauthorizedError
+from ..library.metrics import metrics
 from ..models.auth import AccessToken, RefreshToken
+from ..models.records import AccessTokenRecord, SecretRecord
+from ..storage import engine
+
+LOG = log.logger(__name__)
+STORAGE = engine.storage()
+
+# Concurrent requests presenting the same credentials share one lookup. A
+# follower sees the result as of the leader's server time, which is at most
+# one lookup older than its own.
+VALIDATE_ACCESS_TOKEN = singleflight.SingleFlight("validate_access_token")
+AUTHENTICATE_SECRET = singleflight.SingleFlight("authenticate_secret")
 
-DB = db.db()
+# Token and secret inserts, when group commit is enabled. Auditing, signing
+# and group commit are imported on first use, to keep them off startup.
+__WRITER = None
+
+
+def writer():
+    global __WRITER
+    if __WRITER is None:
+        from ..library import group_commit
+
+        __WRITER = group_commit.GroupCommit(
+            "writer",
+            lambda: STORAGE.atomic(write=True),
+            config().group_commit_max_batch,
+            config().group_commit_max_wait,
+        )
+    return __WRITER
 
 
 class AccessTokenResponse:
-    def __init__(self, access_token: AccessToken):
+    def __init__(
+        self,
+        server_ts: datetime.datetime,
+        access_token: AccessToken,
+    ):
+        self.server_ts = server_ts
         self.access_token = access_token
 
-    def _refresh_tokens(self):
-        for refresh_token in self.access_token.refresh_tokens:
-            if refresh_token.is_valid():
-                yield refresh_token
-
     def into_dict(self):
         as_dict = self.access_token.into_dict()
-        as_dict["refresh_tokens"] = self._refresh_tokens()
+        refresh_tokens = STORAGE.select_valid_refresh_tokens_by_access_token(
+            self.server_ts,
+            self.access_token.id,
+        )
+        as_dict["refresh_tokens"] = refresh_tokens
         return as_dict
 
 
-@DB.atomic()
 def create_access_token(
     create_ts: datetime.datetime,
     name: str,
@@ -39,57 +66,97 @@ def create_access_token(
     access_token_lifetime: datetime.timedelta,
     refresh_token_lifetime: datetime.timedelta,
 ) -> AccessTokenResponse:
-    logging.debug("controllers.auth.create_access_token")
+    LOG.debug("controllers.auth.create_access_token")
 
     secret = _authenticate_secret(create_ts, name, value)
 
     if not secret:
+        _audit("authentication.failed", create_ts, name=name)
         raise UnauthorizedError(
             "secret is invalid or does not match a valid hash"
         )
 
-    access_token = _create_access_token(
-        create_ts,
-        create_ts + access_token_lifetime,
-        secret,
+    limit_ts = None
+    if config().access_token_format == "signed":
+        limit_ts = _expire_limit(name)
+
+    access_token = _write(
+        lambda: _create_tokens(
+            create_ts,
+            secret.id,
+            secret.user_id,
+            access_token_lifetime,
+            refresh_token_lifetime,
+            limit_ts,
+        )
     )
-    refresh_token = _create_refresh_token(
+    _audit(
+        "token.issued",
         create_ts,
-        create_ts + refresh_token_lifetime,
-        access_token,
+        user_id=secret.user_id,
+        secret_id=secret.id,
+        access_token_id=access_token.id,
+        expire_ts=access_token.expire_ts,
     )
 
-    return AccessTokenResponse(access_token)
+    return AccessTokenResponse(create_ts, access_token)
 
 
-@DB.atomic()
+@STORAGE.atomic()
 def read_access_token(
     server_ts: datetime.datetime,
     value: str,
     access_token_value: str,
 ) -> AccessTokenResponse:
-    logging.debug("controllers.auth.read_access_token")
+    LOG.debug("controllers.auth.read_access_token")
 
-    access_token, _, authorized = _authorize(
+    access_token, requesting, authorized = _authorize(
         server_ts,
         value,
         access_token_value,
     )
 
     if not authorized:
+        _deny(server_ts, "read_access_token", requesting)
         raise ForbiddenError("cannot read access token")
 
-    return AccessTokenResponse(access_token)
+    return AccessTokenResponse(server_ts, access_token)
+
+
+def validate_access_tokens(
+    server_ts: datetime.datetime,
+    values: Sequence[str],
+) -> List[Optional[AccessTokenRecord]]:
+    LOG.debug("controllers.auth.validate_access_tokens")
 
+    records: Dict[str, Optional[AccessTokenRecord]] = {}
+    for value in values:
+        if value not in records:
+            records[value] = _validate_access_token(server_ts, value)
+    return [records[value] for value in values]
+
+
+def refresh_revocations(server_ts: datetime.datetime) -> None:
+    """Picks up changes to users and secrets that revoke signed tokens."""
+    LOG.debug("controllers.auth.refresh_revocations")
+
+    revocations = _signer().revocations
+    since = revocations.since(
+        server_ts,
+        config().access_token_revocation_overlap,
+    )
+    revocations.refresh(server_ts, STORAGE.select_modified_since(since))
+    metrics().set_gauge("signing.revocations", len(revocations))
 
-@DB.atomic()
+
+@STORAGE.atomic()
 def refresh_token(
     server_ts: datetime.datetime,
     token: str,
     access_token_lifetime: datetime.timedelta,
     refresh_token_lifetime: datetime.timedelta,
-) -> CreateTokenResponse:
-    logging.debug("controllers.auth.refresh_token")
+) -> AccessTokenResponse:
+    LOG.debug("controllers.auth.refresh_token")
     pass
 
 
@@ -97,75 +164,224 @@ def _authenticate_secret(
     server_ts: datetime.datetime,
     name: str,
     value: str,
-) -> Optional[Secret]:
-    secret = Secret.select_valid_by_name(server_ts, name).get()
+) -> Optional[SecretRecord]:
+    # Key on a digest so plaintext secrets are not held in the flight table.
+    return AUTHENTICATE_SECRET.do(
+        (name, hashlib.sha256(value.encode()).digest()),
+        lambda: _authenticate_secret_uncoalesced(server_ts, name, value),
+    )
+
+
+def _authenticate_secret_uncoalesced(
+    server_ts: datetime.datetime,
+    name: str,
+    value: str,
+) -> Optional[SecretRecord]:
+    secret = STORAGE.select_valid_secret_record_by_name(server_ts, name)
 
     # We combine these two failure modes to obfuscate responses to brute-force
     # attacks. Attackers should not be able to tell the difference between
     # unknown secret keys, expired secrets, and incorrect secret values.
-    if not secret or not bcrypt.checkpw(value.encode(), secret.hash.encode()):
+    if not secret or not crypto.check_secret(value, secret.hash):
         return None
 
     return secret
 
 
+def _deny(
+    server_ts: datetime.datetime,
+    action: str,
+    access_token: Optional[AccessTokenRecord],
+) -> None:
+    _audit(
+        "access.denied",
+        server_ts,
+        user_id=access_token.user_id if access_token else None,
+        action=action,
+    )
+
+
+def _audit(kind: str, server_ts: datetime.datetime, **fields: Any) -> None:
+    # Kinds are those listed in library/audit.py.
+    from ..library import audit
+
+    audit.audit().record(kind, server_ts, **fields)
+
+
+def _signer():
+    from ..library import signing
+
+    return signing.signer()
+
+
+def _write(fn: Callable[[], Any]) -> Any:
+    # Inserts go through here so that group commit can batch them. Callers
+    # do their reads and hashing first, outside of any transaction.
+    if config().group_commit:
+        return writer().submit(fn)
+    with STORAGE.atomic(write=True):
+        return fn()
+
+
+def _revoke(
+    id: uuid.UUID,
+    server_ts: datetime.datetime,
+    expire_ts: Optional[datetime.datetime],
+) -> None:
+    # Signed tokens issued from a user or secret before it changed are no
+    # longer valid here once it expires, or at once if it does not; other
+    # processes see the change on their next refresh_revocations.
+    signer = _signer()
+    if signer.keyring is not None:
+        signer.revocations.revoke(id, server_ts, expire_ts)
+
+
+def _expire_limit(secret_name: str) -> Optional[datetime.datetime]:
+    # Signed tokens carry their own expiry, which must not outlast the
+    # secret's or the user's.
+    secret = STORAGE.select_secret_by_name(secret_name)
+    if secret is None:
+        return None
+    return min(
+        filter(None, (secret.expire_ts, secret.user.expire_ts)),
+        default=None,
+    )
+
+
+def _create_tokens(
+    create_ts: datetime.datetime,
+    secret_id: uuid.UUID,
+    user_id: uuid.UUID,
+    access_token_lifetime: datetime.timedelta,
+    refresh_token_lifetime: datetime.timedelta,
+    limit_ts: Optional[datetime.datetime] = None,
+) -> AccessToken:
+    # Makes room for the new token under the secret's quota, in its
+    # transaction.
+    quota = config().access_token_quota_per_secret
+    if quota:
+        evicted = STORAGE.evict_access_tokens(create_ts, secret_id, quota - 1)
+        if evicted:
+            metrics().increment("quota.access_tokens_evicted", evicted)
+
+    access_token = _create_access_token(
+        create_ts,
+        create_ts + access_token_lifetime,
+        secret_id,
+        user_id,
+        limit_ts,
+    )
+    _create_refresh_token(
+        create_ts,
+        create_ts + refresh_token_lifetime,
+        access_token.id,
+    )
+    return access_token
+
+
 def _create_access_token(
     create_ts: datetime.datetime,
     expire_ts: datetime.datetime,
-    secret: Secret,
+    secret_id: uuid.UUID,
+    user_id: uuid.UUID,
+    limit_ts: Optional[datetime.datetime] = None,
 ) -> AccessToken:
-    logging.debug("controllers.auth._create_access_token")
+    LOG.debug("controllers.auth._create_access_token")
+
+    id = uuid.uuid4()
+    if config().access_token_format == "signed":
+        from ..library import signing
+
+        value = signing.signer().keyring.sign(
+            signing.Claims(
+                id,
+                secret_id,
+                user_id,
+                min(expire_ts, limit_ts or expire_ts),
+                create_ts,
+            )
+        )
+    else:
+        value = crypto.make_secret_string(config().access_token_entropy)
 
     try:
-        return AccessToken.create(
-            id=uuid.uuid4(),
-            value=crypto.make_secret_string(config().access_token_entropy),
+        return STORAGE.create_access_token(
+            id=id,
+            value=value,
             create_ts=create_ts,
             expire_ts=expire_ts,
-            secret=secret,
+            secret_id=secret_id,
         )
-    except peewee.IntegrityError:
+    except engine.IntegrityError:
         raise ConflictError(user={"name": "access token values must be unique"})
 
 
 def _create_refresh_token(
     create_ts: datetime.datetime,
     expire_ts: datetime.datetime,
-    access_token: AccessToken,
+    access_token_id: uuid.UUID,
 ) -> RefreshToken:
-    logging.debug("controllers.auth._create_refresh_token")
+    LOG.debug("controllers.auth._create_refresh_token")
 
     try:
-        return RefreshToken.create(
+        return STORAGE.create_refresh_token(
             id=uuid.uuid4(),
             value=crypto.make_secret_string(config().refresh_token_entropy),
             create_ts=create_ts,
             expire_ts=expire_ts,
-            access_token=access_token,
+            access_token_id=access_token_id,
         )
-    except peewee.IntegrityError:
+    except engine.IntegrityError:
         raise ConflictError(
             user={"name": "refresh token values must be unique"}
         )
 
 
+def _validate_access_token(
+    server_ts: datetime.datetime,
+    access_token_value: Optional[str],
+) -> Optional[AccessTokenRecord]:
+    if access_token_value is None:
+        return None
+
+    signer = _signer()
+    keyring = signer.keyring
+    if keyring is not None and keyring.signed(access_token_value):
+        claims = signer.verify(server_ts, access_token_value)
+        if claims is None:
+            return None
+        return AccessTokenRecord(
+            claims.id,
+            claims.expire_ts,
+            claims.secret_id,
+            claims.user_id,
+        )
+
+    return VALIDATE_ACCESS_TOKEN.do(
+        access_token_value,
+        lambda: STORAGE.select_valid_access_token_record_by_value(
+            server_ts,
+            access_token_value,
+        ),
+    )
+
+
 def _authorize(
     server_ts: datetime.datetime,
     value: str,
     access_token_value: str,
-) -> Tuple[Optional[AccessToken], Optional[AccessToken], bool]:
-    requested_access_token = AccessToken.select_by_value(server_ts, value)
+) -> Tuple[Optional[AccessToken], Optional[AccessTokenRecord], bool]:
+    requested_access_token = STORAGE.select_access_token_by_value(value)
+    requesting_access_token = _validate_access_token(
+        server_ts,
+        access_token_value,
+    )
 
-    if access_token_value is None:
-        requesting_access_token = None
-    else:
-        requesting_access_token = AccessToken.select_valid_by_value(
-            server_ts,
-            access_token_value,
+    authorized = bool(
+        requested_access_token and requesting_access_token and (
+            requested_access_token.secret.user_id ==
+            requesting_access_token.user_id
         )
-
-    authorized = requested_access_token and requesting_access_token and (
-        requested_access_token.id == requesting_access_token.secret.user.id
     )
 
     return (requested_access_token, requesting_access_token, authorized)
@@ -0,0 +1,54 @@
+import datetime
+import time
+from typing import Dict, Optional
+
+from ..library import log
+from ..library.config import config
+from ..library.metrics import metrics
+from ..storage import engine
+
+LOG = log.logger(__name__)
+STORAGE = engine.storage()
+
+
+class ReapResponse:
+    def __init__(self):
+        self.deleted: Dict[str, int] = {}
+        self.vacuumed_pages = 0
+        self.elapsed = datetime.timedelta()
+
+    def into_dict(self):
+        return {
+            "deleted": dict(self.deleted),
+            "vacuumed_pages": self.vacuumed_pages,
+            "elapsed_s": self.elapsed.total_seconds(),
+        }
+
+
+def reap(
+    server_ts: datetime.datetime,
+    grace_period: datetime.timedelta = config().reaper_grace_period,
+    batch_size: int = config().reaper_batch_size,
+    vacuum_pages: Optional[int] = config().reaper_vacuum_pages,
+) -> ReapResponse:
+    LOG.debug("controllers.reaper.reap")
+
+    start = time.perf_counter()
+    cutoff = server_ts - grace_period
+    response = ReapResponse()
+
+    response.deleted = STORAGE.reap(cutoff, batch_size)
+    for table, deleted in response.deleted.items():
+        metrics().increment(f"reaper.deleted.{table}", deleted)
+
+    if vacuum_pages:
+        response.vacuumed_pages = STORAGE.vacuum(vacuum_pages)
+        metrics().increment("reaper.vacuumed_pages", response.vacuumed_pages)
+
+    elapsed_s = time.perf_counter() - start
+    response.elapsed = datetime.timedelta(seconds=elapsed_s)
+    metrics().observe("reaper.reap", elapsed_s)
+
+    LOG.info("reaper: %s", response.into_dict())
+
+    return response
@@ -0,0 +1,22 @@
+from typing import Any, Dict
+
+from ..library import log
+
+LOG = log.logger(__name__)
+
+
+class ReplicationResponse:
+    def __init__(self, status: Dict[str, Any]):
+        self.status = status
+
+    def into_dict(self):
+        return dict(self.status)
+
+
+def read_replication() -> ReplicationResponse:
+    LOG.debug("controllers.replication.read_replication")
+
+    # Only replicating deployments need the module loaded at startup.
+    from ..storage import replication
+
+    return ReplicationResponse(replication.replication().status())
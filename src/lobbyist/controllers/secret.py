@@ -1,18 +1,29 @@
+import concurrent.futures
+import contextlib
 import datetime
-import logging
 import uuid
-from typing import Any, Mapping, Optional, Tuple
+from typing import (
+    Any, ContextManager, List, Mapping, Optional, Set, Tuple
+)
 
-import peewee
-
-from ..library import crypto, db, validation
+from ..library import crypto, log, validation
 from ..library.config import Range, config
-from ..library.error import ConflictError, ForbiddenError
-from ..models.auth import AccessToken
+from .auth import _audit, _deny, _revoke, _validate_access_token, _write
+from ..library.error import BadRequestError, ConflictError, ForbiddenError
+from ..library.metrics import metrics
+from ..models.records import AccessTokenRecord
 from ..models.secret import Secret
 from ..models.user import User
+from ..storage import engine
+
+LOG = log.logger(__name__)
+STORAGE = engine.storage()
 
-DB = db.db()
+# bcrypt releases the GIL, so a rotation's secrets are hashed in parallel.
+HASHERS = concurrent.futures.ThreadPoolExecutor(
+    config().secret_rotation_hash_threads,
+    thread_name_prefix="secret-hasher",
+)
 
 # TODO: make into_dict_transitive functions for all models
 # consider pulling into_dict out of the model and putting it where ever the
@@ -37,70 +48,179 @@ class ReadSecretResponse:
     def __init__(self, secret: Secret):
         self.secret = secret
 
+    def etag(self) -> str:
+        return f"s{self.secret.version}"
+
+    def match(self, etags: Set[str]) -> Optional[str]:
+        etag = self.etag()
+        return etag if etag in etags else None
+
+    def last_modified(self) -> Optional[datetime.datetime]:
+        return self.secret.modify_ts or self.secret.create_ts
+
+    def reading(self) -> ContextManager[None]:
+        return contextlib.nullcontext()
+
     def into_dict(self):
         return {
-            "secret": self.secret.into_dict(),
+            "secret": self.secret,
         }
 
 
-@DB.atomic()
 def create_secret(
     create_ts: datetime.datetime,
     access_token_value: str,
     expire_ts: Optional[datetime.datetime],
 ) -> CreateSecretResponse:
-    logging.debug("controllers.secret.create_secret")
+    LOG.debug("controllers.secret.create_secret")
 
-    access_token = AccessToken.select_valid_by_value(
-        create_ts,
-        access_token_value,
-    )
+    access_token = _validate_access_token(create_ts, access_token_value)
     if not access_token:
+        _deny(create_ts, "create_secret", None)
         raise ForbiddenError("token is not authorized")
 
+    # Checked before hashing, to refuse cheaply, and again as the secret is
+    # written.
+    _check_secret_quota(create_ts, access_token.user_id)
+
     secret_name = crypto.make_secret_string(config().secret_name_entropy)
     secret_plain = crypto.make_secret_string(config().secret_value_entropy)
     secret_hash = crypto.hash_secret(secret_plain)
 
-    secret = _create_secret(
-        secret_name,
-        secret_hash,
+    def create():
+        _check_secret_quota(create_ts, access_token.user_id)
+        return _create_secret(
+            secret_name,
+            secret_hash,
+            create_ts,
+            expire_ts,
+            access_token.user_id,
+        )
+
+    secret = _write(create)
+
+    _audit(
+        "secret.created",
         create_ts,
-        expire_ts,
-        access_token.secret.user,
+        user_id=access_token.user_id,
+        secret_id=secret.id,
+        expire_ts=expire_ts,
     )
 
     return CreateSecretResponse(secret, secret_plain)
 
 
-@DB.atomic()
+class RotateSecretsResponse:
+    def __init__(
+        self,
+        user: User,
+        rotated: List[Tuple[str, datetime.datetime, Secret, str]],
+    ):
+        self.user = user
+        self.rotated = rotated
+
+    def into_dict(self):
+        # A generator, so that the response is encoded as it is streamed.
+        return {
+            "secrets": (
+                self._entry(*rotated) for rotated in self.rotated
+            ),
+        }
+
+    def _entry(
+        self,
+        name: str,
+        expire_ts: datetime.datetime,
+        secret: Secret,
+        value: str,
+    ):
+        # The replacement is written out, rather than with Secret.into_dict,
+        # which would load its user again for each one.
+        replacement = {
+            "name": secret.name,
+            "create_ts": secret.create_ts,
+            "user_name": self.user.name,
+        }
+        if secret.expire_ts is not None:
+            replacement["expire_ts"] = secret.expire_ts
+        replacement["value"] = value
+        return {
+            "name": name,
+            "expire_ts": expire_ts,
+            "replacement": replacement,
+        }
+
+
+@STORAGE.atomic()
 def read_secret(
     server_ts: datetime.datetime,
     name: str,
     access_token_value: Optional[str],
 ) -> ReadSecretResponse:
-    logging.debug("controllers.secret.read_secret")
+    LOG.debug("controllers.secret.read_secret")
 
-    secret, _, authorized = _authorize(server_ts, name, access_token_value)
+    secret, access_token, authorized = _authorize(
+        server_ts,
+        name,
+        access_token_value,
+    )
 
     if not authorized:
+        _deny(server_ts, "read_secret", access_token)
         raise ForbiddenError("cannot read secret")
 
     return ReadSecretResponse(secret)
 
 
-@DB.atomic()
 def update_secret(
     server_ts: datetime.datetime, name: str, access_token_value: str,
     **fields: Mapping[str, Any]
 ) -> ReadSecretResponse:
-    logging.debug("controllers.secret.update_secret")
+    LOG.debug("controllers.secret.update_secret")
 
-    secret, _, authorized = _authorize(server_ts, name, access_token_value)
+    secret, changed = _update_secret_txn(
+        server_ts,
+        name,
+        access_token_value,
+        **fields,
+    )
+
+    if "hash" in changed:
+        _audit(
+            "secret.value_changed",
+            server_ts,
+            user_id=secret.user_id,
+            secret_id=secret.id,
+        )
+    if "expire_ts" in changed:
+        _audit(
+            "secret.expiry_changed",
+            server_ts,
+            user_id=secret.user_id,
+            secret_id=secret.id,
+            expire_ts=secret.expire_ts,
+        )
+
+    return ReadSecretResponse(secret)
+
+
+@STORAGE.atomic(write=True)
+def _update_secret_txn(
+    server_ts: datetime.datetime, name: str, access_token_value: str,
+    **fields: Mapping[str, Any]
+) -> Tuple[Secret, Set[str]]:
+    secret, access_token, authorized = _authorize(
+        server_ts,
+        name,
+        access_token_value,
+    )
 
     if not authorized:
+        _deny(server_ts, "update_secret", access_token)
         raise ForbiddenError("cannot update secret")
 
+    changes = {}
+
     if "value" in fields:
         if name != secret.user.name:
             raise BadRequestError(
@@ -108,10 +228,10 @@ def update_secret(
                 fields={"value": "secret value must not be set"},
             )
 
-            value = fields["value"]
-            validation.validate_secret("value", value)
+        value = fields["value"]
+        validation.validate_secret("value", value)
 
-            secret.hash = crypto.hash_secret(secret_plain)
+        changes["hash"] = crypto.hash_secret(value)
 
     if "expire_ts" in fields:
         if name == secret.user.name:
@@ -128,31 +248,155 @@ def update_secret(
                 Range(secret.create_ts, secret.expire_ts),
             )
 
-        secret.expire_ts = expire_ts
+        changes["expire_ts"] = expire_ts
 
-    if fields:
-        secret.save()
+    if changes:
+        secret = STORAGE.update_secret(server_ts, secret, **changes)
+        _revoke(secret.id, server_ts, secret.expire_ts)
 
-    return ReadSecretResponse(secret)
+    return secret, set(changes)
 
 
-@DB.atomic()
 def delete_secret(
     server_ts: datetime.datetime,
     name: str,
     access_token_value: str,
 ) -> ReadSecretResponse:
-    logging.debug("controllers.secret.update_secret")
+    LOG.debug("controllers.secret.update_secret")
 
-    secret, _, authorized = _authorize(server_ts, name, access_token_value)
+    secret = _delete_secret_txn(server_ts, name, access_token_value)
+
+    _audit(
+        "secret.expiry_changed",
+        server_ts,
+        user_id=secret.user_id,
+        secret_id=secret.id,
+        expire_ts=server_ts,
+    )
+
+    return ReadSecretResponse(secret)
+
+
+@STORAGE.atomic(write=True)
+def _delete_secret_txn(
+    server_ts: datetime.datetime,
+    name: str,
+    access_token_value: str,
+) -> Secret:
+    secret, access_token, authorized = _authorize(
+        server_ts,
+        name,
+        access_token_value,
+    )
 
     if not authorized:
+        _deny(server_ts, "delete_secret", access_token)
         raise ForbiddenError("cannot update secret")
 
-    secret.expire_ts = expire_ts
-    secret.save()
+    secret = STORAGE.update_secret(server_ts, secret, expire_ts=server_ts)
+    _revoke(secret.id, server_ts, server_ts)
 
-    return ReadSecretResponse(secret)
+    return secret
+
+
+def rotate_secrets(
+    server_ts: datetime.datetime,
+    name: str,
+    access_token_value: str,
+    secret_names: List[str],
+    grace_period: datetime.timedelta,
+    expire_ts: Optional[datetime.datetime],
+) -> RotateSecretsResponse:
+    """
+    Replaces the named secrets of user `name` with new ones, which expire
+    at `expire_ts`, and expires the old ones `grace_period` from now.
+    """
+    LOG.debug("controllers.secret.rotate_secrets")
+
+    user = STORAGE.select_user_by_name(name)
+    access_token = _validate_access_token(server_ts, access_token_value)
+    if not (user and access_token and user.id == access_token.user_id):
+        _deny(server_ts, "rotate_secrets", access_token)
+        raise ForbiddenError("cannot rotate secrets")
+
+    if user.name in secret_names:
+        raise BadRequestError(
+            "cannot rotate password",
+            fields={"names": "the password is changed with PATCH"},
+        )
+    # Checked before hashing, and again in the transaction, which fails if
+    # a concurrent request changed any of the secrets in between.
+    versions = [
+        secret.version
+        for secret in _rotating(server_ts, user.id, secret_names)
+    ]
+    grace_ts = server_ts + grace_period
+    # The old secrets count towards the quota until they expire, so only a
+    # rotation without a grace period always fits.
+    expiring = len(secret_names) if grace_ts <= server_ts else 0
+    _check_secret_quota(server_ts, user.id, len(secret_names), expiring)
+
+    values = [
+        crypto.make_secret_string(config().secret_value_entropy)
+        for _ in secret_names
+    ]
+    hashes = list(HASHERS.map(crypto.hash_secret, values))
+    new_names = [
+        crypto.make_secret_string(config().secret_name_entropy)
+        for _ in secret_names
+    ]
+
+    def rotate():
+        old_secrets = _rotating(server_ts, user.id, secret_names)
+        if [secret.version for secret in old_secrets] != versions:
+            raise ConflictError(
+                user={"names": "secrets changed while being rotated"}
+            )
+        _check_secret_quota(server_ts, user.id, len(secret_names), expiring)
+        # Taken now: the memory engine updates the rows in place.
+        old_expire_ts = [
+            min(filter(None, (secret.expire_ts, grace_ts)))
+            for secret in old_secrets
+        ]
+        new_secrets = [
+            _create_secret(new_name, hash, server_ts, expire_ts, user.id)
+            for new_name, hash in zip(new_names, hashes)
+        ]
+        STORAGE.expire_secrets(
+            server_ts,
+            user.id,
+            [secret.id for secret in old_secrets],
+            grace_ts,
+        )
+        return old_secrets, old_expire_ts, new_secrets
+
+    old_secrets, old_expire_ts, new_secrets = _write(rotate)
+    metrics().increment("secret.rotated", len(new_secrets))
+
+    # As with PATCH, signed tokens issued from the old secrets are revoked
+    # once they expire, as are opaque ones.
+    for old, old_expire, new in zip(old_secrets, old_expire_ts, new_secrets):
+        _audit(
+            "secret.created",
+            server_ts,
+            user_id=user.id,
+            secret_id=new.id,
+            expire_ts=expire_ts,
+        )
+        if old_expire == grace_ts:
+            _revoke(old.id, server_ts, grace_ts)
+            _audit(
+                "secret.expiry_changed",
+                server_ts,
+                user_id=user.id,
+                secret_id=old.id,
+                expire_ts=grace_ts,
+            )
+
+    return RotateSecretsResponse(
+        user,
+        list(zip(secret_names, old_expire_ts, new_secrets, values)),
+    )
 
 
 def _create_secret(
@@ -160,40 +404,75 @@ def _create_secret(
     hash: str,
     create_ts: datetime.datetime,
     expire_ts: Optional[datetime.datetime],
-    user: User,
+    user_id: uuid.UUID,
 ) -> Secret:
-    logging.debug("controllers.secret._create_secret")
+    LOG.debug("controllers.secret._create_secret")
 
     try:
-        return Secret.create(
+        return STORAGE.create_secret(
             id=uuid.uuid4(),
             name=name,
             hash=hash,
             create_ts=create_ts,
             expire_ts=expire_ts,
-            user=user,
+            user_id=user_id,
         )
-    except peewee.IntegrityError:
+    except engine.IntegrityError:
         raise ConflictError(user={"name": "secret names must be unique"})
 
 
+def _rotating(
+    server_ts: datetime.datetime,
+    user_id: uuid.UUID,
+    secret_names: List[str],
+) -> List[Secret]:
+    valid = {
+        secret.name: secret
+        for secret in STORAGE.select_valid_secrets_by_user(server_ts, user_id)
+    }
+    missing = [
+        secret_name for secret_name in secret_names
+        if secret_name not in valid
+    ]
+    if missing:
+        raise BadRequestError(
+            "unknown secrets",
+            fields={
+                "names":
+                    "no valid secrets named: {}".format(", ".join(missing))
+            },
+        )
+    return [valid[secret_name] for secret_name in secret_names]
+
+
+def _check_secret_quota(
+    server_ts: datetime.datetime,
+    user_id: uuid.UUID,
+    created: int = 1,
+    expired: int = 0,
+) -> None:
+    # Refuses writes that would leave the user over quota, having created
+    # and expired that many of their secrets.
+    quota = config().secret_quota_per_user
+    if quota and sum(
+        1 for _ in STORAGE.select_valid_secrets_by_user(server_ts, user_id)
+    ) + created - expired > quota:
+        metrics().increment("quota.secrets_refused")
+        raise ConflictError(
+            user={"secrets": f"a user may have at most {quota} valid secrets"}
+        )
+
+
 def _authorize(
     server_ts: datetime.datetime,
     name: str,
     access_token_value: str,
-) -> Tuple[Optional[Secret], Optional[AccessToken], bool]:
-    secret = Secret.select_by_name(server_ts, name)
-
-    if access_token_value is None:
-        access_token = None
-    else:
-        access_token = AccessToken.select_valid_by_value(
-            server_ts,
-            access_token_value,
-        )
+) -> Tuple[Optional[Secret], Optional[AccessTokenRecord], bool]:
+    secret = STORAGE.select_secret_by_name(name)
+    access_token = _validate_access_token(server_ts, access_token_value)
 
-    authorized = secret and access_token and (
-        secret.id == access_token.secret.id
+    authorized = bool(
+        secret and access_token and (secret.id == access_token.secret_id)
     )
 
-    return (user, access_token, authorized)
+    return (secret, access_token, authorized)
@@ -1,127 +1,302 @@
+import contextlib
 import datetime
-import logging
+import sys
 import uuid
-from typing import Any, Mapping, Optional, Tuple, Union
-
-import peewee
-
-from .auth import _create_access_token, _create_refresh_token
+from typing import (
+    Any, Callable, ContextManager, Iterable, Iterator, Mapping, Optional, Set,
+    Tuple, Union
+)
+
+from .auth import (
+    _audit, _create_access_token, _create_refresh_token, _deny, _revoke,
+    _validate_access_token, _write
+)
 from .secret import _create_secret
-from ..library import crypto, db, validation
+from ..library import (
+    cache, crypto, log, serialization, validation
+)
 from ..library.config import Range, config
 from ..library.error import ConflictError, ForbiddenError, NotFoundError
-from ..models.secret import Secret
+from ..models.auth import AccessToken
 from ..models.user import User
-from ..models.auth import AccessToken, RefreshToken
+from ..models.records import AccessTokenRecord
+from ..models.secret import Secret
+from ..storage import engine
+
+LOG = log.logger(__name__)
+STORAGE = engine.storage()
 
-DB = db.db()
+PUBLIC_USERS = cache.Cache(
+    "public_user",
+    config().public_user_cache_entries,
+    config().public_user_cache_ttl,
+    config().public_user_cache_negative_ttl,
+)
 
 
 class PublicUserResponse:
+    # Public responses are the same for every caller, so they are encoded
+    # once up front and shared through PUBLIC_USERS.
+    __slots__ = ("user_id", "_etag", "_last_modified", "_payload")
+
     def __init__(self, user: User):
-        self.user = user
+        self.user_id = user.id
+        self._etag = f"u{user.version}"
+        self._last_modified = user.modify_ts or user.create_ts
+        self._payload = serialization.pre_encode({"user": user})
+
+    def __sizeof__(self) -> int:
+        return object.__sizeof__(self) + sum(
+            sys.getsizeof(getattr(self, name)) for name in self.__slots__
+        )
+
+    def etag(self) -> str:
+        return self._etag
+
+    def match(self, etags: Set[str]) -> Optional[str]:
+        return self._etag if self._etag in etags else None
+
+    def last_modified(self) -> Optional[datetime.datetime]:
+        return self._last_modified
+
+    def reading(self) -> ContextManager[None]:
+        return contextlib.nullcontext()
 
     def into_dict(self):
-        return {
-            "user": self.user.into_dict(),
-        }
+        return self._payload
 
 
 class PrivateUserResponse:
-    def __init__(self, user: User):
+    def __init__(self, server_ts: datetime.datetime, user: User):
+        self.server_ts = server_ts
         self.user = user
+        self._etag: Optional[str] = None
+
+    # The private view changes with writes anywhere under the user, and with
+    # time as its secrets and tokens expire. The ETag carries the tree version
+    # and the next expiry, so computing it takes one query beyond the user.
+    def etag(self) -> str:
+        if self._etag is None:
+            next_expire_us = _epoch_us(self._next_expire_ts())
+            self._etag = f"p{self.user.tree_version}.{next_expire_us}"
+        return self._etag
+
+    def match(self, etags: Set[str]) -> Optional[str]:
+        # The next expiry is looked up rather than read from the client's
+        # tags, which are only compared.
+        etag = self.etag()
+        return etag if etag in etags else None
+
+    def last_modified(self) -> Optional[datetime.datetime]:
+        # Expiry changes the view without a write, which a modification time
+        # cannot express.
+        return None
+
+    def _next_expire_ts(self) -> Optional[datetime.datetime]:
+        expire_ts = STORAGE.select_next_expire_ts_by_user(
+            self.server_ts,
+            self.user.id,
+        )
+        return min(filter(None, (self.user.expire_ts, expire_ts)), default=None)
 
-    def _secrets(self):
-        for secret in self.user.secrets:
-            if secret.is_valid():
-                yield secret
-
-    def _access_tokens(self):
-        for secret in self._secrets():
-            for access_token in secret.access_tokens:
-                if access_token.is_valid():
-                    yield access_token
-
-    def _refresh_tokens(self):
-        for access_token in self._access_tokens():
-            for refresh_token in access_token.refresh_tokens:
-                if refresh_token.is_valid():
-                    yield refresh_token
+    def reading(self) -> ContextManager[None]:
+        # The rows are selected as they are encoded, in one transaction.
+        return STORAGE.reading()
 
     def into_dict(self):
+        # Engines may hand back lazy iterables, so that large payloads can be
+        # streamed without materializing every row. Nothing is selected until
+        # the response is encoded, within `reading`.
         return {
             "user":
-                self.user.into_dict(),
-            "secrets": [secret.into_dict() for secret in self._secrets()],
-            "access_tokens": [
-                token.into_dict() for token in self._access_tokens()
-            ],
-            "refresh_tokens": [
-                token.into_dict() for token in self._refresh_tokens()
-            ],
+                self.user,
+            "secrets":
+                _selected(
+                    STORAGE.select_valid_secrets_by_user,
+                    self.server_ts,
+                    self.user.id,
+                ),
+            "access_tokens":
+                _selected(
+                    STORAGE.select_valid_access_tokens_by_user,
+                    self.server_ts,
+                    self.user.id,
+                ),
+            "refresh_tokens":
+                _selected(
+                    STORAGE.select_valid_refresh_tokens_by_user,
+                    self.server_ts,
+                    self.user.id,
+                ),
         }
 
 
-@DB.atomic()
 def create_user(
     create_ts: datetime.datetime,
     name: str,
     secret_plain: str,
     access_token_lifetime: datetime.timedelta,
     refresh_token_lifetime: datetime.timedelta,
-) -> CreateUserResponse:
-    logging.debug("controllers.user.create_user")
+) -> PrivateUserResponse:
+    LOG.debug("controllers.user.create_user")
 
+    # Hashed before the write, which holds the write lock or a group commit
+    # batch for as short a time as it can.
     secret_hash = crypto.hash_secret(secret_plain)
 
+    user, secret, access_token = _write(
+        lambda: _create_user_with_secret(
+            create_ts,
+            name,
+            secret_hash,
+            access_token_lifetime,
+            refresh_token_lifetime,
+        )
+    )
+    # Drops any negative entry for the name, now that it is committed.
+    PUBLIC_USERS.invalidate(name)
+
+    _audit(
+        "user.created",
+        create_ts,
+        user_id=user.id,
+        name=name,
+    )
+    _audit(
+        "secret.created",
+        create_ts,
+        user_id=user.id,
+        name=name,
+        secret_id=secret.id,
+        expire_ts=None,
+    )
+    _audit(
+        "token.issued",
+        create_ts,
+        user_id=user.id,
+        name=name,
+        secret_id=secret.id,
+        access_token_id=access_token.id,
+        expire_ts=access_token.expire_ts,
+    )
+
+    return PrivateUserResponse(create_ts, user)
+
+
+def _create_user_with_secret(
+    create_ts: datetime.datetime,
+    name: str,
+    secret_hash: str,
+    access_token_lifetime: datetime.timedelta,
+    refresh_token_lifetime: datetime.timedelta,
+) -> Tuple[User, Secret, AccessToken]:
     user = _create_user(create_ts, name)
-    secret = _create_secret(name, secret_hash, create_ts, None, user)
+    secret = _create_secret(name, secret_hash, create_ts, None, user.id)
     access_token = _create_access_token(
         create_ts,
         create_ts + access_token_lifetime,
-        secret,
+        secret.id,
+        user.id,
     )
-    refresh_token = _create_refresh_token(
+    _create_refresh_token(
         create_ts,
         create_ts + refresh_token_lifetime,
-        access_token,
+        access_token.id,
     )
 
-    return PrivateUserResponse(user)
+    return user, secret, access_token
 
 
-@DB.atomic()
 def read_user(
     server_ts: datetime.datetime,
     name: str,
     access_token_value: Optional[str],
 ) -> Union[PrivateUserResponse, PublicUserResponse]:
-    logging.debug("controllers.user.read_user")
+    LOG.debug("controllers.user.read_user")
 
-    user, _, authorized = _authorize(server_ts, name, access_token_value)
+    access_token = _validate_access_token(server_ts, access_token_value)
 
-    if not user:
+    # A cached public view answers everyone except the user themself, who is
+    # owed the private view.
+    public = PUBLIC_USERS.get(name)
+    if public is None:
         raise NotFoundError(f"user {name} does not exist")
-    elif authorized:
-        return PrivateUserResponse(user)
+    elif public is not cache.MISS and not (
+        access_token and access_token.user_id == public.user_id
+    ):
+        return public
+
+    generation = PUBLIC_USERS.generation()
+    response = _read_user_txn(server_ts, name, access_token)
+    if isinstance(response, PublicUserResponse):
+        PUBLIC_USERS.put(name, response, generation)
+    elif response is None:
+        PUBLIC_USERS.put(name, None, generation)
+        raise NotFoundError(f"user {name} does not exist")
+    return response
+
+
+@STORAGE.atomic()
+def _read_user_txn(
+    server_ts: datetime.datetime,
+    name: str,
+    access_token: Optional[AccessTokenRecord],
+) -> Union[PrivateUserResponse, PublicUserResponse, None]:
+    user = STORAGE.select_user_by_name(name)
+
+    if not user:
+        return None
+    elif access_token and user.id == access_token.user_id:
+        return PrivateUserResponse(server_ts, user)
     else:
         return PublicUserResponse(user)
 
 
-@DB.atomic()
 def update_user(
     server_ts: datetime.datetime, name: str, access_token_value: str,
     **fields: Mapping[str, Any]
 ) -> PrivateUserResponse:
-    logging.debug("controllers.user.update_user")
+    LOG.debug("controllers.user.update_user")
+
+    user, changed = _update_user_txn(
+        server_ts,
+        name,
+        access_token_value,
+        **fields,
+    )
+    PUBLIC_USERS.invalidate(name)
+
+    if "expire_ts" in changed:
+        _audit(
+            "user.expiry_changed",
+            server_ts,
+            user_id=user.id,
+            name=name,
+            expire_ts=user.expire_ts,
+        )
 
-    user, _, authorized = _authorize(server_ts, name, access_token_value)
+    return PrivateUserResponse(server_ts, user)
+
+
+@STORAGE.atomic(write=True)
+def _update_user_txn(
+    server_ts: datetime.datetime, name: str, access_token_value: str,
+    **fields: Mapping[str, Any]
+) -> Tuple[User, Set[str]]:
+    user, access_token, authorized = _authorize(
+        server_ts,
+        name,
+        access_token_value,
+    )
 
     if not user:
         raise NotFoundError(f"user {name} does not exist")
     elif not authorized:
+        _deny(server_ts, "update_user", access_token)
         raise ForbiddenError("cannot update user")
 
+    changes = {}
+
     if "expire_ts" in fields:
         expire_ts = fields["expire_ts"]
         if expire_ts is not None:
@@ -130,61 +305,99 @@ def update_user(
                 expire_ts,
                 Range(user.create_ts, None),
             )
-        user.expire_ts = expire_ts
+        changes["expire_ts"] = expire_ts
 
-    if fields:
-        user.save()
+    if changes:
+        user = STORAGE.update_user(server_ts, user, **changes)
+        _revoke(user.id, server_ts, user.expire_ts)
 
-    return PrivateUserResponse(user)
+    return user, set(changes)
 
 
-@DB.atomic()
 def delete_user(
     server_ts: datetime.datetime,
     name: str,
     access_token_value: str,
 ) -> PublicUserResponse:
-    logging.debug("controllers.user.update_user")
+    LOG.debug("controllers.user.delete_user")
+
+    user = _delete_user_txn(server_ts, name, access_token_value)
+    PUBLIC_USERS.invalidate(name)
 
-    user, _, authorized = _authorize(server_ts, name, access_token_value)
+    _audit(
+        "user.expiry_changed",
+        server_ts,
+        user_id=user.id,
+        name=name,
+        expire_ts=server_ts,
+    )
+
+    return PublicUserResponse(user)
+
+
+@STORAGE.atomic(write=True)
+def _delete_user_txn(
+    server_ts: datetime.datetime,
+    name: str,
+    access_token_value: str,
+) -> User:
+    user, access_token, authorized = _authorize(
+        server_ts,
+        name,
+        access_token_value,
+    )
 
     if not user:
         raise NotFoundError(f"user {name} does not exist")
     elif not authorized:
+        _deny(server_ts, "delete_user", access_token)
         raise ForbiddenError("cannot delete user")
 
-    user.expire_ts = server_ts
-    user.save()
+    user = STORAGE.update_user(server_ts, user, expire_ts=server_ts)
+    _revoke(user.id, server_ts, server_ts)
 
-    return PublicUserResponse(user)
+    return user
 
 
 def _create_user(server_ts: datetime.datetime, name: str) -> User:
-    logging.debug("controllers.user._create_user")
+    LOG.debug("controllers.user._create_user")
 
     try:
-        return User.create(id=uuid.uuid4(), name=name, create_ts=server_ts)
-    except peewee.IntegrityError:
+        return STORAGE.create_user(
+            id=uuid.uuid4(),
+            name=name,
+            create_ts=server_ts,
+        )
+    except engine.IntegrityError:
         raise ConflictError(user={"name": "user names must be unique"})
 
 
+def _selected(
+    select: Callable[..., Iterable[Any]],
+    *args: Any,
+) -> Iterator[Any]:
+    # Selects once iterated, rather than when called.
+    yield from select(*args)
+
+
+def _epoch_us(ts: Optional[datetime.datetime]) -> float:
+    if ts is None:
+        return float("inf")
+    return (ts - datetime.datetime(1970, 1, 1)) // datetime.timedelta(
+        microseconds=1
+    )
+
+
 def _authorize(
     server_ts: datetime.datetime,
     name: str,
     access_token_value: str,
-) -> Tuple[Optional[User], Optional[AccessToken], bool]:
-    user = User.select_by_name(server_ts, name)
-
-    if access_token_value is None:
-        access_token = None
-    else:
-        access_token = AccessToken.select_valid_by_value(
-            server_ts,
-            access_token_value,
-        )
+) -> Tuple[Optional[User], Optional[AccessTokenRecord], bool]:
+    user = STORAGE.select_user_by_name(name)
+    access_token = _validate_access_token(server_ts, access_token_value)
 
-    authorized = user and access_token and (
-        user.id == access_token.secret.user.id
+    authorized = bool(
+        user and access_token and (user.id == access_token.user_id)
     )
 
     return (user, access_token, authorized)
@@ -1,8 +1,17 @@
+import time
+import uuid
+
 import flask
 
+from . import log, serialization
+from .config import config
 from .error import HttpError
+from .serialization import JSONProvider
+
+ACCESS = log.logger(log.ACCESS)
 
 __SINGLETON = flask.Flask(__name__)
+__SINGLETON.json = JSONProvider(__SINGLETON)
 
 
 def app():
@@ -10,6 +19,41 @@ def app():
     return __SINGLETON
 
 
+@__SINGLETON.before_request
+def start_request():
+    # Callers may pass their own id to correlate logs across services.
+    flask.g.request_id = (
+        flask.request.headers.get("X-Request-Id") or uuid.uuid4().hex
+    )
+    flask.g.start = time.perf_counter()
+
+
+@__SINGLETON.after_request
+def finish_request(response: flask.Response) -> flask.Response:
+    response.headers["X-Request-Id"] = flask.g.request_id
+    db_statements = flask.g.get("db_statements", 0)
+    db_time_ms = round(flask.g.get("db_time_s", 0.0) * 1e3, 3)
+    if config().db_query_headers:
+        response.headers["X-DB-Statements"] = str(db_statements)
+        response.headers["X-DB-Time-Ms"] = str(db_time_ms)
+    ACCESS.info(
+        "%s %s %d",
+        flask.request.method,
+        flask.request.path,
+        response.status_code,
+        extra={
+            "status": response.status_code,
+            "latency_ms": round(
+                (time.perf_counter() - flask.g.start) * 1e3, 3
+            ),
+            "db_statements": db_statements,
+            "db_time_ms": db_time_ms,
+        },
+    )
+    return response
+
+
 @__SINGLETON.errorhandler(HttpError)
 def handle_http_error(error):
-    return error.into_response()
+    payload, code = error.into_response()
+    return serialization.into_response(payload, code)
@@ -0,0 +1,149 @@
+"""
+An audit trail of credential events: token issuance, user and secret
+creation, expiry changes, and refused authentication.
+
+Controllers call `audit().record(...)`, which only queues the event. A writer
+thread hands queued events to a sink (see storage/audit.py) in batches, so
+no request waits on an audit write. A batch is written at most
+`flush_interval` after its first event was queued, which bounds what a crash
+can lose to that, plus whatever is still queued. When the queue is full,
+events are dropped and counted as audit.dropped rather than holding up the
+request.
+"""
+
+import datetime
+import queue
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import flask
+
+from . import log
+from .metrics import metrics
+
+LOG = log.logger(__name__)
+_STOP = object()
+
+Event = Dict[str, Any]
+
+TOKEN_ISSUED = "token.issued"
+USER_CREATED = "user.created"
+USER_EXPIRY_CHANGED = "user.expiry_changed"
+SECRET_CREATED = "secret.created"
+SECRET_EXPIRY_CHANGED = "secret.expiry_changed"
+SECRET_VALUE_CHANGED = "secret.value_changed"
+AUTHENTICATION_FAILED = "authentication.failed"
+ACCESS_DENIED = "access.denied"
+
+
+class Audit:
+    def __init__(self):
+        self.sink: Any = None
+        self.max_batch = 0
+        self.flush_interval_s = 0.0
+        self._queue: Optional["queue.Queue[Any]"] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(
+        self,
+        sink: Any,
+        max_batch: int,
+        flush_interval: datetime.timedelta,
+        queue_size: int,
+    ) -> None:
+        LOG.debug("audit.start")
+
+        self.sink = sink
+        self.max_batch = max_batch
+        self.flush_interval_s = flush_interval.total_seconds()
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(
+            target=self._run,
+            name="audit",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Writes whatever is queued, then closes the sink."""
+        LOG.debug("audit.stop")
+
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(_STOP)
+        thread.join()
+        self._queue = None
+        self.sink.close()
+
+    def record(
+        self,
+        kind: str,
+        ts: datetime.datetime,
+        user_id: Optional[uuid.UUID] = None,
+        name: Optional[str] = None,
+        **fields: Any,
+    ) -> None:
+        """
+        Queues an event. `user_id` and `name` identify the user concerned,
+        as far as the caller knows them; both are what queries filter on.
+        """
+        events = self._queue
+        if events is None:
+            return
+
+        event = {"ts": ts, "kind": kind, "user_id": user_id, "name": name}
+        event.update(fields)
+        if flask.has_request_context():
+            event["request_id"] = flask.g.get("request_id")
+        try:
+            events.put_nowait(event)
+        except queue.Full:
+            metrics().increment("audit.dropped")
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval_s
+            stopping = False
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    event = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if event is _STOP:
+                    stopping = True
+                    break
+                batch.append(event)
+
+            self._write(batch)
+            if stopping:
+                return
+
+    def _write(self, batch: List[Event]) -> None:
+        start = time.perf_counter()
+        try:
+            self.sink.write(batch)
+        except Exception:
+            LOG.exception("audit: failed to write %d events", len(batch))
+            metrics().increment("audit.failed", len(batch))
+            return
+        metrics().increment("audit.written", len(batch))
+        metrics().observe("audit.write", time.perf_counter() - start)
+
+
+__SINGLETON = Audit()
+
+
+def audit() -> Audit:
+    global __SINGLETON
+    return __SINGLETON
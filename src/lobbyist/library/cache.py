@@ -0,0 +1,94 @@
+import collections
+import datetime
+import sys
+import threading
+import time
+from typing import Any, Hashable
+
+from .metrics import metrics
+
+MISS = object()
+
+# The (expire_s, value, size) tuple each entry is stored as.
+_ENTRY_BYTES = sys.getsizeof((0.0, None, 0)) + sys.getsizeof(0.0)
+
+
+class Cache:
+    """
+    A bounded LRU cache with expiry, shared across request threads.
+
+    Storing None records a negative entry, which expires after
+    `negative_ttl` instead of `ttl`.
+
+    Invalidation races with loads that started before it: a loader reads
+    `generation()` before going to the database and passes it to `put`, which
+    drops the value if anything was invalidated in the meantime.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: int,
+        ttl: datetime.timedelta,
+        negative_ttl: datetime.timedelta,
+    ):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_s = ttl.total_seconds()
+        self.negative_ttl_s = negative_ttl.total_seconds()
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._generation = 0
+        self._bytes = 0
+
+    def get(self, key: Hashable) -> Any:
+        """Returns the cached value, which may be None, or MISS."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expire_s, value, _ = entry
+                if now < expire_s:
+                    self._entries.move_to_end(key)
+                    metrics().increment(f"cache.{self.name}.hit")
+                    return value
+                self._remove(key)
+        metrics().increment(f"cache.{self.name}.miss")
+        return MISS
+
+    def generation(self) -> int:
+        with self._lock:
+            return self._generation
+
+    def put(self, key: Hashable, value: Any, generation: int) -> None:
+        ttl_s = self.ttl_s if value is not None else self.negative_ttl_s
+        size = _ENTRY_BYTES + sys.getsizeof(key) + sys.getsizeof(value)
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl_s, value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+            self._report()
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._generation += 1
+            self._remove(key)
+            self._report()
+
+    def footprint(self) -> int:
+        """Approximate bytes held by keys, values and entry bookkeeping."""
+        with self._lock:
+            return self._bytes + sys.getsizeof(self._entries)
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def _report(self) -> None:
+        metrics().set_gauge(f"cache.{self.name}.entries", len(self._entries))
+        metrics().set_gauge(f"cache.{self.name}.bytes", self._bytes)
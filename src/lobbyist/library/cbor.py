@@ -0,0 +1,237 @@
+"""
+The subset of CBOR (RFC 8949) that responses and request bodies use.
+
+Datetimes are epoch-based date/time tags (tag 1) holding whole seconds, and
+UUIDs are tag 37 around their 16 bytes. Arrays of unknown length, as
+streamed from lazy iterables, use the indefinite-length encoding.
+"""
+
+import datetime
+import math
+import struct
+import uuid
+from typing import Any, Callable, Dict, Tuple
+
+MIMETYPE = "application/cbor"
+
+UNSIGNED = 0
+NEGATIVE = 1
+BYTES = 2
+TEXT = 3
+ARRAY = 4
+MAP = 5
+TAG = 6
+SIMPLE = 7
+
+TAG_EPOCH = 1
+TAG_UUID = 37
+
+FALSE = b"\xf4"
+TRUE = b"\xf5"
+NULL = b"\xf6"
+INDEFINITE_ARRAY = b"\x9f"
+BREAK = b"\xff"
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+_FLOAT = struct.Struct(">Bd")
+_EPOCH_U32 = struct.Struct(">BBI")
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def head(major: int, argument: int) -> bytes:
+    if argument < 24:
+        return bytes((major << 5 | argument, ))
+    if argument < 2**8:
+        return bytes((major << 5 | 24, argument))
+    if argument < 2**16:
+        return bytes((major << 5 | 25, )) + argument.to_bytes(2, "big")
+    if argument < 2**32:
+        return bytes((major << 5 | 26, )) + argument.to_bytes(4, "big")
+    return bytes((major << 5 | 27, )) + argument.to_bytes(8, "big")
+
+
+def encode_text(value: str) -> bytes:
+    data = value.encode()
+    return head(TEXT, len(data)) + data
+
+
+def encode_int(value: int) -> bytes:
+    if value >= 0:
+        return head(UNSIGNED, value)
+    return head(NEGATIVE, -1 - value)
+
+
+def encode_datetime(value: datetime.datetime) -> bytes:
+    # All timestamps are naive UTC. Those from 1970 to 2106 take the
+    # 4-byte form; packing it directly halves the cost of the general path.
+    delta = value - EPOCH
+    seconds = delta.days * 86400 + delta.seconds
+    if 2**16 <= seconds < 2**32:
+        return _EPOCH_U32.pack(0xc1, 0x1a, seconds)
+    return b"\xc1" + encode_int(seconds)
+
+
+def encode_uuid(value: uuid.UUID) -> bytes:
+    return b"\xd8\x25\x50" + value.bytes
+
+
+def encode(value: Any) -> bytes:
+    if value is None:
+        return NULL
+    if value is True:
+        return TRUE
+    if value is False:
+        return FALSE
+    if isinstance(value, int):
+        return encode_int(value)
+    if isinstance(value, float):
+        return _FLOAT.pack(0xfb, value)
+    if isinstance(value, str):
+        return encode_text(value)
+    if isinstance(value, bytes):
+        return head(BYTES, len(value)) + value
+    if isinstance(value, datetime.datetime):
+        return encode_datetime(value)
+    if isinstance(value, uuid.UUID):
+        return encode_uuid(value)
+    if isinstance(value, dict):
+        return head(MAP, len(value)) + b"".join(
+            encode(key) + encode(item) for key, item in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return head(ARRAY, len(value)) + b"".join(map(encode, value))
+    raise TypeError(f"cannot encode {type(value).__name__} as CBOR")
+
+
+def decode(data: bytes) -> Any:
+    try:
+        value, offset = _decode(data, 0)
+    except (
+        IndexError,
+        RecursionError,
+        TypeError,
+        UnicodeDecodeError,
+        struct.error,
+    ) as error:
+        raise DecodeError(f"truncated or malformed CBOR: {error}")
+    if offset != len(data):
+        raise DecodeError("trailing bytes after CBOR item")
+    return value
+
+
+def _decode(data: bytes, offset: int) -> Tuple[Any, int]:
+    initial = data[offset]
+    major, info = initial >> 5, initial & 0x1f
+    offset += 1
+
+    if major == SIMPLE:
+        return _decode_simple(data, offset, info)
+
+    if info == 31:
+        if major == ARRAY:
+            items = []
+            while data[offset] != 0xff:
+                item, offset = _decode(data, offset)
+                items.append(item)
+            return items, offset + 1
+        if major == MAP:
+            items = {}
+            while data[offset] != 0xff:
+                key, offset = _decode(data, offset)
+                items[key], offset = _decode(data, offset)
+            return items, offset + 1
+        raise DecodeError(f"unsupported indefinite length for type {major}")
+
+    argument, offset = _argument(data, offset, info)
+    if major == UNSIGNED:
+        return argument, offset
+    if major == NEGATIVE:
+        return -1 - argument, offset
+    if major in (BYTES, TEXT):
+        end = offset + argument
+        if end > len(data):
+            raise DecodeError("string runs past the end of the data")
+        value = data[offset:end]
+        return (value.decode() if major == TEXT else bytes(value)), end
+    if major == ARRAY:
+        items = []
+        for _ in range(argument):
+            item, offset = _decode(data, offset)
+            items.append(item)
+        return items, offset
+    if major == MAP:
+        items = {}
+        for _ in range(argument):
+            key, offset = _decode(data, offset)
+            items[key], offset = _decode(data, offset)
+        return items, offset
+    # TAG
+    value, offset = _decode(data, offset)
+    return _TAGS.get(argument, _untagged)(value), offset
+
+
+def _argument(data: bytes, offset: int, info: int) -> Tuple[int, int]:
+    if info < 24:
+        return info, offset
+    if info > 27:
+        raise DecodeError(f"reserved additional information {info}")
+    size = 1 << (info - 24)
+    return int.from_bytes(data[offset:offset + size], "big"), offset + size
+
+
+def _decode_simple(data: bytes, offset: int, info: int) -> Tuple[Any, int]:
+    if info == 20:
+        return False, offset
+    if info == 21:
+        return True, offset
+    if info in (22, 23):
+        return None, offset
+    if info == 25:
+        return _half(data[offset:offset + 2]), offset + 2
+    if info == 26:
+        return struct.unpack_from(">f", data, offset)[0], offset + 4
+    if info == 27:
+        return struct.unpack_from(">d", data, offset)[0], offset + 8
+    raise DecodeError(f"unsupported simple value {info}")
+
+
+def _half(data: bytes) -> float:
+    half = int.from_bytes(data, "big")
+    exponent, mantissa = (half >> 10) & 0x1f, half & 0x3ff
+    if exponent == 0:
+        value = math.ldexp(mantissa, -24)
+    elif exponent == 31:
+        value = math.inf if mantissa == 0 else math.nan
+    else:
+        value = math.ldexp(mantissa + 1024, exponent - 25)
+    return -value if half & 0x8000 else value
+
+
+def _decode_epoch(value: Any) -> datetime.datetime:
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        raise DecodeError("epoch date/time must be a number")
+    try:
+        return EPOCH + datetime.timedelta(seconds=value)
+    except (OverflowError, ValueError):
+        # Too far from the epoch, infinite, or NaN.
+        raise DecodeError("epoch date/time out of range")
+
+
+def _decode_uuid(value: Any) -> uuid.UUID:
+    if not isinstance(value, bytes) or len(value) != 16:
+        raise DecodeError("uuid must be 16 bytes")
+    return uuid.UUID(bytes=value)
+
+
+def _untagged(value: Any) -> Any:
+    return value
+
+
+_TAGS: Dict[int, Callable[[Any], Any]] = {
+    TAG_EPOCH: _decode_epoch,
+    TAG_UUID: _decode_uuid,
+}
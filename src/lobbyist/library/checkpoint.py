@@ -0,0 +1,72 @@
+import os
+import time
+from typing import Optional, Tuple
+
+from . import log
+from .config import config
+from .db import db
+from .metrics import metrics
+
+LOG = log.logger(__name__)
+
+
+class Checkpointer:
+    """
+    Checkpoints the WAL from a background thread.
+
+    A quiet period is a tick interval in which the WAL file was not written.
+    Quiet periods get a TRUNCATE checkpoint, which resets the WAL file to zero
+    bytes but has to wait out readers and writers. While the database is busy
+    only PASSIVE checkpoints are run, and only once the WAL exceeds
+    `passive_bytes`, so that writers are never blocked.
+    """
+
+    def __init__(
+        self,
+        passive_bytes: int = config().db_checkpoint_passive_bytes,
+    ):
+        self.passive_bytes = passive_bytes
+        self._last_wal_mtime_ns: Optional[int] = None
+
+    def tick(self) -> Optional[str]:
+        wal_bytes, wal_mtime_ns = self._wal_stat()
+        metrics().set_gauge("db.wal_bytes", wal_bytes)
+
+        quiet = wal_mtime_ns == self._last_wal_mtime_ns
+        if wal_bytes and quiet:
+            mode = "TRUNCATE"
+        elif wal_bytes >= self.passive_bytes:
+            mode = "PASSIVE"
+        else:
+            mode = None
+
+        if mode:
+            self.checkpoint(mode)
+            wal_bytes, wal_mtime_ns = self._wal_stat()
+            metrics().set_gauge("db.wal_bytes", wal_bytes)
+
+        self._last_wal_mtime_ns = wal_mtime_ns
+        return mode
+
+    def checkpoint(self, mode: str) -> Tuple[int, int, int]:
+        LOG.debug("checkpoint.checkpoint %s", mode)
+
+        start = time.perf_counter()
+        busy, log_frames, checkpointed_frames = db().execute_sql(
+            f"PRAGMA wal_checkpoint({mode})"
+        ).fetchone()
+        metrics().observe(
+            f"db.checkpoint.{mode.lower()}",
+            time.perf_counter() - start,
+        )
+        if busy:
+            metrics().increment(f"db.checkpoint.{mode.lower()}.busy")
+
+        return (busy, log_frames, checkpointed_frames)
+
+    def _wal_stat(self) -> Tuple[int, Optional[int]]:
+        try:
+            stat = os.stat(db().database + "-wal")
+        except OSError:
+            return (0, None)
+        return (stat.st_size, stat.st_mtime_ns)
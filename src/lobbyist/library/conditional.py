@@ -0,0 +1,76 @@
+"""
+Conditional GET support.
+
+Responses that take part implement:
+
+    etag() -> str
+        A weak entity tag for the representation. May query.
+    match(etags: Set[str]) -> Optional[str]
+        The first of the client's tags that is still current, if any. Must be
+        cheap; it runs before, and instead of, building the representation.
+    last_modified() -> Optional[datetime.datetime]
+        Naive UTC, or None when If-Modified-Since cannot be honoured.
+    reading() -> ContextManager
+        What to build the representation within, and hold while it is sent.
+
+The ETag is taken before the representation is built, so that it is never
+newer than the representation it is sent with.
+"""
+
+import datetime
+from typing import Any, Optional
+
+import flask
+
+from . import serialization
+
+
+def into_response(response: Any, status: int) -> flask.Response:
+    etags = flask.request.if_none_match
+    if etags:
+        # If-Modified-Since is ignored whenever If-None-Match is present.
+        etag = response.match(etags.as_set(include_weak=True))
+        if etag:
+            return _not_modified(etag)
+    elif flask.request.if_modified_since:
+        last_modified = _last_modified(response)
+        if last_modified and last_modified <= flask.request.if_modified_since:
+            return _not_modified(response.etag())
+
+    etag = response.etag()
+    http_response = serialization.into_response(
+        response.into_dict(),
+        status,
+        within=response.reading(),
+    )
+    _set_validators(http_response, etag, _last_modified(response))
+    return http_response
+
+
+def _not_modified(etag: str) -> flask.Response:
+    http_response = flask.Response(status=304)
+    _set_validators(http_response, etag, None)
+    return http_response
+
+
+def _set_validators(
+    http_response: flask.Response,
+    etag: str,
+    last_modified: Optional[datetime.datetime],
+) -> None:
+    http_response.set_etag(etag, weak=True)
+    if last_modified:
+        http_response.last_modified = last_modified
+    # The representation depends on who is asking.
+    http_response.vary.add("Authorization")
+
+
+def _last_modified(response: Any) -> Optional[datetime.datetime]:
+    last_modified = response.last_modified()
+    if last_modified is None:
+        return None
+    # HTTP dates have whole-second precision; the ETag is authoritative.
+    return last_modified.replace(
+        microsecond=0,
+        tzinfo=datetime.timezone.utc,
+    )
@@ -27,14 +27,153 @@ class Range:
 
 
 class Config:
+    # The default, and every mimetype responses can be negotiated into.
+    # Request bodies may be sent as form data or, as application/cbor, in a
+    # CBOR map.
     content_mimetype = "application/json"
+    content_mimetypes = ["application/json", "application/cbor"]
     content_encodings = ["identity", "gzip"]
     content_charset = "utf-8"
     content_language = "en-US"
+    stream_chunk_size = 64 * 1024
 
+    # Records are written by a background thread, as JSON lines ("json") or
+    # plain text ("text"). Per-logger levels override log_level, eg:
+    # {"lobbyist.storage": "DEBUG"}. Sample rates are the fraction of debug
+    # and access log records kept.
+    log_level = "INFO"
+    log_levels = {"werkzeug": "WARNING"}
+    log_format = "json"
+    log_debug_sample_rate = 1.0
+    log_access_sample_rate = 1.0
+    log_queue_size = 10000
+
+    # "sqlite", or "memory" to serve entirely from process memory.
+    storage_engine = "sqlite"
+
+    db_path = "testing.db"
     db_retry_count_default = 3
     db_retry_delay_ms_default = 10.0
 
+    # Selected by name, or by the LOBBYIST_DB_PRAGMA_PROFILE environment
+    # variable. Individual pragmas can be overridden with
+    # LOBBYIST_DB_PRAGMA_<NAME> (eg: LOBBYIST_DB_PRAGMA_MMAP_SIZE=0).
+    db_pragma_profile = "throughput"
+    db_pragma_profiles = {
+        "durable": {
+            "page_size": 4096,
+            "synchronous": 2,
+            "mmap_size": 0,
+            "busy_timeout": 10000,
+            "wal_autocheckpoint": 1000,
+            "temp_store": 0,
+        },
+        "balanced": {
+            "page_size": 4096,
+            "synchronous": 1,
+            "mmap_size": 256 * 2**20,
+            "busy_timeout": 5000,
+            "wal_autocheckpoint": 1000,
+            "temp_store": 2,
+        },
+        "throughput": {
+            "page_size": 8192,
+            "synchronous": 0,
+            "mmap_size": 1024 * 2**20,
+            "busy_timeout": 5000,
+            "wal_autocheckpoint": 10000,
+            "temp_store": 2,
+        },
+    }
+    db_pragmas = {
+        # Must precede table creation to take effect on a new file. Existing
+        # files need a one-off VACUUM to switch modes.
+        "auto_vacuum": "incremental",
+        "journal_mode": "wal",
+        "cache_size": -1 * 64000,
+        "foreign_keys": 1,
+        "ignore_check_constraints": 0,
+    }
+
+    # Access and refresh tokens are spread across this many SQLite files
+    # beside db_path, by a hash of their value. 0 keeps them in the primary
+    # database. Existing tokens are moved with the rebalance-shards command.
+    db_token_shards = 0
+
+    # Statements slower than db_slow_query_threshold are logged, with their
+    # parameters redacted. Totals per query are kept for /admin/queries and,
+    # with db_query_headers, responses report their statement count and
+    # time.
+    db_slow_query_threshold = datetime.timedelta(milliseconds=100)
+    db_query_headers = False
+
+    db_checkpoint_interval = datetime.timedelta(seconds=10)
+    db_checkpoint_passive_bytes = 16 * 2**20
+
+    # Online backups (the backup command, and /admin/backup) copy
+    # db_backup_step_pages pages at a time, pausing db_backup_step_pause
+    # between steps, and gzip at db_backup_compress_level if compressed.
+    db_backup_step_pages = 256
+    db_backup_step_pause = datetime.timedelta(milliseconds=5)
+    db_backup_compress_level = 1
+
+    memory_storage_path = "testing.memory"
+    memory_storage_snapshot_interval = datetime.timedelta(minutes=5)
+    memory_storage_fsync = False
+
+    # Token and secret inserts from concurrent requests are queued to one
+    # writer thread, and committed in batches of up to group_commit_max_batch,
+    # waiting at most group_commit_max_wait for a batch to fill.
+    group_commit = False
+    group_commit_max_batch = 64
+    group_commit_max_wait = datetime.timedelta(milliseconds=2)
+    group_commit_report_interval = datetime.timedelta(minutes=1)
+
+    # With --changelog, every write is also appended to a change log split
+    # into segments of about changelog_segment_bytes, and synced before it
+    # commits if changelog_fsync. Followers (--follow) poll the shipped
+    # segments every follower_poll_interval, and apply up to
+    # follower_max_batch changes per transaction.
+    changelog_segment_bytes = 16 * 2**20
+    changelog_fsync = True
+    follower_poll_interval = datetime.timedelta(milliseconds=200)
+    follower_max_batch = 500
+
+    # Co-located services can validate and introspect access tokens over a
+    # Unix socket, speaking library.wire, when wire_socket_path is set.
+    wire_socket_path = None
+    wire_read_bytes = 64 * 1024
+    wire_max_frame_bytes = 2**20
+    wire_max_batch = 1024
+
+    # With --audit, credential events are queued and written by one thread
+    # in batches of up to audit_max_batch, at most audit_flush_interval after
+    # the first was queued. File segments rotate at about audit_segment_bytes
+    # and index every audit_index_interval events.
+    audit_path = None
+    audit_sink = "file"
+    audit_max_batch = 1000
+    audit_flush_interval = datetime.timedelta(milliseconds=200)
+    audit_queue_size = 100000
+    audit_fsync = True
+    audit_segment_bytes = 16 * 2**20
+    audit_index_interval = 256
+
+    # With --admin-token-file, requests bearing the token in that file may
+    # use the /admin endpoints. Profiles sample stacks every
+    # profile_interval, for profile_duration seconds. With
+    # profile_slowest_requests, every request is sampled, and the profiles
+    # of that many of the slowest are kept.
+    admin_token_path = None
+    profile_interval = datetime.timedelta(milliseconds=10)
+    profile_duration = Range(min=1, max=300, default=10)
+    profile_slowest_requests = 0
+
+    reaper_interval = datetime.timedelta(minutes=5)
+    reaper_grace_period = datetime.timedelta(days=1)
+    reaper_batch_size = 500
+    reaper_vacuum_pages = 1024
+
     username_length = Range(4, 64)
     username_valid_characters = set(
         string.ascii_letters + string.digits + "_-."
@@ -42,8 +181,49 @@ class Config:
 
     password_length_min = 8
 
+    public_user_cache_entries = 10000
+    public_user_cache_ttl = datetime.timedelta(minutes=5)
+    public_user_cache_negative_ttl = datetime.timedelta(seconds=5)
+
+    # A user may hold at most secret_quota_per_user valid secrets; creating
+    # more is refused. Issuing an access token beyond
+    # access_token_quota_per_secret valid ones expires the oldest, with their
+    # refresh tokens, in the same transaction. 0 disables either quota; the
+    # access token quota must be disabled for signed tokens, which stay
+    # valid until their own expiry.
+    secret_quota_per_user = 100
+    access_token_quota_per_secret = 100
+
+    # Up to secret_rotation_max of a user's secrets may be rotated in one
+    # request, their replacements hashed on secret_rotation_hash_threads
+    # threads (bcrypt releases the GIL). The old secrets stay valid for the
+    # grace period asked for, within secret_rotation_grace_period. Old and
+    # new secrets both count towards the quota until the old ones expire,
+    # so a rotation with a grace period needs room for its replacements.
+    secret_rotation_max = 500
+    secret_rotation_hash_threads = 4
+    secret_rotation_grace_period = Range(
+        min=datetime.timedelta(0),
+        max=datetime.timedelta(days=7),
+        default=datetime.timedelta(hours=1),
+    )
+
+    # Requests creating users and secrets may carry an Idempotency-Key
+    # header, of idempotency_key_length characters; a retry with the same
+    # key gets the first response back (see library/idempotency.py). Keys
+    # are kept for idempotency_ttl, at most idempotency_max_entries of them,
+    # and expired ones are swept every idempotency_sweep_interval. A retry
+    # waits up to idempotency_wait for the first request to finish.
+    idempotency_key_length = Range(1, 255)
+    idempotency_ttl = datetime.timedelta(hours=1)
+    idempotency_max_entries = 10000
+    idempotency_sweep_interval = datetime.timedelta(minutes=1)
+    idempotency_wait = datetime.timedelta(seconds=30)
+
     secret_name_entropy = 24
-    secret_value_entropy = 128
+    # bcrypt refuses secrets over 72 bytes, where older versions silently
+    # ignored the rest; 48 bytes encode to 64 characters.
+    secret_value_entropy = 48
     secret_bcrypt_cost = 12
 
     access_token_lifetime = Range(
@@ -52,6 +232,17 @@ class Config:
         default=datetime.timedelta(days=1),
     )
     access_token_entropy = 128
+    # Access tokens are opaque and validated by a lookup, or "signed" with
+    # the keys in access_token_keys_path (see library/signing.py) and
+    # validated without one. Signed tokens validate wherever the keys are
+    # set, whichever format is issued. Keys are reread every
+    # access_token_keys_reload_interval, and changes to users and secrets
+    # every access_token_revocation_interval.
+    access_token_format = "opaque"
+    access_token_keys_path = None
+    access_token_keys_reload_interval = datetime.timedelta(seconds=10)
+    access_token_revocation_interval = datetime.timedelta(seconds=1)
+    access_token_revocation_overlap = datetime.timedelta(seconds=30)
 
     refresh_token_lifetime = Range(
         min=datetime.timedelta(hours=1),
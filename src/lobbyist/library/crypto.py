@@ -1,14 +1,23 @@
-import bcrypt
 import secrets
 
 from .config import config
 
+# bcrypt is imported on first use, off the startup path.
+
 
 def hash_secret(secret: str, bcrypt_cost: int = config().secret_bcrypt_cost):
+    import bcrypt
+
     return bcrypt.hashpw(
         secret.encode("utf-8"), bcrypt.gensalt(rounds=bcrypt_cost)
     )
 
 
+def check_secret(secret: str, hash: str) -> bool:
+    import bcrypt
+
+    return bcrypt.checkpw(secret.encode("utf-8"), hash.encode())
+
+
 def make_secret_string(byte_count: int):
     return secrets.token_urlsafe(byte_count)
@@ -1,23 +1,66 @@
-import logging
+import os
 import time
-from typing import Any, Callable
+from typing import Any, Callable, Dict, Optional
 
 import peewee
 
+from . import log
 from .config import config
+from .queries import queries
 
+LOG = log.logger(__name__)
 __SINGLETON: peewee.Database = peewee.DatabaseProxy()
 
 
+class SqliteDatabase(peewee.SqliteDatabase):
+    """Times every statement executed, for library.queries."""
+
+    def execute_sql(self, sql, params=None):
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params)
+        finally:
+            queries().observe(sql, params, time.perf_counter() - start)
+
+
 def db() -> peewee.Database:
     global __SINGLETON
     return __SINGLETON
 
 
-def txn(fn: Callable[[], Any]) -> Any:
-    logging.debug("db.txn")
+def pragmas(profile: Optional[str] = None) -> Dict[str, Any]:
+    profile = profile or os.environ.get(
+        "LOBBYIST_DB_PRAGMA_PROFILE",
+        config().db_pragma_profile,
+    )
+    LOG.debug("db.pragmas %s", profile)
+
+    try:
+        profile_pragmas = config().db_pragma_profiles[profile]
+    except KeyError:
+        raise ValueError(f"unknown pragma profile: {profile}")
+
+    # The page size has to be set before anything (like switching to WAL)
+    # writes the database header.
+    result = {"page_size": profile_pragmas["page_size"]}
+    result.update(config().db_pragmas)
+    result.update(profile_pragmas)
+
+    prefix = "LOBBYIST_DB_PRAGMA_"
+    for key, value in os.environ.items():
+        if key.startswith(prefix) and key != prefix + "PROFILE":
+            result[key[len(prefix):].lower()] = _parse_pragma_value(value)
+
+    return result
 
-    with db().atomic() as _:
+
+def txn(
+    fn: Callable[[], Any],
+    database: Optional[peewee.Database] = None,
+) -> Any:
+    LOG.debug("db.txn")
+
+    with (database or db()).atomic() as _:
         return fn()
 
 
@@ -25,10 +68,18 @@ def retry_txn(
     fn: Callable[[], Any],
     count: int = config().db_retry_count_default,
     delay_ms: float = config().db_retry_delay_ms_default,
+    database: Optional[peewee.Database] = None,
 ) -> Any:
-    logging.debug("db.retry_txn %d %f", count, delay_ms)
+    LOG.debug("db.retry_txn %d %f", count, delay_ms)
 
-    return __retry(fn, 0, count, delay_ms)
+    return __retry(fn, 0, count, delay_ms, database)
+
+
+def _parse_pragma_value(value: str) -> Any:
+    try:
+        return int(value)
+    except ValueError:
+        return value
 
 
 def __should_retry(index: int, count: int, delay_ms: float) -> bool:
@@ -42,11 +93,12 @@ def __retry(
     index: int,
     count: int,
     delay_ms: float,
+    database: Optional[peewee.Database],
 ) -> Any:
     try:
-        return txn(fn)
+        return txn(fn, database)
     except peewee.PeeweeException as error:
-        logging.debug("%s", error)
+        LOG.debug("%s", error)
         if __should_retry(index, count, delay_ms):
-            return __retry(fn, index + 1, count, delay_ms)
+            return __retry(fn, index + 1, count, delay_ms, database)
         raise
@@ -58,3 +58,17 @@ class NotAcceptableError(ClientError):
 class ConflictError(ClientError):
     def __init__(self, **context):
         super().__init__(409, "", "integrity constraint failure", context)
+
+
+class UnprocessableEntityError(ClientError):
+    def __init__(self, description: str, **context):
+        super().__init__(422, "", description, context)
+
+
+class ServerError(HttpError):
+    pass
+
+
+class ServiceUnavailableError(ServerError):
+    def __init__(self, description: str):
+        super().__init__(503, "temporarily_unavailable", description)
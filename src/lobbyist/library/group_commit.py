@@ -0,0 +1,155 @@
+import datetime
+import queue
+import threading
+import time
+from typing import Any, Callable, ContextManager, Dict, List, Optional
+
+from . import log
+from .metrics import metrics
+
+LOG = log.logger(__name__)
+_STOP = object()
+
+
+class _Request:
+    __slots__ = ("fn", "result", "error", "done")
+
+    def __init__(self, fn: Callable[[], Any]):
+        self.fn = fn
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+
+
+class GroupCommit:
+    """
+    Runs writes from many threads on one writer thread, committing them in
+    batches so that concurrent requests share a commit, and its fsync.
+
+    A batch closes once it holds `max_batch` writes or `max_wait` after its
+    first write arrived. Each write runs in its own nested transaction
+    within the batch's, so one failing write only rolls back itself.
+    `submit` returns only once the batch containing the write has
+    committed.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        atomic: Callable[[], ContextManager[Any]],
+        max_batch: int,
+        max_wait: datetime.timedelta,
+    ):
+        self.name = name
+        self.atomic = atomic
+        self.max_batch = max_batch
+        self.max_wait_s = max_wait.total_seconds()
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._requests = 0
+        self._commits = 0
+        self._report = (time.monotonic(), 0, 0)
+
+    def submit(self, fn: Callable[[], Any]) -> Any:
+        if self._thread is None:
+            self.start()
+
+        request = _Request(fn)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def start(self) -> None:
+        LOG.debug("group_commit.start %s", self.name)
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name=self.name,
+                    daemon=True,
+                )
+                self._thread.start()
+
+    def stop(self) -> None:
+        """Commits whatever is queued, then stops the writer."""
+        LOG.debug("group_commit.stop %s", self.name)
+
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+
+    def report(self) -> Dict[str, float]:
+        """Rates since the previous report."""
+        with self._lock:
+            now = time.monotonic()
+            last, last_requests, last_commits = self._report
+            self._report = (now, self._requests, self._commits)
+            requests = self._requests - last_requests
+            commits = self._commits - last_commits
+        elapsed_s = max(now - last, 1e-9)
+        return {
+            "requests_per_s": requests / elapsed_s,
+            "commits_per_s": commits / elapsed_s,
+            "requests_per_commit": requests / commits if commits else 0.0,
+        }
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait_s
+            stopping = False
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is _STOP:
+                    stopping = True
+                    break
+                batch.append(request)
+
+            self._commit(batch)
+            if stopping:
+                return
+
+    def _commit(self, batch: List[_Request]) -> None:
+        start = time.perf_counter()
+        try:
+            with self.atomic():
+                for request in batch:
+                    try:
+                        with self.atomic():
+                            request.result = request.fn()
+                    except Exception as error:
+                        request.error = error
+        except Exception as error:
+            # The commit itself failed, taking every write with it.
+            LOG.exception("group commit %s failed", self.name)
+            for request in batch:
+                request.error = request.error or error
+        finally:
+            for request in batch:
+                request.done.set()
+
+        with self._lock:
+            self._requests += len(batch)
+            self._commits += 1
+        metrics().increment(f"group_commit.{self.name}.requests", len(batch))
+        metrics().increment(f"group_commit.{self.name}.commits")
+        metrics().observe(
+            f"group_commit.{self.name}.commit",
+            time.perf_counter() - start,
+        )
@@ -0,0 +1,210 @@
+"""
+Idempotency keys for requests that create things.
+
+A client may send an `Idempotency-Key` header with a request, and retry it
+with the same key, eg: after a timeout, to get the first response back
+instead of a second user or secret, without hashing or inserting again.
+
+Each key is kept with a fingerprint of its request and, once it succeeds,
+the response, for `idempotency_ttl`. A request reusing a key with a
+different fingerprint is refused with a 422, so guessing another client's
+key does not get its response. A retry that arrives while the first
+request is still running waits for it, for up to `idempotency_wait`; past
+that the key is dropped, so that a first request which never finishes does
+not hold it until it expires, and the retry gets a 409. Error responses are
+not kept: the request did not change anything, and a retry runs again.
+
+The fingerprint is an HMAC, under a key made at startup, of the method,
+path, Accept, Content-Type and Authorization headers, and body, so no
+secret in the request is kept in a form cheaper to guess than its hash.
+
+Keys are kept in memory, not the database: responses carry new secrets,
+which the database otherwise only holds hashed. At most
+`idempotency_max_entries` are kept, the oldest dropped first, and a
+restart forgets them all.
+"""
+
+import collections
+import functools
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+import flask
+
+from . import log, validation
+from .config import config
+from .error import ConflictError, UnprocessableEntityError
+from .metrics import metrics
+
+LOG = log.logger(__name__)
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+_FINGERPRINT_HEADERS = ("Accept", "Content-Type", "Authorization")
+
+# status, headers, body
+Response = Tuple[int, List[Tuple[str, str]], bytes]
+
+
+class _Entry:
+    __slots__ = ("fingerprint", "expire_s", "done", "response")
+
+    def __init__(self, fingerprint: bytes, expire_s: float):
+        self.fingerprint = fingerprint
+        self.expire_s = expire_s
+        self.done = threading.Event()
+        self.response: Optional[Response] = None
+
+
+class Idempotency:
+    def __init__(self):
+        self._key = secrets.token_bytes(32)
+        self._lock = threading.Lock()
+        # In the order added, which with one ttl is the order they expire.
+        self._entries: collections.OrderedDict[str, _Entry] = (
+            collections.OrderedDict()
+        )
+
+    def fingerprint(self, parts: List[bytes]) -> bytes:
+        digest = hmac.new(self._key, digestmod=hashlib.sha256)
+        for part in parts:
+            digest.update(len(part).to_bytes(8, "big"))
+            digest.update(part)
+        return digest.digest()
+
+    def run(
+        self,
+        key: str,
+        fingerprint: bytes,
+        fn: Callable[[], flask.Response],
+    ) -> flask.Response:
+        """The response `fn` gave for `key`, calling it if there is none."""
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry.expire_s <= now:
+                    del self._entries[key]
+                    entry = None
+                if entry is None:
+                    entry = _Entry(
+                        fingerprint,
+                        now + config().idempotency_ttl.total_seconds(),
+                    )
+                    self._entries[key] = entry
+                    limit = config().idempotency_max_entries
+                    while len(self._entries) > limit:
+                        self._entries.popitem(last=False)
+                        metrics().increment("idempotency.evicted")
+                    self._report()
+                    break
+
+            if not hmac.compare_digest(entry.fingerprint, fingerprint):
+                metrics().increment("idempotency.mismatched")
+                raise UnprocessableEntityError(
+                    "idempotency key reused",
+                    headers={
+                        HEADER.lower(): "key was used for a different request"
+                    },
+                )
+            if not entry.done.is_set():
+                metrics().increment("idempotency.waited")
+                wait_s = config().idempotency_wait.total_seconds()
+                if not entry.done.wait(wait_s):
+                    self._drop(key, entry)
+                    metrics().increment("idempotency.timed_out")
+                    raise ConflictError(
+                        headers={
+                            HEADER.lower(): "a request with the key is running"
+                        },
+                    )
+            if entry.response is not None:
+                LOG.debug("idempotency.run replayed")
+                metrics().increment("idempotency.replayed")
+                return _replay(entry.response)
+            # The request failed, and its entry is gone; run it again.
+
+        try:
+            response = fn()
+            if response.status_code < 300:
+                entry.response = (
+                    response.status_code,
+                    list(response.headers.items()),
+                    response.get_data(),
+                )
+            return response
+        finally:
+            if entry.response is None:
+                self._drop(key, entry)
+            entry.done.set()
+
+    def sweep(self) -> int:
+        """Drops expired keys; returns how many."""
+        LOG.debug("idempotency.sweep")
+
+        now = time.monotonic()
+        swept = 0
+        with self._lock:
+            while self._entries:
+                entry = next(iter(self._entries.values()))
+                if entry.expire_s > now:
+                    break
+                self._entries.popitem(last=False)
+                swept += 1
+            self._report()
+        return swept
+
+    def _drop(self, key: str, entry: _Entry) -> None:
+        # Unless the key has moved on to another request already.
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+            self._report()
+
+    def _report(self) -> None:
+        metrics().set_gauge("idempotency.entries", len(self._entries))
+
+
+def _replay(response: Response) -> flask.Response:
+    status, headers, body = response
+    replayed = flask.Response(body, status=status, headers=headers)
+    replayed.headers[REPLAYED_HEADER] = "true"
+    return replayed
+
+
+def idempotent(view: Callable[..., flask.Response]) -> Callable:
+    """Makes a view replay its response to retries with the same key."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs) -> flask.Response:
+        key = validation.optional_header_idempotency_key(HEADER)
+        if key is None:
+            return view(*args, **kwargs)
+
+        request = flask.request
+        parts = [request.method.encode(), request.full_path.encode()]
+        parts.extend(
+            request.headers.get(name, "").encode()
+            for name in _FINGERPRINT_HEADERS
+        )
+        parts.append(request.get_data())
+        return idempotency().run(
+            key,
+            idempotency().fingerprint(parts),
+            lambda: view(*args, **kwargs),
+        )
+
+    return wrapper
+
+
+__SINGLETON = Idempotency()
+
+
+def idempotency() -> Idempotency:
+    global __SINGLETON
+    return __SINGLETON
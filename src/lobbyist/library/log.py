@@ -0,0 +1,180 @@
+"""
+Logging that stays off the request thread.
+
+Modules log through `LOG = log.logger(__name__)`. Records are queued by the
+thread that logs them and formatted and written by a listener thread, as
+JSON lines by default, carrying the id and route of the request they were
+logged under. Levels are set per logger, eg: "lobbyist.storage=DEBUG".
+
+Debug records, and the access log, can be sampled. Sampling is decided in
+`isEnabledFor`, like the level, so a record that is sampled out is never
+built: callers pay one random draw.
+"""
+
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+from typing import Any, Dict, Optional
+
+import flask
+
+from . import serialization
+from .metrics import metrics
+
+ACCESS = "lobbyist.access"
+
+# Attributes every LogRecord has; anything else was passed as `extra`.
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message"}
+
+
+class _Sampling:
+    debug = 1.0
+    access = 1.0
+
+
+_SAMPLING = _Sampling()
+_LOCK = threading.Lock()
+
+
+class SampledLogger(logging.Logger):
+    def isEnabledFor(self, level: int) -> bool:
+        if not super().isEnabledFor(level):
+            return False
+        if level == logging.DEBUG:
+            rate = _SAMPLING.debug
+        elif self.name == ACCESS:
+            rate = _SAMPLING.access
+        else:
+            return True
+        return rate >= 1.0 or random.random() < rate
+
+
+def logger(name: str) -> logging.Logger:
+    with _LOCK:
+        # The logger class is process wide; it only applies to loggers
+        # created while it is set.
+        previous = logging.getLoggerClass()
+        logging.setLoggerClass(SampledLogger)
+        try:
+            return logging.getLogger(name)
+        finally:
+            logging.setLoggerClass(previous)
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamps records with the request they were logged under, if any."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if flask.has_request_context():
+            rule = flask.request.url_rule
+            record.request_id = flask.g.get("request_id", "-")
+            record.route = rule.rule if rule else None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        created = datetime.datetime.utcfromtimestamp(record.created)
+        payload = {
+            "ts": serialization.format_datetime(created),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                payload[key] = value
+        if record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # Leaves formatting to the listener thread, and drops records rather
+    # than block when the listener falls behind.
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Arguments are rendered now, while they still hold their values.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics().increment("log.dropped")
+
+
+_LISTENER: Optional[logging.handlers.QueueListener] = None
+
+
+def configure(
+    level: str,
+    levels: Dict[str, str],
+    format: str,
+    debug_sample_rate: float,
+    access_sample_rate: float,
+    queue_size: int,
+) -> None:
+    """Replaces the root logger's handlers with one queued handler."""
+    global _LISTENER
+
+    stop()
+
+    _SAMPLING.debug = debug_sample_rate
+    _SAMPLING.access = access_sample_rate
+
+    output = logging.StreamHandler(sys.stderr)
+    if format == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(
+            logging.Formatter(
+                "%(asctime)s %(levelname)s %(name)s "
+                "[%(request_id)s] %(message)s",
+                defaults={"request_id": "-"},
+            )
+        )
+
+    handler = _QueueHandler(queue.Queue(queue_size))
+    handler.addFilter(RequestContextFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+    for name, name_level in levels.items():
+        logging.getLogger(name).setLevel(name_level.upper())
+
+    _LISTENER = logging.handlers.QueueListener(handler.queue, output)
+    _LISTENER.start()
+    atexit.register(stop)
+
+
+def stop() -> None:
+    """Writes out whatever is queued."""
+    global _LISTENER
+
+    if _LISTENER is not None:
+        _LISTENER.stop()
+        _LISTENER = None
+
+
+def parse_levels(specs: Any) -> Dict[str, str]:
+    """Parses "logger=LEVEL" strings."""
+    levels = {}
+    for spec in specs:
+        name, _, level = spec.partition("=")
+        if not level or level.upper() not in logging.getLevelNamesMapping():
+            raise ValueError(f"expected logger=LEVEL, got {spec!r}")
+        levels[name] = level
+    return levels
@@ -0,0 +1,199 @@
+"""
+A stack-sampling profiler for request threads.
+
+While anything is listening, one daemon thread wakes every
+`profile_interval`, reads every thread's current frame, and counts each
+stack it finds. Stacks are folded into "collapsed" lines, root first:
+
+    ...;create_user (controllers/user.py);hash_secret (library/crypto.py) 42
+
+which flamegraph.pl, speedscope and inferno read as they are.
+
+Requests announce their thread with `begin_request` and `end_request`;
+a `profile` samples those threads (or every thread) for a while. With
+`capture_slowest`, every request is sampled into a profile of its own, and
+those of the slowest few since are kept, rooted at a frame naming the
+request.
+"""
+
+import collections
+import heapq
+import itertools
+import os
+import sys
+import threading
+import time
+from typing import Counter, Dict, Iterable, List, Optional, Tuple
+
+from . import log
+
+LOG = log.logger(__name__)
+
+
+class _Request:
+    __slots__ = ("request_id", "label", "stacks")
+
+    def __init__(self, request_id: str, label: str):
+        self.request_id = request_id
+        self.label = label
+        self.stacks: Counter[str] = collections.Counter()
+
+
+class _Session:
+    __slots__ = ("all_threads", "stacks")
+
+    def __init__(self, all_threads: bool):
+        self.all_threads = all_threads
+        self.stacks: Counter[str] = collections.Counter()
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.interval_s = 0.01
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        # By thread id. Written without the lock: each request thread only
+        # sets and removes its own entry.
+        self._requests: Dict[int, _Request] = {}
+        self._sessions: List[_Session] = []
+        self._slowest_k = 0
+        self._slowest: List[Tuple[float, int, _Request]] = []
+        self._sequence = itertools.count()
+        self._labels: Dict[object, str] = {}
+
+    def begin_request(self, request_id: str, label: str) -> None:
+        if self.enabled:
+            request = _Request(request_id, label)
+            self._requests[threading.get_ident()] = request
+
+    def ignore_request(self) -> None:
+        """Leaves the current request out of profiles, eg: a profiler's."""
+        self._requests.pop(threading.get_ident(), None)
+
+    def end_request(self, latency_s: float) -> None:
+        if not self.enabled:
+            return
+        request = self._requests.pop(threading.get_ident(), None)
+        if request is None or not self._slowest_k or not request.stacks:
+            return
+        with self._lock:
+            entry = (latency_s, next(self._sequence), request)
+            if len(self._slowest) < self._slowest_k:
+                heapq.heappush(self._slowest, entry)
+            elif latency_s > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def profile(self, duration_s: float, all_threads: bool = False) -> str:
+        """Samples for `duration_s`, and returns the collapsed stacks."""
+        LOG.debug("profiler.profile %s", duration_s)
+
+        session = _Session(all_threads)
+        with self._lock:
+            self._sessions.append(session)
+            self._ensure_running()
+        try:
+            time.sleep(duration_s)
+        finally:
+            with self._lock:
+                self._sessions.remove(session)
+        return _collapse(session.stacks.items())
+
+    def capture_slowest(self, k: int) -> None:
+        """Keeps the profiles of the `k` slowest requests; 0 stops."""
+        LOG.debug("profiler.capture_slowest %d", k)
+
+        with self._lock:
+            self._slowest_k = k
+            self._slowest = heapq.nlargest(k, self._slowest)
+            heapq.heapify(self._slowest)
+            if k:
+                self._ensure_running()
+
+    def slowest(self, reset: bool = False) -> str:
+        """The collapsed stacks of the slowest requests kept."""
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+            if reset:
+                self._slowest = []
+        return _collapse(
+            (
+                f"{request.label} {latency_s * 1e3:.0f}ms "
+                f"{request.request_id};{stack}",
+                count,
+            )
+            for latency_s, _, request in slowest
+            for stack, count in request.stacks.items()
+        )
+
+    def _ensure_running(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run,
+                name="profiler",
+                daemon=True,
+            )
+            self._thread.start()
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while True:
+            with self._lock:
+                sessions = list(self._sessions)
+                if not sessions and not self._slowest_k:
+                    self._thread = None
+                    return
+            names = None
+            if any(session.all_threads for session in sessions):
+                names = {
+                    thread.ident: thread.name
+                    for thread in threading.enumerate()
+                }
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                request = self._requests.get(ident)
+                if request is None and names is None:
+                    continue
+                stack = self._fold(frame)
+                if request is not None:
+                    request.stacks[stack] += 1
+                    for session in sessions:
+                        session.stacks[stack] += 1
+                else:
+                    stack = f"{names.get(ident, ident)};{stack}"
+                    for session in sessions:
+                        if session.all_threads:
+                            session.stacks[stack] += 1
+            time.sleep(self.interval_s)
+
+    def _fold(self, frame) -> str:
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = _label(code)
+            labels.append(label)
+            frame = frame.f_back
+        labels.reverse()
+        return ";".join(labels)
+
+
+def _label(code) -> str:
+    directory, name = os.path.split(code.co_filename)
+    path = f"{os.path.basename(directory)}/{name}" if directory else name
+    # Collapsed stacks separate frames with ";" and counts with " ".
+    return f"{code.co_qualname} ({path})".replace(";", ":")
+
+
+def _collapse(stacks: Iterable[Tuple[str, int]]) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+
+__SINGLETON = Profiler()
+
+
+def profiler() -> Profiler:
+    global __SINGLETON
+    return __SINGLETON
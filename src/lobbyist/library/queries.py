@@ -0,0 +1,140 @@
+"""
+Accounting for the statements `db.SqliteDatabase` executes.
+
+Statements are grouped by their normalized SQL: peewee already binds every
+value as a parameter, so only whitespace and the length of IN (...) lists
+vary between runs of one query. Each group keeps a count and the total and
+longest time taken, for the `top` table.
+
+Statements slower than `db_slow_query_threshold` are logged with their
+parameters reduced to types, and the controller (or, failing that, the
+first code outside peewee and this module) that ran them.
+
+Statements run from a request also count towards the request's
+`db_statements` and `db_time_s`, on `flask.g`.
+
+Times cover executing a statement and stepping to its first row; rows
+read later, while iterating a cursor, are not counted.
+"""
+
+import re
+import sys
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import flask
+
+from . import log
+from .config import config
+
+LOG = log.logger(__name__)
+
+_IN_LIST = re.compile(r"\(\?(?:\s*,\s*\?)+\)")
+_SPACE = re.compile(r"\s+")
+_NORMALIZED_ENTRIES = 4096
+# Frames in these modules are never the caller.
+_INTERNAL = ("peewee", "lobbyist.library.db", __name__)
+
+
+class Query:
+    __slots__ = ("sql", "count", "total_s", "max_s")
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+
+    def into_dict(self) -> Dict[str, Any]:
+        return {
+            "sql": self.sql,
+            "count": self.count,
+            "total_ms": round(self.total_s * 1e3, 3),
+            "mean_ms": round(self.total_s / self.count * 1e3, 3),
+            "max_ms": round(self.max_s * 1e3, 3),
+        }
+
+
+class Queries:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queries: Dict[str, Query] = {}
+        self._normalized: Dict[str, str] = {}
+
+    def observe(
+        self,
+        sql: str,
+        params: Optional[Sequence[Any]],
+        elapsed_s: float,
+    ) -> None:
+        normalized = self._normalized.get(sql)
+        if normalized is None:
+            if len(self._normalized) >= _NORMALIZED_ENTRIES:
+                self._normalized.clear()
+            normalized = self._normalized[sql] = normalize(sql)
+
+        with self._lock:
+            query = self._queries.get(normalized)
+            if query is None:
+                query = self._queries[normalized] = Query(normalized)
+            query.count += 1
+            query.total_s += elapsed_s
+            query.max_s = max(query.max_s, elapsed_s)
+
+        if flask.has_request_context():
+            flask.g.db_statements = flask.g.get("db_statements", 0) + 1
+            flask.g.db_time_s = flask.g.get("db_time_s", 0.0) + elapsed_s
+
+        if elapsed_s >= config().db_slow_query_threshold.total_seconds():
+            LOG.warning(
+                "slow query: %.1fms %s",
+                elapsed_s * 1e3,
+                normalized,
+                extra={
+                    "duration_ms": round(elapsed_s * 1e3, 3),
+                    "sql": normalized,
+                    "params": redact(params),
+                    "caller": caller(),
+                },
+            )
+
+    def top(self, limit: int) -> List[Query]:
+        """The `limit` queries that took the most time in total."""
+        with self._lock:
+            queries = list(self._queries.values())
+        queries.sort(key=lambda query: query.total_s, reverse=True)
+        return queries[:limit]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._queries = {}
+
+
+def normalize(sql: str) -> str:
+    return _IN_LIST.sub("(?, ...)", _SPACE.sub(" ", sql).strip())
+
+
+def redact(params: Optional[Sequence[Any]]) -> List[str]:
+    return [type(param).__name__ for param in params or ()]
+
+
+def caller() -> Optional[str]:
+    """Where the statement being executed was run from."""
+    fallback = None
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module.startswith("lobbyist.controllers."):
+            return f"{module}.{frame.f_code.co_qualname}"
+        if fallback is None and module not in _INTERNAL:
+            fallback = f"{module}.{frame.f_code.co_qualname}"
+        frame = frame.f_back
+    return fallback
+
+
+__SINGLETON = Queries()
+
+
+def queries() -> Queries:
+    global __SINGLETON
+    return __SINGLETON
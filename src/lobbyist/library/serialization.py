@@ -0,0 +1,332 @@
+"""
+JSON and CBOR encoding for responses.
+
+Response `into_dict` results may hold model instances and lazy iterables of
+model instances, not only plain values. Models register a `ModelEncoder`
+whose field list is compiled once into functions that format an instance
+straight to JSON text or CBOR bytes, and `iter_encode` walks a response,
+streaming iterables element by element instead of building the whole payload
+first. `into_response` picks the format from the request's Accept header.
+"""
+
+import datetime
+import itertools
+import json
+import sys
+import uuid
+from json.encoder import encode_basestring_ascii
+from typing import (
+    Any, Callable, ContextManager, Dict, Iterable, Iterator, Optional,
+    Sequence
+)
+
+import flask
+import flask.json.provider
+
+from . import cbor
+from .config import config
+
+JSON = "application/json"
+CBOR = cbor.MIMETYPE
+
+STR = "str"
+INT = "int"
+DATETIME = "datetime"
+UUID = "uuid"
+
+
+def format_datetime(value: datetime.datetime) -> str:
+    # All timestamps are naive UTC.
+    return value.isoformat() + "Z"
+
+
+def format_uuid(value: uuid.UUID) -> str:
+    return str(value)
+
+
+_FORMATTERS = {
+    STR: encode_basestring_ascii,
+    INT: str,
+    DATETIME: lambda value: '"' + format_datetime(value) + '"',
+    UUID: lambda value: '"' + format_uuid(value) + '"',
+}
+
+_CBOR_FORMATTERS = {
+    STR: cbor.encode_text,
+    INT: cbor.encode_int,
+    DATETIME: cbor.encode_datetime,
+    UUID: cbor.encode_uuid,
+}
+
+
+class Field:
+    def __init__(
+        self,
+        key: str,
+        kind: str,
+        path: str = None,
+        omit_none: bool = False,
+    ):
+        self.key = key
+        self.kind = kind
+        self.path = path or key
+        self.omit_none = omit_none
+
+
+class ModelEncoder:
+    """
+    Encodes instances of one model class from a fixed list of fields.
+
+    `path` may be dotted to reach through a foreign key, eg: "secret.name".
+    """
+
+    def __init__(self, *fields: Field):
+        self.fields = fields
+        self.encode = self._compile(fields)
+        self.encode_cbor = self._compile_cbor(fields)
+
+    def into_dict(self, obj: Any) -> Dict[str, Any]:
+        as_dict = {}
+        for field in self.fields:
+            value = obj
+            for name in field.path.split("."):
+                value = getattr(value, name)
+            if value is None and field.omit_none:
+                continue
+            as_dict[field.key] = value
+        return as_dict
+
+    @staticmethod
+    def _compile(fields: Sequence[Field]) -> Callable[[Any], str]:
+        # Generating the function once avoids per-field dispatch and
+        # attribute-name lookups on every encoded row.
+        namespace = {
+            f"_format_{kind}": formatter
+            for kind, formatter in _FORMATTERS.items()
+        }
+        lines = ["def encode(obj):", "    parts = []"]
+        for field in fields:
+            key = encode_basestring_ascii(field.key)
+            formatter = f"_format_{field.kind}"
+            lines.append(f"    value = obj.{field.path}")
+            if field.omit_none:
+                lines.append("    if value is not None:")
+                indent = "        "
+            else:
+                indent = "    "
+            lines.append(
+                f"{indent}parts.append({key!r} + ':' + {formatter}(value))"
+            )
+        lines.append("    return '{' + ','.join(parts) + '}'")
+
+        exec("\n".join(lines), namespace)
+        return namespace["encode"]
+
+    @staticmethod
+    def _compile_cbor(fields: Sequence[Field]) -> Callable[[Any], bytes]:
+        # As _compile, but the map's length is only known once optional
+        # fields have been looked at, so it is prepended last.
+        namespace = {
+            f"_format_{kind}": formatter
+            for kind, formatter in _CBOR_FORMATTERS.items()
+        }
+        namespace["_head"] = cbor.head
+        lines = ["def encode(obj):", "    parts = []"]
+        for field in fields:
+            key = cbor.encode_text(field.key)
+            formatter = f"_format_{field.kind}"
+            lines.append(f"    value = obj.{field.path}")
+            if field.omit_none:
+                lines.append("    if value is not None:")
+                indent = "        "
+            else:
+                indent = "    "
+            lines.append(f"{indent}parts.append({key!r} + {formatter}(value))")
+        lines.append(
+            f"    return _head({cbor.MAP}, len(parts)) + b''.join(parts)"
+        )
+
+        exec("\n".join(lines), namespace)
+        return namespace["encode"]
+
+
+class Encoded:
+    """A value encoded ahead of time in every format, eg: for a cache."""
+
+    __slots__ = ("text", "binary")
+
+    def __init__(self, text: str, binary: bytes):
+        self.text = text
+        self.binary = binary
+
+    def __sizeof__(self) -> int:
+        return (
+            object.__sizeof__(self) + sys.getsizeof(self.text) +
+            sys.getsizeof(self.binary)
+        )
+
+
+_ENCODERS: Dict[type, ModelEncoder] = {}
+
+
+def register(cls: type, *fields: Field) -> ModelEncoder:
+    encoder = _ENCODERS[cls] = ModelEncoder(*fields)
+    return encoder
+
+
+def encoder_for(cls: type) -> ModelEncoder:
+    return _ENCODERS[cls]
+
+
+def iter_encode(value: Any) -> Iterator[str]:
+    encoder = _ENCODERS.get(type(value))
+    if encoder is not None:
+        yield encoder.encode(value)
+    elif isinstance(value, Encoded):
+        yield value.text
+    elif isinstance(value, dict):
+        separator = "{"
+        for key, item in value.items():
+            yield separator + encode_basestring_ascii(key) + ":"
+            yield from iter_encode(item)
+            separator = ","
+        yield "}" if separator == "," else "{}"
+    elif isinstance(value, (str, bytes)) or not isinstance(value, Iterable):
+        yield _encode_scalar(value)
+    else:
+        separator = "["
+        for item in value:
+            yield separator
+            yield from iter_encode(item)
+            separator = ","
+        yield "]" if separator == "," else "[]"
+
+
+def iter_encode_cbor(value: Any) -> Iterator[bytes]:
+    encoder = _ENCODERS.get(type(value))
+    if encoder is not None:
+        yield encoder.encode_cbor(value)
+    elif isinstance(value, Encoded):
+        yield value.binary
+    elif isinstance(value, dict):
+        yield cbor.head(cbor.MAP, len(value))
+        for key, item in value.items():
+            yield cbor.encode_text(key)
+            yield from iter_encode_cbor(item)
+    elif isinstance(value, bytes):
+        yield cbor.encode_text(value.decode())
+    elif isinstance(value, str) or not isinstance(value, Iterable):
+        yield cbor.encode(value)
+    else:
+        yield cbor.INDEFINITE_ARRAY
+        for item in value:
+            yield from iter_encode_cbor(item)
+        yield cbor.BREAK
+
+
+def encode(value: Any) -> str:
+    return "".join(iter_encode(value))
+
+
+def encode_cbor(value: Any) -> bytes:
+    return b"".join(iter_encode_cbor(value))
+
+
+def pre_encode(value: Any) -> Encoded:
+    return Encoded(encode(value), encode_cbor(value))
+
+
+def negotiate() -> str:
+    """The response mimetype that best suits the current request."""
+    return flask.request.accept_mimetypes.best_match(
+        config().content_mimetypes,
+        default=config().content_mimetype,
+    )
+
+
+def into_response(
+    value: Any,
+    status: int,
+    chunk_size: int = config().stream_chunk_size,
+    within: Optional[ContextManager[Any]] = None,
+) -> flask.Response:
+    """
+    Small payloads are sent whole with a Content-Length. Once a payload
+    outgrows `chunk_size` the rest is streamed with chunked encoding, in
+    chunks of at least `chunk_size`.
+
+    `within`, if given, is entered before `value` is encoded, and exited
+    once it has been or the response is closed: eg: the read transaction
+    that lazy iterables in `value` select in.
+    """
+    mimetype = negotiate()
+    if mimetype == CBOR:
+        chunks = _buffer(iter_encode_cbor(value), chunk_size, b"")
+    else:
+        chunks = _buffer(iter_encode(value), chunk_size, "")
+    if within is not None:
+        chunks = _within(within, chunks)
+    first = next(chunks)
+    second = next(chunks, None)
+    if second is None:
+        body = first
+    else:
+        body = itertools.chain((first, second), chunks)
+    response = flask.Response(body, status=status, mimetype=mimetype)
+    response.vary.add("Accept")
+    if within is not None:
+        # A client gone mid-stream leaves `chunks` unfinished.
+        response.call_on_close(chunks.close)
+    return response
+
+
+class JSONProvider(flask.json.provider.DefaultJSONProvider):
+    """Lets `jsonify` and (payload, code) returns use the same formatting."""
+
+    @staticmethod
+    def default(value: Any) -> Any:
+        encoder = _ENCODERS.get(type(value))
+        if encoder is not None:
+            return encoder.into_dict(value)
+        if isinstance(value, Encoded):
+            return json.loads(value.text)
+        if isinstance(value, datetime.datetime):
+            return format_datetime(value)
+        if isinstance(value, uuid.UUID):
+            return format_uuid(value)
+        if isinstance(value, Iterable):
+            return list(value)
+        return flask.json.provider.DefaultJSONProvider.default(value)
+
+
+def _encode_scalar(value: Any) -> str:
+    if isinstance(value, datetime.datetime):
+        return '"' + format_datetime(value) + '"'
+    if isinstance(value, uuid.UUID):
+        return '"' + format_uuid(value) + '"'
+    if isinstance(value, bytes):
+        value = value.decode()
+    return json.dumps(value)
+
+
+def _within(
+    context: ContextManager[Any],
+    chunks: Iterator[Any],
+) -> Iterator[Any]:
+    with context:
+        yield from chunks
+
+
+def _buffer(chunks: Iterator[Any], size: int, empty: Any) -> Iterator[Any]:
+    # Always yields at least one chunk, `empty` if nothing else.
+    buffer = []
+    buffered = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield empty.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer or not buffered:
+        yield empty.join(buffer)
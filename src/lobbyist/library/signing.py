@@ -0,0 +1,335 @@
+"""
+Signed access tokens, which validate without a database lookup.
+
+A signed token is three dot-separated, base64url fields:
+
+    <key id>.<claims>.<tag>
+
+The claims pack the token id, secret id, user id, expiry and generation; the
+tag is a truncated HMAC-SHA256 of the key id and claims under the key named.
+Opaque tokens never contain a dot, so the two formats tell apart; values
+naming no key in the keyring are looked up like opaque ones.
+
+The generation is the token's issue time. A token is revoked by any later
+change to its user or secret, which `Revocations` tracks from their
+modify_ts: expiring, deleting, or changing either invalidates every signed
+token issued from it before the change. That takes effect when the user or
+secret now expires, if it does, and at once otherwise. Users and secrets
+that expire only ever change their expiry, so their tokens stay valid until
+then, as opaque tokens do, eg: through a rotated secret's grace period. The
+expiry is the earliest of the token's, its secret's and its user's, as of
+issue, so that expiries set before then need no revocation. Timestamps are
+the server times of the requests involved, so a change from a request that
+overlaps the one issuing a token may not revoke it.
+
+Keys live in a JSON file, read by `Keyring`:
+
+    {"active": "<key id>", "keys": {"<key id>": "<base64url key>", ...}}
+
+New tokens are signed with the active key; any key in the file verifies.
+Rotating adds a key and makes it active; retiring a key, once the tokens it
+signed have expired, removes it.
+"""
+
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import re
+import secrets
+import struct
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, Optional, Tuple
+
+from . import log
+from .config import config
+
+LOG = log.logger(__name__)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+_NEVER = (datetime.datetime.min, datetime.datetime.min)
+TAG_BYTES = 16
+KEY_BYTES = 32
+
+_CLAIMS = struct.Struct(">16s16s16sqq")
+_KEY_ID = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+
+
+class Claims:
+    __slots__ = ("id", "secret_id", "user_id", "expire_ts", "generation")
+
+    def __init__(
+        self,
+        id: uuid.UUID,
+        secret_id: uuid.UUID,
+        user_id: uuid.UUID,
+        expire_ts: datetime.datetime,
+        generation: datetime.datetime,
+    ):
+        self.id = id
+        self.secret_id = secret_id
+        self.user_id = user_id
+        self.expire_ts = expire_ts
+        self.generation = generation
+
+
+class Keyring:
+    def __init__(self, active: Optional[str], keys: Dict[str, bytes]):
+        self.active = active
+        self.keys = keys
+
+    @staticmethod
+    def load(path: str) -> "Keyring":
+        with open(path) as file:
+            document = json.load(file)
+        keys = {
+            key_id: _b64decode(key)
+            for key_id, key in document.get("keys", {}).items()
+        }
+        active = document.get("active")
+        if active is not None and active not in keys:
+            raise ValueError(f"active key {active!r} is not in {path}")
+        return Keyring(active, keys)
+
+    def save(self, path: str) -> None:
+        document = {
+            "active": self.active,
+            "keys": {
+                key_id: _b64encode(key)
+                for key_id, key in sorted(self.keys.items())
+            },
+        }
+        temporary = path + ".tmp"
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as file:
+            json.dump(document, file, indent=2)
+            file.write("\n")
+        os.replace(temporary, path)
+
+    def rotate(
+        self,
+        key_id: Optional[str] = None,
+        activate: bool = True,
+    ) -> str:
+        """Adds a new key, and by default makes it active. Returns its id."""
+        key_id = key_id or time.strftime("k%Y%m%d%H%M%S", time.gmtime())
+        if not _KEY_ID.match(key_id):
+            raise ValueError(f"invalid key id {key_id!r}")
+        if key_id in self.keys:
+            raise ValueError(f"key {key_id!r} already exists")
+        self.keys[key_id] = secrets.token_bytes(KEY_BYTES)
+        if activate:
+            self.active = key_id
+        return key_id
+
+    def retire(self, key_id: str) -> None:
+        if key_id == self.active:
+            raise ValueError(f"key {key_id!r} is active")
+        if self.keys.pop(key_id, None) is None:
+            raise ValueError(f"no key {key_id!r}")
+
+    def sign(self, claims: Claims) -> str:
+        if self.active is None:
+            raise ValueError("no active signing key")
+        payload = _b64encode(
+            _CLAIMS.pack(
+                claims.id.bytes,
+                claims.secret_id.bytes,
+                claims.user_id.bytes,
+                _epoch_us(claims.expire_ts),
+                _epoch_us(claims.generation),
+            )
+        )
+        signed = f"{self.active}.{payload}"
+        return f"{signed}.{_b64encode(self._tag(self.active, signed))}"
+
+    def signed(self, value: str) -> bool:
+        """Whether the value claims to be signed by one of these keys."""
+        key_id, dot, rest = value.partition(".")
+        return bool(dot) and rest.count(".") == 1 and key_id in self.keys
+
+    def verify(self, value: str) -> Optional[Claims]:
+        """The claims of a token this keyring signed, or None."""
+        # Tokens are ASCII; compare_digest refuses to compare other strings.
+        if not value.isascii():
+            return None
+        parts = value.split(".")
+        if len(parts) != 3 or parts[0] not in self.keys:
+            return None
+        key_id, payload, tag = parts
+        expected = _b64encode(self._tag(key_id, f"{key_id}.{payload}"))
+        if not hmac.compare_digest(tag, expected):
+            return None
+        try:
+            fields = _CLAIMS.unpack(_b64decode(payload))
+        except (ValueError, struct.error):
+            return None
+        id, secret_id, user_id, expire_us, generation_us = fields
+        return Claims(
+            uuid.UUID(bytes=id),
+            uuid.UUID(bytes=secret_id),
+            uuid.UUID(bytes=user_id),
+            EPOCH + datetime.timedelta(microseconds=expire_us),
+            EPOCH + datetime.timedelta(microseconds=generation_us),
+        )
+
+    def _tag(self, key_id: str, signed: str) -> bytes:
+        return hmac.new(
+            self.keys[key_id],
+            signed.encode(),
+            hashlib.sha256,
+        ).digest()[:TAG_BYTES]
+
+
+class Revocations:
+    """
+    When each recently changed user and secret last changed, and when that
+    change takes effect. Entries for changes older than `horizon`, the
+    longest an access token lives, can no longer revoke anything and are
+    dropped.
+    """
+
+    def __init__(self, horizon: datetime.timedelta):
+        self.horizon = horizon
+        self._lock = threading.Lock()
+        # id: (changed, effective)
+        self._changed: Dict[
+            uuid.UUID,
+            Tuple[datetime.datetime, datetime.datetime],
+        ] = {}
+        self._since: Optional[datetime.datetime] = None
+
+    def revoke(
+        self,
+        id: uuid.UUID,
+        ts: datetime.datetime,
+        expire_ts: Optional[datetime.datetime] = None,
+    ) -> None:
+        """
+        Revokes tokens issued from `id` up to `ts`, from `expire_ts` if
+        given, or at once.
+        """
+        with self._lock:
+            if ts > self._changed.get(id, _NEVER)[0]:
+                self._changed[id] = (ts, expire_ts or ts)
+
+    def is_revoked(
+        self,
+        server_ts: datetime.datetime,
+        claims: Claims,
+    ) -> bool:
+        changed = self._changed
+        for id in (claims.user_id, claims.secret_id):
+            entry = changed.get(id)
+            if (
+                entry is not None and entry[0] >= claims.generation and
+                entry[1] <= server_ts
+            ):
+                return True
+        return False
+
+    def since(
+        self,
+        server_ts: datetime.datetime,
+        overlap: datetime.timedelta,
+    ) -> datetime.datetime:
+        """Where the next `refresh` should read from."""
+        with self._lock:
+            if self._since is None:
+                return server_ts - self.horizon
+            # Changes commit a little after their modify_ts, so reads
+            # overlap the last one.
+            return self._since - overlap
+
+    def refresh(
+        self,
+        server_ts: datetime.datetime,
+        changes: Iterable[Tuple[
+            uuid.UUID,
+            datetime.datetime,
+            Optional[datetime.datetime],
+        ]],
+    ) -> None:
+        """
+        Merges changes read from storage, as (id, modify_ts, expire_ts), and
+        forgets old ones.
+        """
+        cutoff = server_ts - self.horizon
+        with self._lock:
+            changed = {
+                id: entry for id, entry in self._changed.items()
+                if entry[0] >= cutoff
+            }
+            for id, ts, expire_ts in changes:
+                if ts >= cutoff and ts > changed.get(id, (cutoff, ))[0]:
+                    changed[id] = (ts, expire_ts or ts)
+            # Replaced rather than mutated, so that readers need no lock.
+            self._changed = changed
+            self._since = server_ts
+
+    def __len__(self) -> int:
+        return len(self._changed)
+
+
+class Signer:
+    """The keys and revocations this process signs and verifies with."""
+
+    def __init__(self):
+        self.path: Optional[str] = None
+        self.keyring: Optional[Keyring] = None
+        self.revocations = Revocations(config().access_token_lifetime.max)
+        self._mtime: Optional[int] = None
+
+    def open(self, path: str) -> None:
+        self.path = path
+        self.reload()
+
+    def reload(self) -> None:
+        """Rereads the key file, if it changed."""
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        keyring = Keyring.load(self.path)
+        self.keyring, self._mtime = keyring, mtime
+        LOG.info(
+            "signing: loaded keys %s, signing with %s",
+            sorted(keyring.keys),
+            keyring.active,
+        )
+
+    def verify(
+        self,
+        server_ts: datetime.datetime,
+        value: str,
+    ) -> Optional[Claims]:
+        """The claims of a valid, unrevoked token, or None."""
+        claims = self.keyring.verify(value)
+        if claims is None or not (
+            claims.generation <= server_ts <= claims.expire_ts
+        ) or self.revocations.is_revoked(server_ts, claims):
+            return None
+        return claims
+
+
+def _epoch_us(ts: datetime.datetime) -> int:
+    return (ts - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+__SINGLETON = Signer()
+
+
+def signer() -> Signer:
+    global __SINGLETON
+    return __SINGLETON
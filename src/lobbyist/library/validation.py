@@ -1,10 +1,11 @@
 import base64
 import binascii
 import datetime
-from typing import Optional, Tuple
+from typing import Any, List, Mapping, Optional, Tuple
 
 import flask
 
+from . import cbor
 from .config import Range, config
 from .error import BadRequestError, NotAcceptableError, UnauthorizedError
 
@@ -13,10 +14,14 @@ def validate_accept() -> None:
     context = {}
 
     if (
-        flask.request.accept_mimetypes and
-        (config().content_mimetype not in flask.request.accept_mimetypes)
+        flask.request.accept_mimetypes and not any(
+            mimetype in flask.request.accept_mimetypes
+            for mimetype in config().content_mimetypes
+        )
     ):
-        context["mimetype"] = f"need mimetype: {config().content_mimetype}"
+        context["mimetype"] = "need one of mimetypes: {}".format(
+            ", ".join(config().content_mimetypes)
+        )
 
     if (
         flask.request.accept_encodings and any(
@@ -68,8 +73,39 @@ def validate_authentication_bearer() -> str:
     return payload
 
 
+def optional_header_idempotency_key(key: str) -> Optional[str]:
+    value = flask.request.headers.get(key)
+    if value is None:
+        return None
+
+    if not config().idempotency_key_length.contains(len(value)):
+        raise BadRequestError(
+            "invalid idempotency key",
+            headers={
+                key.lower():
+                    "key length must be between {}".format(
+                        config().idempotency_key_length
+                    )
+            },
+        )
+
+    if not value.isascii() or not value.isprintable():
+        raise BadRequestError(
+            "invalid idempotency key",
+            headers={key.lower(): "key must be printable ASCII"},
+        )
+
+    return value
+
+
 def required_field_username(key: str) -> str:
-    name = flask.request.form.get(key, "")
+    name = _form().get(key, "")
+
+    if not isinstance(name, str):
+        raise BadRequestError(
+            "invalid username",
+            fields={key: "username must be a string"},
+        )
 
     if not name:
         raise BadRequestError(
@@ -103,7 +139,13 @@ def required_field_username(key: str) -> str:
 
 
 def required_field_secret(key: str) -> str:
-    secret = flask.request.form.get(key, "")
+    secret = _form().get(key, "")
+
+    if not isinstance(secret, str):
+        raise BadRequestError(
+            "invalid secret",
+            fields={key: "secret must be a string"},
+        )
 
     if not secret:
         raise BadRequestError(
@@ -116,14 +158,57 @@ def required_field_secret(key: str) -> str:
     return secret
 
 
+def required_field_secret_names(key: str) -> List[str]:
+    # Repeated form fields, or a CBOR array.
+    form = _form()
+    names = form.getlist(key) if hasattr(form, "getlist") else form.get(key)
+
+    if not names:
+        raise BadRequestError(
+            "missing secret names",
+            fields={key: "must provide at least one secret name"},
+        )
+
+    if not isinstance(names, list) or not all(
+        isinstance(name, str) and name for name in names
+    ):
+        raise BadRequestError(
+            "invalid secret names",
+            fields={key: "secret names must be non-empty strings"},
+        )
+
+    if len(names) > config().secret_rotation_max:
+        raise BadRequestError(
+            "too many secret names",
+            fields={
+                key:
+                    "at most {} secrets may be rotated at once".format(
+                        config().secret_rotation_max
+                    )
+            },
+        )
+
+    if len(set(names)) != len(names):
+        raise BadRequestError(
+            "invalid secret names",
+            fields={key: "secret names must not repeat"},
+        )
+
+    return names
+
+
 def optional_field_expire_ts(key: str) -> Optional[datetime.datetime]:
-    expire_ts = flask.request.form.get(key, "")
-    if not expire_ts:
+    expire_ts = _form().get(key, "")
+    if expire_ts is None or expire_ts == "":
         return None
 
+    # CBOR bodies may send an epoch date/time rather than a number.
+    if isinstance(expire_ts, datetime.datetime):
+        return expire_ts
+
     try:
         expire_ts_s = int(expire_ts)
-    except ValueError:
+    except (TypeError, ValueError, OverflowError):
         raise BadRequestError(
             "invalid expire time",
             fields={
@@ -133,7 +218,7 @@ def optional_field_expire_ts(key: str) -> Optional[datetime.datetime]:
 
     try:
         return datetime.datetime.utcfromtimestamp(expire_ts_s)
-    except (OverflowError, OSError):
+    except (OverflowError, OSError, ValueError):
         raise BadRequestError(
             "invalid expire time",
             fields={
@@ -179,6 +264,82 @@ def optional_field_refresh_token_lifetime(
     return _optional_field_token_lifetime(key, config().refresh_token_lifetime)
 
 
+def optional_field_grace_period(key: str) -> datetime.timedelta:
+    grace_period = _form().get(key)
+    allowed_range = config().secret_rotation_grace_period
+    if grace_period is None or grace_period == "":
+        return allowed_range.default
+
+    try:
+        grace_period_s = int(grace_period)
+    except (TypeError, ValueError, OverflowError):
+        raise BadRequestError(
+            "invalid grace period",
+            fields={
+                key: "grace period must be an integer number of seconds",
+            },
+        )
+
+    grace_period_td = _timedelta(grace_period_s)
+    if grace_period_td is None or not allowed_range.contains(grace_period_td):
+        raise BadRequestError(
+            "invalid grace period",
+            fields={
+                key: f"grace period must be between {allowed_range}",
+            },
+        )
+
+    return grace_period_td
+
+
+def optional_arg_profile_duration(key: str) -> float:
+    duration = flask.request.args.get(key)
+    if duration is None or duration == "":
+        return config().profile_duration.default
+
+    try:
+        duration_s = float(duration)
+    except ValueError:
+        raise BadRequestError(
+            "invalid duration",
+            args={key: "duration must be a number of seconds"},
+        )
+
+    if not config().profile_duration.contains(duration_s):
+        raise BadRequestError(
+            "invalid duration",
+            args={
+                key: f"duration must be between {config().profile_duration}",
+            },
+        )
+
+    return duration_s
+
+
+def _timedelta(seconds: int) -> Optional[datetime.timedelta]:
+    # CBOR integers are unbounded; None past what a timedelta holds.
+    try:
+        return datetime.timedelta(seconds=seconds)
+    except OverflowError:
+        return None
+
+
+def _form() -> Mapping[str, Any]:
+    # Form data, or the fields of a CBOR body, decoded once per request.
+    if flask.request.mimetype != cbor.MIMETYPE:
+        return flask.request.form
+
+    if "cbor_form" not in flask.g:
+        try:
+            form = cbor.decode(flask.request.get_data())
+        except cbor.DecodeError as error:
+            raise BadRequestError("invalid body", body=str(error))
+        if not isinstance(form, dict):
+            raise BadRequestError("invalid body", body="must be a CBOR map")
+        flask.g.cbor_form = form
+    return flask.g.cbor_form
+
+
 def _parse_authorization_header() -> Tuple[str, str]:
     try:
         authorization = flask.request.headers["authorization"]
@@ -208,13 +369,13 @@ def _optional_field_token_lifetime(
     key: str,
     config_lifetime: Range,
 ) -> Optional[datetime.timedelta]:
-    token_lifetime = flask.request.form.get(key)
-    if not token_lifetime:
+    token_lifetime = _form().get(key)
+    if token_lifetime is None or token_lifetime == "":
         return config_lifetime.default
 
     try:
         token_lifetime_s = int(token_lifetime)
-    except ValueError:
+    except (TypeError, ValueError, OverflowError):
         raise BadRequestError(
             "invalid lifetime",
             fields={
@@ -222,8 +383,11 @@ def _optional_field_token_lifetime(
             },
         )
 
-    token_lifetime_td = datetime.timedelta(seconds=token_lifetime_s)
-    if not config_lifetime.contains(token_lifetime_td):
+    token_lifetime_td = _timedelta(token_lifetime_s)
+    if (
+        token_lifetime_td is None or
+        not config_lifetime.contains(token_lifetime_td)
+    ):
         raise BadRequestError(
             "invalid lifetime",
             fields={
@@ -0,0 +1,227 @@
+"""
+A compact binary protocol for validating access tokens over a Unix socket.
+
+Every message is a frame: a 4-byte big-endian payload length, then the
+payload. A request payload is
+
+    u32 request id | u8 op | u16 count | count * (u16 length | token)
+
+and its response payload is
+
+    u32 request id | u8 status | u16 count | count * result
+
+with results in request order. For OP_VALIDATE a result is one byte, 1 if
+the token is valid. For OP_INTROSPECT it is that byte, followed for valid
+tokens by the token id, user id and secret id (16 bytes each), and the
+expiry in microseconds since the epoch (i64).
+
+Clients may pipeline: send any number of requests before reading, and read
+responses in the order the requests were sent.
+"""
+
+import datetime
+import socket
+import struct
+import uuid
+from typing import Any, List, Optional, Sequence, Tuple
+
+OP_VALIDATE = 1
+OP_INTROSPECT = 2
+
+STATUS_OK = 0
+STATUS_BAD_REQUEST = 1
+STATUS_UNAVAILABLE = 2
+
+LENGTH = struct.Struct(">I")
+HEADER = struct.Struct(">IBH")
+TOKEN_LENGTH = struct.Struct(">H")
+INTROSPECTION = struct.Struct(">B16s16s16sq")
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class Introspection:
+    __slots__ = ("id", "user_id", "secret_id", "expire_ts")
+
+    def __init__(
+        self,
+        id: uuid.UUID,
+        user_id: uuid.UUID,
+        secret_id: uuid.UUID,
+        expire_ts: datetime.datetime,
+    ):
+        self.id = id
+        self.user_id = user_id
+        self.secret_id = secret_id
+        self.expire_ts = expire_ts
+
+
+def frame(payload: bytes) -> bytes:
+    return LENGTH.pack(len(payload)) + payload
+
+
+def split_frames(buffer: bytearray, max_bytes: int) -> List[bytes]:
+    """Removes and returns every complete frame at the front of `buffer`."""
+    payloads = []
+    offset = 0
+    while len(buffer) - offset >= LENGTH.size:
+        (length, ) = LENGTH.unpack_from(buffer, offset)
+        if length > max_bytes:
+            raise ProtocolError(f"frame of {length} bytes is too large")
+        end = offset + LENGTH.size + length
+        if len(buffer) < end:
+            break
+        payloads.append(bytes(buffer[offset + LENGTH.size:end]))
+        offset = end
+    del buffer[:offset]
+    return payloads
+
+
+def encode_request(request_id: int, op: int, tokens: Sequence[str]) -> bytes:
+    parts = [HEADER.pack(request_id, op, len(tokens))]
+    for token in tokens:
+        value = token.encode()
+        parts.append(TOKEN_LENGTH.pack(len(value)))
+        parts.append(value)
+    return frame(b"".join(parts))
+
+
+def decode_request(payload: bytes) -> Tuple[int, int, List[str]]:
+    try:
+        request_id, op, count = HEADER.unpack_from(payload)
+        offset = HEADER.size
+        tokens = []
+        for _ in range(count):
+            (length, ) = TOKEN_LENGTH.unpack_from(payload, offset)
+            offset += TOKEN_LENGTH.size
+            tokens.append(payload[offset:offset + length].decode())
+            offset += length
+    except (struct.error, UnicodeDecodeError) as error:
+        raise ProtocolError(str(error))
+    if offset != len(payload):
+        raise ProtocolError("request has trailing bytes")
+    return request_id, op, tokens
+
+
+def encode_response(
+    request_id: int,
+    status: int,
+    results: List[bytes],
+) -> bytes:
+    return frame(
+        HEADER.pack(request_id, status, len(results)) + b"".join(results)
+    )
+
+
+def encode_validation(valid: bool) -> bytes:
+    return b"\x01" if valid else b"\x00"
+
+
+def encode_introspection(introspection: Optional[Any]) -> bytes:
+    """Takes anything with the fields of `Introspection`."""
+    if introspection is None:
+        return b"\x00"
+    return INTROSPECTION.pack(
+        1,
+        introspection.id.bytes,
+        introspection.user_id.bytes,
+        introspection.secret_id.bytes,
+        (introspection.expire_ts - EPOCH) // MICROSECOND,
+    )
+
+
+def decode_response(payload: bytes, op: int) -> Tuple[int, int, List]:
+    request_id, status, count = HEADER.unpack_from(payload)
+    offset = HEADER.size
+    results: List = []
+    for _ in range(count):
+        if op == OP_VALIDATE:
+            results.append(payload[offset] == 1)
+            offset += 1
+        elif payload[offset] == 0:
+            results.append(None)
+            offset += 1
+        else:
+            _, id, user_id, secret_id, expire_us = INTROSPECTION.unpack_from(
+                payload,
+                offset,
+            )
+            results.append(
+                Introspection(
+                    uuid.UUID(bytes=id),
+                    uuid.UUID(bytes=user_id),
+                    uuid.UUID(bytes=secret_id),
+                    EPOCH + expire_us * MICROSECOND,
+                )
+            )
+            offset += INTROSPECTION.size
+    return request_id, status, results
+
+
+class Client:
+    """
+    A blocking client for one connection. Not safe to share between threads;
+    open one per thread.
+    """
+
+    def __init__(self, path: str, max_frame_bytes: int = 2**20):
+        self.max_frame_bytes = max_frame_bytes
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(path)
+        self._buffer = bytearray()
+        self._frames: List[bytes] = []
+        self._next_id = 0
+
+    def close(self) -> None:
+        self._socket.close()
+
+    def __enter__(self) -> "Client":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def validate(self, tokens: Sequence[str]) -> List[bool]:
+        return self.pipeline(OP_VALIDATE, [tokens])[0]
+
+    def introspect(
+        self,
+        tokens: Sequence[str],
+    ) -> List[Optional[Introspection]]:
+        return self.pipeline(OP_INTROSPECT, [tokens])[0]
+
+    def pipeline(self, op: int, batches: Sequence[Sequence[str]]) -> List:
+        """Sends every batch before reading any response."""
+        ids = []
+        requests = []
+        for tokens in batches:
+            self._next_id = (self._next_id + 1) % 2**32
+            ids.append(self._next_id)
+            requests.append(encode_request(self._next_id, op, tokens))
+        self._socket.sendall(b"".join(requests))
+
+        results = []
+        for expected_id in ids:
+            request_id, status, batch = decode_response(self._receive(), op)
+            if request_id != expected_id:
+                raise ProtocolError(
+                    f"expected response {expected_id}, got {request_id}"
+                )
+            if status != STATUS_OK:
+                raise ProtocolError(f"request failed with status {status}")
+            results.append(batch)
+        return results
+
+    def _receive(self) -> bytes:
+        while not self._frames:
+            data = self._socket.recv(65536)
+            if not data:
+                raise ProtocolError("connection closed")
+            self._buffer += data
+            self._frames = split_frames(self._buffer, self.max_frame_bytes)
+        return self._frames.pop(0)
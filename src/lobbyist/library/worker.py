@@ -0,0 +1,49 @@
+import datetime
+import threading
+from typing import Any, Callable, Optional
+
+from . import log
+
+LOG = log.logger(__name__)
+
+
+class PeriodicWorker:
+    """Runs `fn` on a daemon thread every `interval` until stopped."""
+
+    def __init__(
+        self,
+        name: str,
+        interval: datetime.timedelta,
+        fn: Callable[[], Any],
+    ):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        LOG.debug("worker.start %s", self.name)
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name=self.name,
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        LOG.debug("worker.stop %s", self.name)
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval.total_seconds()):
+            try:
+                self.fn()
+            except Exception:
+                LOG.exception("worker %s failed", self.name)
@@ -0,0 +1,23 @@
+import peewee
+
+
+class AuditEvent(peewee.Model):
+    # Lives in its own database, apart from the rows it describes, so that
+    # audit writes never contend with credential writes.
+    id = peewee.AutoField()
+    ts = peewee.DateTimeField()
+    kind = peewee.CharField()
+    user_id = peewee.UUIDField(null=True)
+    name = peewee.CharField(null=True)
+    # Everything else about the event, as JSON.
+    data = peewee.TextField()
+
+    class Meta:
+        # Bound to the audit database when the sink opens it.
+        database = None
+        table_name = "auditevent"
+        indexes = (
+            (("ts", ), False),
+            (("user_id", "ts"), False),
+            (("name", "ts"), False),
+        )
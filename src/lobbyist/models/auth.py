@@ -1,11 +1,15 @@
 import datetime
+import uuid
 from typing import Optional
 
 import peewee
 
 from .base import Base, ExpiryMixin
+from .records import AccessTokenRecord
 from .secret import Secret
 from .user import User
+from ..library import serialization
+from ..library.serialization import DATETIME, STR, Field
 
 
 class AccessToken(Base, ExpiryMixin):
@@ -19,6 +23,8 @@ class AccessToken(Base, ExpiryMixin):
         indexes = (
             (("id", "create_ts", "expire_ts"), False),
             (("value", "create_ts", "expire_ts"), False),
+            (("expire_ts", ), False),
+            (("secret", "create_ts"), False),
         )
 
     @staticmethod
@@ -42,19 +48,61 @@ class AccessToken(Base, ExpiryMixin):
     ) -> Optional["AccessToken"]:
         try:
             return AccessToken._select_by_value(value).where(
-                AccessToken.is_valid(server_ts) & Secret.is_valid(server_ts) &
-                User.is_valid(server_ts)
+                AccessToken.where_valid(server_ts) &
+                Secret.where_valid(server_ts) & User.where_valid(server_ts)
             ).get()
         except peewee.DoesNotExist:
             return None
 
+    @staticmethod
+    def select_valid_record_by_value(
+        server_ts: datetime.datetime,
+        value: str,
+    ) -> Optional[AccessTokenRecord]:
+        row = AccessToken.select(
+            AccessToken.id,
+            AccessToken.expire_ts,
+            AccessToken.secret,
+            Secret.user,
+        ).join(Secret).join(User).where(
+            (AccessToken.value == value) &
+            AccessToken.where_valid(server_ts) &
+            Secret.where_valid(server_ts) & User.where_valid(server_ts)
+        ).tuples().first()
+        return AccessTokenRecord(*row) if row else None
+
+    @staticmethod
+    def select_valid_by_user(
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> peewee.ModelSelect:
+        return AccessToken.select(AccessToken, Secret).join(Secret).where(
+            (Secret.user == user_id) & AccessToken.where_valid(server_ts) &
+            Secret.where_valid(server_ts)
+        )
+
+    @staticmethod
+    def select_valid_ids_by_secret(
+        server_ts: datetime.datetime,
+        secret_id: uuid.UUID,
+    ) -> peewee.ModelSelect:
+        """The ids and create_ts of the secret's valid tokens, newest first."""
+        return AccessToken.select(AccessToken.id, AccessToken.create_ts).where(
+            (AccessToken.secret == secret_id) &
+            AccessToken.where_valid(server_ts)
+        ).order_by(AccessToken.create_ts.desc())
+
     def into_dict(self):
-        return {
-            "value": self.value,
-            "create_ts": self.create_ts,
-            "expire_ts": self.expire_ts,
-            "secret_name": self.secret.name,
-        }
+        return ACCESS_TOKEN_ENCODER.into_dict(self)
+
+
+ACCESS_TOKEN_ENCODER = serialization.register(
+    AccessToken,
+    Field("value", STR),
+    Field("create_ts", DATETIME),
+    Field("expire_ts", DATETIME),
+    Field("secret_name", STR, path="secret.name"),
+)
 
 
 class RefreshToken(Base, ExpiryMixin):
@@ -68,6 +116,7 @@ class RefreshToken(Base, ExpiryMixin):
         indexes = (
             (("id", "create_ts", "expire_ts"), False),
             (("value", "create_ts", "expire_ts"), False),
+            (("expire_ts", ), False),
         )
 
     @staticmethod
@@ -92,17 +141,43 @@ class RefreshToken(Base, ExpiryMixin):
     ) -> Optional["RefreshToken"]:
         try:
             return RefreshToken._select_by_value(value).where(
-                RefreshToken.is_valid(server_ts) &
-                AccessToken.is_valid(server_ts) & Secret.is_valid(server_ts) &
-                User.is_valid(server_ts)
+                RefreshToken.where_valid(server_ts) &
+                AccessToken.where_valid(server_ts) &
+                Secret.where_valid(server_ts) & User.where_valid(server_ts)
             ).get()
         except peewee.DoesNotExist:
             return None
 
+    @staticmethod
+    def select_valid_by_user(
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> peewee.ModelSelect:
+        return RefreshToken.select(RefreshToken, AccessToken).join(
+            AccessToken
+        ).join(Secret).where(
+            (Secret.user == user_id) & RefreshToken.where_valid(server_ts) &
+            AccessToken.where_valid(server_ts) & Secret.where_valid(server_ts)
+        )
+
+    @staticmethod
+    def select_valid_by_access_token(
+        server_ts: datetime.datetime,
+        access_token_id: uuid.UUID,
+    ) -> peewee.ModelSelect:
+        return RefreshToken.select(RefreshToken, AccessToken).join(
+            AccessToken
+        ).where((RefreshToken.access_token == access_token_id) &
+                RefreshToken.where_valid(server_ts))
+
     def into_dict(self):
-        return {
-            "value": self.value,
-            "create_ts": self.create_ts,
-            "expire_ts": self.expire_ts,
-            "access_token_value": self.access_token.value,
-        }
+        return REFRESH_TOKEN_ENCODER.into_dict(self)
+
+
+REFRESH_TOKEN_ENCODER = serialization.register(
+    RefreshToken,
+    Field("value", STR),
+    Field("create_ts", DATETIME),
+    Field("expire_ts", DATETIME),
+    Field("access_token_value", STR, path="access_token.value"),
+)
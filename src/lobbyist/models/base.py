@@ -16,7 +16,7 @@ class ExpiryMixin:
 
     @classmethod
     def where_valid(cls, server_ts: datetime.datetime):
-        return (cls.create_ts <= server_ts <= cls.expire_ts)
+        return ((cls.create_ts <= server_ts) & (server_ts <= cls.expire_ts))
 
 
 class OptionallyExpiryMixin:
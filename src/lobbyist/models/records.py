@@ -0,0 +1,61 @@
+import datetime
+import uuid
+from typing import Optional
+
+
+class UserRecord:
+    __slots__ = (
+        "id",
+        "name",
+        "create_ts",
+        "expire_ts",
+        "version",
+        "modify_ts",
+        "tree_version",
+        "tree_modify_ts",
+    )
+
+    def __init__(
+        self,
+        id: uuid.UUID,
+        name: str,
+        create_ts: datetime.datetime,
+        expire_ts: Optional[datetime.datetime],
+        version: int,
+        modify_ts: Optional[datetime.datetime],
+        tree_version: int,
+        tree_modify_ts: Optional[datetime.datetime],
+    ):
+        self.id = id
+        self.name = name
+        self.create_ts = create_ts
+        self.expire_ts = expire_ts
+        self.version = version
+        self.modify_ts = modify_ts
+        self.tree_version = tree_version
+        self.tree_modify_ts = tree_modify_ts
+
+
+class SecretRecord:
+    __slots__ = ("id", "hash", "user_id")
+
+    def __init__(self, id: uuid.UUID, hash: str, user_id: uuid.UUID):
+        self.id = id
+        self.hash = hash
+        self.user_id = user_id
+
+
+class AccessTokenRecord:
+    __slots__ = ("id", "expire_ts", "secret_id", "user_id")
+
+    def __init__(
+        self,
+        id: uuid.UUID,
+        expire_ts: datetime.datetime,
+        secret_id: uuid.UUID,
+        user_id: uuid.UUID,
+    ):
+        self.id = id
+        self.expire_ts = expire_ts
+        self.secret_id = secret_id
+        self.user_id = user_id
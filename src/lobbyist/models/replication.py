@@ -0,0 +1,13 @@
+import peewee
+
+from .base import Base
+
+
+class ReplicationPosition(Base):
+    # How far a follower has applied its leader's change log. A single row,
+    # written in the same transaction as the changes it covers.
+    id = peewee.IntegerField(primary_key=True)
+    segment = peewee.IntegerField()
+    offset = peewee.IntegerField()
+    lsn = peewee.IntegerField()
+    ts = peewee.CharField(null=True)
@@ -0,0 +1,15 @@
+import peewee
+
+
+class SchemaVersion(peewee.Model):
+    # The migrations applied to a database (see storage/migrations.py), one
+    # row each; the highest version is the database's. The primary and each
+    # token shard keep their own.
+    version = peewee.IntegerField(primary_key=True)
+    name = peewee.CharField()
+    apply_ts = peewee.DateTimeField()
+
+    class Meta:
+        # Only ever queried against a database bound explicitly.
+        database = None
+        table_name = "schemaversion"
@@ -1,10 +1,14 @@
 import datetime
+import uuid
 from typing import Optional
 
 import peewee
 
 from .base import Base, OptionallyExpiryMixin
+from .records import SecretRecord
 from .user import User
+from ..library import serialization
+from ..library.serialization import DATETIME, STR, Field
 
 
 class Secret(Base, OptionallyExpiryMixin):
@@ -14,11 +18,16 @@ class Secret(Base, OptionallyExpiryMixin):
     create_ts = peewee.DateTimeField()
     expire_ts = peewee.DateTimeField(null=True)
     user = peewee.ForeignKeyField(User, backref="secrets")
+    # Bumped whenever the secret row changes; backs the secret view's ETag.
+    version = peewee.IntegerField(default=1)
+    modify_ts = peewee.DateTimeField(null=True)
 
     class Meta:
         indexes = (
             (("id", "create_ts", "expire_ts"), False),
             (("name", "create_ts", "expire_ts"), False),
+            (("modify_ts", ), False),
+            (("expire_ts", ), False),
         )
 
     @staticmethod
@@ -39,19 +48,53 @@ class Secret(Base, OptionallyExpiryMixin):
     ) -> Optional["Secret"]:
         try:
             return Secret._select_by_name(name).where(
-                Secret.is_valid(server_ts) & User.is_valid(server_ts)
+                Secret.where_valid(server_ts) & User.where_valid(server_ts)
             ).get()
         except peewee.DoesNotExist:
             return None
 
+    @staticmethod
+    def select_valid_record_by_name(
+        server_ts: datetime.datetime,
+        name: str,
+    ) -> Optional[SecretRecord]:
+        row = Secret.select(
+            Secret.id,
+            Secret.hash,
+            Secret.user,
+        ).join(User).where(
+            (Secret.name == name) & Secret.where_valid(server_ts) &
+            User.where_valid(server_ts)
+        ).tuples().first()
+        return SecretRecord(*row) if row else None
+
+    @staticmethod
+    def touch(secret_id: uuid.UUID, server_ts: datetime.datetime) -> None:
+        Secret.update(
+            version=Secret.version + 1,
+            modify_ts=server_ts,
+        ).where(Secret.id == secret_id).execute()
+
+    @staticmethod
+    def select_valid_by_user(
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> peewee.ModelSelect:
+        return Secret.select(Secret, User).join(User).where(
+            (Secret.user == user_id) & Secret.where_valid(server_ts)
+        )
+
     def into_dict(self, value: Optional[str] = None):
-        as_dict = {
-            "name": self.name,
-            "create_ts": self.create_ts,
-            "user_name": self.user.name,
-        }
-        if self.expire_ts is not None:
-            as_dict["expire_ts"] = self.expire_ts
+        as_dict = SECRET_ENCODER.into_dict(self)
         if value is not None:
             as_dict["value"] = value
         return as_dict
+
+
+SECRET_ENCODER = serialization.register(
+    Secret,
+    Field("name", STR),
+    Field("create_ts", DATETIME),
+    Field("user_name", STR, path="user.name"),
+    Field("expire_ts", DATETIME, omit_none=True),
+)
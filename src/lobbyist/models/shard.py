@@ -0,0 +1,14 @@
+import peewee
+
+
+class TreeVersion(peewee.Model):
+    # Tree version bumps made by token writes to one token shard. A user's
+    # tree version is the primary's plus the sum over every shard, so that
+    # issuing a token never writes to the primary database.
+    user = peewee.UUIDField(primary_key=True)
+    version = peewee.IntegerField()
+
+    class Meta:
+        # Only ever queried against a shard database, explicitly.
+        database = None
+        table_name = "treeversion"
@@ -1,8 +1,13 @@
+import datetime
+import uuid
 from typing import Optional
 
 import peewee
 
 from .base import Base, OptionallyExpiryMixin
+from .records import UserRecord
+from ..library import serialization
+from ..library.serialization import DATETIME, STR, UUID, Field
 
 
 class User(Base, OptionallyExpiryMixin):
@@ -10,11 +15,20 @@ class User(Base, OptionallyExpiryMixin):
     name = peewee.CharField(max_length=255, unique=True)
     create_ts = peewee.DateTimeField()
     expire_ts = peewee.DateTimeField(null=True)
+    # Bumped whenever the user row changes; backs the public view's ETag.
+    version = peewee.IntegerField(default=1)
+    modify_ts = peewee.DateTimeField(null=True)
+    # Bumped whenever the user or anything owned by it changes; backs the
+    # private view's ETag.
+    tree_version = peewee.IntegerField(default=1)
+    tree_modify_ts = peewee.DateTimeField(null=True)
 
     class Meta:
         indexes = (
             (("id", "create_ts", "expire_ts"), False),
             (("name", "create_ts", "expire_ts"), False),
+            (("modify_ts", ), False),
+            (("expire_ts", ), False),
         )
 
     @staticmethod
@@ -24,12 +38,45 @@ class User(Base, OptionallyExpiryMixin):
         except peewee.DoesNotExist:
             return None
 
+    @staticmethod
+    def select_record_by_name(name: str) -> Optional[UserRecord]:
+        row = User.select(
+            *(getattr(User, name) for name in UserRecord.__slots__)
+        ).where(User.name == name).tuples().first()
+        return UserRecord(*row) if row else None
+
+    @staticmethod
+    def from_record(record: UserRecord) -> "User":
+        # Builds the model without a query, for callers that go on to walk
+        # backrefs or save changes.
+        return User(
+            **{name: getattr(record, name) for name in UserRecord.__slots__}
+        )
+
+    @staticmethod
+    def touch(user_id: uuid.UUID, server_ts: datetime.datetime) -> None:
+        User.update(
+            version=User.version + 1,
+            modify_ts=server_ts,
+            tree_version=User.tree_version + 1,
+            tree_modify_ts=server_ts,
+        ).where(User.id == user_id).execute()
+
+    @staticmethod
+    def touch_tree(user_id: uuid.UUID, server_ts: datetime.datetime) -> None:
+        User.update(
+            tree_version=User.tree_version + 1,
+            tree_modify_ts=server_ts,
+        ).where(User.id == user_id).execute()
+
     def into_dict(self):
-        as_dict = {
-            "id": self.id,
-            "name": self.name,
-            "create_ts": self.create_ts,
-        }
-        if self.expire_ts is not None:
-            as_dict["expire_ts"] = self.expire_ts
-        return as_dict
+        return USER_ENCODER.into_dict(self)
+
+
+USER_ENCODER = serialization.register(
+    User,
+    Field("id", UUID),
+    Field("name", STR),
+    Field("create_ts", DATETIME),
+    Field("expire_ts", DATETIME, omit_none=True),
+)
@@ -0,0 +1,371 @@
+"""
+Where audit events (see library/audit.py) are written, and how they are
+read back.
+
+`FileSink` appends events, as lines of JSON, to rotating segments:
+
+    <path>/audit.<index>
+    <path>/audit.<index>.idx
+
+Events are indexed in blocks of `index_interval`. Each line of a segment's
+index covers one block: its byte range, its time range, and the users it
+mentions. A query reads the indexes, then only the blocks that can match,
+and whatever follows the last indexed block. Blocks carry a time range
+rather than a start time because events arrive in roughly, not strictly,
+time order: each carries the time its request started.
+
+`SqliteSink` inserts events into a separate SQLite database instead,
+indexed by time and by user.
+"""
+
+import datetime
+import json
+import os
+import re
+import uuid
+from typing import (
+    Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+)
+
+import peewee
+
+from ..library import log
+from ..library.config import config
+from ..models.audit import AuditEvent
+
+LOG = log.logger(__name__)
+_SEGMENT_PATTERN = re.compile(r"^audit\.(\d+)$")
+
+Event = Dict[str, Any]
+
+
+class _Block:
+    __slots__ = ("offset", "end", "count", "min_ts", "max_ts", "users")
+
+    def __init__(self, offset: int):
+        self.offset = offset
+        self.end = offset
+        self.count = 0
+        self.min_ts: Optional[str] = None
+        self.max_ts: Optional[str] = None
+        self.users: Set[str] = set()
+
+    def add(self, event: Event, end: int) -> None:
+        ts = event["ts"]
+        if self.min_ts is None or ts < self.min_ts:
+            self.min_ts = ts
+        if self.max_ts is None or ts > self.max_ts:
+            self.max_ts = ts
+        for key in ("user_id", "name"):
+            if event.get(key) is not None:
+                self.users.add(event[key])
+        self.count += 1
+        self.end = end
+
+    def into_line(self) -> bytes:
+        return _dump({
+            "offset": self.offset,
+            "end": self.end,
+            "count": self.count,
+            "min_ts": self.min_ts,
+            "max_ts": self.max_ts,
+            "users": sorted(self.users),
+        })
+
+
+class FileSink:
+    def __init__(
+        self,
+        path: str,
+        segment_bytes: int,
+        index_interval: int,
+        fsync: bool,
+    ):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.fsync = fsync
+        os.makedirs(path, exist_ok=True)
+
+        segments = list_segments(path)
+        self.segment = segments[-1] if segments else 0
+        self._open()
+
+    def write(self, events: Sequence[Event]) -> None:
+        lines = []
+        index_lines = []
+        for event in events:
+            stored = _stored(event)
+            line = _dump(stored)
+            lines.append(line)
+            self._size += len(line)
+            self._block.add(stored, self._size)
+            if self._block.count >= self.index_interval:
+                index_lines.append(self._block.into_line())
+                self._block = _Block(self._size)
+
+        # Data first, so that the index never covers bytes a crash lost.
+        self._append(self._data, lines)
+        if index_lines:
+            self._append(self._index, index_lines)
+
+        if self._size >= self.segment_bytes:
+            self._close_segment()
+            self.segment += 1
+            self._open()
+
+    def close(self) -> None:
+        self._close_segment()
+
+    def _open(self) -> None:
+        data_path = segment_path(self.path, self.segment)
+        index_path = data_path + ".idx"
+
+        # Drops a line torn by a crash mid-write, and any index lines that
+        # cover it.
+        self._size = _truncate_torn(data_path)
+        blocks, index_size = _read_index(index_path, self._size)
+        if os.path.exists(index_path):
+            os.truncate(index_path, index_size)
+
+        self._data = open(data_path, "ab")
+        self._index = open(index_path, "ab")
+
+        # Events after the last indexed block start the next one.
+        block = self._block = _Block(blocks[-1]["end"] if blocks else 0)
+        with open(data_path, "rb") as data:
+            data.seek(block.offset)
+            for line in data:
+                block.add(json.loads(line), block.end + len(line))
+
+    def _close_segment(self) -> None:
+        if self._block.count:
+            self._append(self._index, [self._block.into_line()])
+            self._block = _Block(self._size)
+        self._data.close()
+        self._index.close()
+
+    def _append(self, file: Any, lines: List[bytes]) -> None:
+        file.write(b"".join(lines))
+        file.flush()
+        if self.fsync:
+            os.fsync(file.fileno())
+
+
+def read_file_events(
+    path: str,
+    user: Optional[str] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    kinds: Optional[Set[str]] = None,
+) -> Iterator[Event]:
+    """
+    Events matching every filter given, in the order they were written.
+    `user` matches either a user id or a name.
+    """
+    LOG.debug("storage.audit.read_file_events")
+
+    since_ts = _format_ts(since) if since else None
+    until_ts = _format_ts(until) if until else None
+
+    for segment in list_segments(path):
+        data_path = segment_path(path, segment)
+        blocks, _ = _read_index(
+            data_path + ".idx",
+            os.path.getsize(data_path),
+        )
+
+        ranges = [
+            (block["offset"], block["end"])
+            for block in blocks
+            if (since_ts is None or block["max_ts"] >= since_ts) and
+            (until_ts is None or block["min_ts"] <= until_ts) and
+            (user is None or user in block["users"])
+        ]
+        ranges.append((blocks[-1]["end"] if blocks else 0, None))
+
+        with open(data_path, "rb") as data:
+            for start, end in ranges:
+                data.seek(start)
+                chunk = data.read(-1 if end is None else end - start)
+                for line in chunk.splitlines(keepends=True):
+                    if not line.endswith(b"\n"):
+                        break
+                    event = json.loads(line)
+                    if _matches(event, user, since_ts, until_ts, kinds):
+                        yield event
+
+
+class SqliteSink:
+    def __init__(self, path: str, fsync: bool):
+        self.database = _open_database(path, fsync)
+        self.database.create_tables([AuditEvent])
+
+    def write(self, events: Sequence[Event]) -> None:
+        rows = [_row(event) for event in events]
+        with self.database.atomic():
+            for chunk in peewee.chunked(rows, 100):
+                AuditEvent.insert_many(chunk).execute()
+
+    def close(self) -> None:
+        self.database.close()
+
+
+def read_sqlite_events(
+    path: str,
+    user: Optional[str] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    kinds: Optional[Set[str]] = None,
+) -> Iterator[Event]:
+    """As `read_file_events`, in time order."""
+    LOG.debug("storage.audit.read_sqlite_events")
+
+    _open_database(path, fsync=False)
+    query = AuditEvent.select().order_by(AuditEvent.ts, AuditEvent.id)
+    if user is not None:
+        where = AuditEvent.name == user
+        try:
+            where |= AuditEvent.user_id == uuid.UUID(user)
+        except ValueError:
+            pass
+        query = query.where(where)
+    if since is not None:
+        query = query.where(AuditEvent.ts >= since)
+    if until is not None:
+        query = query.where(AuditEvent.ts <= until)
+    if kinds:
+        query = query.where(AuditEvent.kind.in_(list(kinds)))
+
+    for row in query.iterator():
+        event = {
+            "ts": _format_ts(row.ts),
+            "kind": row.kind,
+            "user_id": str(row.user_id) if row.user_id else None,
+            "name": row.name,
+        }
+        event.update(json.loads(row.data))
+        yield event
+
+
+def open_sink(kind: str, path: str) -> Any:
+    if kind == "sqlite":
+        return SqliteSink(path, config().audit_fsync)
+    return FileSink(
+        path,
+        config().audit_segment_bytes,
+        config().audit_index_interval,
+        config().audit_fsync,
+    )
+
+
+def read_events(kind: str, path: str, **filters: Any) -> Iterator[Event]:
+    if kind == "sqlite":
+        return read_sqlite_events(path, **filters)
+    return read_file_events(path, **filters)
+
+
+def segment_path(path: str, segment: int) -> str:
+    return os.path.join(path, f"audit.{segment:08d}")
+
+
+def list_segments(path: str) -> List[int]:
+    if not os.path.isdir(path):
+        return []
+    return sorted(
+        int(match[1])
+        for match in map(_SEGMENT_PATTERN.match, os.listdir(path))
+        if match
+    )
+
+
+def _open_database(path: str, fsync: bool) -> peewee.Database:
+    database = peewee.SqliteDatabase(
+        path,
+        pragmas={
+            "journal_mode": "wal",
+            "synchronous": "full" if fsync else "normal",
+        },
+    )
+    # Only the audit writer, or the query command, uses the model.
+    AuditEvent.bind(database, bind_refs=False, bind_backrefs=False)
+    return database
+
+
+def _truncate_torn(path: str) -> int:
+    good = 0
+    if os.path.exists(path):
+        with open(path, "rb") as data:
+            for line in data:
+                if not line.endswith(b"\n"):
+                    break
+                good += len(line)
+        os.truncate(path, good)
+    return good
+
+
+def _read_index(
+    path: str,
+    data_size: int,
+) -> Tuple[List[Dict[str, Any]], int]:
+    # The blocks within the first `data_size` bytes of the segment, and the
+    # length of the index lines that describe them.
+    blocks = []
+    size = 0
+    if os.path.exists(path):
+        with open(path, "rb") as index:
+            for line in index:
+                if not line.endswith(b"\n"):
+                    break
+                block = json.loads(line)
+                if block["end"] > data_size:
+                    break
+                blocks.append(block)
+                size += len(line)
+    return blocks, size
+
+
+def _matches(
+    event: Event,
+    user: Optional[str],
+    since_ts: Optional[str],
+    until_ts: Optional[str],
+    kinds: Optional[Set[str]],
+) -> bool:
+    return ((user is None or user in (event["user_id"], event["name"])) and
+            (since_ts is None or event["ts"] >= since_ts) and
+            (until_ts is None or event["ts"] <= until_ts) and
+            (not kinds or event["kind"] in kinds))
+
+
+def _row(event: Event) -> Dict[str, Any]:
+    data = {
+        key: value
+        for key, value in _stored(event).items()
+        if key not in ("ts", "kind", "user_id", "name")
+    }
+    return {
+        "ts": event["ts"],
+        "kind": event["kind"],
+        "user_id": event["user_id"],
+        "name": event["name"],
+        "data": json.dumps(data, separators=(",", ":")),
+    }
+
+
+def _stored(event: Event) -> Event:
+    # Timestamps are written at a fixed precision so that they compare as
+    # strings.
+    return {
+        key: _format_ts(value) if isinstance(value, datetime.datetime) else
+        str(value) if isinstance(value, uuid.UUID) else value
+        for key, value in event.items()
+    }
+
+
+def _format_ts(value: datetime.datetime) -> str:
+    return value.isoformat(timespec="microseconds")
+
+
+def _dump(value: Any) -> bytes:
+    return (json.dumps(value, separators=(",", ":")) + "\n").encode()
@@ -0,0 +1,239 @@
+"""
+Online backups of the SQLite storage, and restoring them.
+
+`snapshot` copies the primary database, and each token shard beside it,
+with SQLite's online backup API: `pages` pages per step, pausing `pause`
+between steps so that requests get the disk and the GIL. Each copy holds a
+read transaction on its source throughout. In WAL mode that blocks no
+writer, and it pins one snapshot, so writes made meanwhile neither restart
+the copy (as they would between unpinned steps) nor end up in it. The WAL
+cannot be checkpointed past that snapshot until the copy is done, so it
+grows meanwhile.
+
+Files are copied one after another, each consistent in itself. As after a
+crash, a shard may hold tokens the primary's copy has no secret for; they
+are unreachable, and reaped when they expire.
+
+`iter_archive` streams the copies as a tar archive, gzipped if asked, with
+the primary as "primary" and shards as "tokens.<index>-of-<n>".
+
+`restore` unpacks one beside the database it replaces, runs PRAGMA
+integrity_check on every file, and checks their schema versions are ones
+this build knows, before moving them into place. Nothing may have the
+database open meanwhile.
+"""
+
+import datetime
+import os
+import re
+import shutil
+import sqlite3
+import tarfile
+import time
+import zlib
+from typing import BinaryIO, Iterator, List, Tuple
+
+import peewee
+
+from . import migrations, sharded
+from ..library import log
+
+LOG = log.logger(__name__)
+
+PRIMARY = "primary"
+_SHARD = re.compile(r"tokens\.(\d+)-of-(\d+)")
+_RESTORING = ".restoring"
+
+
+def snapshot(
+    path: str,
+    directory: str,
+    pages: int,
+    pause: datetime.timedelta,
+) -> List[Tuple[str, str]]:
+    """Copies the storage at `path` into `directory`; (name, path) each."""
+    LOG.debug("storage.backup.snapshot %s", path)
+
+    if not os.path.exists(path):
+        raise ValueError(f"no database at {path}")
+    counts = sharded.shard_counts(path)
+    if len(counts) > 1:
+        raise ValueError(f"found more than one layout: {sorted(counts)}")
+    count = counts.pop() if counts else 0
+
+    sources = [(PRIMARY, path)] + [
+        (f"tokens.{index}-of-{count}", shard_path)
+        for index, shard_path in enumerate(sharded.shard_paths(path, count))
+    ]
+    copies = []
+    for name, source_path in sources:
+        copy_path = os.path.join(directory, name)
+        copy_database(source_path, copy_path, pages, pause)
+        copies.append((name, copy_path))
+    return copies
+
+
+def copy_database(
+    source_path: str,
+    target_path: str,
+    pages: int,
+    pause: datetime.timedelta,
+) -> None:
+    LOG.debug("storage.backup.copy_database %s", source_path)
+
+    pause_s = pause.total_seconds()
+
+    def progress(status: int, remaining: int, total: int) -> None:
+        if remaining and pause_s:
+            time.sleep(pause_s)
+
+    start = time.perf_counter()
+    source = sqlite3.connect(source_path, isolation_level=None)
+    target = sqlite3.connect(target_path, isolation_level=None)
+    try:
+        source.execute("BEGIN")
+        source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+        source.backup(target, pages=pages, progress=progress)
+        source.execute("COMMIT")
+    finally:
+        target.close()
+        source.close()
+    LOG.info(
+        "backed up %s: %d bytes in %.1fs",
+        source_path,
+        os.path.getsize(target_path),
+        time.perf_counter() - start,
+    )
+
+
+def iter_archive(
+    files: List[Tuple[str, str]],
+    compress_level: int,
+    chunk_size: int,
+) -> Iterator[bytes]:
+    """A tar archive of `files`, gzipped unless `compress_level` is 0."""
+    compressor = None
+    if compress_level:
+        # wbits=31 writes a gzip header and trailer.
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 31)
+
+    def emit(data: bytes) -> bytes:
+        return compressor.compress(data) if compressor else data
+
+    for name, path in files:
+        info = tarfile.TarInfo(name)
+        info.size = os.path.getsize(path)
+        info.mtime = int(time.time())
+        info.mode = 0o600
+        yield emit(info.tobuf(format=tarfile.PAX_FORMAT))
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(chunk_size), b""):
+                yield emit(chunk)
+        yield emit(tarfile.NUL * (-info.size % tarfile.BLOCKSIZE))
+    yield emit(tarfile.NUL * 2 * tarfile.BLOCKSIZE)
+    if compressor:
+        yield compressor.flush()
+
+
+def restore(stream: BinaryIO, path: str) -> List[str]:
+    """
+    Replaces the storage at `path` with the archive read from `stream`,
+    which may be gzipped. Returns the names restored. Raises ValueError,
+    leaving the storage as it was, if the archive is not a whole, intact
+    backup.
+    """
+    LOG.debug("storage.backup.restore %s", path)
+
+    restored = {}
+    try:
+        try:
+            with tarfile.open(fileobj=stream, mode="r|*") as archive:
+                for member in archive:
+                    target = _target(path, member)
+                    if member.name in restored:
+                        raise ValueError(f"{member.name} appears twice")
+                    restored[member.name] = target
+                    with archive.extractfile(member) as source, open(
+                        target + _RESTORING,
+                        "wb",
+                    ) as file:
+                        shutil.copyfileobj(source, file)
+        except tarfile.TarError as error:
+            raise ValueError(f"not a backup archive: {error}")
+        count = _check_layout(restored)
+        for name, target in restored.items():
+            _verify(name, target + _RESTORING)
+    except BaseException:
+        for target in restored.values():
+            _remove(target + _RESTORING)
+        raise
+
+    # The old files' WALs would be applied to the new ones; they go first.
+    for old_count in sharded.shard_counts(path):
+        for shard_path in sharded.shard_paths(path, old_count):
+            _remove_database(shard_path)
+    _remove_database(path)
+    for target in sharded.shard_paths(path, count) + [path]:
+        os.replace(target + _RESTORING, target)
+    return sorted(restored)
+
+
+def _target(path: str, member: tarfile.TarInfo) -> str:
+    if not member.isfile():
+        raise ValueError(f"unexpected entry in archive: {member.name}")
+    if member.name == PRIMARY:
+        return path
+    match = _SHARD.fullmatch(member.name)
+    if match is None or int(match[1]) >= int(match[2]):
+        raise ValueError(f"unexpected entry in archive: {member.name}")
+    return sharded.shard_paths(path, int(match[2]))[int(match[1])]
+
+
+def _check_layout(restored) -> int:
+    if PRIMARY not in restored:
+        raise ValueError("archive holds no primary database")
+    counts = {
+        int(_SHARD.fullmatch(name)[2]) for name in restored if name != PRIMARY
+    }
+    count = counts.pop() if counts else 0
+    if counts or len(restored) != count + 1:
+        raise ValueError("archive does not hold one whole shard layout")
+    return count
+
+
+def _verify(name: str, path: str) -> None:
+    database = peewee.SqliteDatabase(path)
+    try:
+        result = database.execute_sql("PRAGMA integrity_check").fetchall()
+        if result != [("ok",)]:
+            raise ValueError(
+                f"{name} failed its integrity check: "
+                + "; ".join(row[0] for row in result)
+            )
+        known = len(
+            migrations.MIGRATIONS if name == PRIMARY
+            else sharded.SHARD_MIGRATIONS
+        )
+        version = migrations.version(database)
+        if version > known:
+            raise ValueError(
+                f"{name} is at schema version {version}, newer than this "
+                f"build's {known}"
+            )
+    # Rows are fetched outside peewee, which then does not wrap errors.
+    except (peewee.DatabaseError, sqlite3.DatabaseError) as error:
+        raise ValueError(f"{name} is not an intact database: {error}")
+    finally:
+        database.close()
+
+
+def _remove_database(path: str) -> None:
+    for suffix in ("", "-wal", "-shm"):
+        _remove(path + suffix)
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,302 @@
+"""
+The storage interface beneath the controllers.
+
+Engines hand out model instances as plain values: callers read their fields
+and pass them back to the engine, but never save them, walk backrefs, or
+otherwise reach the database through them. Validity lookups return the
+projected records from `models.records`.
+
+Engines maintain the version counters behind conditional GETs themselves:
+creating or updating anything owned by a user bumps that user's tree
+version, and updating a user or secret bumps its own version.
+"""
+
+import datetime
+import functools
+import threading
+import uuid
+from typing import (
+    Any, Callable, ContextManager, Dict, Iterable, List, Optional, Tuple
+)
+
+from ..models.auth import AccessToken, RefreshToken
+from ..models.records import AccessTokenRecord, SecretRecord
+from ..models.secret import Secret
+from ..models.user import User
+
+# Unset keyword arguments to the update methods leave the field unchanged.
+UNSET: Any = object()
+
+# Evicted tokens expire this long before the eviction, so that they are no
+# longer valid at its server time.
+EVICTION_OFFSET = datetime.timedelta(microseconds=1)
+
+
+class IntegrityError(Exception):
+    pass
+
+
+class Engine:
+    def atomic(self, write: bool = False) -> ContextManager[None]:
+        """
+        A transaction, or a savepoint within one. Transactions that will
+        write say so, so that engines can take their write lock up front:
+        a transaction that reads first may otherwise find it cannot write.
+        """
+        raise NotImplementedError()
+
+    def reading(self) -> ContextManager[None]:
+        """
+        A read transaction to hold while results selected in it are
+        streamed, so that lazy iterables read one snapshot. Held for as long
+        as the client takes to read the response; in WAL mode that blocks
+        no writer, but no checkpoint can pass it meanwhile.
+        """
+        return self.atomic()
+
+    def close(self) -> None:
+        pass
+
+    def create_user(
+        self,
+        id: uuid.UUID,
+        name: str,
+        create_ts: datetime.datetime,
+    ) -> User:
+        raise NotImplementedError()
+
+    def select_user_by_name(self, name: str) -> Optional[User]:
+        raise NotImplementedError()
+
+    def update_user(
+        self,
+        server_ts: datetime.datetime,
+        user: User,
+        expire_ts: Optional[datetime.datetime] = UNSET,
+    ) -> User:
+        raise NotImplementedError()
+
+    def select_next_expire_ts_by_user(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> Optional[datetime.datetime]:
+        """The earliest expiry among the user's valid secrets and tokens."""
+        raise NotImplementedError()
+
+    def create_secret(
+        self,
+        id: uuid.UUID,
+        name: str,
+        hash: str,
+        create_ts: datetime.datetime,
+        expire_ts: Optional[datetime.datetime],
+        user_id: uuid.UUID,
+    ) -> Secret:
+        raise NotImplementedError()
+
+    def select_secret_by_name(self, name: str) -> Optional[Secret]:
+        raise NotImplementedError()
+
+    def select_valid_secret_record_by_name(
+        self,
+        server_ts: datetime.datetime,
+        name: str,
+    ) -> Optional[SecretRecord]:
+        raise NotImplementedError()
+
+    def select_valid_secrets_by_user(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> Iterable[Secret]:
+        raise NotImplementedError()
+
+    def update_secret(
+        self,
+        server_ts: datetime.datetime,
+        secret: Secret,
+        hash: str = UNSET,
+        expire_ts: Optional[datetime.datetime] = UNSET,
+    ) -> Secret:
+        raise NotImplementedError()
+
+    def expire_secrets(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+        secret_ids: List[uuid.UUID],
+        expire_ts: datetime.datetime,
+    ) -> int:
+        """
+        Sets the expire_ts of those of the user's secrets in `secret_ids`
+        that would otherwise outlive it, in one statement. Returns the
+        number changed.
+        """
+        raise NotImplementedError()
+
+    def create_access_token(
+        self,
+        id: uuid.UUID,
+        value: str,
+        create_ts: datetime.datetime,
+        expire_ts: datetime.datetime,
+        secret_id: uuid.UUID,
+    ) -> AccessToken:
+        raise NotImplementedError()
+
+    def select_access_token_by_value(
+        self,
+        value: str,
+    ) -> Optional[AccessToken]:
+        raise NotImplementedError()
+
+    def select_valid_access_token_record_by_value(
+        self,
+        server_ts: datetime.datetime,
+        value: str,
+    ) -> Optional[AccessTokenRecord]:
+        raise NotImplementedError()
+
+    def select_valid_access_tokens_by_user(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> Iterable[AccessToken]:
+        raise NotImplementedError()
+
+    def create_refresh_token(
+        self,
+        id: uuid.UUID,
+        value: str,
+        create_ts: datetime.datetime,
+        expire_ts: datetime.datetime,
+        access_token_id: uuid.UUID,
+    ) -> RefreshToken:
+        """
+        Only called in the transaction that creates the access token, whose
+        insert moves the user's tree version for both.
+        """
+        raise NotImplementedError()
+
+    def evict_access_tokens(
+        self,
+        server_ts: datetime.datetime,
+        secret_id: uuid.UUID,
+        keep: int,
+    ) -> int:
+        """
+        Expires all but the newest `keep` of the secret's valid access
+        tokens, with their refresh tokens. Returns the number evicted.
+        """
+        raise NotImplementedError()
+
+    def select_valid_refresh_tokens_by_user(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> Iterable[RefreshToken]:
+        raise NotImplementedError()
+
+    def select_valid_refresh_tokens_by_access_token(
+        self,
+        server_ts: datetime.datetime,
+        access_token_id: uuid.UUID,
+    ) -> Iterable[RefreshToken]:
+        raise NotImplementedError()
+
+    def select_modified_since(
+        self,
+        since: datetime.datetime,
+    ) -> Iterable[Tuple[
+        uuid.UUID,
+        datetime.datetime,
+        Optional[datetime.datetime],
+    ]]:
+        """
+        The id, modify_ts and expire_ts of every user and secret updated
+        since.
+        """
+        raise NotImplementedError()
+
+    def reap(
+        self,
+        cutoff: datetime.datetime,
+        batch_size: int,
+    ) -> Dict[str, int]:
+        """
+        Deletes rows that expired before `cutoff`, children before parents,
+        in batches of at most `batch_size` rows. Returns the number of rows
+        deleted per table.
+        """
+        raise NotImplementedError()
+
+    def vacuum(self, pages: int) -> int:
+        """Returns freed storage to the system. Returns pages freed."""
+        return 0
+
+    def export(self) -> Iterable[Any]:
+        """Every row, users then secrets then access and refresh tokens."""
+        raise NotImplementedError()
+
+
+class StorageProxy:
+    """
+    Stands in for the engine chosen at startup, the way `db()` stands in for
+    the database, so that modules can bind it at import time.
+    """
+
+    def __init__(self):
+        self.engine: Optional[Engine] = None
+
+    def initialize(self, engine: Engine) -> None:
+        self.engine = engine
+
+    def atomic(self, write: bool = False) -> "_Atomic":
+        return _Atomic(self, write)
+
+    def __getattr__(self, name: str) -> Any:
+        if self.engine is None:
+            raise AttributeError("storage engine is not initialized")
+        return getattr(self.engine, name)
+
+
+class _Atomic:
+    # Usable as a decorator bound once at import time, so the engine's own
+    # context manager is created per entry, and kept per thread.
+
+    def __init__(self, proxy: StorageProxy, write: bool):
+        self._proxy = proxy
+        self._write = write
+        self._local = threading.local()
+
+    def __enter__(self) -> None:
+        context = self._proxy.engine.atomic(self._write)
+        self._stack().append(context)
+        context.__enter__()
+
+    def __exit__(self, *exc_info) -> Any:
+        return self._stack().pop().__exit__(*exc_info)
+
+    def __call__(self, fn: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with self:
+                return fn(*args, **kwargs)
+
+        return inner
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+
+__SINGLETON = StorageProxy()
+
+
+def storage() -> StorageProxy:
+    global __SINGLETON
+    return __SINGLETON
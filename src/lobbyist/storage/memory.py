@@ -0,0 +1,761 @@
+"""
+An engine that keeps everything in process memory.
+
+Rows are model instances held in dict indexes, with foreign keys resolved
+to the parent instance so that reads never touch a database. Every change is
+an op, applied to the indexes and, when its transaction commits, appended to
+a log file as a line of JSON. `snapshot` writes the whole state out and
+starts a new log, so recovery loads the newest snapshot and replays only
+the logs written after it.
+
+    <path>/snapshot.<n>  state as of the start of log.<n>
+    <path>/log.<n>       ops committed after snapshot.<n> was taken
+"""
+
+import contextlib
+import datetime
+import heapq
+import json
+import os
+import re
+import threading
+import uuid
+from typing import Any, ContextManager, Dict, Iterable, List, Optional, Tuple
+
+import peewee
+
+from .engine import EVICTION_OFFSET, UNSET, Engine, IntegrityError
+from ..library import log
+from ..library.metrics import metrics
+from ..models.auth import AccessToken, RefreshToken
+from ..models.records import AccessTokenRecord, SecretRecord
+from ..models.secret import Secret
+from ..models.user import User
+
+LOG = log.logger(__name__)
+
+
+# In foreign-key order, parents first.
+MODELS = (User, Secret, AccessToken, RefreshToken)
+_MODELS_BY_TABLE = {model._meta.table_name: model for model in MODELS}
+
+# The unique, non-primary-key column of each table.
+_UNIQUE = {User: "name", Secret: "name", AccessToken: "value",
+           RefreshToken: "value"}
+
+# The foreign key of each child table.
+_PARENT = {Secret: "user", AccessToken: "secret", RefreshToken: "access_token"}
+_CHILD = {parent_model: model for model, parent_model in (
+    (Secret, User), (AccessToken, Secret), (RefreshToken, AccessToken)
+)}
+
+_FILE_PATTERN = re.compile(r"^(snapshot|log)\.(\d+)$")
+
+Op = Dict[str, Any]
+
+
+class MemoryEngine(Engine):
+    def __init__(self, path: Optional[str] = None, fsync: bool = False):
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._rows: Dict[type, Dict[uuid.UUID, peewee.Model]] = {
+            model: {} for model in MODELS
+        }
+        self._unique: Dict[type, Dict[str, peewee.Model]] = {
+            model: {} for model in MODELS
+        }
+        self._children: Dict[type, Dict[uuid.UUID, Dict[uuid.UUID, Any]]] = {
+            model: {} for model in _CHILD
+        }
+        # (expire_ts, table, id) for every row with an expiry, ordered by
+        # expiry. Entries go stale when rows change; the reaper skips those.
+        self._expiry_heap: List[Tuple[datetime.datetime, str, uuid.UUID]] = []
+        self._expiry_entries = set()
+        self._log = None
+        self._log_index = 0
+
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+            self._recover()
+
+    def atomic(self, write: bool = False) -> ContextManager[None]:
+        return _MemoryTransaction(self)
+
+    def reading(self) -> ContextManager[None]:
+        # Selects materialize their rows under the lock, which a transaction
+        # held while streaming would keep from every writer.
+        return contextlib.nullcontext()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    def snapshot(self) -> None:
+        """Writes the current state out and discards the logs before it."""
+        if self.path is None:
+            return
+
+        LOG.debug("storage.memory.snapshot")
+
+        with self._lock:
+            ops = [
+                _insert_op(model, row)
+                for model in MODELS
+                for row in self._rows[model].values()
+            ]
+            index = self._log_index + 1
+            self._open_log(index)
+
+        snapshot_path = os.path.join(self.path, f"snapshot.{index}")
+        with open(snapshot_path + ".tmp", "w") as snapshot:
+            for op in ops:
+                snapshot.write(_dump_op(op))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(snapshot_path + ".tmp", snapshot_path)
+
+        for kind, old_index in self._files():
+            if old_index < index:
+                os.remove(os.path.join(self.path, f"{kind}.{old_index}"))
+
+        metrics().increment("storage.memory.snapshot")
+
+    def create_user(
+        self,
+        id: uuid.UUID,
+        name: str,
+        create_ts: datetime.datetime,
+    ) -> User:
+        return self._insert(
+            User,
+            id=id,
+            name=name,
+            create_ts=create_ts,
+            expire_ts=None,
+            version=1,
+            modify_ts=None,
+            tree_version=1,
+            tree_modify_ts=None,
+        )
+
+    def select_user_by_name(self, name: str) -> Optional[User]:
+        with self._lock:
+            return self._unique[User].get(name)
+
+    def update_user(
+        self,
+        server_ts: datetime.datetime,
+        user: User,
+        expire_ts: Optional[datetime.datetime] = UNSET,
+    ) -> User:
+        fields = {}
+        if expire_ts is not UNSET:
+            fields["expire_ts"] = expire_ts
+        with self.atomic():
+            user = self._rows[User][user.id]
+            self._update(
+                User,
+                user.id,
+                version=user.version + 1,
+                modify_ts=server_ts,
+                tree_version=user.tree_version + 1,
+                tree_modify_ts=server_ts,
+                **fields,
+            )
+            return user
+
+    def select_next_expire_ts_by_user(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> Optional[datetime.datetime]:
+        with self._lock:
+            expire_tss = []
+            for model in (Secret, AccessToken, RefreshToken):
+                expire_tss.extend(
+                    row.expire_ts
+                    for row in self._select_valid_by_user(
+                        model, server_ts, user_id
+                    )
+                )
+        return min(filter(None, expire_tss), default=None)
+
+    def create_secret(
+        self,
+        id: uuid.UUID,
+        name: str,
+        hash: str,
+        create_ts: datetime.datetime,
+        expire_ts: Optional[datetime.datetime],
+        user_id: uuid.UUID,
+    ) -> Secret:
+        with self.atomic():
+            secret = self._insert(
+                Secret,
+                id=id,
+                name=name,
+                hash=hash,
+                create_ts=create_ts,
+                expire_ts=expire_ts,
+                user=user_id,
+                version=1,
+                modify_ts=None,
+            )
+            self._touch_user_tree(user_id, create_ts)
+            return secret
+
+    def select_secret_by_name(self, name: str) -> Optional[Secret]:
+        with self._lock:
+            return self._unique[Secret].get(name)
+
+    def select_valid_secret_record_by_name(
+        self,
+        server_ts: datetime.datetime,
+        name: str,
+    ) -> Optional[SecretRecord]:
+        with self._lock:
+            secret = self._unique[Secret].get(name)
+            if secret is None or not _is_valid(secret, server_ts):
+                return None
+            return SecretRecord(secret.id, secret.hash, secret.user_id)
+
+    def select_valid_secrets_by_user(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> Iterable[Secret]:
+        with self._lock:
+            return self._select_valid_by_user(Secret, server_ts, user_id)
+
+    def update_secret(
+        self,
+        server_ts: datetime.datetime,
+        secret: Secret,
+        hash: str = UNSET,
+        expire_ts: Optional[datetime.datetime] = UNSET,
+    ) -> Secret:
+        fields = {}
+        if hash is not UNSET:
+            fields["hash"] = hash
+        if expire_ts is not UNSET:
+            fields["expire_ts"] = expire_ts
+        with self.atomic():
+            secret = self._rows[Secret][secret.id]
+            self._update(
+                Secret,
+                secret.id,
+                version=secret.version + 1,
+                modify_ts=server_ts,
+                **fields,
+            )
+            self._touch_user_tree(secret.user_id, server_ts)
+            return secret
+
+    def expire_secrets(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+        secret_ids: List[uuid.UUID],
+        expire_ts: datetime.datetime,
+    ) -> int:
+        with self.atomic():
+            secrets = self._children[User].get(user_id, {})
+            expired = [
+                secret for secret in (
+                    secrets.get(id) for id in dict.fromkeys(secret_ids)
+                ) if secret is not None and (
+                    secret.expire_ts is None or secret.expire_ts > expire_ts
+                )
+            ]
+            for secret in expired:
+                self._update(
+                    Secret,
+                    secret.id,
+                    expire_ts=expire_ts,
+                    version=secret.version + 1,
+                    modify_ts=server_ts,
+                )
+            if expired:
+                self._touch_user_tree(user_id, server_ts)
+            return len(expired)
+
+    def create_access_token(
+        self,
+        id: uuid.UUID,
+        value: str,
+        create_ts: datetime.datetime,
+        expire_ts: datetime.datetime,
+        secret_id: uuid.UUID,
+    ) -> AccessToken:
+        with self.atomic():
+            access_token = self._insert(
+                AccessToken,
+                id=id,
+                value=value,
+                create_ts=create_ts,
+                expire_ts=expire_ts,
+                secret=secret_id,
+            )
+            self._touch_user_tree(access_token.secret.user_id, create_ts)
+            return access_token
+
+    def select_access_token_by_value(
+        self,
+        value: str,
+    ) -> Optional[AccessToken]:
+        with self._lock:
+            return self._unique[AccessToken].get(value)
+
+    def select_valid_access_token_record_by_value(
+        self,
+        server_ts: datetime.datetime,
+        value: str,
+    ) -> Optional[AccessTokenRecord]:
+        with self._lock:
+            access_token = self._unique[AccessToken].get(value)
+            if access_token is None or not _is_valid(access_token, server_ts):
+                return None
+            return AccessTokenRecord(
+                access_token.id,
+                access_token.expire_ts,
+                access_token.secret_id,
+                access_token.secret.user_id,
+            )
+
+    def select_valid_access_tokens_by_user(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> Iterable[AccessToken]:
+        with self._lock:
+            return self._select_valid_by_user(AccessToken, server_ts, user_id)
+
+    def create_refresh_token(
+        self,
+        id: uuid.UUID,
+        value: str,
+        create_ts: datetime.datetime,
+        expire_ts: datetime.datetime,
+        access_token_id: uuid.UUID,
+    ) -> RefreshToken:
+        with self.atomic():
+            refresh_token = self._insert(
+                RefreshToken,
+                id=id,
+                value=value,
+                create_ts=create_ts,
+                expire_ts=expire_ts,
+                access_token=access_token_id,
+            )
+            return refresh_token
+
+    def evict_access_tokens(
+        self,
+        server_ts: datetime.datetime,
+        secret_id: uuid.UUID,
+        keep: int,
+    ) -> int:
+        with self.atomic():
+            evicted = sorted(
+                (
+                    access_token for access_token in
+                    self._children[Secret].get(secret_id, {}).values()
+                    if access_token.is_valid(server_ts)
+                ),
+                key=lambda access_token: access_token.create_ts,
+                reverse=True,
+            )[keep:]
+            expire_ts = server_ts - EVICTION_OFFSET
+            for access_token in evicted:
+                self._update(AccessToken, access_token.id, expire_ts=expire_ts)
+                for refresh_token in list(
+                    self._children[AccessToken].get(access_token.id, {}).
+                    values()
+                ):
+                    if refresh_token.expire_ts > expire_ts:
+                        self._update(
+                            RefreshToken,
+                            refresh_token.id,
+                            expire_ts=expire_ts,
+                        )
+            if evicted:
+                self._touch_user_tree(
+                    self._rows[Secret][secret_id].user_id,
+                    server_ts,
+                )
+            return len(evicted)
+
+    def select_valid_refresh_tokens_by_user(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> Iterable[RefreshToken]:
+        with self._lock:
+            return self._select_valid_by_user(
+                RefreshToken,
+                server_ts,
+                user_id,
+            )
+
+    def select_valid_refresh_tokens_by_access_token(
+        self,
+        server_ts: datetime.datetime,
+        access_token_id: uuid.UUID,
+    ) -> Iterable[RefreshToken]:
+        with self._lock:
+            return [
+                refresh_token for refresh_token in self._children[AccessToken].
+                get(access_token_id, {}).values()
+                if refresh_token.is_valid(server_ts)
+            ]
+
+    def reap(
+        self,
+        cutoff: datetime.datetime,
+        batch_size: int,
+    ) -> Dict[str, int]:
+        deleted = {model._meta.table_name: 0 for model in reversed(MODELS)}
+        deferred = []
+        while True:
+            # Each batch holds the lock for at most `batch_size` heap pops.
+            with self.atomic():
+                popped = 0
+                while (
+                    self._expiry_heap and self._expiry_heap[0][0] < cutoff and
+                    popped < batch_size
+                ):
+                    entry = heapq.heappop(self._expiry_heap)
+                    self._expiry_entries.discard(entry)
+                    popped += 1
+                    expire_ts, table, id = entry
+                    model = _MODELS_BY_TABLE[table]
+                    row = self._rows[model].get(id)
+                    if row is None or _expire_ts(row) != expire_ts:
+                        continue
+                    if model is User:
+                        # The user's secrets expire with it.
+                        for secret in self._children[User].get(id, {}
+                                                              ).values():
+                            self._push_expiry(Secret, secret)
+                    if self._children.get(model, {}).get(id):
+                        # Parents wait for their children, and are pushed
+                        # again below once the last of them is deleted.
+                        deferred.append(entry)
+                        continue
+                    self._apply({"op": "delete", "table": table, "id": id})
+                    deleted[table] += 1
+                    parent_name = _PARENT.get(model)
+                    if parent_name:
+                        parent = getattr(row, parent_name)
+                        if not self._children[type(parent)].get(parent.id):
+                            self._push_expiry(type(parent), parent)
+            if popped < batch_size:
+                break
+
+        with self._lock:
+            for entry in deferred:
+                self._push_expiry_entry(entry)
+
+        return deleted
+
+    def select_modified_since(
+        self,
+        since: datetime.datetime,
+    ) -> Iterable[Tuple[
+        uuid.UUID,
+        datetime.datetime,
+        Optional[datetime.datetime],
+    ]]:
+        with self._lock:
+            return [
+                (row.id, row.modify_ts, row.expire_ts)
+                for model in (User, Secret)
+                for row in self._rows[model].values()
+                if row.modify_ts is not None and row.modify_ts >= since
+            ]
+
+    def export(self) -> Iterable[Any]:
+        with self._lock:
+            return [
+                row for model in MODELS for row in self._rows[model].values()
+            ]
+
+    def _select_valid_by_user(
+        self,
+        model: type,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> List[peewee.Model]:
+        # Materialized under the lock; the indexes may change once released.
+        rows = [
+            secret for secret in self._children[User].get(user_id, {}).values()
+            if secret.is_valid(server_ts)
+        ]
+        for parent_model in (Secret, AccessToken):
+            if model is parent_model:
+                break
+            rows = [
+                child for parent in rows
+                for child in self._children[parent_model].get(parent.id, {}).
+                values() if child.is_valid(server_ts)
+            ]
+        return rows
+
+    def _insert(self, model: type, **row: Any) -> peewee.Model:
+        with self.atomic():
+            self._apply({
+                "op": "insert",
+                "table": model._meta.table_name,
+                "row": _coerce(model, row),
+            })
+            return self._rows[model][row["id"]]
+
+    def _update(self, model: type, id: uuid.UUID, **fields: Any) -> None:
+        with self.atomic():
+            self._apply({
+                "op": "update",
+                "table": model._meta.table_name,
+                "id": id,
+                "fields": _coerce(model, fields),
+            })
+
+    def _touch_user_tree(
+        self,
+        user_id: uuid.UUID,
+        server_ts: datetime.datetime,
+    ) -> None:
+        self._update(
+            User,
+            user_id,
+            tree_version=self._rows[User][user_id].tree_version + 1,
+            tree_modify_ts=server_ts,
+        )
+
+    def _apply(self, op: Op) -> None:
+        """Applies `op` to the indexes, journaling it in the transaction."""
+        model = _MODELS_BY_TABLE[op["table"]]
+        rows = self._rows[model]
+        unique = self._unique[model]
+        parent_name = _PARENT.get(model)
+
+        if op["op"] == "insert":
+            row = op["row"]
+            key = row[_UNIQUE[model]]
+            if row["id"] in rows or key in unique:
+                raise IntegrityError(f"{op['table']}: duplicate row")
+            instance = model(**row)
+            if parent_name:
+                parent_model = model._meta.fields[parent_name].rel_model
+                parent = self._rows[parent_model].get(row[parent_name])
+                if parent is None:
+                    raise IntegrityError(f"{op['table']}: missing parent")
+                setattr(instance, parent_name, parent)
+                self._children[parent_model].setdefault(parent.id, {}
+                                                       )[instance.id] = instance
+            rows[instance.id] = instance
+            unique[key] = instance
+            self._push_expiry(model, instance)
+            undo = {"op": "delete", "table": op["table"], "id": instance.id}
+
+        elif op["op"] == "update":
+            instance = rows[op["id"]]
+            undo = {
+                "op": "update",
+                "table": op["table"],
+                "id": op["id"],
+                "fields": {
+                    name: getattr(instance, name)
+                    for name in op["fields"]
+                },
+            }
+            for name, value in op["fields"].items():
+                setattr(instance, name, value)
+            if "expire_ts" in op["fields"]:
+                self._push_expiry(model, instance)
+
+        elif op["op"] == "delete":
+            instance = rows[op["id"]]
+            if self._children.get(model, {}).get(instance.id):
+                raise IntegrityError(f"{op['table']}: row has children")
+            del rows[instance.id]
+            del unique[getattr(instance, _UNIQUE[model])]
+            self._children.get(model, {}).pop(instance.id, None)
+            if parent_name:
+                parent_model = model._meta.fields[parent_name].rel_model
+                siblings = self._children[parent_model]
+                parent_id = instance.__data__[parent_name]
+                siblings[parent_id].pop(instance.id)
+                if not siblings[parent_id]:
+                    del siblings[parent_id]
+            undo = _insert_op(model, instance)
+
+        else:
+            raise ValueError(f"unknown op: {op['op']}")
+
+        transaction = getattr(self._local, "transaction", None)
+        if transaction is not None:
+            transaction.ops.append(op)
+            transaction.undo.append(undo)
+
+    def _push_expiry(self, model: type, row: peewee.Model) -> None:
+        expire_ts = _expire_ts(row)
+        if expire_ts is not None:
+            self._push_expiry_entry((expire_ts, model._meta.table_name, row.id))
+
+    def _push_expiry_entry(
+        self,
+        entry: Tuple[datetime.datetime, str, uuid.UUID],
+    ) -> None:
+        if entry not in self._expiry_entries:
+            self._expiry_entries.add(entry)
+            heapq.heappush(self._expiry_heap, entry)
+
+    def _commit(self, ops: List[Op]) -> None:
+        if self._log is None or not ops:
+            return
+        self._log.write("".join(_dump_op(op) for op in ops))
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+
+    def _rollback(self, undo: List[Op]) -> None:
+        for op in reversed(undo):
+            self._apply(op)
+
+    def _recover(self) -> None:
+        files = self._files()
+        snapshots = [index for kind, index in files if kind == "snapshot"]
+        start = max(snapshots, default=0)
+        if snapshots:
+            self._replay(os.path.join(self.path, f"snapshot.{start}"))
+        logs = sorted(
+            index for kind, index in files if kind == "log" and index >= start
+        )
+        for index in logs:
+            self._replay(os.path.join(self.path, f"log.{index}"))
+        self._open_log(max(logs + [start]) + 1)
+
+    def _replay(self, path: str) -> None:
+        LOG.debug("storage.memory._replay %s", path)
+
+        with open(path) as ops:
+            for line in ops:
+                try:
+                    op = _load_op(line)
+                except ValueError:
+                    # A torn final line from a crash mid-write.
+                    LOG.warning("storage.memory: skipping %r", line)
+                    continue
+                self._apply(op)
+
+    def _open_log(self, index: int) -> None:
+        if self._log is not None:
+            self._log.close()
+        self._log_index = index
+        self._log = open(os.path.join(self.path, f"log.{index}"), "a")
+
+    def _files(self) -> List[Tuple[str, int]]:
+        return [(match[1], int(match[2]))
+                for match in map(_FILE_PATTERN.match, os.listdir(self.path))
+                if match]
+
+
+class _MemoryTransaction:
+    # The engine lock is held for the whole of the outermost transaction, so
+    # transactions are serialized. Nested transactions join the outermost
+    # one, and roll back only their own ops, like a savepoint.
+
+    def __init__(self, engine: MemoryEngine):
+        self.engine = engine
+        self.ops: List[Op] = []
+        self.undo: List[Op] = []
+        self._outer: Optional["_MemoryTransaction"] = None
+        self._mark = 0
+
+    def __enter__(self) -> None:
+        self.engine._lock.acquire()
+        self._outer = getattr(self.engine._local, "transaction", None)
+        if self._outer is None:
+            self.engine._local.transaction = self
+        else:
+            self._mark = len(self._outer.undo)
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if self._outer is None:
+                self.engine._local.transaction = None
+                if exc_type is None:
+                    self.engine._commit(self.ops)
+                else:
+                    self.engine._rollback(self.undo)
+            elif exc_type is not None:
+                outer = self._outer
+                undo = outer.undo[self._mark:]
+                del outer.ops[self._mark:], outer.undo[self._mark:]
+                # Rolled back outside the transaction, so it is not logged.
+                self.engine._local.transaction = None
+                try:
+                    self.engine._rollback(undo)
+                finally:
+                    self.engine._local.transaction = outer
+        finally:
+            self.engine._lock.release()
+
+
+def _expire_ts(row: peewee.Model) -> Optional[datetime.datetime]:
+    # Secrets expire with their user, if not before.
+    if isinstance(row, Secret):
+        return min(
+            filter(None, (row.expire_ts, row.user.expire_ts)),
+            default=None,
+        )
+    return row.expire_ts
+
+
+def _is_valid(row: peewee.Model, server_ts: datetime.datetime) -> bool:
+    while row is not None:
+        if not row.is_valid(server_ts):
+            return False
+        parent_name = _PARENT.get(type(row))
+        row = getattr(row, parent_name) if parent_name else None
+    return True
+
+
+def _coerce(model: type, values: Dict[str, Any]) -> Dict[str, Any]:
+    # Stores values as SQLite would hand them back, eg: bytes as str.
+    fields = model._meta.fields
+    return {
+        name: fields[name].python_value(fields[name].db_value(value))
+        for name, value in values.items()
+    }
+
+
+def _insert_op(model: type, row: peewee.Model) -> Op:
+    return {
+        "op": "insert",
+        "table": model._meta.table_name,
+        "row": dict(row.__data__),
+    }
+
+
+def _dump_op(op: Op) -> str:
+    return json.dumps(op, default=str, separators=(",", ":")) + "\n"
+
+
+def _load_op(line: str) -> Op:
+    op = json.loads(line)
+    model = _MODELS_BY_TABLE[op["table"]]
+    fields = model._meta.fields
+    if "id" in op:
+        op["id"] = fields["id"].python_value(op["id"])
+    for key in ("row", "fields"):
+        if key in op:
+            op[key] = {
+                name: fields[name].python_value(value)
+                for name, value in op[key].items()
+            }
+    return op
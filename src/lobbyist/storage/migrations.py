@@ -0,0 +1,212 @@
+"""
+Schema versions, and the migrations between them.
+
+Each database records the migrations applied to it in its `schemaversion`
+table. Opening one reads the highest version there, and only if that is
+behind the migrations this build knows applies the rest, in order. Each
+runs in an IMMEDIATE transaction, with its row, so that of several
+processes opening a database at once only one applies it.
+
+Migrations are appended, never edited or reordered: one that has run
+somewhere must keep doing what it did. So they must not rely on the models
+as they are now, which later changes may alter, but spell out the SQL they
+run. The first creates the schema as it was when versions were introduced;
+a database created before then has every table already, and it only adds
+the version table.
+
+A change to the tables or indexes of the models needs a migration
+appended here (or to `sharded.SHARD_MIGRATIONS`, for the token shards).
+"""
+
+import datetime
+from typing import Callable, List
+
+import peewee
+
+from ..library import log
+from ..models.schema import SchemaVersion
+
+LOG = log.logger(__name__)
+
+
+class Migration:
+    def __init__(self, name: str, apply: Callable[[peewee.Database], None]):
+        self.name = name
+        self.apply = apply
+
+
+_SCHEMA_VERSION = (
+    'CREATE TABLE IF NOT EXISTS "schemaversion" ('
+    '"version" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL, '
+    '"apply_ts" DATETIME NOT NULL)'
+)
+
+# The schema when versions were introduced, as the models created it then.
+# IF NOT EXISTS lets it run on databases created before, which have it all.
+# The token tables also start every shard's schema.
+TOKEN_SCHEMA = [
+    (
+        'CREATE TABLE IF NOT EXISTS "accesstoken" ('
+        '"id" TEXT NOT NULL PRIMARY KEY, "value" VARCHAR(255) NOT NULL, '
+        '"create_ts" DATETIME NOT NULL, "expire_ts" DATETIME NOT NULL, '
+        '"secret_id" TEXT NOT NULL, '
+        'FOREIGN KEY ("secret_id") REFERENCES "secret" ("id"))'
+    ),
+    (
+        'CREATE UNIQUE INDEX IF NOT EXISTS "accesstoken_value"'
+        ' ON "accesstoken" ("value")'
+    ),
+    (
+        'CREATE INDEX IF NOT EXISTS "accesstoken_secret_id"'
+        ' ON "accesstoken" ("secret_id")'
+    ),
+    (
+        'CREATE INDEX IF NOT EXISTS "accesstoken_id_create_ts_expire_ts"'
+        ' ON "accesstoken" ("id", "create_ts", "expire_ts")'
+    ),
+    (
+        'CREATE INDEX IF NOT EXISTS "accesstoken_value_create_ts_expire_ts"'
+        ' ON "accesstoken" ("value", "create_ts", "expire_ts")'
+    ),
+    (
+        'CREATE INDEX IF NOT EXISTS "accesstoken_expire_ts"'
+        ' ON "accesstoken" ("expire_ts")'
+    ),
+    (
+        'CREATE INDEX IF NOT EXISTS "accesstoken_secret_id_create_ts"'
+        ' ON "accesstoken" ("secret_id", "create_ts")'
+    ),
+    (
+        'CREATE TABLE IF NOT EXISTS "refreshtoken" ('
+        '"id" TEXT NOT NULL PRIMARY KEY, "value" VARCHAR(255) NOT NULL, '
+        '"create_ts" DATETIME NOT NULL, "expire_ts" DATETIME NOT NULL, '
+        '"access_token_id" TEXT NOT NULL, '
+        'FOREIGN KEY ("access_token_id") REFERENCES "accesstoken" ("id"))'
+    ),
+    (
+        'CREATE UNIQUE INDEX IF NOT EXISTS "refreshtoken_value"'
+        ' ON "refreshtoken" ("value")'
+    ),
+    (
+        'CREATE INDEX IF NOT EXISTS "refreshtoken_access_token_id"'
+        ' ON "refreshtoken" ("access_token_id")'
+    ),
+    (
+        'CREATE INDEX IF NOT EXISTS "refreshtoken_id_create_ts_expire_ts"'
+        ' ON "refreshtoken" ("id", "create_ts", "expire_ts")'
+    ),
+    (
+        'CREATE INDEX IF NOT EXISTS "refreshtoken_value_create_ts_expire_ts"'
+        ' ON "refreshtoken" ("value", "create_ts", "expire_ts")'
+    ),
+    (
+        'CREATE INDEX IF NOT EXISTS "refreshtoken_expire_ts"'
+        ' ON "refreshtoken" ("expire_ts")'
+    ),
+]
+
+_SCHEMA = [
+    (
+        'CREATE TABLE IF NOT EXISTS "user" ("id" TEXT NOT NULL PRIMARY KEY, '
+        '"name" VARCHAR(255) NOT NULL, "create_ts" DATETIME NOT NULL, '
+        '"expire_ts" DATETIME, "version" INTEGER NOT NULL, '
+        '"modify_ts" DATETIME, "tree_version" INTEGER NOT NULL, '
+        '"tree_modify_ts" DATETIME)'
+    ),
+    'CREATE UNIQUE INDEX IF NOT EXISTS "user_name" ON "user" ("name")',
+    (
+        'CREATE INDEX IF NOT EXISTS "user_id_create_ts_expire_ts"'
+        ' ON "user" ("id", "create_ts", "expire_ts")'
+    ),
+    (
+        'CREATE INDEX IF NOT EXISTS "user_name_create_ts_expire_ts"'
+        ' ON "user" ("name", "create_ts", "expire_ts")'
+    ),
+    'CREATE INDEX IF NOT EXISTS "user_modify_ts" ON "user" ("modify_ts")',
+    'CREATE INDEX IF NOT EXISTS "user_expire_ts" ON "user" ("expire_ts")',
+    (
+        'CREATE TABLE IF NOT EXISTS "secret" ("id" TEXT NOT NULL PRIMARY KEY, '
+        '"name" VARCHAR(255) NOT NULL, "hash" VARCHAR(255) NOT NULL, '
+        '"create_ts" DATETIME NOT NULL, "expire_ts" DATETIME, '
+        '"user_id" TEXT NOT NULL, "version" INTEGER NOT NULL, '
+        '"modify_ts" DATETIME, '
+        'FOREIGN KEY ("user_id") REFERENCES "user" ("id"))'
+    ),
+    'CREATE UNIQUE INDEX IF NOT EXISTS "secret_name" ON "secret" ("name")',
+    'CREATE INDEX IF NOT EXISTS "secret_user_id" ON "secret" ("user_id")',
+    (
+        'CREATE INDEX IF NOT EXISTS "secret_id_create_ts_expire_ts"'
+        ' ON "secret" ("id", "create_ts", "expire_ts")'
+    ),
+    (
+        'CREATE INDEX IF NOT EXISTS "secret_name_create_ts_expire_ts"'
+        ' ON "secret" ("name", "create_ts", "expire_ts")'
+    ),
+    'CREATE INDEX IF NOT EXISTS "secret_modify_ts" ON "secret" ("modify_ts")',
+    'CREATE INDEX IF NOT EXISTS "secret_expire_ts" ON "secret" ("expire_ts")',
+    *TOKEN_SCHEMA,
+    (
+        'CREATE TABLE IF NOT EXISTS "replicationposition" ('
+        '"id" INTEGER NOT NULL PRIMARY KEY, "segment" INTEGER NOT NULL, '
+        '"offset" INTEGER NOT NULL, "lsn" INTEGER NOT NULL, "ts" VARCHAR(255))'
+    ),
+]
+
+
+def _create_schema(database: peewee.Database) -> None:
+    for statement in _SCHEMA:
+        database.execute_sql(statement)
+
+
+# The primary database's; a migration's version is its position, from 1.
+MIGRATIONS: List[Migration] = [
+    Migration("create schema", _create_schema),
+]
+
+
+def version(database: peewee.Database) -> int:
+    """The schema version of `database`, 0 if it has none."""
+    with database.bind_ctx([SchemaVersion]):
+        try:
+            return SchemaVersion.select(
+                peewee.fn.MAX(SchemaVersion.version)
+            ).scalar() or 0
+        except peewee.OperationalError as error:
+            if "no such table" not in str(error):
+                raise
+            return 0
+
+
+def migrate(database: peewee.Database, migrations: List[Migration]) -> int:
+    """
+    Brings `database` up to the last of `migrations`, and returns that
+    version. Raises ValueError if the database is ahead of them, ie: was
+    migrated by a newer build.
+    """
+    LOG.debug("storage.migrations.migrate")
+
+    current = version(database)
+    if current > len(migrations):
+        raise ValueError(
+            f"schema version {current} is newer than this build's "
+            f"{len(migrations)}"
+        )
+    for number in range(current + 1, len(migrations) + 1):
+        migration = migrations[number - 1]
+        with database.bind_ctx([SchemaVersion]):
+            with database.atomic("IMMEDIATE"):
+                if version(database) >= number:
+                    continue
+                LOG.info(
+                    "migrating to schema version %d: %s",
+                    number,
+                    migration.name,
+                )
+                database.execute_sql(_SCHEMA_VERSION)
+                migration.apply(database)
+                SchemaVersion.create(
+                    version=number,
+                    name=migration.name,
+                    apply_ts=datetime.datetime.utcnow(),
+                )
+    return len(migrations)
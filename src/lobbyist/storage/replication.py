@@ -0,0 +1,690 @@
+"""
+Log shipping to read-only followers.
+
+On the leader, `CapturingEngine` records every engine call that writes, as a
+line of JSON, to an append-only change log split into segments:
+
+    <path>/changes.<index>
+
+Each transaction's calls are appended, and synced, before it commits, and
+followed by a commit line once it has (or an abort line, if the commit
+failed), so the log is in commit order. A crash in between leaves calls
+with neither; the leader redoes them when it restarts, and then commits
+them in the log. Closed segments never change, so any file transport that
+delivers segments in order, and appends to the newest one, can ship them
+(eg: rsync --append).
+
+A `Follower` tails the segments and replays the committed calls against its
+own engine, which is wrapped in `ReadOnlyEngine` to serve the read and
+validation routes. Replaying the same calls in the same order keeps the
+follower's rows in step with the leader's, though the version counters
+behind ETags are the follower's own. Expired rows are reaped locally, as on
+the leader; deletes are not shipped.
+"""
+
+import datetime
+import json
+import os
+import re
+import threading
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ..library import log
+from .engine import UNSET, Engine, IntegrityError
+from ..library.error import ServiceUnavailableError
+from ..library.metrics import metrics
+from ..models.auth import AccessToken, RefreshToken
+from ..models.replication import ReplicationPosition
+from ..models.secret import Secret
+from ..models.user import User
+
+LOG = log.logger(__name__)
+_SEGMENT_PATTERN = re.compile(r"^changes\.(\d+)$")
+
+Op = Dict[str, Any]
+
+
+def _nothing(*args: Any) -> None:
+    return None
+
+
+class ChangeLog:
+    def __init__(self, path: str, segment_bytes: int, fsync: bool = True):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+        segments = list_segments(path)
+        self.segment = segments[-1] if segments else 0
+        # The newest segment may be empty, just after a rotation. Segments
+        # only rotate after a commit line, so calls that were never committed
+        # or aborted can only be at the end of the newest.
+        self.lsn = 0
+        self.pending: List[Op] = []
+        for index, segment in enumerate(reversed(segments)):
+            self.lsn, pending = _recover_tail(
+                segment_path(path, segment),
+                truncate=index == 0,
+            )
+            if index == 0:
+                self.pending = pending
+            if self.lsn:
+                break
+        self._file = open(segment_path(path, self.segment), "a")
+
+    def is_empty(self) -> bool:
+        return self.lsn == 0
+
+    def append(self, calls: List[Tuple[str, Dict[str, Any]]]) -> None:
+        """
+        Appends the calls of one transaction, before it commits. Callers
+        hold `lock`, and then `commit` or `abort`.
+        """
+        ts = datetime.datetime.utcnow()
+        lines = []
+        for call, args in calls:
+            self.lsn += 1
+            lines.append(
+                _dump({
+                    "lsn": self.lsn,
+                    "ts": ts,
+                    "call": call,
+                    "args": args,
+                })
+            )
+        self._file.write("".join(lines))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def commit(self) -> None:
+        """Marks the calls appended last as committed."""
+        self._end({"commit": self.lsn})
+        metrics().set_gauge("replication.lsn", self.lsn)
+
+    def abort(self) -> None:
+        """Marks the calls appended last as never committed."""
+        self._end({"abort": self.lsn})
+
+    def _end(self, mark: Dict[str, int]) -> None:
+        # Not synced: if it is lost, the calls are redone on restart.
+        self._file.write(_dump(mark))
+        self._file.flush()
+
+        if self._file.tell() >= self.segment_bytes:
+            self._file.close()
+            self.segment += 1
+            self._file = open(segment_path(self.path, self.segment), "a")
+
+    def status(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "role": "leader",
+                "lsn": self.lsn,
+                "segment": self.segment,
+            }
+
+    def close(self) -> None:
+        with self.lock:
+            self._file.close()
+
+
+class CapturingEngine:
+    """Wraps an engine, recording its writes to a change log."""
+
+    def __init__(self, engine: Engine, log: ChangeLog):
+        self.engine = engine
+        self.log = log
+        self._local = threading.local()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.engine, name)
+
+    def atomic(self, write: bool = False) -> "_CapturingTransaction":
+        return _CapturingTransaction(self, write)
+
+    def close(self) -> None:
+        self.engine.close()
+        self.log.close()
+
+    def recover(self) -> None:
+        """
+        Redoes the calls a crash left in the log neither committed nor
+        aborted. They were synced before their transaction committed, which
+        it may or may not have done.
+        """
+        log = self.log
+        if not log.pending:
+            return
+
+        LOG.warning(
+            "replication: redoing %d uncommitted calls up to lsn %d",
+            len(log.pending),
+            log.lsn,
+        )
+        with log.lock:
+            with self.engine.atomic(write=True):
+                for op in log.pending:
+                    _apply(self.engine, op)
+            log.commit()
+            log.pending = []
+
+    def bootstrap(self) -> None:
+        """Records the engine's existing rows, if the log is empty."""
+        if not self.log.is_empty():
+            return
+
+        LOG.info("replication: bootstrapping change log")
+        with self.atomic(write=True):
+            for row in self.engine.export():
+                self._capture(*_create_call(row))
+                if isinstance(row, User) and row.expire_ts is not None:
+                    self._capture(
+                        "update_user",
+                        {
+                            "server_ts": row.modify_ts or row.create_ts,
+                            "user_name": row.name,
+                            "expire_ts": row.expire_ts,
+                        },
+                    )
+
+    def create_user(self, id, name, create_ts):
+        return self._call(
+            "create_user",
+            id=id,
+            name=name,
+            create_ts=create_ts,
+        )
+
+    def update_user(self, server_ts, user, expire_ts=UNSET):
+        with self.atomic(write=True):
+            user = self.engine.update_user(server_ts, user, expire_ts)
+            self._capture(
+                "update_user",
+                _set({
+                    "server_ts": server_ts,
+                    "user_name": user.name,
+                    "expire_ts": expire_ts,
+                }),
+            )
+            return user
+
+    def create_secret(self, id, name, hash, create_ts, expire_ts, user_id):
+        return self._call(
+            "create_secret",
+            id=id,
+            name=name,
+            hash=hash,
+            create_ts=create_ts,
+            expire_ts=expire_ts,
+            user_id=user_id,
+        )
+
+    def update_secret(self, server_ts, secret, hash=UNSET, expire_ts=UNSET):
+        with self.atomic(write=True):
+            secret = self.engine.update_secret(
+                server_ts,
+                secret,
+                hash,
+                expire_ts,
+            )
+            self._capture(
+                "update_secret",
+                _set({
+                    "server_ts": server_ts,
+                    "secret_name": secret.name,
+                    "hash": hash,
+                    "expire_ts": expire_ts,
+                }),
+            )
+            return secret
+
+    def create_access_token(self, id, value, create_ts, expire_ts, secret_id):
+        return self._call(
+            "create_access_token",
+            id=id,
+            value=value,
+            create_ts=create_ts,
+            expire_ts=expire_ts,
+            secret_id=secret_id,
+        )
+
+    def create_refresh_token(
+        self, id, value, create_ts, expire_ts, access_token_id
+    ):
+        return self._call(
+            "create_refresh_token",
+            id=id,
+            value=value,
+            create_ts=create_ts,
+            expire_ts=expire_ts,
+            access_token_id=access_token_id,
+        )
+
+    def evict_access_tokens(self, server_ts, secret_id, keep):
+        return self._call(
+            "evict_access_tokens",
+            server_ts=server_ts,
+            secret_id=secret_id,
+            keep=keep,
+        )
+
+    def expire_secrets(self, server_ts, user_id, secret_ids, expire_ts):
+        return self._call(
+            "expire_secrets",
+            server_ts=server_ts,
+            user_id=user_id,
+            secret_ids=list(secret_ids),
+            expire_ts=expire_ts,
+        )
+
+    def _call(self, call: str, **args: Any) -> Any:
+        with self.atomic(write=True):
+            result = getattr(self.engine, call)(**args)
+            self._capture(call, args)
+            return result
+
+    def _capture(self, call: str, args: Dict[str, Any]) -> None:
+        self._local.calls.append((call, args))
+
+
+class _CapturingTransaction:
+    # Calls are buffered per outermost transaction, and appended under the
+    # log lock together with the commit, so the log is in commit order. They
+    # are synced to the log before the commit, so that a commit is never
+    # acknowledged without them.
+
+    def __init__(self, engine: CapturingEngine, write: bool):
+        self.engine = engine
+        self.write = write
+        self._context = None
+        self._outermost = False
+        self._mark = 0
+
+    def __enter__(self) -> None:
+        local = self.engine._local
+        if getattr(local, "calls", None) is None:
+            local.calls = []
+            self._outermost = True
+        else:
+            self._mark = len(local.calls)
+        self._context = self.engine.engine.atomic(self.write)
+        try:
+            self._context.__enter__()
+        except BaseException:
+            if self._outermost:
+                local.calls = None
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback) -> Any:
+        local = self.engine._local
+        if not self._outermost:
+            if exc_type is not None:
+                del local.calls[self._mark:]
+            return self._context.__exit__(exc_type, exc_value, traceback)
+
+        calls, local.calls = local.calls, None
+        if exc_type is not None or not calls:
+            return self._context.__exit__(exc_type, exc_value, traceback)
+        log = self.engine.log
+        with log.lock:
+            try:
+                log.append(calls)
+            except BaseException as error:
+                self._context.__exit__(
+                    type(error),
+                    error,
+                    error.__traceback__,
+                )
+                log.abort()
+                raise
+            try:
+                result = self._context.__exit__(None, None, None)
+            except BaseException:
+                log.abort()
+                raise
+            log.commit()
+        return result
+
+
+class ReadOnlyEngine:
+    """Wraps a follower's engine, refusing writes from requests."""
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.engine, name)
+
+    def _refuse(self, *args, **kwargs) -> Any:
+        raise ServiceUnavailableError("this node is a read-only follower")
+
+    create_user = update_user = create_secret = update_secret = _refuse
+    create_access_token = create_refresh_token = _refuse
+    evict_access_tokens = expire_secrets = _refuse
+
+
+class Follower:
+    """Applies a leader's change log to a local engine."""
+
+    def __init__(
+        self,
+        path: str,
+        engine: Engine,
+        max_batch: int,
+        load_position: Callable[[], Optional[Dict[str, Any]]] = _nothing,
+        save_position: Callable[[Dict[str, Any]], None] = _nothing,
+        on_user_change: Callable[[str], None] = _nothing,
+    ):
+        self.path = path
+        self.engine = engine
+        self.max_batch = max_batch
+        self.save_position = save_position
+        # Called after each commit with the name of every user created or
+        # updated by it, so that caches in front of the engine can drop them.
+        self.on_user_change = on_user_change
+        self.position = load_position() or {
+            "segment": 0,
+            "offset": 0,
+            "lsn": 0,
+            "ts": None,
+        }
+        self._behind_bytes = 0
+        self._lock = threading.Lock()
+
+    def tick(self) -> int:
+        """Applies whatever has arrived. Returns the number of calls."""
+        applied = 0
+        while True:
+            ops, position = self._read(self.max_batch)
+            if not ops:
+                break
+            with self.engine.atomic(write=True):
+                for op in ops:
+                    _apply(self.engine, op)
+                self.save_position(position)
+            with self._lock:
+                self.position = position
+            for op in ops:
+                if op["call"] == "create_user":
+                    self.on_user_change(op["args"]["name"])
+                elif op["call"] == "update_user":
+                    self.on_user_change(op["args"]["user_name"])
+            applied += len(ops)
+
+        behind_bytes = self._unread_bytes()
+        with self._lock:
+            self._behind_bytes = behind_bytes
+        status = self.status()
+        metrics().set_gauge("replication.lsn", status["lsn"])
+        metrics().set_gauge("replication.lag_s", status["lag_s"])
+        metrics().set_gauge("replication.behind_bytes", behind_bytes)
+        return applied
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            position = dict(self.position)
+            behind_bytes = self._behind_bytes
+
+        # Lag is how long ago the last applied commit happened on the
+        # leader, while anything remains unapplied.
+        lag_s = 0.0
+        if behind_bytes and position["ts"] is not None:
+            lag_s = max(
+                0.0,
+                (datetime.datetime.utcnow() -
+                 _parse_ts(position["ts"])).total_seconds(),
+            )
+        return {
+            "role": "follower",
+            "lsn": position["lsn"],
+            "applied_ts": position["ts"],
+            "lag_s": lag_s,
+            "behind_bytes": behind_bytes,
+        }
+
+    def _read(self, limit: int) -> Tuple[List[Op], Dict[str, Any]]:
+        # Reads whole transactions, until at least `limit` calls.
+        position = dict(self.position)
+        ops = []
+        while len(ops) < limit:
+            path = segment_path(self.path, position["segment"])
+            if not os.path.exists(path):
+                break
+            with open(path, "rb") as segment:
+                segment.seek(position["offset"])
+                offset = position["offset"]
+                calls = []
+                for line in segment:
+                    # A line without its newline is still being written.
+                    if not line.endswith(b"\n"):
+                        break
+                    offset += len(line)
+                    op = _load(line)
+                    if "lsn" in op:
+                        calls.append(op)
+                        continue
+                    position["offset"] = offset
+                    if "commit" in op:
+                        for op in calls:
+                            if op["lsn"] <= position["lsn"]:
+                                continue
+                            position["lsn"] = op["lsn"]
+                            position["ts"] = op["ts"]
+                            ops.append(op)
+                    calls = []
+                    if len(ops) >= limit:
+                        return ops, position
+            # Move on only once the leader has started the next segment.
+            next_path = segment_path(self.path, position["segment"] + 1)
+            if not os.path.exists(next_path) or \
+                    position["offset"] < os.path.getsize(path):
+                break
+            position["segment"] += 1
+            position["offset"] = 0
+        return ops, position
+
+    def _unread_bytes(self) -> int:
+        position = self.position
+        total = 0
+        for segment in list_segments(self.path):
+            if segment >= position["segment"]:
+                total += os.path.getsize(segment_path(self.path, segment))
+        return max(0, total - position["offset"])
+
+
+class Replication:
+    """The leader's change log or the follower, whichever this node has."""
+
+    def __init__(self):
+        self.log: Optional[ChangeLog] = None
+        self.follower: Optional[Follower] = None
+
+    def status(self) -> Dict[str, Any]:
+        if self.log is not None:
+            return self.log.status()
+        if self.follower is not None:
+            return self.follower.status()
+        return {"role": "standalone"}
+
+
+def load_position() -> Optional[Dict[str, Any]]:
+    """A SQLite follower's position, kept beside the rows it covers."""
+    row = ReplicationPosition.get_or_none(ReplicationPosition.id == 1)
+    if row is None:
+        return None
+    return {
+        "segment": row.segment,
+        "offset": row.offset,
+        "lsn": row.lsn,
+        "ts": row.ts,
+    }
+
+
+def save_position(position: Dict[str, Any]) -> None:
+    ReplicationPosition.replace(id=1, **position).execute()
+
+
+def segment_path(path: str, segment: int) -> str:
+    return os.path.join(path, f"changes.{segment:08d}")
+
+
+def list_segments(path: str) -> List[int]:
+    if not os.path.isdir(path):
+        return []
+    return sorted(
+        int(match[1])
+        for match in map(_SEGMENT_PATTERN.match, os.listdir(path))
+        if match
+    )
+
+
+def _recover_tail(path: str, truncate: bool) -> Tuple[int, List[Op]]:
+    # Finds the last lsn, and the calls after the last commit or abort, and
+    # drops a line torn by a crash mid-write.
+    lsn = 0
+    pending = []
+    good = 0
+    with open(path, "rb") as segment:
+        for line in segment:
+            if not line.endswith(b"\n"):
+                break
+            op = _load(line)
+            if "lsn" in op:
+                lsn = op["lsn"]
+                pending.append(op)
+            else:
+                pending = []
+            good += len(line)
+    if truncate:
+        with open(path, "ab") as segment:
+            segment.truncate(good)
+    return lsn, pending
+
+
+def _apply(engine: Engine, op: Op) -> None:
+    call, args = op["call"], _decode_args(op["args"])
+    try:
+        with engine.atomic():
+            if call == "update_user":
+                user = engine.select_user_by_name(args.pop("user_name"))
+                if user is None:
+                    raise LookupError("user does not exist")
+                engine.update_user(user=user, **args)
+            elif call == "update_secret":
+                secret = engine.select_secret_by_name(
+                    args.pop("secret_name")
+                )
+                if secret is None:
+                    raise LookupError("secret does not exist")
+                engine.update_secret(secret=secret, **args)
+            else:
+                getattr(engine, call)(**args)
+    except (IntegrityError, LookupError) as error:
+        # Rows reaped here before the leader reaped them, or applied
+        # already. Either way there is nothing left to do.
+        LOG.warning(
+            "replication: skipping lsn %d (%s): %s",
+            op["lsn"],
+            call,
+            error,
+        )
+        metrics().increment("replication.skipped")
+
+
+def _create_call(row: Any) -> Tuple[str, Dict[str, Any]]:
+    if isinstance(row, User):
+        return "create_user", {
+            "id": row.id,
+            "name": row.name,
+            "create_ts": row.create_ts,
+        }
+    if isinstance(row, Secret):
+        return "create_secret", {
+            "id": row.id,
+            "name": row.name,
+            "hash": row.hash,
+            "create_ts": row.create_ts,
+            "expire_ts": row.expire_ts,
+            "user_id": row.user_id,
+        }
+    if isinstance(row, AccessToken):
+        return "create_access_token", {
+            "id": row.id,
+            "value": row.value,
+            "create_ts": row.create_ts,
+            "expire_ts": row.expire_ts,
+            "secret_id": row.secret_id,
+        }
+    if isinstance(row, RefreshToken):
+        return "create_refresh_token", {
+            "id": row.id,
+            "value": row.value,
+            "create_ts": row.create_ts,
+            "expire_ts": row.expire_ts,
+            "access_token_id": row.access_token_id,
+        }
+    raise TypeError(f"cannot replicate {type(row).__name__}")
+
+
+def _set(args: Dict[str, Any]) -> Dict[str, Any]:
+    return {name: value for name, value in args.items() if value is not UNSET}
+
+
+# Values are tagged so that they decode to the types they were written as.
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, datetime.datetime):
+        return {"$ts": value.isoformat()}
+    if isinstance(value, uuid.UUID):
+        return {"$uuid": str(value)}
+    if isinstance(value, bytes):
+        return value.decode()
+    raise TypeError(f"cannot encode {type(value).__name__}")
+
+
+def _decode(value: Dict[str, Any]) -> Any:
+    if "$ts" in value:
+        return _parse_ts(value["$ts"])
+    if "$uuid" in value:
+        return uuid.UUID(value["$uuid"])
+    return value
+
+
+def _dump(op: Op) -> str:
+    return json.dumps(op, default=_encode, separators=(",", ":")) + "\n"
+
+
+def _load(line: bytes) -> Op:
+    op = json.loads(line)
+    if "ts" in op:
+        op["ts"] = op["ts"]["$ts"]
+    return op
+
+
+def _decode_args(args: Dict[str, Any]) -> Dict[str, Any]:
+    return {name: _decode_arg(value) for name, value in args.items()}
+
+
+def _decode_arg(value: Any) -> Any:
+    if isinstance(value, dict):
+        return _decode(value)
+    if isinstance(value, list):
+        return [_decode_arg(item) for item in value]
+    return value
+
+
+def _parse_ts(value: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(value)
+
+
+__SINGLETON = Replication()
+
+
+def replication() -> Replication:
+    global __SINGLETON
+    return __SINGLETON
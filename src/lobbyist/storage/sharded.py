@@ -0,0 +1,636 @@
+"""
+SQLite storage with access and refresh tokens spread across several files.
+
+Users and secrets stay in the primary database behind `db()`. Each token
+goes to shard `hash(value) % n`, so concurrent issuance contends for n write
+locks rather than one:
+
+    <db_path>.tokens.<index>-of-<n>
+
+Shards cannot hold foreign keys into each other or into the primary, so the
+engine checks references itself. Token writes commit in their shard ahead of
+the caller's primary transaction; if that transaction rolls back, the tokens
+it wrote are unreachable (their values were never returned) and are reaped
+when they expire.
+
+`rebalance` moves tokens between layouts, offline.
+"""
+
+import collections
+import datetime
+import hashlib
+import os
+import re
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+import peewee
+
+from .engine import EVICTION_OFFSET, IntegrityError
+from .migrations import TOKEN_SCHEMA, Migration, migrate
+from .sqlite import (
+    SqliteEngine, _incremental_vacuum, _where_secret_dead, _where_user_dead
+)
+from ..library import db, log
+from ..models.auth import AccessToken, RefreshToken
+from ..models.records import AccessTokenRecord
+from ..models.secret import Secret
+from ..models.shard import TreeVersion
+from ..models.user import User
+
+LOG = log.logger(__name__)
+DB = db.db()
+
+# As of the first shard migration; see storage/migrations.py.
+_SHARD_SCHEMA = [
+    *TOKEN_SCHEMA,
+    (
+        'CREATE TABLE IF NOT EXISTS "treeversion" ('
+        '"user" TEXT NOT NULL PRIMARY KEY, "version" INTEGER NOT NULL)'
+    ),
+]
+
+
+def _create_shard_schema(shard: peewee.Database) -> None:
+    for statement in _SHARD_SCHEMA:
+        shard.execute_sql(statement)
+
+
+SHARD_MIGRATIONS = [
+    Migration("create schema", _create_shard_schema),
+]
+
+# The foreign key each token would have, were its parent in the same file.
+_PARENT = {AccessToken: "secret", RefreshToken: "access_token"}
+
+
+class ShardedSqliteEngine(SqliteEngine):
+    def __init__(self, shards: List[peewee.Database]):
+        self.shards = shards
+
+    def close(self) -> None:
+        for shard in self.shards:
+            shard.close()
+        super().close()
+
+    def select_user_by_name(self, name: str) -> Optional[User]:
+        user = super().select_user_by_name(name)
+        if user:
+            user.tree_version += sum(
+                TreeVersion.select(TreeVersion.version).where(
+                    TreeVersion.user == user.id
+                ).scalar(shard) or 0 for shard in self.shards
+            )
+        return user
+
+    def select_next_expire_ts_by_user(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> Optional[datetime.datetime]:
+        secrets = self._select_valid_secrets_by_id(server_ts, user_id)
+        access_tokens = self._select_valid_access_tokens_by_secret(
+            server_ts,
+            secrets,
+        )
+        refresh_tokens = self._select_valid_refresh_tokens_by_access_token(
+            server_ts,
+            access_tokens,
+        )
+        return min(
+            filter(
+                None,
+                (
+                    row.expire_ts
+                    for rows in (secrets, access_tokens, refresh_tokens)
+                    for row in rows.values()
+                ),
+            ),
+            default=None,
+        )
+
+    def create_access_token(
+        self,
+        id: uuid.UUID,
+        value: str,
+        create_ts: datetime.datetime,
+        expire_ts: datetime.datetime,
+        secret_id: uuid.UUID,
+    ) -> AccessToken:
+        secret = Secret.select(Secret.user
+                              ).where(Secret.id == secret_id).tuples().first()
+        if secret is None:
+            raise IntegrityError(f"secret {secret_id} does not exist")
+
+        access_token = AccessToken(
+            id=id,
+            value=value,
+            create_ts=create_ts,
+            expire_ts=expire_ts,
+            secret=secret_id,
+        )
+        self._insert(access_token, secret[0])
+        return access_token
+
+    def select_access_token_by_value(
+        self,
+        value: str,
+    ) -> Optional[AccessToken]:
+        access_token = AccessToken.select().where(
+            AccessToken.value == value
+        ).first(self._shard(value))
+        if access_token is None:
+            return None
+
+        secret = Secret.select(Secret, User).join(User).where(
+            Secret.id == access_token.secret_id
+        ).first()
+        if secret is None:
+            return None
+
+        access_token.secret = secret
+        return access_token
+
+    def select_valid_access_token_record_by_value(
+        self,
+        server_ts: datetime.datetime,
+        value: str,
+    ) -> Optional[AccessTokenRecord]:
+        row = AccessToken.select(
+            AccessToken.id,
+            AccessToken.expire_ts,
+            AccessToken.secret,
+        ).where((AccessToken.value == value) &
+                AccessToken.where_valid(server_ts)
+               ).tuples().first(self._shard(value))
+        if row is None:
+            return None
+
+        user = Secret.select(Secret.user).join(User).where(
+            (Secret.id == row[2]) & Secret.where_valid(server_ts) &
+            User.where_valid(server_ts)
+        ).tuples().first()
+        return AccessTokenRecord(*row, user[0]) if user else None
+
+    def select_valid_access_tokens_by_user(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> Iterable[AccessToken]:
+        return self._select_valid_access_tokens_by_secret(
+            server_ts,
+            self._select_valid_secrets_by_id(server_ts, user_id),
+        ).values()
+
+    def create_refresh_token(
+        self,
+        id: uuid.UUID,
+        value: str,
+        create_ts: datetime.datetime,
+        expire_ts: datetime.datetime,
+        access_token_id: uuid.UUID,
+    ) -> RefreshToken:
+        access_token = self._select_access_token_by_id(access_token_id)
+        if access_token is None:
+            raise IntegrityError(
+                f"access token {access_token_id} does not exist"
+            )
+
+        refresh_token = RefreshToken(
+            id=id,
+            value=value,
+            create_ts=create_ts,
+            expire_ts=expire_ts,
+            access_token=access_token,
+        )
+        # Unlike elsewhere, the refresh token moves the tree version too: it
+        # commits in its own shard, after its access token.
+        self._insert(refresh_token, access_token.secret.user_id)
+        return refresh_token
+
+    def evict_access_tokens(
+        self,
+        server_ts: datetime.datetime,
+        secret_id: uuid.UUID,
+        keep: int,
+    ) -> int:
+        # Each shard's updates commit in that shard, like inserts.
+        evicted = sorted(
+            (
+                (create_ts, id, shard) for shard in self.shards
+                for id, create_ts in AccessToken.
+                select_valid_ids_by_secret(server_ts, secret_id).tuples().
+                execute(shard)
+            ),
+            key=lambda row: row[0],
+            reverse=True,
+        )[keep:]
+        if not evicted:
+            return 0
+        user = Secret.select(Secret.user).where(Secret.id == secret_id
+                                               ).tuples().first()
+        expire_ts = server_ts - EVICTION_OFFSET
+        ids = [id for _, id, _ in evicted]
+        for shard in self.shards:
+            with shard.atomic():
+                AccessToken.update(expire_ts=expire_ts).where(
+                    AccessToken.id.in_(ids)
+                ).execute(shard)
+                RefreshToken.update(expire_ts=expire_ts).where(
+                    RefreshToken.access_token.in_(ids) &
+                    (RefreshToken.expire_ts > expire_ts)
+                ).execute(shard)
+                if user is not None:
+                    _bump_tree_version(shard, user[0])
+        return len(evicted)
+
+    def select_valid_refresh_tokens_by_user(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> Iterable[RefreshToken]:
+        secrets = self._select_valid_secrets_by_id(server_ts, user_id)
+        return self._select_valid_refresh_tokens_by_access_token(
+            server_ts,
+            self._select_valid_access_tokens_by_secret(server_ts, secrets),
+        ).values()
+
+    def select_valid_refresh_tokens_by_access_token(
+        self,
+        server_ts: datetime.datetime,
+        access_token_id: uuid.UUID,
+    ) -> Iterable[RefreshToken]:
+        access_token = self._select_access_token_by_id(access_token_id)
+        if access_token is None:
+            return []
+
+        refresh_tokens = []
+        for shard in self.shards:
+            for refresh_token in RefreshToken.select().where(
+                (RefreshToken.access_token == access_token_id) &
+                RefreshToken.where_valid(server_ts)
+            ).execute(shard):
+                refresh_token.access_token = access_token
+                refresh_tokens.append(refresh_token)
+        return refresh_tokens
+
+    def reap(
+        self,
+        cutoff: datetime.datetime,
+        batch_size: int,
+    ) -> Dict[str, int]:
+        deleted = collections.Counter()
+
+        # As with a single file, children go before their parents, but the
+        # references are checked across every shard rather than by EXISTS.
+        for shard in self.shards:
+            deleted[RefreshToken._meta.table_name] += _delete_in_batches(
+                shard,
+                RefreshToken,
+                RefreshToken.expire_ts < cutoff,
+                batch_size,
+            )
+        for shard in self.shards:
+            deleted[AccessToken._meta.table_name] += _delete_in_batches(
+                shard,
+                AccessToken,
+                AccessToken.expire_ts < cutoff,
+                batch_size,
+                referenced=lambda ids: self._referenced(
+                    RefreshToken.access_token,
+                    ids,
+                ),
+            )
+        deleted[Secret._meta.table_name] += _delete_in_batches(
+            DB,
+            Secret,
+            _where_secret_dead(cutoff),
+            batch_size,
+            referenced=lambda ids: self._referenced(AccessToken.secret, ids),
+        )
+        deleted[User._meta.table_name] += _delete_in_batches(
+            DB,
+            User,
+            _where_user_dead(cutoff),
+            batch_size,
+            on_delete=self._delete_tree_versions,
+        )
+
+        return dict(deleted)
+
+    def vacuum(self, pages: int) -> int:
+        return super().vacuum(pages) + sum(
+            _incremental_vacuum(shard, pages) for shard in self.shards
+        )
+
+    def export(self) -> Iterable[Any]:
+        for model in (User, Secret):
+            yield from model.select().order_by(model.create_ts).iterator()
+        for model in (AccessToken, RefreshToken):
+            for shard in self.shards:
+                yield from model.select().order_by(
+                    model.create_ts
+                ).iterator(shard)
+
+    def _shard(self, value: str) -> peewee.Database:
+        return self.shards[shard_index(value, len(self.shards))]
+
+    def _insert(self, token: peewee.Model, user_id: uuid.UUID) -> None:
+        # The tree version bump commits with the token, in its shard.
+        shard = self._shard(token.value)
+        try:
+            with shard.atomic():
+                type(token).insert(**token.__data__).execute(shard)
+                _bump_tree_version(shard, user_id)
+        except peewee.IntegrityError as error:
+            raise IntegrityError(str(error))
+
+    def _select_access_token_by_id(
+        self,
+        access_token_id: uuid.UUID,
+    ) -> Optional[AccessToken]:
+        # Ids carry no shard, so every shard is asked.
+        for shard in self.shards:
+            access_token = AccessToken.select().where(
+                AccessToken.id == access_token_id
+            ).first(shard)
+            if access_token is not None:
+                access_token.secret = Secret.select(Secret, User).join(
+                    User
+                ).where(Secret.id == access_token.secret_id).first()
+                return access_token if access_token.secret else None
+        return None
+
+    def _select_valid_secrets_by_id(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> Dict[uuid.UUID, Secret]:
+        return {
+            secret.id: secret
+            for secret in Secret.select_valid_by_user(server_ts, user_id)
+        }
+
+    def _select_valid_access_tokens_by_secret(
+        self,
+        server_ts: datetime.datetime,
+        secrets: Dict[uuid.UUID, Secret],
+    ) -> Dict[uuid.UUID, AccessToken]:
+        access_tokens = {}
+        if not secrets:
+            return access_tokens
+        for shard in self.shards:
+            for access_token in AccessToken.select().where(
+                AccessToken.secret.in_(list(secrets)) &
+                AccessToken.where_valid(server_ts)
+            ).execute(shard):
+                access_token.secret = secrets[access_token.secret_id]
+                access_tokens[access_token.id] = access_token
+        return access_tokens
+
+    def _select_valid_refresh_tokens_by_access_token(
+        self,
+        server_ts: datetime.datetime,
+        access_tokens: Dict[uuid.UUID, AccessToken],
+    ) -> Dict[uuid.UUID, RefreshToken]:
+        refresh_tokens = {}
+        if not access_tokens:
+            return refresh_tokens
+        for shard in self.shards:
+            for refresh_token in RefreshToken.select().where(
+                RefreshToken.access_token.in_(list(access_tokens)) &
+                RefreshToken.where_valid(server_ts)
+            ).execute(shard):
+                refresh_token.access_token = access_tokens[
+                    refresh_token.access_token_id]
+                refresh_tokens[refresh_token.id] = refresh_token
+        return refresh_tokens
+
+    def _referenced(
+        self,
+        field: peewee.ForeignKeyField,
+        ids: List[uuid.UUID],
+    ) -> Set[uuid.UUID]:
+        return {
+            row[0]
+            for shard in self.shards
+            for row in field.model.select(field).where(field.in_(ids)).
+            distinct().tuples().execute(shard)
+        }
+
+    def _delete_tree_versions(self, user_ids: List[uuid.UUID]) -> None:
+        for shard in self.shards:
+            TreeVersion.delete().where(TreeVersion.user.in_(user_ids)
+                                      ).execute(shard)
+
+
+def shard_index(value: str, count: int) -> int:
+    digest = hashlib.blake2b(value.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % count
+
+
+def shard_paths(path: str, count: int) -> List[str]:
+    return [f"{path}.tokens.{index}-of-{count}" for index in range(count)]
+
+
+def shard_counts(path: str) -> Set[int]:
+    """The shard counts of the layouts present beside the primary."""
+    pattern = re.compile(
+        re.escape(os.path.basename(path)) + r"\.tokens\.\d+-of-(\d+)$"
+    )
+    names = os.listdir(os.path.dirname(path) or ".")
+    return {int(match[1]) for match in map(pattern.match, names) if match}
+
+
+def open_shards(path: str, count: int, profile: str) -> List[peewee.Database]:
+    LOG.debug("storage.sharded.open_shards %s %d", path, count)
+
+    return [
+        _open_shard(shard_path, profile)
+        for shard_path in shard_paths(path, count)
+    ]
+
+
+def check_layout(path: str, count: int) -> None:
+    """Raises ValueError unless the tokens on disk are laid out for `count`."""
+    if shard_counts(path) - {count} or (
+        count and AccessToken.select().exists()
+    ):
+        raise ValueError(
+            f"tokens are not laid out across {count} shards; run "
+            "rebalance-shards first"
+        )
+
+
+def rebalance(
+    path: str,
+    count: int,
+    profile: str,
+    batch_size: int = 10000,
+) -> Dict[str, int]:
+    """
+    Moves every token into a layout of `count` shards, or back into the
+    primary database if `count` is 0. The primary database must be open and
+    nothing else may be using any of the files.
+    """
+    LOG.debug("storage.sharded.rebalance %s %d", path, count)
+
+    counts = shard_counts(path)
+    if len(counts) > 1:
+        raise ValueError(f"found more than one layout: {sorted(counts)}")
+    old_count = counts.pop() if counts else 0
+    report = collections.Counter({"from": old_count, "to": count})
+    if old_count == count:
+        return dict(report)
+
+    sources = open_shards(path, old_count, profile) if old_count else [DB]
+    # New files are written under a temporary name, so that an interrupted
+    # rebalance leaves the old layout as the only one.
+    targets = [
+        _open_shard(shard_path + ".tmp", profile)
+        for shard_path in shard_paths(path, count)
+    ]
+
+    # Moving into the primary, where foreign keys are enforced, drops
+    # orphans; their values were never handed out.
+    parent_ids = None
+    if not targets:
+        parent_ids = {
+            secret_id
+            for secret_id, in Secret.select(Secret.id).tuples()
+        }
+
+    def move(model: peewee.ModelBase, rows: List[Dict]) -> None:
+        by_target = collections.defaultdict(list)
+        for row in rows:
+            if parent_ids is not None:
+                if row[_PARENT[model]] not in parent_ids:
+                    report["dropped"] += 1
+                    continue
+            target = targets[shard_index(row["value"], count)
+                            ] if targets else DB
+            by_target[target].append(row)
+        for target, target_rows in by_target.items():
+            with target.atomic():
+                model.insert_many(target_rows).execute(target)
+            report[model._meta.table_name] += len(target_rows)
+
+    with DB.atomic():
+        for model in (AccessToken, RefreshToken):
+            for source in sources:
+                _in_batches(
+                    model.select().dicts().iterator(source),
+                    batch_size,
+                    lambda rows: move(model, rows),
+                )
+            if parent_ids is not None:
+                parent_ids = {
+                    access_token_id for access_token_id,
+                    in AccessToken.select(AccessToken.id).tuples()
+                }
+
+        # The per-user sums carry over, so tree versions never go backwards.
+        tree_versions = collections.Counter()
+        for source in sources if old_count else []:
+            for user_id, version in TreeVersion.select().tuples(
+            ).iterator(source):
+                tree_versions[user_id] += version
+        for user_id, version in tree_versions.items():
+            if targets:
+                TreeVersion.insert(user=user_id, version=version).execute(
+                    targets[shard_index(str(user_id), count)]
+                )
+            else:
+                User.update(tree_version=User.tree_version + version
+                           ).where(User.id == user_id).execute()
+
+        if not old_count:
+            RefreshToken.delete().execute()
+            AccessToken.delete().execute()
+
+        for database in targets + sources:
+            if database is not DB:
+                database.close()
+        for shard_path in shard_paths(path, count):
+            os.replace(shard_path + ".tmp", shard_path)
+        for shard_path in shard_paths(path, old_count):
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(shard_path + suffix):
+                    os.remove(shard_path + suffix)
+
+    return dict(report)
+
+
+def _open_shard(path: str, profile: str) -> peewee.Database:
+    # Shards hold no rows their foreign keys could refer to.
+    shard = db.SqliteDatabase(
+        path,
+        pragmas=dict(db.pragmas(profile), foreign_keys=0),
+    )
+    migrate(shard, SHARD_MIGRATIONS)
+    return shard
+
+
+def _bump_tree_version(shard: peewee.Database, user_id: uuid.UUID) -> None:
+    TreeVersion.insert(
+        user=user_id,
+        version=1,
+    ).on_conflict(
+        conflict_target=[TreeVersion.user],
+        update={TreeVersion.version: TreeVersion.version + 1},
+    ).execute(shard)
+
+
+def _delete_in_batches(
+    database: peewee.Database,
+    model: peewee.ModelBase,
+    where: peewee.Expression,
+    batch_size: int,
+    referenced: Optional[Callable[[List[uuid.UUID]], Set[uuid.UUID]]] = None,
+    on_delete: Optional[Callable[[List[uuid.UUID]], None]] = None,
+) -> int:
+    LOG.debug("storage.sharded._delete_in_batches %s", model.__name__)
+
+    # Rows that are still referenced stay put, so candidates are paged by id
+    # rather than re-selected from the top.
+    total = 0
+    after = None
+    while True:
+        query = model.select(model.id).where(where)
+        if after is not None:
+            query = query.where(model.id > after)
+        ids = [
+            id for id, in query.order_by(model.id).limit(batch_size).tuples().
+            execute(database)
+        ]
+        if not ids:
+            return total
+        after = ids[-1]
+
+        keep = referenced(ids) if referenced else set()
+        dead = [id for id in ids if id not in keep]
+        if dead:
+            total += db.retry_txn(
+                lambda: model.delete().where(model.id.in_(dead)).
+                execute(database),
+                database=database,
+            )
+            if on_delete:
+                on_delete(dead)
+        if len(ids) < batch_size:
+            return total
+
+
+def _in_batches(
+    rows: Iterable[Dict],
+    batch_size: int,
+    fn: Callable[[List[Dict]], None],
+) -> None:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            fn(batch)
+            batch = []
+    if batch:
+        fn(batch)
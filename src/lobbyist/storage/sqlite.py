@@ -0,0 +1,390 @@
+import datetime
+import uuid
+from typing import (
+    Any, ContextManager, Dict, Iterable, List, Optional, Tuple
+)
+
+import peewee
+
+from .engine import EVICTION_OFFSET, UNSET, Engine, IntegrityError
+from ..library import db, log
+from ..models.auth import AccessToken, RefreshToken
+from ..models.records import AccessTokenRecord, SecretRecord
+from ..models.secret import Secret
+from ..models.user import User
+
+LOG = log.logger(__name__)
+DB = db.db()
+
+
+class SqliteEngine(Engine):
+    """Stores everything through the peewee models and the `db()` proxy."""
+
+    def atomic(self, write: bool = False) -> ContextManager[None]:
+        # A deferred transaction that has read cannot wait for the write
+        # lock once another connection has committed since: SQLite fails it
+        # at once with "database is locked". IMMEDIATE waits at BEGIN,
+        # under busy_timeout, instead. Nested calls are savepoints, which
+        # ignore the lock type.
+        return DB.atomic("IMMEDIATE") if write else DB.atomic()
+
+    def close(self) -> None:
+        DB.close()
+
+    def create_user(
+        self,
+        id: uuid.UUID,
+        name: str,
+        create_ts: datetime.datetime,
+    ) -> User:
+        try:
+            return User.create(id=id, name=name, create_ts=create_ts)
+        except peewee.IntegrityError as error:
+            raise IntegrityError(str(error))
+
+    def select_user_by_name(self, name: str) -> Optional[User]:
+        record = User.select_record_by_name(name)
+        return User.from_record(record) if record else None
+
+    def update_user(
+        self,
+        server_ts: datetime.datetime,
+        user: User,
+        expire_ts: Optional[datetime.datetime] = UNSET,
+    ) -> User:
+        if expire_ts is not UNSET:
+            user.expire_ts = expire_ts
+            user.save(only=[User.expire_ts])
+        User.touch(user.id, server_ts)
+        _touch_user(user, server_ts)
+        return user
+
+    def select_next_expire_ts_by_user(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> Optional[datetime.datetime]:
+        expire_tss = []
+        for model in (Secret, AccessToken, RefreshToken):
+            query = model.select_valid_by_user(server_ts, user_id)
+            expire_ts = query.select(peewee.fn.MIN(model.expire_ts)).scalar()
+            expire_tss.append(model.expire_ts.python_value(expire_ts))
+        return min(filter(None, expire_tss), default=None)
+
+    def create_secret(
+        self,
+        id: uuid.UUID,
+        name: str,
+        hash: str,
+        create_ts: datetime.datetime,
+        expire_ts: Optional[datetime.datetime],
+        user_id: uuid.UUID,
+    ) -> Secret:
+        try:
+            secret = Secret.create(
+                id=id,
+                name=name,
+                hash=hash,
+                create_ts=create_ts,
+                expire_ts=expire_ts,
+                user=user_id,
+            )
+        except peewee.IntegrityError as error:
+            raise IntegrityError(str(error))
+        User.touch_tree(user_id, create_ts)
+        return secret
+
+    def select_secret_by_name(self, name: str) -> Optional[Secret]:
+        return Secret.select_by_name(name)
+
+    def select_valid_secret_record_by_name(
+        self,
+        server_ts: datetime.datetime,
+        name: str,
+    ) -> Optional[SecretRecord]:
+        return Secret.select_valid_record_by_name(server_ts, name)
+
+    def select_valid_secrets_by_user(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> Iterable[Secret]:
+        return Secret.select_valid_by_user(server_ts, user_id).iterator()
+
+    def update_secret(
+        self,
+        server_ts: datetime.datetime,
+        secret: Secret,
+        hash: str = UNSET,
+        expire_ts: Optional[datetime.datetime] = UNSET,
+    ) -> Secret:
+        only = []
+        if hash is not UNSET:
+            secret.hash = hash
+            only.append(Secret.hash)
+        if expire_ts is not UNSET:
+            secret.expire_ts = expire_ts
+            only.append(Secret.expire_ts)
+        if only:
+            secret.save(only=only)
+        Secret.touch(secret.id, server_ts)
+        User.touch_tree(secret.user_id, server_ts)
+        secret.version += 1
+        secret.modify_ts = server_ts
+        return secret
+
+    def expire_secrets(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+        secret_ids: List[uuid.UUID],
+        expire_ts: datetime.datetime,
+    ) -> int:
+        count = Secret.update(
+            expire_ts=expire_ts,
+            version=Secret.version + 1,
+            modify_ts=server_ts,
+        ).where(
+            (Secret.user == user_id) & Secret.id.in_(secret_ids) & (
+                Secret.expire_ts.is_null() | (Secret.expire_ts > expire_ts)
+            )
+        ).execute()
+        if count:
+            User.touch_tree(user_id, server_ts)
+        return count
+
+    def create_access_token(
+        self,
+        id: uuid.UUID,
+        value: str,
+        create_ts: datetime.datetime,
+        expire_ts: datetime.datetime,
+        secret_id: uuid.UUID,
+    ) -> AccessToken:
+        try:
+            access_token = AccessToken.create(
+                id=id,
+                value=value,
+                create_ts=create_ts,
+                expire_ts=expire_ts,
+                secret=secret_id,
+            )
+        except peewee.IntegrityError as error:
+            raise IntegrityError(str(error))
+        _touch_user_tree_where(
+            User.id == Secret.select(Secret.user).where(Secret.id == secret_id),
+            create_ts,
+        )
+        return access_token
+
+    def select_access_token_by_value(
+        self,
+        value: str,
+    ) -> Optional[AccessToken]:
+        return AccessToken.select_by_value(value)
+
+    def select_valid_access_token_record_by_value(
+        self,
+        server_ts: datetime.datetime,
+        value: str,
+    ) -> Optional[AccessTokenRecord]:
+        return AccessToken.select_valid_record_by_value(server_ts, value)
+
+    def select_valid_access_tokens_by_user(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> Iterable[AccessToken]:
+        return AccessToken.select_valid_by_user(server_ts, user_id).iterator()
+
+    def create_refresh_token(
+        self,
+        id: uuid.UUID,
+        value: str,
+        create_ts: datetime.datetime,
+        expire_ts: datetime.datetime,
+        access_token_id: uuid.UUID,
+    ) -> RefreshToken:
+        try:
+            refresh_token = RefreshToken.create(
+                id=id,
+                value=value,
+                create_ts=create_ts,
+                expire_ts=expire_ts,
+                access_token=access_token_id,
+            )
+        except peewee.IntegrityError as error:
+            raise IntegrityError(str(error))
+        return refresh_token
+
+    def evict_access_tokens(
+        self,
+        server_ts: datetime.datetime,
+        secret_id: uuid.UUID,
+        keep: int,
+    ) -> int:
+        ids = [
+            id for id, _ in AccessToken.select_valid_ids_by_secret(
+                server_ts,
+                secret_id,
+            ).offset(keep).tuples()
+        ]
+        if not ids:
+            return 0
+        expire_ts = server_ts - EVICTION_OFFSET
+        AccessToken.update(expire_ts=expire_ts).where(
+            AccessToken.id.in_(ids)
+        ).execute()
+        RefreshToken.update(expire_ts=expire_ts).where(
+            RefreshToken.access_token.in_(ids) &
+            (RefreshToken.expire_ts > expire_ts)
+        ).execute()
+        _touch_user_tree_where(
+            User.id == Secret.select(Secret.user).where(Secret.id == secret_id),
+            server_ts,
+        )
+        return len(ids)
+
+    def select_valid_refresh_tokens_by_user(
+        self,
+        server_ts: datetime.datetime,
+        user_id: uuid.UUID,
+    ) -> Iterable[RefreshToken]:
+        return RefreshToken.select_valid_by_user(server_ts, user_id).iterator()
+
+    def select_valid_refresh_tokens_by_access_token(
+        self,
+        server_ts: datetime.datetime,
+        access_token_id: uuid.UUID,
+    ) -> Iterable[RefreshToken]:
+        return RefreshToken.select_valid_by_access_token(
+            server_ts,
+            access_token_id,
+        ).iterator()
+
+    def select_modified_since(
+        self,
+        since: datetime.datetime,
+    ) -> Iterable[Tuple[
+        uuid.UUID,
+        datetime.datetime,
+        Optional[datetime.datetime],
+    ]]:
+        return [
+            row for model in (User, Secret)
+            for row in model.select(
+                model.id,
+                model.modify_ts,
+                model.expire_ts,
+            ).where(
+                model.modify_ts >= since
+            ).tuples()
+        ]
+
+    def reap(
+        self,
+        cutoff: datetime.datetime,
+        batch_size: int,
+    ) -> Dict[str, int]:
+        # Children are deleted before their parents so that foreign-key
+        # constraints hold after every batch. A parent row is only eligible
+        # once none of its children remain.
+        return {
+            model._meta.table_name:
+                _delete_in_batches(model, where, batch_size)
+            for model, where in (
+                (RefreshToken, _where_refresh_token_dead(cutoff)),
+                (AccessToken, _where_access_token_dead(cutoff)),
+                (Secret, _where_secret_dead(cutoff)),
+                (User, _where_user_dead(cutoff)),
+            )
+        }
+
+    def vacuum(self, pages: int) -> int:
+        return _incremental_vacuum(DB, pages)
+
+    def export(self) -> Iterable[Any]:
+        for model in (User, Secret, AccessToken, RefreshToken):
+            yield from model.select().order_by(model.create_ts).iterator()
+
+
+def _touch_user(user: User, server_ts: datetime.datetime) -> None:
+    # Keeps the caller's copy in step with User.touch.
+    user.version += 1
+    user.modify_ts = server_ts
+    user.tree_version += 1
+    user.tree_modify_ts = server_ts
+
+
+def _touch_user_tree_where(
+    where: peewee.Expression,
+    server_ts: datetime.datetime,
+) -> None:
+    User.update(
+        tree_version=User.tree_version + 1,
+        tree_modify_ts=server_ts,
+    ).where(where).execute()
+
+
+def _where_refresh_token_dead(cutoff: datetime.datetime) -> peewee.Expression:
+    return RefreshToken.expire_ts < cutoff
+
+
+def _where_access_token_dead(cutoff: datetime.datetime) -> peewee.Expression:
+    # Refresh tokens routinely outlive the access token they were issued with.
+    return (AccessToken.expire_ts < cutoff) & ~peewee.fn.EXISTS(
+        RefreshToken.select(RefreshToken.id
+                           ).where(RefreshToken.access_token == AccessToken.id)
+    )
+
+
+def _where_secret_dead(cutoff: datetime.datetime) -> peewee.Expression:
+    return (
+        (Secret.expire_ts < cutoff) |
+        Secret.user.in_(User.select(User.id).where(User.expire_ts < cutoff))
+    ) & ~peewee.fn.EXISTS(
+        AccessToken.select(AccessToken.id
+                          ).where(AccessToken.secret == Secret.id)
+    )
+
+
+def _where_user_dead(cutoff: datetime.datetime) -> peewee.Expression:
+    return (User.expire_ts < cutoff) & ~peewee.fn.EXISTS(
+        Secret.select(Secret.id).where(Secret.user == User.id)
+    )
+
+
+def _delete_in_batches(
+    model: peewee.ModelBase,
+    where: peewee.Expression,
+    batch_size: int,
+) -> int:
+    LOG.debug("storage.sqlite._delete_in_batches %s", model.__name__)
+
+    total = 0
+    while True:
+        # One short transaction per batch keeps the write lock hold time
+        # bounded, so request writers interleave between batches.
+        deleted = db.retry_txn(
+            lambda: model.delete().where(
+                model.id.in_(model.select(model.id).where(where).
+                             limit(batch_size))
+            ).execute()
+        )
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+
+def _incremental_vacuum(database: peewee.Database, pages: int) -> int:
+    LOG.debug("storage.sqlite._incremental_vacuum %d", pages)
+
+    before = _freelist_count(database)
+    # The pragma frees one page per step; the cursor must be drained for all
+    # of the steps to run.
+    database.execute_sql(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return max(0, before - _freelist_count(database))
+
+
+def _freelist_count(database: peewee.Database) -> int:
+    return database.execute_sql("PRAGMA freelist_count").fetchone()[0]
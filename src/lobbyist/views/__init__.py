@@ -1,2 +1,3 @@
+from .replication import *
 from .secret import *
 from .user import *
@@ -0,0 +1,173 @@
+import datetime
+import hmac
+import os
+import tempfile
+import time
+from typing import Optional
+
+import flask
+
+from ..library import app, error, log, serialization, validation
+from ..library.config import config
+from ..library.db import db
+from ..library.metrics import metrics
+from ..library.profiler import profiler
+from ..library.queries import queries
+
+LOG = log.logger(__name__)
+APP = app.app()
+
+# Set from config().admin_token_path at startup. Without it, the admin
+# endpoints do not exist.
+TOKEN: Optional[str] = None
+
+COLLAPSED_MIMETYPE = "text/plain"
+TAR_MIMETYPE = "application/x-tar"
+GZIP_MIMETYPE = "application/gzip"
+
+
+def load_token(path: str) -> None:
+    global TOKEN
+    with open(path) as file:
+        TOKEN = file.read().strip()
+    if not TOKEN:
+        raise ValueError(f"no admin token in {path}")
+    profiler().enabled = True
+    APP.before_request(_begin_profile)
+    APP.teardown_request(_end_profile)
+
+
+def _begin_profile() -> None:
+    # Runs after app.start_request, which sets the id and start time.
+    rule = flask.request.url_rule
+    profiler().begin_request(
+        flask.g.request_id,
+        f"{flask.request.method} {rule.rule if rule else flask.request.path}",
+    )
+
+
+def _end_profile(error) -> None:
+    # Runs whether or not the request raised.
+    profiler().end_request(time.perf_counter() - flask.g.start)
+
+
+@APP.route("/admin/profile", methods=["GET"])
+def read_profile():
+    LOG.debug("views.admin.read_profile")
+
+    _authorize()
+    profiler().ignore_request()
+    duration_s = validation.optional_arg_profile_duration("seconds")
+    all_threads = flask.request.args.get("threads") == "all"
+
+    LOG.info("admin: profiling for %ss", duration_s)
+    return _collapsed(profiler().profile(duration_s, all_threads))
+
+
+@APP.route("/admin/profile/slowest", methods=["GET"])
+def read_slowest_profiles():
+    LOG.debug("views.admin.read_slowest_profiles")
+
+    _authorize()
+    return _collapsed(profiler().slowest())
+
+
+@APP.route("/admin/profile/slowest", methods=["DELETE"])
+def delete_slowest_profiles():
+    LOG.debug("views.admin.delete_slowest_profiles")
+
+    _authorize()
+    profiler().slowest(reset=True)
+    return flask.Response(status=204)
+
+
+@APP.route("/admin/queries", methods=["GET"])
+def read_queries():
+    LOG.debug("views.admin.read_queries")
+
+    _authorize()
+    validation.validate_accept()
+    limit = flask.request.args.get("limit", 20, type=int)
+
+    return serialization.into_response(
+        {"queries": [query.into_dict() for query in queries().top(limit)]},
+        200,
+    )
+
+
+@APP.route("/admin/queries", methods=["DELETE"])
+def delete_queries():
+    LOG.debug("views.admin.delete_queries")
+
+    _authorize()
+    queries().reset()
+    return flask.Response(status=204)
+
+
+@APP.route("/admin/metrics", methods=["GET"])
+def read_metrics():
+    LOG.debug("views.admin.read_metrics")
+
+    _authorize()
+    validation.validate_accept()
+
+    return serialization.into_response(metrics().snapshot(), 200)
+
+
+@APP.route("/admin/backup", methods=["GET"])
+def read_backup():
+    LOG.debug("views.admin.read_backup")
+
+    _authorize()
+    profiler().ignore_request()
+    compress = flask.request.args.get("compress") == "gzip"
+    if db().obj is None:
+        raise error.NotFoundError("storage is not sqlite")
+
+    from ..storage import backup
+
+    path = db().database
+    directory = tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(path))
+    )
+    try:
+        LOG.info("admin: backing up %s", path)
+        files = backup.snapshot(
+            path,
+            directory.name,
+            config().db_backup_step_pages,
+            config().db_backup_step_pause,
+        )
+    except BaseException:
+        directory.cleanup()
+        raise
+
+    response = flask.Response(
+        backup.iter_archive(
+            files,
+            config().db_backup_compress_level if compress else 0,
+            config().stream_chunk_size,
+        ),
+        200,
+        mimetype=GZIP_MIMETYPE if compress else TAR_MIMETYPE,
+    )
+    response.call_on_close(directory.cleanup)
+    response.headers["Content-Disposition"] = (
+        "attachment; filename=lobbyist-{}.tar{}".format(
+            datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ"),
+            ".gz" if compress else "",
+        )
+    )
+    return response
+
+
+def _authorize() -> None:
+    if TOKEN is None:
+        raise error.NotFoundError("not found")
+    token = validation.validate_authentication_bearer()
+    if not hmac.compare_digest(token.encode(), TOKEN.encode()):
+        raise error.UnauthorizedError("invalid admin token")
+
+
+def _collapsed(stacks: str) -> flask.Response:
+    return flask.Response(stacks, 200, mimetype=COLLAPSED_MIMETYPE)
@@ -0,0 +1,17 @@
+
+from ..library import app, log, serialization, validation
+from ..controllers import replication
+
+LOG = log.logger(__name__)
+APP = app.app()
+
+
+@APP.route("/replication", methods=["GET"])
+def read_replication():
+    LOG.debug("views.replication.read_replication")
+
+    validation.validate_accept()
+
+    response = replication.read_replication()
+
+    return serialization.into_response(response.into_dict(), 200)
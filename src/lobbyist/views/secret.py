@@ -3,20 +3,31 @@ POST    /secret         [['expire_ts']]
 GET     /secret/<name>
 PATCH   /secret/<name>  [['value' if password; 'expire_ts' if not password]]
 DELETE  /secret/<name>  [[if not password]]
+POST    /user/<name>/secrets/rotate  [['names'+; 'grace_period'; 'expire_ts']]
 """
 
 import datetime
-import logging
 
-from ..library import app, config, error, validation
+from ..library import (
+    app,
+    conditional,
+    config,
+    error,
+    idempotency,
+    log,
+    serialization,
+    validation,
+)
 from ..controllers import secret
 
+LOG = log.logger(__name__)
 APP = app.app()
 
 
 @APP.route("/secret", methods=["POST"])
+@idempotency.idempotent
 def create_secret():
-    logging.debug("views.secret.create_secret")
+    LOG.debug("views.secret.create_secret")
 
     server_ts = datetime.datetime.utcnow()
 
@@ -30,12 +41,12 @@ def create_secret():
         expire_ts=expire_ts,
     )
 
-    return (response.into_dict(), 201)
+    return serialization.into_response(response.into_dict(), 201)
 
 
 @APP.route("/secret/<name>", methods=["GET"])
 def read_secret(name: str):
-    logging.debug("views.secret.read_secret")
+    LOG.debug("views.secret.read_secret")
 
     server_ts = datetime.datetime.utcnow()
 
@@ -48,4 +59,29 @@ def read_secret(name: str):
         access_token_value=access_token,
     )
 
-    return (response.into_dict(), 200)
+    return conditional.into_response(response, 200)
+
+
+@APP.route("/user/<name>/secrets/rotate", methods=["POST"])
+@idempotency.idempotent
+def rotate_secrets(name: str):
+    LOG.debug("views.secret.rotate_secrets")
+
+    server_ts = datetime.datetime.utcnow()
+
+    validation.validate_accept()
+    access_token = validation.validate_authentication_bearer()
+    secret_names = validation.required_field_secret_names("names")
+    grace_period = validation.optional_field_grace_period("grace_period")
+    expire_ts = validation.optional_field_expire_ts("expire_ts")
+
+    response = secret.rotate_secrets(
+        server_ts=server_ts,
+        name=name,
+        access_token_value=access_token,
+        secret_names=secret_names,
+        grace_period=grace_period,
+        expire_ts=expire_ts,
+    )
+
+    return serialization.into_response(response.into_dict(), 201)
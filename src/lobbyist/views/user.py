@@ -1,15 +1,18 @@
 import datetime
-import logging
 
-from ..library import app, error, validation
+from ..library import (
+    app, conditional, error, idempotency, log, serialization, validation
+)
 from ..controllers import user
 
+LOG = log.logger(__name__)
 APP = app.app()
 
 
 @APP.route("/user", methods=["POST"])
+@idempotency.idempotent
 def create_user():
-    logging.debug("views.user.create_user")
+    LOG.debug("views.user.create_user")
 
     server_ts = datetime.datetime.utcnow()
 
@@ -31,12 +34,16 @@ def create_user():
         refresh_token_lifetime=refresh_token_lifetime,
     )
 
-    return (response.into_dict(), 201)
+    return serialization.into_response(
+        response.into_dict(),
+        201,
+        within=response.reading(),
+    )
 
 
 @APP.route("/user/<name>", methods=["GET"])
 def read_user(name: str):
-    logging.debug("views.user.read_user")
+    LOG.debug("views.user.read_user")
 
     server_ts = datetime.datetime.utcnow()
 
@@ -52,12 +59,12 @@ def read_user(name: str):
         access_token_value=access_token,
     )
 
-    return (response.into_dict(), 200)
+    return conditional.into_response(response, 200)
 
 
 @APP.route("/user/<name>", methods=["PATCH"])
 def update_user(name: str):
-    logging.debug("views.user.update_user")
+    LOG.debug("views.user.update_user")
 
     server_ts = datetime.datetime.utcnow()
 
@@ -72,12 +79,16 @@ def update_user(name: str):
         expire_ts=expire_ts,
     )
 
-    return (response.into_dict(), 200)
+    return serialization.into_response(
+        response.into_dict(),
+        200,
+        within=response.reading(),
+    )
 
 
 @APP.route("/user/<name>", methods=["DELETE"])
 def delete_user(name: str):
-    logging.debug("views.user.delete_user")
+    LOG.debug("views.user.delete_user")
 
     server_ts = datetime.datetime.utcnow()
 
@@ -90,4 +101,4 @@ def delete_user(name: str):
         access_token_value=access_token,
     )
 
-    return (response.into_dict(), 200)
+    return serialization.into_response(response.into_dict(), 200)
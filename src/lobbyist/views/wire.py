@@ -0,0 +1,101 @@
+import datetime
+import os
+import socketserver
+import threading
+import time
+from typing import List
+
+from ..controllers import auth
+from ..library import log, wire
+from ..library.config import config
+from ..library.error import HttpError
+from ..library.metrics import metrics
+
+LOG = log.logger(__name__)
+ENCODERS = {
+    wire.OP_VALIDATE: lambda record: wire.encode_validation(bool(record)),
+    wire.OP_INTROSPECT: wire.encode_introspection,
+}
+
+
+class WireServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves `library.wire` on a Unix socket, one thread per connection."""
+
+    daemon_threads = True
+
+    def __init__(self, path: str):
+        # A socket file left behind by a previous process would fail bind.
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, _Handler)
+
+    def start(self) -> None:
+        LOG.debug("views.wire.start %s", self.server_address)
+
+        threading.Thread(
+            target=self.serve_forever,
+            name="wire",
+            daemon=True,
+        ).start()
+
+    def stop(self) -> None:
+        LOG.debug("views.wire.stop %s", self.server_address)
+
+        self.shutdown()
+        self.server_close()
+        os.remove(self.server_address)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    # Everything already received is answered with one write, so pipelined
+    # requests share a system call each way.
+
+    def handle(self) -> None:
+        buffer = bytearray()
+        while True:
+            data = self.request.recv(config().wire_read_bytes)
+            if not data:
+                return
+            buffer += data
+            try:
+                payloads = wire.split_frames(
+                    buffer,
+                    config().wire_max_frame_bytes,
+                )
+            except wire.ProtocolError as error:
+                LOG.warning("wire: closing connection: %s", error)
+                return
+            if payloads:
+                self.request.sendall(b"".join(map(_respond, payloads)))
+
+
+def _respond(payload: bytes) -> bytes:
+    start = time.perf_counter()
+    server_ts = datetime.datetime.utcnow()
+
+    try:
+        request_id, op, tokens = wire.decode_request(payload)
+    except wire.ProtocolError as error:
+        # Without a request id the client cannot match the response.
+        LOG.warning("wire: malformed request: %s", error)
+        return wire.encode_response(0, wire.STATUS_BAD_REQUEST, [])
+
+    encode = ENCODERS.get(op)
+    if encode is None or len(tokens) > config().wire_max_batch:
+        return wire.encode_response(request_id, wire.STATUS_BAD_REQUEST, [])
+
+    try:
+        records = auth.validate_access_tokens(server_ts, tokens)
+    except HttpError as error:
+        LOG.warning("wire: request failed: %s", error.description)
+        return wire.encode_response(request_id, wire.STATUS_UNAVAILABLE, [])
+    except Exception:
+        LOG.exception("wire: request failed")
+        return wire.encode_response(request_id, wire.STATUS_UNAVAILABLE, [])
+
+    results: List[bytes] = [encode(record) for record in records]
+
+    metrics().increment("wire.requests")
+    metrics().increment("wire.tokens", len(tokens))
+    metrics().observe("wire.request", time.perf_counter() - start)
+    return wire.encode_response(request_id, wire.STATUS_OK, results)
@@ -0,0 +1,324 @@
+"""
+Measures the memory each user and secret route, and each hot model lookup,
+allocates per request, at several dataset sizes. test_allocations.py checks
+the results against the budgets in allocations.json; to see them, or to
+rewrite the budgets:
+
+    python -m tests.allocations [--sizes small,...] [--update]
+
+Routes run through Flask's test client, on an in-memory database seeded by
+benchmarks.fixtures.seed. For each, tracemalloc reports:
+
+- peak: the most memory held above the starting point while one request
+  runs (the median over --iterations requests), which is what concurrent
+  requests add to a worker's high-water mark.
+- retained: the memory still held, after a collection, per request, eg: in
+  caches, or leaked.
+
+tracemalloc does not count memory allocated and freed between samples, so
+the total allocated is not measured; peak bounds what it costs at once.
+
+Each request reads or changes a different user, so caches are cold, as
+they are for most requests. Every route runs once before measuring, so
+that one-off imports and compiled statements are not counted.
+
+--update rewrites the budgets as what was measured plus --headroom. Do it
+when a change is meant to cost more (or less), and commit the result.
+Numbers vary across Python versions; budgets record the one they came
+from, and a mismatch is warned about.
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import logging
+import math
+import os
+import statistics
+import sys
+import tracemalloc
+import urllib.parse
+import uuid
+from typing import Any, Callable, Dict, List, Tuple
+
+import flask.testing
+
+from .context import lobbyist
+from benchmarks.fixtures import open_memory_db, seed
+from lobbyist.controllers import user
+from lobbyist.library.app import app
+from lobbyist.models import AccessToken, RefreshToken, Secret, User
+from lobbyist.storage.engine import storage
+import lobbyist.views
+
+BUDGETS_PATH = os.path.join(os.path.dirname(__file__), "allocations.json")
+
+# users, secrets per user, access tokens per secret
+SIZES = {
+    "small": (100, 1, 1),
+    "medium": (1000, 4, 2),
+    "large": (200, 16, 8),
+}
+
+
+class Context:
+    def __init__(self, client: flask.testing.FlaskClient, tokens: List[str]):
+        self.client = client
+        self.tokens = tokens
+        self.server_ts = datetime.datetime.utcnow()
+        self.expire_ts = int(
+            (self.server_ts + datetime.timedelta(days=7)).timestamp()
+        )
+
+    def bearer(self, index: int) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.tokens[index]}"}
+
+
+Case = Callable[[Context, int], Any]
+
+
+def _request(method: str, path: str, **kwargs) -> Case:
+    def run(context: Context, index: int) -> Any:
+        options = {
+            key: value(context, index) if callable(value) else value
+            for key, value in kwargs.items()
+        }
+        response = context.client.open(
+            path.format(index=index),
+            method=method,
+            **options,
+        )
+        response.get_data()
+        assert response.status_code < 300, (path, response.status_code)
+
+    return run
+
+
+# In order: later cases may depend on, or undo, what earlier ones did.
+CASES: List[Tuple[str, Case]] = [
+    (
+        "POST /user",
+        _request(
+            "POST",
+            "/user",
+            data=lambda context, index: {
+                "name": f"new{index}",
+                "secret": "password",
+            },
+        ),
+    ),
+    ("GET /user/<name> (public)", _request("GET", "/user/user{index}")),
+    (
+        "GET /user/<name>",
+        _request(
+            "GET",
+            "/user/user{index}",
+            headers=Context.bearer,
+        ),
+    ),
+    (
+        "PATCH /user/<name>",
+        _request(
+            "PATCH",
+            "/user/user{index}",
+            headers=Context.bearer,
+            data=lambda context, index: {"expire_ts": context.expire_ts},
+        ),
+    ),
+    (
+        "POST /secret",
+        _request("POST", "/secret", headers=Context.bearer),
+    ),
+    (
+        "GET /secret/<name>",
+        _request("GET", "/secret/user{index}", headers=Context.bearer),
+    ),
+    (
+        "POST /user/<name>/secrets/rotate",
+        _request(
+            "POST",
+            "/user/user{index}/secrets/rotate",
+            headers=Context.bearer,
+            data=lambda context, index: {"names": f"user{index}.rotate"},
+        ),
+    ),
+    (
+        "User.select_by_name",
+        lambda context, index: User.select_by_name(f"user{index}"),
+    ),
+    (
+        "Secret.select_valid_by_name",
+        lambda context, index: Secret.select_valid_by_name(
+            context.server_ts,
+            f"user{index}",
+        ),
+    ),
+    (
+        "AccessToken.select_valid_by_value",
+        lambda context, index: AccessToken.select_valid_by_value(
+            context.server_ts,
+            context.tokens[index],
+        ),
+    ),
+    (
+        "RefreshToken.select_valid_by_value",
+        lambda context, index: RefreshToken.select_valid_by_value(
+            context.server_ts,
+            f"user{index}.r0",
+        ),
+    ),
+    (
+        "select_valid_access_token_record_by_value",
+        lambda context, index: storage().
+        select_valid_access_token_record_by_value(
+            context.server_ts,
+            context.tokens[index],
+        ),
+    ),
+    (
+        "DELETE /user/<name>",
+        _request("DELETE", "/user/user{index}", headers=Context.bearer),
+    ),
+]
+
+
+def measure(
+    context: Context,
+    case: Case,
+    iterations: int,
+) -> Tuple[float, float]:
+    """The median peak and the mean retained bytes, per run of `case`."""
+    # Users from 1 up; user0 warmed every case up.
+    peaks = []
+    # urlsplit caches each request's URL, up to a bound. Starting from empty,
+    # what is retained does not depend on how full earlier cases left it.
+    urllib.parse.clear_cache()
+    gc.collect()
+    start, _ = tracemalloc.get_traced_memory()
+    for index in range(1, iterations + 1):
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        case(context, index)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - before)
+    gc.collect()
+    end, _ = tracemalloc.get_traced_memory()
+    return statistics.median(peaks), max(end - start, 0) / iterations
+
+
+def run_size(
+    size: str,
+    iterations: int,
+) -> Dict[str, Dict[str, float]]:
+    users, secrets_per_user, access_tokens_per_secret = SIZES[size]
+    open_memory_db()
+    tokens = seed(
+        datetime.datetime.utcnow() - datetime.timedelta(minutes=1),
+        max(users, iterations + 1),
+        secrets_per_user,
+        access_tokens_per_secret,
+    )
+    # Names repeat across sizes. Each user rotates a secret of its own,
+    # since the password cannot be.
+    for index in range(iterations + 1):
+        user.PUBLIC_USERS.invalidate(f"user{index}")
+        owner = storage().select_user_by_name(f"user{index}")
+        storage().create_secret(
+            uuid.uuid4(),
+            f"user{index}.rotate",
+            "hash",
+            owner.create_ts,
+            None,
+            owner.id,
+        )
+    context = Context(app().test_client(), tokens)
+
+    for _, case in CASES:
+        case(context, 0)
+
+    results = {}
+    tracemalloc.start()
+    try:
+        for name, case in CASES:
+            peak, retained = measure(context, case, iterations)
+            results[name] = {
+                "peak_kib": peak / 1024,
+                "retained_kib": retained / 1024,
+            }
+    finally:
+        tracemalloc.stop()
+    return results
+
+
+def python_version() -> str:
+    return "{}.{}".format(*sys.version_info)
+
+
+def load_budgets() -> Dict[str, Any]:
+    try:
+        with open(BUDGETS_PATH) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {"python": python_version(), "budgets": {}}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default=",".join(SIZES))
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--update", action="store_true")
+    parser.add_argument("--headroom", type=float, default=0.25)
+    args = parser.parse_args()
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    document = load_budgets()
+    if document["python"] != python_version():
+        print(
+            f"warning: budgets were measured on Python {document['python']}, "
+            f"this is {python_version()}"
+        )
+
+    failed = False
+    print(
+        f"{'case':<44} {'size':<7} {'peak KiB':>9} {'budget':>7} "
+        f"{'retained':>9} {'budget':>7}"
+    )
+    for size in args.sizes.split(","):
+        results = run_size(size, args.iterations)
+        budgets = document["budgets"].setdefault(size, {})
+        for name, measured in results.items():
+            budget = budgets.get(name, {})
+            over = [
+                key for key, value in measured.items()
+                if key in budget and value > budget[key]
+            ]
+            failed = failed or bool(over)
+            print(
+                f"{name:<44} {size:<7} "
+                f"{measured['peak_kib']:>9.1f} "
+                f"{budget.get('peak_kib', '-'):>7} "
+                f"{measured['retained_kib']:>9.1f} "
+                f"{budget.get('retained_kib', '-'):>7}"
+                + (f"  OVER: {', '.join(over)}" if over else "")
+            )
+            if args.update:
+                budgets[name] = {
+                    # Retained memory is often near zero, where relative
+                    # headroom leaves no room for noise.
+                    key: math.ceil(max(value * (1 + args.headroom), 1))
+                    for key, value in measured.items()
+                }
+
+    if args.update:
+        document["python"] = python_version()
+        with open(BUDGETS_PATH, "w") as file:
+            json.dump(document, file, indent=2)
+            file.write("\n")
+        print(f"updated {BUDGETS_PATH}")
+    elif failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
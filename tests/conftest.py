@@ -0,0 +1,16 @@
+import pytest
+
+from .engines import KINDS, Engines
+
+
+@pytest.fixture(params=KINDS)
+def engines(request, tmp_path) -> Engines:
+    """Opens engines of each kind in turn, on files in tmp_path."""
+    engines = Engines(request.param, str(tmp_path))
+    yield engines
+    engines.close()
+
+
+@pytest.fixture
+def engine(engines: Engines):
+    return engines.open()
@@ -0,0 +1,66 @@
+"""
+Opens each kind of storage engine on fresh files, for the tests.
+"""
+
+import itertools
+import os
+from typing import Optional
+
+from .context import lobbyist
+from lobbyist.library.db import SqliteDatabase, db, pragmas
+from lobbyist.storage import migrations, sharded
+from lobbyist.storage.engine import Engine
+from lobbyist.storage.memory import MemoryEngine
+from lobbyist.storage.sqlite import SqliteEngine
+
+KINDS = ["sqlite", "sharded", "memory"]
+SHARDS = 3
+
+
+def open_db(path: str) -> None:
+    """Opens the SQLite database at `path` as db(), migrated."""
+    db().initialize(SqliteDatabase(path, pragmas=pragmas()))
+    db().connect()
+    migrations.migrate(db(), migrations.MIGRATIONS)
+
+
+class Engines:
+    """Opens engines of one kind, and reopens them on the same files."""
+
+    def __init__(self, kind: str, directory: str):
+        self.kind = kind
+        self._paths = (
+            os.path.join(directory, str(index))
+            for index in itertools.count()
+        )
+        self._path: Optional[str] = None
+        self._engine: Optional[Engine] = None
+
+    def open(self) -> Engine:
+        """An engine on storage no other engine has used."""
+        self.close()
+        self._path = next(self._paths)
+        return self._open()
+
+    def reopen(self, engine: Engine) -> Engine:
+        """Closes `engine`, and opens another on the same storage."""
+        engine.close()
+        return self._open()
+
+    def close(self) -> None:
+        if self._engine is not None:
+            self._engine.close()
+            self._engine = None
+
+    def _open(self) -> Engine:
+        if self.kind == "memory":
+            self._engine = MemoryEngine(self._path)
+        elif self.kind == "sharded":
+            open_db(self._path)
+            self._engine = sharded.ShardedSqliteEngine(
+                sharded.open_shards(self._path, SHARDS, None)
+            )
+        else:
+            open_db(self._path)
+            self._engine = SqliteEngine()
+        return self._engine
@@ -0,0 +1,106 @@
+"""
+Runs lobbyist servers as separate processes, for the tests.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import Any, List, Optional, Tuple
+
+MAIN = os.path.join(os.path.dirname(__file__), "..", "src", "__main__.py")
+HEADERS = {"Accept-Encoding": "identity, gzip"}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Node:
+    """A server on its own files in `directory`, restartable on them."""
+
+    def __init__(
+        self,
+        directory: str,
+        name: str,
+        storage: str,
+        role_args: List[str],
+    ):
+        self.directory = directory
+        self.name = name
+        self.storage = storage
+        self.role_args = role_args
+        self.port = free_port()
+        self._process: Optional[subprocess.Popen] = None
+
+    def start(self, timeout_s: float = 30.0) -> None:
+        path = os.path.join(self.directory, self.name)
+        with open(f"{path}.log", "a") as log:
+            self._process = subprocess.Popen(
+                [
+                    sys.executable,
+                    MAIN,
+                    "--port",
+                    str(self.port),
+                    "--db",
+                    f"{path}.db",
+                    "--storage",
+                    self.storage,
+                    "--memory-path",
+                    f"{path}.memory",
+                    *self.role_args,
+                    "serve",
+                ],
+                stdout=subprocess.DEVNULL,
+                stderr=log,
+            )
+
+        deadline = time.monotonic() + timeout_s
+        while time.monotonic() < deadline:
+            try:
+                self.request("GET", "/replication")
+                return
+            except urllib.error.URLError:
+                assert self._process.poll() is None, f"{self.name} exited"
+                time.sleep(0.1)
+        raise RuntimeError(f"{self.name} did not start")
+
+    def stop(self, kill: bool = False) -> None:
+        if self._process is not None:
+            if kill:
+                self._process.kill()
+            else:
+                self._process.terminate()
+            self._process.wait()
+            self._process = None
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        form: Optional[dict] = None,
+        token: Optional[str] = None,
+    ) -> Tuple[int, Any]:
+        headers = dict(HEADERS)
+        if token is not None:
+            headers["Authorization"] = f"Bearer {token}"
+        data = urllib.parse.urlencode(form).encode() if form else None
+        try:
+            with urllib.request.urlopen(
+                urllib.request.Request(
+                    f"http://127.0.0.1:{self.port}{path}",
+                    data=data,
+                    headers=headers,
+                    method=method,
+                )
+            ) as response:
+                return response.status, json.load(response)
+        except urllib.error.HTTPError as error:
+            return error.code, None
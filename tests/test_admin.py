@@ -0,0 +1,214 @@
+"""
+The admin endpoints, behind the admin token.
+"""
+
+import threading
+import time
+from typing import Dict, Optional
+
+import pytest
+
+from .context import lobbyist
+from lobbyist.library import profiler
+from lobbyist.library.app import app
+from lobbyist.library.config import Range, config
+from lobbyist.library.metrics import metrics
+from lobbyist.views import admin
+
+TOKEN = "admin-token"
+HEADERS = {"Accept-Encoding": "identity, gzip"}
+AUTHORIZED = {**HEADERS, "Authorization": f"Bearer {TOKEN}"}
+WAIT_S = 10
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(admin, "TOKEN", TOKEN)
+    return app().test_client()
+
+
+def test_metrics(client) -> None:
+    metrics().increment("tests.admin")
+    metrics().set_gauge("tests.admin", 2.5)
+    with metrics().time("tests.admin"):
+        pass
+
+    response = client.get(
+        "/admin/metrics",
+        headers={**HEADERS, "Authorization": f"Bearer {TOKEN}"},
+    )
+    assert response.status_code == 200, response.get_data()
+    snapshot = response.get_json()
+    assert snapshot["counters"]["tests.admin"] >= 1
+    assert snapshot["gauges"]["tests.admin"] == 2.5
+    assert snapshot["timings"]["tests.admin"]["count"] >= 1
+
+
+def test_metrics_need_the_token(client, monkeypatch) -> None:
+    response = client.get(
+        "/admin/metrics",
+        headers={**HEADERS, "Authorization": "Bearer wrong"},
+    )
+    assert response.status_code == 401
+
+    monkeypatch.setattr(admin, "TOKEN", None)
+    response = client.get(
+        "/admin/metrics",
+        headers={**HEADERS, "Authorization": f"Bearer {TOKEN}"},
+    )
+    assert response.status_code == 404
+
+
+@pytest.fixture
+def profiling(monkeypatch) -> profiler.Profiler:
+    """A profiler of its own, sampling often, for short profiles."""
+    instance = profiler.Profiler()
+    instance.enabled = True
+    instance.interval_s = 0.001
+    monkeypatch.setattr(profiler, "__SINGLETON", instance)
+    monkeypatch.setattr(
+        config(),
+        "profile_duration",
+        Range(min=0.01, max=1, default=0.1),
+    )
+    yield instance
+    instance.capture_slowest(0)
+
+
+class Spinner(threading.Thread):
+    """
+    A thread busy in spin() until stopped. A request, if it has a latency,
+    announced to the profiler and ended with that latency.
+    """
+
+    def __init__(
+        self,
+        profiling: profiler.Profiler,
+        name: str,
+        latency_s: Optional[float] = None,
+    ):
+        super().__init__(name=name)
+        self.profiling = profiling
+        self.latency_s = latency_s
+        self.spinning = threading.Event()
+        self.stop = threading.Event()
+
+    def run(self) -> None:
+        if self.latency_s is not None:
+            self.profiling.begin_request(self.name, f"GET /{self.name}")
+        self.spinning.set()
+        spin(self.stop)
+        if self.latency_s is not None:
+            self.profiling.end_request(self.latency_s)
+
+    def sampled(self) -> None:
+        """Waits until the profiler has sampled this request."""
+        deadline = time.monotonic() + WAIT_S
+        while not self.profiling._requests[self.ident].stacks:
+            assert time.monotonic() < deadline
+            time.sleep(0.001)
+
+    def __enter__(self) -> "Spinner":
+        self.start()
+        assert self.spinning.wait(WAIT_S)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop.set()
+        self.join()
+
+
+def spin(stop: threading.Event) -> None:
+    while not stop.is_set():
+        pass
+
+
+def _stacks(response) -> Dict[str, int]:
+    assert response.status_code == 200, response.get_data()
+    assert response.mimetype == admin.COLLAPSED_MIMETYPE
+    stacks = {}
+    for line in response.get_data(as_text=True).splitlines():
+        stack, _, count = line.rpartition(" ")
+        stacks[stack] = int(count)
+    return stacks
+
+
+@pytest.mark.parametrize(
+    "method,path",
+    [
+        ("GET", "/admin/profile"),
+        ("GET", "/admin/profile/slowest"),
+        ("DELETE", "/admin/profile/slowest"),
+    ],
+)
+def test_profiles_need_the_token(
+    client, profiling, monkeypatch, method, path
+) -> None:
+    response = client.open(
+        path,
+        method=method,
+        headers={**HEADERS, "Authorization": "Bearer wrong"},
+    )
+    assert response.status_code == 401
+
+    monkeypatch.setattr(admin, "TOKEN", None)
+    response = client.open(path, method=method, headers=AUTHORIZED)
+    assert response.status_code == 404
+
+
+def test_profile(client, profiling) -> None:
+    with Spinner(profiling, "announced", 0.0), \
+            Spinner(profiling, "unannounced"):
+        stacks = _stacks(
+            client.get("/admin/profile?seconds=0.2", headers=AUTHORIZED)
+        )
+        assert stacks
+        assert all(count > 0 for count in stacks.values())
+        # Only announced requests are sampled, without their thread's name.
+        assert any("spin (tests/test_admin.py)" in stack for stack in stacks)
+        assert not any(stack.startswith("unannounced;") for stack in stacks)
+
+        stacks = _stacks(
+            client.get(
+                "/admin/profile?seconds=0.2&threads=all",
+                headers=AUTHORIZED,
+            )
+        )
+        assert any(
+            stack.startswith("unannounced;") and
+            "spin (tests/test_admin.py)" in stack for stack in stacks
+        )
+
+
+@pytest.mark.parametrize("seconds", ["soon", "0", "301"])
+def test_profile_duration_checked(client, profiling, seconds) -> None:
+    response = client.get(
+        f"/admin/profile?seconds={seconds}",
+        headers=AUTHORIZED,
+    )
+    assert response.status_code == 400
+
+
+def test_slowest(client, profiling) -> None:
+    profiling.capture_slowest(2)
+    for name, latency_s in [("a", 0.1), ("b", 0.3), ("c", 0.2)]:
+        with Spinner(profiling, name, latency_s) as spinner:
+            spinner.sampled()
+
+    response = client.get("/admin/profile/slowest", headers=AUTHORIZED)
+    stacks = _stacks(response)
+    roots = [stack.split(";", 1)[0] for stack in stacks]
+    # The slowest first, each rooted at a frame naming its request.
+    assert roots[0] == "GET /b 300ms b"
+    assert set(roots) == {"GET /b 300ms b", "GET /c 200ms c"}
+    assert any("spin (tests/test_admin.py)" in stack for stack in stacks)
+
+    # Kept until deleted.
+    assert _stacks(
+        client.get("/admin/profile/slowest", headers=AUTHORIZED)
+    ) == stacks
+    response = client.delete("/admin/profile/slowest", headers=AUTHORIZED)
+    assert response.status_code == 204
+    assert _stacks(
+        client.get("/admin/profile/slowest", headers=AUTHORIZED)
+    ) == {}
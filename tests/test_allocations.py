@@ -0,0 +1,52 @@
+"""
+Per-request allocations, against the budgets in allocations.json.
+
+Every size is measured once, and each case checked against its budget.
+A case with no budget fails: run `python -m tests.allocations --update`
+and commit the result.
+"""
+
+import warnings
+from typing import Dict, Tuple
+
+import pytest
+
+from . import allocations
+from .context import lobbyist
+from lobbyist.library.app import app
+
+BUDGETS = allocations.load_budgets()
+CASES = [name for name, _ in allocations.CASES]
+VIEWS = ("lobbyist.views.user", "lobbyist.views.secret")
+
+
+@pytest.fixture(scope="module", params=list(allocations.SIZES))
+def measured(request) -> Tuple[str, Dict[str, Dict[str, float]]]:
+    if BUDGETS["python"] != allocations.python_version():
+        warnings.warn(
+            f"budgets were measured on Python {BUDGETS['python']}, "
+            f"this is {allocations.python_version()}"
+        )
+    return request.param, allocations.run_size(request.param, 10)
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_allocations(measured, case: str) -> None:
+    size, results = measured
+    budget = BUDGETS["budgets"].get(size, {}).get(case)
+    assert budget is not None, f"no budget for {case} ({size})"
+    over = {
+        key: value for key, value in results[case].items()
+        if value > budget[key]
+    }
+    assert not over, f"{case} ({size}) is over budget {budget}: {over}"
+
+
+def test_every_route_has_a_case() -> None:
+    names = {name.split(" (")[0] for name in CASES}
+    for rule in app().url_map.iter_rules():
+        view = app().view_functions[rule.endpoint]
+        if view.__module__ not in VIEWS:
+            continue
+        for method in rule.methods - {"HEAD", "OPTIONS"}:
+            assert f"{method} {rule.rule}" in names, (method, rule.rule)
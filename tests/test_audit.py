@@ -0,0 +1,61 @@
+"""
+Audit events are recorded once the change they describe has committed, so
+that a rolled-back write never leaves one behind.
+"""
+
+import datetime
+
+from .engines import Engines
+from .context import lobbyist
+from lobbyist.controllers import auth, secret, user
+from lobbyist.library.db import db
+from lobbyist.storage.engine import storage
+
+HOUR = datetime.timedelta(hours=1)
+
+
+def test_recorded_after_commit(tmp_path, monkeypatch) -> None:
+    recorded = []
+
+    def audit(kind: str, server_ts: datetime.datetime, **fields) -> None:
+        recorded.append((kind, db().in_transaction()))
+
+    for module in (auth, secret, user):
+        monkeypatch.setattr(module, "_audit", audit)
+
+    engines = Engines("sqlite", str(tmp_path))
+    storage().initialize(engines.open())
+    server_ts = datetime.datetime.utcnow()
+    try:
+        response = user.create_user(server_ts, "alice", "password", HOUR, HOUR)
+        token, = (
+            access_token.value for access_token in storage().
+            select_valid_access_tokens_by_user(server_ts, response.user.id)
+        )
+        user.update_user(server_ts, "alice", token, expire_ts=server_ts + HOUR)
+        created = secret.create_secret(server_ts, token, None)
+        name = created.secret.name
+        # A secret is changed with a token issued from it.
+        secret_token = auth.create_access_token(
+            server_ts, name, created.value, HOUR, HOUR
+        ).access_token.value
+        secret.update_secret(
+            server_ts, name, secret_token, expire_ts=server_ts + HOUR
+        )
+        secret.delete_secret(server_ts, name, secret_token)
+        user.delete_user(server_ts, "alice", token)
+    finally:
+        engines.close()
+
+    assert [kind for kind, _ in recorded] == [
+        "user.created",
+        "secret.created",
+        "token.issued",
+        "user.expiry_changed",
+        "secret.created",
+        "token.issued",
+        "secret.expiry_changed",
+        "secret.expiry_changed",
+        "user.expiry_changed",
+    ]
+    assert not [kind for kind, in_transaction in recorded if in_transaction]
@@ -0,0 +1,127 @@
+"""
+Backing up SQLite storage, primary and shards, and restoring it.
+"""
+
+import datetime
+import io
+import os
+import uuid
+from typing import List
+
+import pytest
+
+from .engines import Engines
+from .context import lobbyist
+from lobbyist.controllers import auth
+from lobbyist.library.db import db
+from lobbyist.storage import backup
+from lobbyist.storage.engine import storage
+
+HOUR = datetime.timedelta(hours=1)
+USERS = 20
+TOKENS = 10
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+# Kept intact: the header, and the start of the schema.
+INTACT_BYTES = 4096
+
+
+def _create_users(server_ts: datetime.datetime, names: List[str]) -> List:
+    """Creates each user with a secret and TOKENS access tokens."""
+    tokens = []
+    with storage().atomic(write=True):
+        for name in names:
+            created = storage().create_user(uuid.uuid4(), name, server_ts)
+            secret = storage().create_secret(
+                uuid.uuid4(), name, "hash", server_ts, None, created.id
+            )
+            for index in range(TOKENS):
+                token = storage().create_access_token(
+                    uuid.uuid4(),
+                    f"{name}.{index}",
+                    server_ts,
+                    server_ts + HOUR,
+                    secret.id,
+                )
+                tokens.append(token.value)
+    return tokens
+
+
+def _archive(path: str, directory: str, compress_level: int) -> bytes:
+    os.mkdir(directory)
+    files = backup.snapshot(path, directory, 4, datetime.timedelta(0))
+    return b"".join(backup.iter_archive(files, compress_level, 4096))
+
+
+@pytest.fixture(params=["sqlite", "sharded"])
+def engines(request, tmp_path) -> Engines:
+    engines = Engines(request.param, str(tmp_path))
+    yield engines
+    engines.close()
+
+
+@pytest.mark.parametrize("compress_level", [0, 6])
+def test_restore(engines, tmp_path, compress_level: int) -> None:
+    engine = engines.open()
+    storage().initialize(engine)
+    path = db().database
+    server_ts = datetime.datetime.utcnow()
+    names = [f"user{index}" for index in range(USERS)]
+    tokens = _create_users(server_ts, names)
+
+    archive = _archive(path, str(tmp_path / "backup"), compress_level)
+    # Written after the backup, so lost by restoring it.
+    later = _create_users(server_ts, ["later"])
+
+    engine.close()
+    restored = backup.restore(io.BytesIO(archive), path)
+    assert backup.PRIMARY in restored
+    assert len(restored) == (1 if engines.kind == "sqlite" else 4)
+    assert not [name for name in os.listdir(tmp_path) if "restoring" in name]
+
+    storage().initialize(engines.reopen(engine))
+    assert all(auth.validate_access_tokens(server_ts, tokens))
+    assert not any(auth.validate_access_tokens(server_ts, later))
+    for name in names:
+        assert storage().select_user_by_name(name) is not None
+    assert storage().select_user_by_name("later") is None
+
+
+def _truncated(archive: bytes, directory: str) -> bytes:
+    return archive[:len(archive) // 2]
+
+
+def _corrupted(archive: bytes, directory: str) -> bytes:
+    # Garbles most of the primary, within an intact archive.
+    size = os.path.getsize(os.path.join(directory, backup.PRIMARY))
+    start = archive.index(SQLITE_HEADER)
+    return (
+        archive[:start + INTACT_BYTES]
+        + b"\xa5" * (size - INTACT_BYTES)
+        + archive[start + size:]
+    )
+
+
+@pytest.mark.parametrize("damage", [_truncated, _corrupted])
+def test_refuse_damaged(engines, tmp_path, damage) -> None:
+    engine = engines.open()
+    storage().initialize(engine)
+    path = db().database
+    server_ts = datetime.datetime.utcnow()
+    tokens = _create_users(
+        server_ts,
+        [f"user{index}" for index in range(USERS)],
+    )
+
+    directory = str(tmp_path / "backup")
+    archive = _archive(path, directory, 0)
+    # Written after the backup, so kept by refusing to restore it.
+    later = _create_users(server_ts, ["later"])
+
+    engine.close()
+    with pytest.raises(ValueError):
+        backup.restore(io.BytesIO(damage(archive, directory)), path)
+    assert not [name for name in os.listdir(tmp_path) if "restoring" in name]
+
+    storage().initialize(engines.reopen(engine))
+    assert all(auth.validate_access_tokens(server_ts, tokens + later))
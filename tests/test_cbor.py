@@ -0,0 +1,88 @@
+"""
+The CBOR codec: round trips, and the errors malformed bodies raise.
+
+Request bodies are untrusted, so anything `decode` cannot make sense of
+must raise DecodeError, which the views answer with a 400.
+"""
+
+import datetime
+import math
+import struct
+import uuid
+
+import pytest
+
+from .context import lobbyist
+from lobbyist.library import cbor
+
+
+@pytest.mark.parametrize("value", [
+    None,
+    True,
+    False,
+    0,
+    23,
+    24,
+    2**32,
+    -1,
+    -2**40,
+    1.5,
+    "",
+    "text",
+    b"\x00\x01",
+    [],
+    [1, [2, "three"]],
+    {"a": 1, "b": [None]},
+    datetime.datetime(2020, 1, 1, 12, 30),
+    datetime.datetime(1970, 1, 1, 0, 1),
+    uuid.UUID(int=1),
+], ids=repr)
+def test_round_trip(value) -> None:
+    assert cbor.decode(cbor.encode(value)) == value
+
+
+def test_indefinite_lengths() -> None:
+    assert cbor.decode(b"\x9f\x01\x02\xff") == [1, 2]
+    assert cbor.decode(b"\xbf\x61a\x01\xff") == {"a": 1}
+
+
+def test_half_floats() -> None:
+    assert cbor.decode(b"\xf9\x3c\x00") == 1.0
+    assert cbor.decode(b"\xf9\xfc\x00") == -math.inf
+    assert math.isnan(cbor.decode(b"\xf9\x7e\x00"))
+
+
+# Tag 1 around a half, single or double float.
+EPOCHS = {"half": b"\xf9", "single": b"\xfa", "double": b"\xfb"}
+FORMATS = {"half": ">e", "single": ">f", "double": ">d"}
+
+
+@pytest.mark.parametrize("width", list(EPOCHS))
+@pytest.mark.parametrize("value", [math.nan, math.inf, -math.inf], ids=repr)
+def test_non_finite_epochs(width: str, value: float) -> None:
+    data = b"\xc1" + EPOCHS[width] + struct.pack(FORMATS[width], value)
+    with pytest.raises(cbor.DecodeError):
+        cbor.decode(data)
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"\x19\x01",  # a 2-byte integer, cut short
+    b"\x62a",  # a 2-byte string, cut short
+    b"\x82\x01",  # a 2-item array, cut short
+    b"\x9f\x01",  # an indefinite array with no break
+    b"\x01\x02",  # trailing bytes
+    b"\x1c",  # reserved additional information
+    b"\xf8\x20",  # an unsupported simple value
+    b"\x5f\xff",  # an indefinite byte string
+    b"\x62\xff\xfe",  # invalid UTF-8
+    b"\xa1\x80\x01",  # an unhashable map key
+    b"\xc1\x61a",  # an epoch that is not a number
+    b"\xc1\xf5",  # an epoch that is a bool
+    b"\xc1\x1b\x7f\xff\xff\xff\xff\xff\xff\xff",  # an epoch out of range
+    b"\xd8\x25\x41\x00",  # a UUID that is not 16 bytes
+    b"\x81" * 10000 + b"\x00",  # nested too deeply
+], ids=repr)
+def test_malformed(data: bytes) -> None:
+    with pytest.raises(cbor.DecodeError):
+        cbor.decode(data)
@@ -0,0 +1,51 @@
+"""
+Conditional GETs of a user's private view.
+
+Its ETag carries the next expiry under the user, which the server looks up
+itself: a client's tag only matches if it is the one the server would send.
+"""
+
+import pytest
+
+from .context import lobbyist
+from lobbyist.library.app import app
+from lobbyist.storage.engine import storage
+import lobbyist.views
+
+HEADERS = {"Accept-Encoding": "identity, gzip"}
+
+
+@pytest.fixture
+def client(engine):
+    storage().initialize(engine)
+    return app().test_client()
+
+
+def test_private_user_etag(client) -> None:
+    response = client.post(
+        "/user",
+        data={"name": "alice", "secret": "password"},
+        headers=HEADERS,
+    )
+    assert response.status_code == 201, response.get_data()
+    token = response.get_json()["access_tokens"][0]["value"]
+    headers = {**HEADERS, "Authorization": f"Bearer {token}"}
+
+    response = client.get("/user/alice", headers=headers)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    version = etag[len('W/"p'):].split(".")[0]
+
+    response = client.get(
+        "/user/alice",
+        headers={**headers, "If-None-Match": etag},
+    )
+    assert response.status_code == 304
+
+    # Tags the server would not send, even ones claiming nothing expires.
+    for forged in (f'W/"p{version}.inf"', f'W/"p{version}.x"', 'W/"p"'):
+        response = client.get(
+            "/user/alice",
+            headers={**headers, "If-None-Match": forged},
+        )
+        assert response.status_code == 200, forged
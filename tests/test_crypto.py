@@ -0,0 +1,21 @@
+"""
+Secrets as generated, hashed and checked.
+"""
+
+from .context import lobbyist
+from lobbyist.library import crypto
+from lobbyist.library.config import config
+
+# bcrypt takes at most 72 bytes of a secret.
+BCRYPT_MAX_BYTES = 72
+
+
+def test_secret_value_fits_bcrypt() -> None:
+    value = crypto.make_secret_string(config().secret_value_entropy)
+    assert len(value.encode("utf-8")) <= BCRYPT_MAX_BYTES
+
+    # All of it counts: a change to its last character fails the check.
+    hash = crypto.hash_secret(value, bcrypt_cost=4).decode()
+    assert crypto.check_secret(value, hash)
+    last = "A" if value[-1] != "A" else "B"
+    assert not crypto.check_secret(value[:-1] + last, hash)
@@ -0,0 +1,127 @@
+"""
+The pragmas each profile applies, and the WAL checkpoints run beside them.
+"""
+
+import datetime
+import os
+import threading
+import time
+
+import pytest
+
+from .engines import open_db
+from .context import lobbyist
+from lobbyist.library import checkpoint
+from lobbyist.library.config import config
+from lobbyist.library.db import SqliteDatabase, db, pragmas
+from lobbyist.library.metrics import metrics
+from lobbyist.library.worker import PeriodicWorker
+
+WAIT_S = 10
+# What SQLite reports for the values config() sets by name.
+REPORTED = {"auto_vacuum": {"incremental": 2}}
+
+
+@pytest.mark.parametrize("profile", sorted(config().db_pragma_profiles))
+def test_profile_applied(tmp_path, profile) -> None:
+    database = SqliteDatabase(
+        os.path.join(str(tmp_path), "db"),
+        pragmas=pragmas(profile),
+    )
+    database.connect()
+    try:
+        expected = {
+            **config().db_pragmas,
+            **config().db_pragma_profiles[profile],
+        }
+        for name, value in expected.items():
+            (applied, ) = database.execute_sql(f"PRAGMA {name}").fetchone()
+            assert applied == REPORTED.get(name, {}).get(value, value), name
+    finally:
+        database.close()
+
+
+def test_profile_from_environment(monkeypatch) -> None:
+    monkeypatch.setenv("LOBBYIST_DB_PRAGMA_PROFILE", "durable")
+    monkeypatch.setenv("LOBBYIST_DB_PRAGMA_MMAP_SIZE", "4096")
+    monkeypatch.setenv("LOBBYIST_DB_PRAGMA_JOURNAL_MODE", "delete")
+
+    applied = pragmas()
+    assert applied["synchronous"] == 2
+    assert applied["mmap_size"] == 4096
+    assert applied["journal_mode"] == "delete"
+    # An explicit profile still takes the overrides.
+    assert pragmas("throughput")["mmap_size"] == 4096
+    assert list(applied)[0] == "page_size"
+
+
+def test_unknown_profile() -> None:
+    with pytest.raises(ValueError):
+        pragmas("fastest")
+
+
+@pytest.fixture
+def wal(tmp_path):
+    """A database with a table to write, through db()."""
+    open_db(os.path.join(str(tmp_path), "db"))
+    db().execute_sql("CREATE TABLE written (value INTEGER)")
+    yield
+    db().close()
+
+
+def _write() -> None:
+    with db().atomic():
+        db().execute_sql("INSERT INTO written VALUES (1)")
+
+
+def _wal_bytes() -> int:
+    return os.path.getsize(db().database + "-wal")
+
+
+def test_tick_modes(wal) -> None:
+    checkpointer = checkpoint.Checkpointer(passive_bytes=1)
+    _write()
+
+    # The WAL was just written: it is checkpointed without blocking.
+    assert checkpointer.tick() == "PASSIVE"
+    assert _wal_bytes() > 0
+    # Nothing was written since: the WAL is truncated.
+    assert checkpointer.tick() == "TRUNCATE"
+    assert _wal_bytes() == 0
+    assert metrics().snapshot()["gauges"]["db.wal_bytes"] == 0
+    assert checkpointer.tick() is None
+
+    # Busy, but short of passive_bytes.
+    checkpointer = checkpoint.Checkpointer(passive_bytes=2**30)
+    _write()
+    assert checkpointer.tick() is None
+    _write()
+    assert checkpointer.tick() is None
+    assert _wal_bytes() > 0
+
+
+def test_background_checkpoint(wal) -> None:
+    worker = PeriodicWorker(
+        "checkpoint",
+        datetime.timedelta(milliseconds=10),
+        checkpoint.Checkpointer().tick,
+    )
+    worker.start()
+    (thread, ) = [
+        thread for thread in threading.enumerate()
+        if thread.name == "checkpoint"
+    ]
+    try:
+        _write()
+        deadline = time.monotonic() + WAIT_S
+        while _wal_bytes():
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    finally:
+        worker.stop(WAIT_S)
+
+    # Stopped, the WAL is left as it is.
+    assert not thread.is_alive()
+    _write()
+    time.sleep(0.1)
+    assert _wal_bytes() > 0
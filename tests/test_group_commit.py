@@ -0,0 +1,160 @@
+"""
+The group commit writer, against transactions that record what each commit
+held, so that batching shows without a database.
+"""
+
+import datetime
+import threading
+import time
+from typing import Any, List
+
+import pytest
+
+from .context import lobbyist
+from lobbyist.library.group_commit import GroupCommit
+
+LONG = datetime.timedelta(seconds=10)
+
+
+class Transactions:
+    """Nested transactions; each outermost one commits what ran in it."""
+
+    def __init__(self):
+        self.depth = 0
+        self.pending: List[Any] = []
+        self.commits: List[List[Any]] = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def atomic(self) -> "Transactions":
+        return self
+
+    def run(self, value: Any) -> Any:
+        self.pending.append(value)
+        return value
+
+    def __enter__(self) -> None:
+        self.depth += 1
+
+    def __exit__(self, kind, error, traceback) -> bool:
+        self.depth -= 1
+        if self.depth == 0:
+            self.release.wait()
+            self.commits.append(self.pending)
+            self.pending = []
+        return False
+
+
+def _submit_all(writer: GroupCommit, fns) -> List[Any]:
+    """Submits each fn from its own thread; returns results or errors."""
+    outcomes: List[Any] = [None] * len(fns)
+
+    def submit(index: int) -> None:
+        try:
+            outcomes[index] = writer.submit(fns[index])
+        except Exception as error:
+            outcomes[index] = error
+
+    threads = [
+        threading.Thread(target=submit, args=(index, ))
+        for index in range(len(fns))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+@pytest.fixture
+def transactions():
+    return Transactions()
+
+
+def test_batch_closes_when_full(transactions) -> None:
+    writer = GroupCommit("test", transactions.atomic, 4, LONG)
+    try:
+        start = time.monotonic()
+        outcomes = _submit_all(
+            writer,
+            [
+                lambda index=index: transactions.run(index)
+                for index in range(4)
+            ],
+        )
+        elapsed_s = time.monotonic() - start
+    finally:
+        writer.stop()
+
+    assert sorted(outcomes) == [0, 1, 2, 3]
+    assert [sorted(commit) for commit in transactions.commits] == [
+        [0, 1, 2, 3]
+    ]
+    # It did not wait out max_wait for more writes.
+    assert elapsed_s < LONG.total_seconds() / 2
+
+
+def test_batch_closes_after_max_wait(transactions) -> None:
+    max_wait = datetime.timedelta(milliseconds=50)
+    writer = GroupCommit("test", transactions.atomic, 100, max_wait)
+    try:
+        start = time.monotonic()
+        assert writer.submit(lambda: transactions.run("a")) == "a"
+        elapsed_s = time.monotonic() - start
+        assert writer.submit(lambda: transactions.run("b")) == "b"
+    finally:
+        writer.stop()
+
+    assert transactions.commits == [["a"], ["b"]]
+    assert elapsed_s >= max_wait.total_seconds()
+
+
+def test_released_after_commit(transactions) -> None:
+    writer = GroupCommit("test", transactions.atomic, 1, LONG)
+    transactions.release.clear()
+    returned = threading.Event()
+
+    def submit() -> None:
+        writer.submit(lambda: transactions.run("a"))
+        returned.set()
+
+    thread = threading.Thread(target=submit)
+    try:
+        thread.start()
+        # The write has run, but its batch has not committed.
+        assert not returned.wait(0.2)
+        assert transactions.pending == ["a"]
+        assert transactions.commits == []
+
+        transactions.release.set()
+        assert returned.wait(LONG.total_seconds())
+        assert transactions.commits == [["a"]]
+    finally:
+        transactions.release.set()
+        thread.join()
+        writer.stop()
+
+
+def test_error_raised_to_its_caller(transactions) -> None:
+    writer = GroupCommit("test", transactions.atomic, 3, LONG)
+
+    def fail() -> None:
+        raise ValueError("fail")
+
+    try:
+        outcomes = _submit_all(
+            writer,
+            [
+                lambda: transactions.run("a"),
+                fail,
+                lambda: transactions.run("c"),
+            ],
+        )
+    finally:
+        writer.stop()
+
+    assert outcomes[0] == "a"
+    assert isinstance(outcomes[1], ValueError)
+    assert outcomes[2] == "c"
+    # The others committed in the same batch.
+    assert [sorted(commit) for commit in transactions.commits] == [["a", "c"]]
@@ -0,0 +1,177 @@
+"""
+Replaying responses to requests retried with the same Idempotency-Key.
+"""
+
+import datetime
+import threading
+from typing import List
+
+import flask
+import pytest
+
+from .context import lobbyist
+from lobbyist.library import idempotency
+from lobbyist.library.app import app
+from lobbyist.library.config import config
+from lobbyist.library.error import ConflictError, UnprocessableEntityError
+from lobbyist.storage.engine import storage
+import lobbyist.views
+
+WAIT_S = 10
+
+
+@pytest.fixture
+def client(engine, monkeypatch):
+    # Keys from other tests would replay into this one.
+    monkeypatch.setattr(
+        idempotency,
+        "__SINGLETON",
+        idempotency.Idempotency(),
+    )
+    storage().initialize(engine)
+    return app().test_client()
+
+
+def test_replay(client) -> None:
+    headers = {idempotency.HEADER: "create-alice"}
+    data = {"name": "alice", "secret": "password"}
+
+    first = client.post("/user", data=data, headers=headers)
+    assert first.status_code == 201, first.get_data()
+    assert idempotency.REPLAYED_HEADER not in first.headers
+
+    retry = client.post("/user", data=data, headers=headers)
+    assert retry.status_code == 201
+    assert retry.headers[idempotency.REPLAYED_HEADER] == "true"
+    assert retry.get_data() == first.get_data()
+
+    # Without the key, the same request is a second create.
+    assert client.post("/user", data=data).status_code == 409
+
+
+def test_different_request_refused(client) -> None:
+    headers = {idempotency.HEADER: "create"}
+    response = client.post(
+        "/user",
+        data={"name": "alice", "secret": "password"},
+        headers=headers,
+    )
+    assert response.status_code == 201
+
+    response = client.post(
+        "/user",
+        data={"name": "bob", "secret": "password"},
+        headers=headers,
+    )
+    assert response.status_code == 422
+    assert idempotency.REPLAYED_HEADER not in response.headers
+
+
+def _respond(calls: List[str], body: str, status: int = 201):
+
+    def fn() -> flask.Response:
+        calls.append(body)
+        return flask.Response(body, status=status)
+
+    return fn
+
+
+def test_mismatched_fingerprint() -> None:
+    keys = idempotency.Idempotency()
+    calls: List[str] = []
+    first = keys.fingerprint([b"POST", b"/user", b"alice"])
+    other = keys.fingerprint([b"POST", b"/user", b"bob"])
+
+    keys.run("key", first, _respond(calls, "alice"))
+    with pytest.raises(UnprocessableEntityError):
+        keys.run("key", other, _respond(calls, "bob"))
+    assert calls == ["alice"]
+
+
+def test_errors_not_kept() -> None:
+    keys = idempotency.Idempotency()
+    calls: List[str] = []
+    fingerprint = keys.fingerprint([b"request"])
+
+    def fail() -> flask.Response:
+        calls.append("fail")
+        raise RuntimeError("fail")
+
+    with pytest.raises(RuntimeError):
+        keys.run("key", fingerprint, fail)
+    response = keys.run("key", fingerprint, _respond(calls, "error", 400))
+    assert response.status_code == 400
+    response = keys.run("key", fingerprint, _respond(calls, "created"))
+    assert response.get_data() == b"created"
+    assert calls == ["fail", "error", "created"]
+
+
+def _run_first(keys: idempotency.Idempotency, fingerprint: bytes):
+    """Starts a first request that runs until `release` is set."""
+    calls: List[str] = []
+    running = threading.Event()
+    release = threading.Event()
+
+    def fn() -> flask.Response:
+        calls.append("first")
+        running.set()
+        release.wait(WAIT_S)
+        return flask.Response("first", status=201)
+
+    thread = threading.Thread(target=keys.run, args=("key", fingerprint, fn))
+    thread.start()
+    assert running.wait(WAIT_S)
+    return thread, release, calls
+
+
+def test_duplicate_waits_for_first() -> None:
+    keys = idempotency.Idempotency()
+    fingerprint = keys.fingerprint([b"request"])
+    thread, release, calls = _run_first(keys, fingerprint)
+
+    responses: List[flask.Response] = []
+    duplicate = threading.Thread(
+        target=lambda: responses.append(
+            keys.run("key", fingerprint, _respond(calls, "duplicate"))
+        )
+    )
+    try:
+        duplicate.start()
+        duplicate.join(0.2)
+        assert duplicate.is_alive()
+        assert not responses
+    finally:
+        release.set()
+        thread.join()
+        duplicate.join()
+
+    (response, ) = responses
+    assert response.get_data() == b"first"
+    assert response.headers[idempotency.REPLAYED_HEADER] == "true"
+    assert calls == ["first"]
+
+
+def test_duplicate_wait_bounded(monkeypatch) -> None:
+    monkeypatch.setattr(
+        config(),
+        "idempotency_wait",
+        datetime.timedelta(milliseconds=50),
+    )
+    keys = idempotency.Idempotency()
+    fingerprint = keys.fingerprint([b"request"])
+    thread, release, calls = _run_first(keys, fingerprint)
+
+    try:
+        with pytest.raises(ConflictError):
+            keys.run("key", fingerprint, _respond(calls, "duplicate"))
+        # The stuck request no longer holds the key.
+        response = keys.run("key", fingerprint, _respond(calls, "retry"))
+        assert response.get_data() == b"retry"
+    finally:
+        release.set()
+        thread.join()
+
+    # Nor does it take the key back on finishing.
+    response = keys.run("key", fingerprint, _respond(calls, "again"))
+    assert response.get_data() == b"retry"
+    assert calls == ["first", "retry"]
@@ -0,0 +1,79 @@
+"""
+Token issuance from many threads at once, each under the access token
+quota, so that every issuance evicts a token in its transaction.
+"""
+
+import datetime
+import threading
+import uuid
+from typing import List
+
+import pytest
+
+from .context import lobbyist
+from lobbyist.controllers import auth
+from lobbyist.library.config import config
+from lobbyist.storage.engine import storage
+
+T0 = datetime.datetime(2020, 1, 1)
+HOUR = datetime.timedelta(hours=1)
+THREADS = 8
+TOKENS = 20
+QUOTA = 3
+
+
+@pytest.mark.parametrize("group_commit", [False, True])
+def test_concurrent_issuance(engine, monkeypatch, group_commit: bool) -> None:
+    monkeypatch.setattr(config(), "access_token_quota_per_secret", QUOTA)
+    monkeypatch.setattr(config(), "group_commit", group_commit)
+    storage().initialize(engine)
+
+    secrets = []
+    with storage().atomic(write=True):
+        for index in range(THREADS):
+            user = storage().create_user(uuid.uuid4(), f"user{index}", T0)
+            secrets.append(
+                storage().create_secret(
+                    uuid.uuid4(), user.name, "hash", T0, None, user.id
+                )
+            )
+
+    errors: List[BaseException] = []
+
+    def issue(secret) -> None:
+        try:
+            for index in range(TOKENS):
+                create_ts = T0 + datetime.timedelta(seconds=index)
+                auth._write(
+                    lambda: auth._create_tokens(
+                        create_ts,
+                        secret.id,
+                        secret.user_id,
+                        HOUR,
+                        HOUR,
+                    )
+                )
+        except BaseException as error:
+            errors.append(error)
+
+    threads = [
+        threading.Thread(target=issue, args=(secret, )) for secret in secrets
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        auth.writer().stop()
+
+    assert not errors, errors
+    server_ts = T0 + datetime.timedelta(seconds=TOKENS - 1)
+    for secret in secrets:
+        valid = list(
+            storage().select_valid_access_tokens_by_user(
+                server_ts,
+                secret.user_id,
+            )
+        )
+        assert len(valid) == QUOTA, secret.name
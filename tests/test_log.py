@@ -0,0 +1,110 @@
+"""
+Sampling decided before a record is built, and the queued handler writing
+out what it holds when it stops.
+"""
+
+import json
+import logging
+
+import pytest
+
+from .context import lobbyist
+from lobbyist.library import log
+
+RECORDS = 500
+
+
+@pytest.fixture
+def configure(monkeypatch):
+    """Configures logging as __main__ does; puts the root logger back."""
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    monkeypatch.setattr(log._SAMPLING, "debug", log._SAMPLING.debug)
+    monkeypatch.setattr(log._SAMPLING, "access", log._SAMPLING.access)
+
+    def configure(debug: float = 1.0, access: float = 1.0) -> None:
+        log.configure("DEBUG", {}, "json", debug, access, RECORDS)
+
+    yield configure
+    log.stop()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def _draws(monkeypatch, value: float) -> None:
+    monkeypatch.setattr(log.random, "random", lambda: value)
+
+
+def test_debug_sampling(configure, monkeypatch) -> None:
+    logger = log.logger("test_log.debug")
+
+    configure(debug=0.0)
+    assert not logger.isEnabledFor(logging.DEBUG)
+    assert logger.isEnabledFor(logging.INFO)
+
+    configure(debug=0.25)
+    _draws(monkeypatch, 0.2)
+    assert logger.isEnabledFor(logging.DEBUG)
+    _draws(monkeypatch, 0.3)
+    assert not logger.isEnabledFor(logging.DEBUG)
+    # Records above DEBUG are never sampled.
+    assert logger.isEnabledFor(logging.INFO)
+
+    configure(debug=1.0)
+    _draws(monkeypatch, 0.99)
+    assert logger.isEnabledFor(logging.DEBUG)
+
+
+def test_access_sampling(configure, monkeypatch) -> None:
+    access = log.logger(log.ACCESS)
+    other = log.logger("test_log.access")
+
+    configure(access=0.0)
+    assert not access.isEnabledFor(logging.INFO)
+    assert other.isEnabledFor(logging.INFO)
+
+    configure(access=0.5)
+    _draws(monkeypatch, 0.4)
+    assert access.isEnabledFor(logging.INFO)
+    _draws(monkeypatch, 0.6)
+    assert not access.isEnabledFor(logging.INFO)
+    assert other.isEnabledFor(logging.INFO)
+
+
+def test_sampled_out_record_is_not_built(configure, capsys) -> None:
+    logger = log.logger("test_log.built")
+    configure(debug=0.0)
+
+    class Argument:
+        def __str__(self) -> str:
+            raise AssertionError("built")
+
+    logger.debug("%s", Argument())
+    log.stop()
+    assert capsys.readouterr().err == ""
+
+
+def test_flushed_on_stop(configure, capsys) -> None:
+    logger = log.logger("test_log.flushed")
+    configure()
+
+    values = []
+    for index in range(RECORDS):
+        values.append(index)
+        # Rendered when queued, not when the listener writes it out.
+        logger.info("record %s", values, extra={"index": index})
+        values.clear()
+    log.stop()
+
+    lines = capsys.readouterr().err.splitlines()
+    records = [json.loads(line) for line in lines]
+    assert [record["index"] for record in records] == list(range(RECORDS))
+    assert all(
+        record["message"] == f"record [{record['index']}]"
+        for record in records
+    )
+    assert records[0]["logger"] == "test_log.flushed"
+    assert records[0]["level"] == "INFO"
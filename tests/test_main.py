@@ -0,0 +1,31 @@
+"""
+Options the command line refuses before running any command.
+"""
+
+import os
+import subprocess
+import sys
+
+from .nodes import MAIN
+
+
+def _main(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, MAIN, *args],
+        capture_output=True,
+        text=True,
+    )
+
+
+def test_signed_tokens_need_no_quota(tmp_path) -> None:
+    keys = str(tmp_path / "keys.json")
+    signed = ["--access-token-format", "signed", "--access-token-keys", keys]
+
+    result = _main(*signed, "rotate-token-keys")
+    assert result.returncode == 1
+    assert "--access-token-quota 0" in result.stderr
+    assert not os.path.exists(keys)
+
+    result = _main(*signed, "--access-token-quota", "0", "rotate-token-keys")
+    assert result.returncode == 0, result.stderr
+    assert os.path.exists(keys)
@@ -0,0 +1,68 @@
+"""
+Schema migrations, against what the models expect.
+
+The migrations spell out their SQL, so a change to the models' tables or
+indexes that has no migration to go with it fails here.
+"""
+
+from typing import List, Set, Tuple
+
+import peewee
+
+from .context import lobbyist
+from lobbyist.models.auth import AccessToken, RefreshToken
+from lobbyist.models.replication import ReplicationPosition
+from lobbyist.models.schema import SchemaVersion
+from lobbyist.models.secret import Secret
+from lobbyist.models.shard import TreeVersion
+from lobbyist.models.user import User
+from lobbyist.storage import migrations, sharded
+
+MODELS = [User, Secret, AccessToken, RefreshToken, ReplicationPosition]
+SHARD_MODELS = [AccessToken, RefreshToken, TreeVersion]
+
+
+def _schema(database: peewee.Database) -> Set[Tuple[str, ...]]:
+    return set(
+        database.execute_sql(
+            "SELECT type, name, tbl_name, sql FROM sqlite_master"
+        ).fetchall()
+    )
+
+
+def _from_models(
+    path: str,
+    models: List[peewee.ModelBase],
+) -> peewee.Database:
+    database = peewee.SqliteDatabase(path)
+    with database.bind_ctx(models + [SchemaVersion]):
+        database.create_tables(models + [SchemaVersion])
+    return database
+
+
+def test_schema(tmp_path) -> None:
+    database = peewee.SqliteDatabase(str(tmp_path / "migrated.db"))
+    assert migrations.migrate(database, migrations.MIGRATIONS) == len(
+        migrations.MIGRATIONS
+    )
+    expected = _from_models(str(tmp_path / "models.db"), MODELS)
+    assert _schema(database) == _schema(expected)
+
+
+def test_shard_schema(tmp_path) -> None:
+    shard = sharded._open_shard(str(tmp_path / "shard.db"), None)
+    expected = _from_models(str(tmp_path / "models.db"), SHARD_MODELS)
+    assert _schema(shard) == _schema(expected)
+
+
+def test_unversioned(tmp_path) -> None:
+    # Databases from before versions have every table but schemaversion.
+    database = peewee.SqliteDatabase(str(tmp_path / "old.db"))
+    with database.bind_ctx(MODELS):
+        database.create_tables(MODELS)
+    before = _schema(database)
+
+    migrations.migrate(database, migrations.MIGRATIONS)
+    assert migrations.version(database) == len(migrations.MIGRATIONS)
+    added = _schema(database) - before
+    assert {row[1] for row in added} == {"schemaversion"}
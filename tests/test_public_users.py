@@ -0,0 +1,109 @@
+"""
+The cache of public user views: hits, invalidation by writes, negative
+entries, and loads that raced an invalidation.
+"""
+
+import datetime
+
+import pytest
+
+from .context import lobbyist
+from lobbyist.controllers import user
+from lobbyist.library import cache
+from lobbyist.library.config import config
+from lobbyist.library.error import NotFoundError
+from lobbyist.storage.engine import storage
+
+HOUR = datetime.timedelta(hours=1)
+
+
+@pytest.fixture
+def public_users(engine, monkeypatch) -> cache.Cache:
+    storage().initialize(engine)
+    # Entries from other tests' storage would answer for this one's.
+    public_users = cache.Cache(
+        "test_public_user",
+        config().public_user_cache_entries,
+        config().public_user_cache_ttl,
+        config().public_user_cache_negative_ttl,
+    )
+    monkeypatch.setattr(user, "PUBLIC_USERS", public_users)
+    return public_users
+
+
+def _create(server_ts: datetime.datetime, name: str) -> str:
+    """Creates user `name`; returns their access token."""
+    response = user.create_user(server_ts, name, "password", HOUR, HOUR)
+    (token, ) = storage().select_valid_access_tokens_by_user(
+        server_ts,
+        response.user.id,
+    )
+    return token.value
+
+
+def test_hit(public_users) -> None:
+    server_ts = datetime.datetime.utcnow()
+    token = _create(server_ts, "alice")
+
+    public = user.read_user(server_ts, "alice", None)
+    assert isinstance(public, user.PublicUserResponse)
+    assert public_users.get("alice") is public
+    assert user.read_user(server_ts, "alice", None) is public
+
+    # The user themself is owed the private view.
+    private = user.read_user(server_ts, "alice", token)
+    assert isinstance(private, user.PrivateUserResponse)
+
+
+def test_invalidated_by_update(public_users) -> None:
+    server_ts = datetime.datetime.utcnow()
+    token = _create(server_ts, "alice")
+    public = user.read_user(server_ts, "alice", None)
+
+    user.update_user(server_ts, "alice", token, expire_ts=server_ts + HOUR)
+    assert public_users.get("alice") is cache.MISS
+    updated = user.read_user(server_ts, "alice", None)
+    assert updated is not public
+    assert updated.etag() != public.etag()
+
+
+def test_invalidated_by_delete(public_users) -> None:
+    server_ts = datetime.datetime.utcnow()
+    token = _create(server_ts, "alice")
+    public = user.read_user(server_ts, "alice", None)
+
+    user.delete_user(server_ts, "alice", token)
+    assert public_users.get("alice") is cache.MISS
+    assert user.read_user(server_ts, "alice", None).etag() != public.etag()
+
+
+def test_negative_entry_then_create(public_users) -> None:
+    server_ts = datetime.datetime.utcnow()
+    with pytest.raises(NotFoundError):
+        user.read_user(server_ts, "alice", None)
+    assert public_users.get("alice") is None
+    with pytest.raises(NotFoundError):
+        user.read_user(server_ts, "alice", None)
+
+    _create(server_ts, "alice")
+    public = user.read_user(server_ts, "alice", None)
+    assert isinstance(public, user.PublicUserResponse)
+
+
+def test_stale_put_dropped(public_users, monkeypatch) -> None:
+    server_ts = datetime.datetime.utcnow()
+    token = _create(server_ts, "alice")
+    read_user_txn = user._read_user_txn
+
+    def racing(*args):
+        # Reads the user, then an update commits before the read is cached.
+        response = read_user_txn(*args)
+        user.update_user(server_ts, "alice", token, expire_ts=server_ts + HOUR)
+        return response
+
+    monkeypatch.setattr(user, "_read_user_txn", racing)
+    stale = user.read_user(server_ts, "alice", None)
+    assert public_users.get("alice") is cache.MISS
+
+    monkeypatch.setattr(user, "_read_user_txn", read_user_txn)
+    assert user.read_user(server_ts, "alice", None).etag() != stale.etag()
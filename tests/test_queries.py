@@ -0,0 +1,124 @@
+"""
+Statements timed and grouped by their normalized SQL, slow ones logged, and
+a request's share reported in its response headers.
+"""
+
+import datetime
+import logging
+
+import pytest
+
+from .engines import Engines
+from .context import lobbyist
+from lobbyist.controllers import user
+from lobbyist.library import cache, queries
+from lobbyist.library.app import app
+from lobbyist.library.config import config
+from lobbyist.library.error import NotFoundError
+from lobbyist.storage.engine import storage
+import lobbyist.views
+
+HEADERS = {"Accept-Encoding": "identity, gzip"}
+FOREVER = datetime.timedelta(days=1)
+
+
+@pytest.fixture
+def observed(tmp_path, monkeypatch) -> queries.Queries:
+    """Queries of their own, observing a fresh sqlite database."""
+    engines = Engines("sqlite", str(tmp_path))
+    storage().initialize(engines.open())
+    observed = queries.Queries()
+    monkeypatch.setattr(queries, "__SINGLETON", observed)
+    # Cached views would answer requests without a statement.
+    monkeypatch.setattr(
+        user,
+        "PUBLIC_USERS",
+        cache.Cache("test_queries", 1, FOREVER, FOREVER),
+    )
+    yield observed
+    engines.close()
+
+
+def _user_queries(observed: queries.Queries):
+    return [
+        query for query in observed.top(100)
+        if query.sql.startswith("SELECT") and 'FROM "user"' in query.sql
+    ]
+
+
+def test_normalize() -> None:
+    assert queries.normalize(
+        ' SELECT "id"\n  FROM "t1"\tWHERE "id" IN (?, ?,?) AND "x" IN (?) '
+    ) == 'SELECT "id" FROM "t1" WHERE "id" IN (?, ...) AND "x" IN (?)'
+
+
+def test_statements_grouped(observed) -> None:
+    for name in ["alice", "bob", "carol"]:
+        assert storage().select_user_by_name(name) is None
+
+    (query, ) = _user_queries(observed)
+    assert query.count == 3
+    assert 0 < query.max_s <= query.total_s
+    into = query.into_dict()
+    assert into["sql"] == query.sql
+    assert into["count"] == 3
+    assert into["max_ms"] <= into["total_ms"]
+
+    observed.reset()
+    assert observed.top(100) == []
+
+
+def test_top(observed) -> None:
+    observed.observe("SELECT 1", None, 0.001)
+    observed.observe("SELECT 2", None, 0.003)
+    observed.observe("SELECT 1", None, 0.001)
+    observed.observe("SELECT 3", None, 0.0025)
+
+    assert [query.sql for query in observed.top(2)] == [
+        "SELECT 2",
+        "SELECT 3",
+    ]
+
+
+def test_slow_query_logged(observed, monkeypatch, caplog) -> None:
+    caplog.set_level(logging.WARNING, logger=queries.__name__)
+
+    with pytest.raises(NotFoundError):
+        user.read_user(datetime.datetime.utcnow(), "alice", None)
+    assert not caplog.records
+
+    monkeypatch.setattr(
+        config(),
+        "db_slow_query_threshold",
+        datetime.timedelta(0),
+    )
+    with pytest.raises(NotFoundError):
+        user.read_user(datetime.datetime.utcnow(), "bob", None)
+
+    (record, ) = [
+        record for record in caplog.records if 'FROM "user"' in record.sql
+    ]
+    assert record.message.startswith("slow query: ")
+    assert record.sql in record.message
+    # Parameters by their type only; the name is not logged.
+    assert "bob" not in record.message
+    assert "str" in record.params
+    assert record.caller == "lobbyist.controllers.user._read_user_txn"
+
+
+@pytest.mark.parametrize("enabled", [True, False])
+def test_request_headers(observed, monkeypatch, enabled) -> None:
+    monkeypatch.setattr(config(), "db_query_headers", enabled)
+
+    response = app().test_client().get("/user/alice", headers=HEADERS)
+    assert response.status_code == 404
+    if not enabled:
+        assert "X-DB-Statements" not in response.headers
+        assert "X-DB-Time-Ms" not in response.headers
+        return
+
+    statements = sum(query.count for query in observed.top(100))
+    assert statements >= 1
+    assert int(response.headers["X-DB-Statements"]) == statements
+    time_ms = sum(query.total_s for query in observed.top(100)) * 1e3
+    assert float(response.headers["X-DB-Time-Ms"]) == round(time_ms, 3)
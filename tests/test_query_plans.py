@@ -0,0 +1,253 @@
+"""
+Query-plan regression tests.
+
+Each test drives the SQLite engine, and through it the models' queries
+(lookups by value and name, the `where_valid` filters, backref walks and
+the reaper's deletes), while capturing every statement it sends. Each
+statement is then run through EXPLAIN QUERY PLAN, and the test fails if
+any step of the plan scans a whole table or index rather than searching
+one.
+
+Plans depend on the schema and, once ANALYZE has run, on the data. The
+tests plan against an empty database, or against a seeded copy of a real
+one named by LOBBYIST_PLANS_DB, eg: one from benchmarks.dataset:
+
+    LOBBYIST_PLANS_DB=big.db pytest tests/test_query_plans.py -v
+
+Everything a test writes is rolled back.
+"""
+
+import contextlib
+import datetime
+import os
+import re
+import uuid
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+import peewee
+import pytest
+
+from .context import lobbyist
+from .engines import open_db
+from lobbyist.library.db import db
+from lobbyist.models.auth import AccessToken, RefreshToken
+from lobbyist.models.secret import Secret
+from lobbyist.models.user import User
+from lobbyist.storage.sqlite import SqliteEngine
+
+T0 = datetime.datetime(2020, 1, 1)
+HOUR = datetime.timedelta(hours=1)
+
+# "SCAN t" or "SCAN t USING [COVERING] INDEX i" read every row of t or i;
+# searches read "SEARCH t USING ...". Scans of subquery results and of
+# the constant rows of an IN (...) list are bounded by those, and fine.
+_SCAN = re.compile(r"^SCAN (?!CONSTANT ROW|\(subquery)")
+_STATEMENT = re.compile(r"^\s*(SELECT|UPDATE|DELETE)\b", re.IGNORECASE)
+
+Statement = Tuple[str, Tuple[Any, ...]]
+Check = Callable[[SqliteEngine, "_Ids"], Any]
+
+
+class _Ids:
+    def __init__(self):
+        self.user = uuid.uuid4()
+        self.secret = uuid.uuid4()
+        self.access_token = uuid.uuid4()
+        self.refresh_token = uuid.uuid4()
+
+
+@contextlib.contextmanager
+def _capture(database: peewee.Database) -> Iterator[List[Statement]]:
+    statements: List[Statement] = []
+    execute_sql = database.execute_sql
+
+    def capturing(sql, params=None):
+        if _STATEMENT.match(sql):
+            statements.append((sql, tuple(params or ())))
+        return execute_sql(sql, params)
+
+    database.execute_sql = capturing
+    try:
+        yield statements
+    finally:
+        del database.execute_sql
+
+
+def _explain(
+    database: peewee.Database,
+    statements: List[Statement],
+) -> Tuple[List[str], Optional[str]]:
+    plans = []
+    scans = []
+    for sql, params in statements:
+        rows = database.execute_sql(
+            "EXPLAIN QUERY PLAN " + sql,
+            params,
+        ).fetchall()
+        details = [row[-1] for row in rows]
+        plans.append(f"{sql}\n" + "".join(f"  {d}\n" for d in details))
+        scans.extend(
+            f"{detail}\n  in {sql}" for detail in details
+            if _SCAN.match(detail)
+        )
+    if not statements:
+        return plans, "no statements were captured"
+    if scans:
+        return plans, "full scans:\n" + "\n".join(scans)
+    return plans, None
+
+
+def _seed(engine: SqliteEngine) -> _Ids:
+    ids = _Ids()
+    engine.create_user(ids.user, "user", T0)
+    engine.create_secret(ids.secret, "user", "hash", T0, None, ids.user)
+    engine.create_access_token(
+        ids.access_token, "a", T0, T0 + HOUR, ids.secret
+    )
+    engine.create_refresh_token(
+        ids.refresh_token, "r", T0, T0 + 2 * HOUR, ids.access_token
+    )
+    return ids
+
+
+def _walk_backrefs(engine: SqliteEngine, ids: _Ids) -> None:
+    user = User.get_by_id(ids.user)
+    for secret in user.secrets:
+        for access_token in secret.access_tokens:
+            list(access_token.refresh_tokens)
+
+
+CHECKS: List[Tuple[str, Check]] = [
+    (
+        "User.select_by_name",
+        lambda engine, ids: User.select_by_name("user"),
+    ),
+    (
+        "select_user_by_name",
+        lambda engine, ids: engine.select_user_by_name("user"),
+    ),
+    (
+        "update_user",
+        lambda engine, ids: engine.
+        update_user(T0, engine.select_user_by_name("user"), T0 + HOUR),
+    ),
+    (
+        "select_next_expire_ts_by_user",
+        lambda engine, ids: engine.select_next_expire_ts_by_user(T0, ids.user),
+    ),
+    (
+        "create_secret",
+        lambda engine, ids: engine.
+        create_secret(uuid.uuid4(), "secret", "hash", T0, None, ids.user),
+    ),
+    (
+        "select_secret_by_name",
+        lambda engine, ids: engine.select_secret_by_name("user"),
+    ),
+    (
+        "Secret.select_valid_by_name",
+        lambda engine, ids: Secret.select_valid_by_name(T0, "user"),
+    ),
+    (
+        "select_valid_secret_record_by_name",
+        lambda engine, ids: engine.
+        select_valid_secret_record_by_name(T0, "user"),
+    ),
+    (
+        "select_valid_secrets_by_user",
+        lambda engine, ids: list(
+            engine.select_valid_secrets_by_user(T0, ids.user)
+        ),
+    ),
+    (
+        "update_secret",
+        lambda engine, ids: engine.
+        update_secret(T0, engine.select_secret_by_name("user"), hash="x"),
+    ),
+    (
+        "expire_secrets",
+        lambda engine, ids: engine.
+        expire_secrets(T0, ids.user, [ids.secret], T0 + HOUR),
+    ),
+    (
+        "create_access_token",
+        lambda engine, ids: engine.
+        create_access_token(uuid.uuid4(), "a2", T0, T0 + HOUR, ids.secret),
+    ),
+    (
+        "select_access_token_by_value",
+        lambda engine, ids: engine.select_access_token_by_value("a"),
+    ),
+    (
+        "AccessToken.select_valid_by_value",
+        lambda engine, ids: AccessToken.select_valid_by_value(T0, "a"),
+    ),
+    (
+        "select_valid_access_token_record_by_value",
+        lambda engine, ids: engine.
+        select_valid_access_token_record_by_value(T0, "a"),
+    ),
+    (
+        "select_valid_access_tokens_by_user",
+        lambda engine, ids: list(
+            engine.select_valid_access_tokens_by_user(T0, ids.user)
+        ),
+    ),
+    (
+        "RefreshToken.select_by_value",
+        lambda engine, ids: RefreshToken.select_by_value("r"),
+    ),
+    (
+        "RefreshToken.select_valid_by_value",
+        lambda engine, ids: RefreshToken.select_valid_by_value(T0, "r"),
+    ),
+    (
+        "select_valid_refresh_tokens_by_user",
+        lambda engine, ids: list(
+            engine.select_valid_refresh_tokens_by_user(T0, ids.user)
+        ),
+    ),
+    (
+        "select_valid_refresh_tokens_by_access_token",
+        lambda engine, ids: list(
+            engine.
+            select_valid_refresh_tokens_by_access_token(T0, ids.access_token)
+        ),
+    ),
+    (
+        "evict_access_tokens",
+        lambda engine, ids: engine.evict_access_tokens(T0, ids.secret, 0),
+    ),
+    ("backrefs", _walk_backrefs),
+    (
+        "select_modified_since",
+        lambda engine, ids: engine.select_modified_since(T0),
+    ),
+    ("reap", lambda engine, ids: engine.reap(T0 + 3 * HOUR, 100)),
+]
+
+
+@pytest.fixture(scope="module")
+def database(tmp_path_factory) -> peewee.Database:
+    path = os.environ.get("LOBBYIST_PLANS_DB") or str(
+        tmp_path_factory.mktemp("plans") / "db"
+    )
+    open_db(path)
+    yield db().obj
+    db().close()
+
+
+@pytest.mark.parametrize(
+    "fn",
+    [fn for _, fn in CHECKS],
+    ids=[name for name, _ in CHECKS],
+)
+def test_plan(database: peewee.Database, fn: Check) -> None:
+    engine = SqliteEngine()
+    with database.atomic() as transaction:
+        ids = _seed(engine)
+        with _capture(database) as statements:
+            fn(engine, ids)
+        plans, failure = _explain(database, statements)
+        transaction.rollback()
+    assert failure is None, failure + "\n\nplans:\n" + "".join(plans)
@@ -0,0 +1,146 @@
+"""
+Moving tokens between shard layouts, with every token still resolving and
+tree versions never going backwards.
+"""
+
+import datetime
+import os
+import uuid
+from typing import List
+
+import pytest
+
+from .engines import open_db
+from .context import lobbyist
+from lobbyist.controllers import user
+from lobbyist.library.db import db
+from lobbyist.storage import sharded
+from lobbyist.storage.engine import Engine, storage
+from lobbyist.storage.sqlite import SqliteEngine
+
+HOUR = datetime.timedelta(hours=1)
+TOKENS = 40
+# Smaller than TOKENS, so that rows move in several batches.
+BATCH_SIZE = 7
+
+
+def _open(path: str, count: int) -> Engine:
+    open_db(path)
+    sharded.check_layout(path, count)
+    if count:
+        engine = sharded.ShardedSqliteEngine(
+            sharded.open_shards(path, count, None)
+        )
+    else:
+        engine = SqliteEngine()
+    storage().initialize(engine)
+    return engine
+
+
+def _rebalance(engine: Engine, path: str, count: int) -> Engine:
+    engine.close()
+    open_db(path)
+    report = sharded.rebalance(path, count, None, BATCH_SIZE)
+    assert report["to"] == count
+    db().close()
+    return _open(path, count)
+
+
+@pytest.fixture
+def path(tmp_path) -> str:
+    return os.path.join(str(tmp_path), "db")
+
+
+def _populate(server_ts: datetime.datetime) -> List[str]:
+    """Creates alice with TOKENS more access tokens; their values."""
+    response = user.create_user(server_ts, "alice", "password", HOUR, HOUR)
+    (token, ) = storage().select_valid_access_tokens_by_user(
+        server_ts,
+        response.user.id,
+    )
+    values = [token.value]
+    with storage().atomic(write=True):
+        for index in range(TOKENS):
+            access_token = storage().create_access_token(
+                uuid.uuid4(),
+                f"access{index}",
+                server_ts,
+                server_ts + HOUR,
+                token.secret_id,
+            )
+            storage().create_refresh_token(
+                uuid.uuid4(),
+                f"refresh{index}",
+                server_ts,
+                server_ts + HOUR,
+                access_token.id,
+            )
+            values.append(access_token.value)
+    return values
+
+
+def _check(server_ts: datetime.datetime, values: List[str]) -> None:
+    alice = storage().select_user_by_name("alice")
+    for value in values:
+        access_token = storage().select_access_token_by_value(value)
+        assert access_token is not None, value
+        assert access_token.secret.user_id == alice.id
+    refresh_tokens = storage().select_valid_refresh_tokens_by_user(
+        server_ts,
+        alice.id,
+    )
+    assert len(list(refresh_tokens)) == TOKENS + 1
+
+
+@pytest.mark.parametrize("counts", [[3, 2, 5, 0], [1, 4, 0]])
+def test_rebalance(path, counts) -> None:
+    server_ts = datetime.datetime.utcnow()
+    engine = _open(path, 0)
+    values = _populate(server_ts)
+    tree_version = storage().select_user_by_name("alice").tree_version
+
+    try:
+        for count in counts:
+            engine = _rebalance(engine, path, count)
+            assert sharded.shard_counts(path) == ({count} if count else set())
+            _check(server_ts, values)
+            alice = storage().select_user_by_name("alice")
+            assert alice.tree_version >= tree_version
+            tree_version = alice.tree_version
+
+            # The new layout takes writes.
+            with storage().atomic(write=True):
+                secret_id = storage().select_access_token_by_value(
+                    values[0]
+                ).secret_id
+                storage().create_access_token(
+                    uuid.uuid4(),
+                    f"after{count}",
+                    server_ts,
+                    server_ts + HOUR,
+                    secret_id,
+                )
+            values.append(f"after{count}")
+            assert storage().select_user_by_name(
+                "alice"
+            ).tree_version > tree_version
+            tree_version = storage().select_user_by_name("alice").tree_version
+    finally:
+        engine.close()
+
+
+def test_same_count_is_a_no_op(path) -> None:
+    engine = _open(path, 0)
+    values = _populate(datetime.datetime.utcnow())
+    engine = _rebalance(engine, path, 2)
+
+    engine.close()
+    open_db(path)
+    assert sharded.rebalance(path, 2, None) == {"from": 2, "to": 2}
+    db().close()
+    engine = _open(path, 2)
+    try:
+        for value in values:
+            assert storage().select_access_token_by_value(value) is not None
+    finally:
+        engine.close()
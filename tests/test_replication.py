@@ -0,0 +1,187 @@
+"""
+Replication from a leader to a follower.
+
+test_followers_converge runs both as servers, in separate processes, and
+checks that the follower serves what was written to the leader, including
+after the leader is killed and restarted.
+
+test_crash kills a leader process with os._exit at either point a crash
+can fall between its change log and its engine: once a transaction's calls
+are synced to the log but before it commits ("append"), and once it
+commits but before the log says so ("commit"). After a restart, the
+leader's engine and a follower replaying the log must both have every
+write.
+"""
+
+import datetime
+import os
+import subprocess
+import sys
+import time
+import uuid
+from typing import Dict, List, Set
+
+import pytest
+
+from .engines import KINDS, Engines
+from .nodes import Node
+from .context import lobbyist
+from lobbyist.storage import replication
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+T0 = datetime.datetime(2020, 1, 1)
+NAMES = ("before", "crashed", "after")
+
+LEADER = """
+import datetime
+import os
+import sys
+import uuid
+
+sys.path.insert(0, {root!r})
+from tests.engines import Engines
+from lobbyist.storage import replication
+
+engine = replication.CapturingEngine(
+    Engines({kind!r}, {directory!r}).open(),
+    replication.ChangeLog({changelog!r}, 2**20),
+)
+engine.create_user(uuid.uuid4(), "before", {t0!r})
+
+log = engine.log
+crash_at = getattr(log, {at!r})
+def crash(*args):
+    if {at!r} == "append":
+        crash_at(*args)
+    os._exit(9)
+setattr(log, {at!r}, crash)
+engine.create_user(uuid.uuid4(), "crashed", {t0!r})
+"""
+
+
+def _crash(kind: str, directory: str, changelog: str, at: str) -> None:
+    script = LEADER.format(
+        root=ROOT,
+        kind=kind,
+        directory=directory,
+        changelog=changelog,
+        t0=T0,
+        at=at,
+    )
+    assert subprocess.run([sys.executable, "-c", script]).returncode == 9
+
+
+def _follow(kind: str, directory: str, changelog: str) -> Set[str]:
+    # Engines share db(), so only one is open at a time.
+    engines = Engines(kind, directory)
+    try:
+        follower = replication.Follower(changelog, engines.open(), 100)
+        follower.tick()
+        return {
+            name for name in NAMES
+            if follower.engine.select_user_by_name(name) is not None
+        }
+    finally:
+        engines.close()
+
+
+@pytest.mark.parametrize("at", ["append", "commit"])
+@pytest.mark.parametrize("kind", KINDS)
+def test_crash(tmp_path, kind: str, at: str) -> None:
+    leader_path = str(tmp_path / "leader")
+    follower_path = str(tmp_path / "follower")
+    changelog = str(tmp_path / "changes")
+    os.makedirs(leader_path)
+    os.makedirs(follower_path)
+    _crash(kind, leader_path, changelog, at)
+
+    # Nothing says whether the crashed transaction committed, yet.
+    assert _follow(kind, follower_path, changelog) == {"before"}
+
+    engines = Engines(kind, leader_path)
+    engine = replication.CapturingEngine(
+        engines.open(),
+        replication.ChangeLog(changelog, 2**20),
+    )
+    try:
+        engine.recover()
+        assert not engine.log.pending
+        engine.create_user(uuid.uuid4(), "after", T0)
+        assert all(engine.select_user_by_name(name) for name in NAMES)
+    finally:
+        engine.log.close()
+        engines.close()
+
+    assert _follow(kind, follower_path, changelog) == set(NAMES)
+
+
+def _create_users(leader: Node, names: List[str]) -> Dict[str, str]:
+    tokens = {}
+    for name in names:
+        status, body = leader.request(
+            "POST",
+            "/user",
+            {"name": name, "secret": "password"},
+        )
+        assert status == 201, status
+        tokens[name] = body["access_tokens"][0]["value"]
+    return tokens
+
+
+def _converge(leader: Node, follower: Node, timeout_s: float = 30.0) -> int:
+    _, status = leader.request("GET", "/replication")
+    deadline = time.monotonic() + timeout_s
+    while True:
+        _, applied = follower.request("GET", "/replication")
+        if applied["lsn"] == status["lsn"]:
+            return status["lsn"]
+        assert time.monotonic() < deadline, (status, applied)
+        time.sleep(0.05)
+
+
+def _check(follower: Node, tokens: Dict[str, str]) -> None:
+    for name, token in tokens.items():
+        status, body = follower.request("GET", f"/user/{name}", token=token)
+        assert status == 200 and "access_tokens" in body, (name, status)
+
+
+@pytest.mark.parametrize("storage", ["sqlite", "memory"])
+def test_followers_converge(tmp_path, storage: str) -> None:
+    changelog = str(tmp_path / "changes")
+    directory = str(tmp_path)
+    leader = Node(directory, "leader", storage, ["--changelog", changelog])
+    follower = Node(directory, "follower", storage, ["--follow", changelog])
+    try:
+        leader.start()
+        follower.start()
+
+        tokens = _create_users(leader, ["user0", "user1", "user2"])
+        expire_ts = int(time.time()) + 3600
+        status, _ = leader.request(
+            "PATCH",
+            "/user/user1",
+            {"expire_ts": expire_ts},
+            token=tokens["user1"],
+        )
+        assert status == 200, status
+        lsn = _converge(leader, follower)
+        _check(follower, tokens)
+        _, body = follower.request("GET", "/user/user1", token=tokens["user1"])
+        assert body["user"]["expire_ts"] is not None
+
+        status, _ = follower.request(
+            "POST",
+            "/user",
+            {"name": "refused", "secret": "password"},
+        )
+        assert status == 503, status
+
+        # A crashed leader picks its log up where it left off.
+        leader.stop(kill=True)
+        leader.start()
+        tokens.update(_create_users(leader, ["user3", "user4"]))
+        assert _converge(leader, follower) > lsn
+        _check(follower, tokens)
+    finally:
+        leader.stop()
+        follower.stop()
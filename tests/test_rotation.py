@@ -0,0 +1,60 @@
+"""
+Rotating a user's secrets under the secret quota.
+"""
+
+import datetime
+
+import pytest
+
+from .context import lobbyist
+from lobbyist.controllers import secret, user
+from lobbyist.library.config import config
+from lobbyist.library.error import ConflictError
+from lobbyist.storage.engine import storage
+
+HOUR = datetime.timedelta(hours=1)
+NOTHING = datetime.timedelta(0)
+SECOND = datetime.timedelta(seconds=1)
+QUOTA = 3
+
+
+def _valid(server_ts: datetime.datetime, user_id) -> int:
+    return sum(
+        1 for _ in storage().select_valid_secrets_by_user(server_ts, user_id)
+    )
+
+
+def test_rotation_quota(engine, monkeypatch) -> None:
+    monkeypatch.setattr(config(), "secret_quota_per_user", QUOTA)
+    storage().initialize(engine)
+    server_ts = datetime.datetime.utcnow()
+
+    created = user.create_user(server_ts, "alice", "password", HOUR, HOUR)
+    user_id = created.user.id
+    (token, ) = storage().select_valid_access_tokens_by_user(
+        server_ts,
+        user_id,
+    )
+    name = secret.create_secret(server_ts, token.value, None).secret.name
+    assert _valid(server_ts, user_id) == 2
+
+    # The old secret stays valid through its grace period, beside its
+    # replacement, which fills the quota.
+    rotated = secret.rotate_secrets(
+        server_ts, "alice", token.value, [name], HOUR, None
+    )
+    (_, _, new, _), = rotated.rotated
+    assert _valid(server_ts, user_id) == QUOTA
+
+    with pytest.raises(ConflictError):
+        secret.rotate_secrets(
+            server_ts, "alice", token.value, [new.name], HOUR, None
+        )
+    assert _valid(server_ts, user_id) == QUOTA
+
+    # Without a grace period, the old secret makes room for the new one.
+    # It expires at server_ts, and is gone right after.
+    secret.rotate_secrets(
+        server_ts, "alice", token.value, [new.name], NOTHING, None
+    )
+    assert _valid(server_ts + SECOND, user_id) == QUOTA
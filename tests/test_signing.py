@@ -0,0 +1,107 @@
+"""
+Signing and verifying access tokens, and their revocation.
+"""
+
+import datetime
+import uuid
+from typing import List
+
+from .context import lobbyist
+from lobbyist.library.signing import Claims, Keyring, Revocations
+
+T0 = datetime.datetime(2020, 1, 1)
+HOUR = datetime.timedelta(hours=1)
+
+
+def _claims(generation: datetime.datetime) -> Claims:
+    return Claims(
+        uuid.uuid4(),
+        uuid.uuid4(),
+        uuid.uuid4(),
+        generation + HOUR,
+        generation,
+    )
+
+
+def test_verify() -> None:
+    keyring = Keyring(None, {})
+    keyring.rotate("k1")
+    claims = _claims(T0)
+    verified = keyring.verify(keyring.sign(claims))
+    assert verified is not None
+    assert (verified.id, verified.expire_ts) == (claims.id, claims.expire_ts)
+
+    # A key that is no longer kept verifies nothing it signed.
+    other = Keyring(None, {})
+    other.rotate("k1")
+    assert other.verify(keyring.sign(claims)) is None
+
+
+def _tampered(token: str) -> List[str]:
+    key_id, payload, tag = token.split(".")
+    flip = {"A": "B"}.get(payload[0], "A")
+    return [
+        f"{key_id}.{flip}{payload[1:]}.{tag}",
+        f"{key_id}.{payload}.{tag[:-1]}",
+        f"{key_id}.{payload}.{tag}A",
+        f"{key_id}.{payload}",
+        f"{key_id}.{payload}.{tag}.{tag}",
+        f"k2.{payload}.{tag}",
+        # Not ASCII, in each part.
+        f"{key_id}.{payload}.{tag[:-1]}\u00e9",
+        f"{key_id}.{payload}\u00e9.{tag}",
+        f"{key_id}\u00e9.{payload}.{tag}",
+        f"{key_id}.{payload}.\ud800",
+    ]
+
+
+def test_verify_refuses_tampered_tokens() -> None:
+    keyring = Keyring(None, {})
+    keyring.rotate("k1")
+    for token in _tampered(keyring.sign(_claims(T0))):
+        assert keyring.verify(token) is None, repr(token)
+
+
+def test_revoke_at_once() -> None:
+    revocations = Revocations(24 * HOUR)
+    before, after = _claims(T0), _claims(T0 + 2 * HOUR)
+    after.secret_id = before.secret_id
+    revocations.revoke(before.secret_id, T0 + HOUR)
+
+    assert revocations.is_revoked(T0 + HOUR, before)
+    assert not revocations.is_revoked(T0 + 2 * HOUR, after)
+
+
+def test_revoke_on_expiry() -> None:
+    revocations = Revocations(24 * HOUR)
+    claims = _claims(T0)
+    revocations.revoke(claims.user_id, T0 + HOUR, T0 + 3 * HOUR)
+
+    assert not revocations.is_revoked(T0 + 2 * HOUR, claims)
+    assert revocations.is_revoked(T0 + 3 * HOUR, claims)
+
+
+def test_latest_change_wins() -> None:
+    revocations = Revocations(24 * HOUR)
+    claims = _claims(T0)
+    revocations.revoke(claims.secret_id, T0 + 2 * HOUR)
+    revocations.revoke(claims.secret_id, T0 + HOUR, T0 + 5 * HOUR)
+
+    assert revocations.is_revoked(T0 + 2 * HOUR, claims)
+
+
+def test_refresh() -> None:
+    revocations = Revocations(24 * HOUR)
+    claims = _claims(T0)
+    revocations.revoke(uuid.uuid4(), T0)
+    revocations.refresh(T0 + HOUR, [
+        (claims.secret_id, T0 + HOUR, T0 + 2 * HOUR),
+        (claims.user_id, T0 - 48 * HOUR, None),
+    ])
+
+    assert len(revocations) == 2
+    assert not revocations.is_revoked(T0 + HOUR, claims)
+    assert revocations.is_revoked(T0 + 2 * HOUR, claims)
+
+    revocations.refresh(T0 + 25 * HOUR, [])
+    assert len(revocations) == 1
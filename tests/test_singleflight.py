@@ -0,0 +1,107 @@
+"""
+Concurrent calls with the same key, collapsed into one.
+"""
+
+import threading
+import time
+from typing import Any, List
+
+from .context import lobbyist
+from lobbyist.library.metrics import metrics
+from lobbyist.library.singleflight import SingleFlight
+
+WAITERS = 8
+WAIT_S = 10
+
+
+class Leader:
+    """A call that runs until released, counting how often it ran."""
+
+    def __init__(self, outcome: Any):
+        self.outcome = outcome
+        self.calls = 0
+        self.running = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self) -> Any:
+        self.calls += 1
+        self.running.set()
+        self.release.wait(WAIT_S)
+        if isinstance(self.outcome, BaseException):
+            raise self.outcome
+        return self.outcome
+
+
+def _coalesced(name: str) -> int:
+    counters = metrics().snapshot()["counters"]
+    return counters.get(f"singleflight.{name}.coalesced", 0)
+
+
+def _run(flight: SingleFlight, leader: Leader) -> List[Any]:
+    """Runs `leader` and WAITERS more calls on one key; their outcomes."""
+    outcomes: List[Any] = [None] * (WAITERS + 1)
+
+    def do(index: int) -> None:
+        try:
+            outcomes[index] = flight.do("key", leader)
+        except BaseException as error:
+            outcomes[index] = error
+
+    threads = [
+        threading.Thread(target=do, args=(index, ))
+        for index in range(WAITERS + 1)
+    ]
+    coalesced = _coalesced(flight.name)
+    try:
+        threads[0].start()
+        assert leader.running.wait(WAIT_S)
+        for thread in threads[1:]:
+            thread.start()
+        deadline = time.monotonic() + WAIT_S
+        while _coalesced(flight.name) < coalesced + WAITERS:
+            assert time.monotonic() < deadline
+            time.sleep(0.001)
+    finally:
+        leader.release.set()
+        for thread in threads:
+            if thread.ident is not None:
+                thread.join()
+    return outcomes
+
+
+def test_coalesces(request) -> None:
+    flight = SingleFlight(request.node.name)
+    result = object()
+    leader = Leader(result)
+
+    outcomes = _run(flight, leader)
+    assert leader.calls == 1
+    assert all(outcome is result for outcome in outcomes)
+
+    # Nothing is kept once the call is done.
+    assert flight.do("key", lambda: "again") == "again"
+
+
+def test_error_reaches_every_waiter(request) -> None:
+    flight = SingleFlight(request.node.name)
+    error = ValueError("fail")
+    leader = Leader(error)
+
+    outcomes = _run(flight, leader)
+    assert leader.calls == 1
+    assert all(outcome is error for outcome in outcomes)
+
+    assert flight.do("key", lambda: "again") == "again"
+
+
+def test_keys_are_separate(request) -> None:
+    flight = SingleFlight(request.node.name)
+    leader = Leader("first")
+    thread = threading.Thread(target=flight.do, args=("first", leader))
+    thread.start()
+    try:
+        assert leader.running.wait(WAIT_S)
+        assert flight.do("second", lambda: "second") == "second"
+    finally:
+        leader.release.set()
+        thread.join()
@@ -0,0 +1,45 @@
+"""
+What serving imports before its first request.
+
+Auditing, signing, group commit, the profiler and the admin views are only
+imported once a deployment uses them, so they must not come in with the
+views. Checked in a fresh interpreter, since the tests import them all.
+"""
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DEFERRED = (
+    "lobbyist.library.audit",
+    "lobbyist.library.group_commit",
+    "lobbyist.library.profiler",
+    "lobbyist.library.signing",
+    "lobbyist.views.admin",
+)
+
+SCRIPT = """
+import sys
+
+sys.path.insert(0, {src!r})
+import lobbyist.views
+from lobbyist.library.app import app
+
+app()
+print(" ".join(name for name in {deferred!r} if name in sys.modules))
+"""
+
+
+def test_deferred_imports() -> None:
+    script = SCRIPT.format(
+        src=os.path.join(ROOT, "src"),
+        deferred=DEFERRED,
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    assert result.stdout.split() == []
@@ -0,0 +1,375 @@
+"""
+Scenarios every storage engine must pass.
+
+Each test runs once per engine (see conftest.py), on freshly opened, empty
+storage. test_persistence also checks that committed state survives
+closing and reopening the engine.
+"""
+
+import datetime
+import uuid
+from typing import Tuple
+
+import pytest
+
+from .engines import Engines
+from .context import lobbyist
+from lobbyist.storage import sharded
+from lobbyist.storage.engine import Engine, IntegrityError
+
+T0 = datetime.datetime(2020, 1, 1)
+HOUR = datetime.timedelta(hours=1)
+MINUTE = datetime.timedelta(minutes=1)
+
+
+def _seed(engine: Engine, suffix: str = "") -> Tuple[uuid.UUID, ...]:
+    user_id, secret_id, access_token_id = (uuid.uuid4() for _ in range(3))
+    with engine.atomic():
+        engine.create_user(user_id, f"user{suffix}", T0)
+        engine.create_secret(
+            secret_id, f"user{suffix}", "hash", T0, None, user_id
+        )
+        engine.create_access_token(
+            access_token_id, f"a{suffix}", T0, T0 + HOUR, secret_id
+        )
+        engine.create_refresh_token(
+            uuid.uuid4(), f"r{suffix}", T0, T0 + 2 * HOUR, access_token_id
+        )
+    return user_id, secret_id, access_token_id
+
+
+def test_lookups(engine: Engine) -> None:
+    user_id, secret_id, access_token_id = _seed(engine)
+
+    user = engine.select_user_by_name("user")
+    assert user.id == user_id and user.name == "user"
+    assert engine.select_user_by_name("nobody") is None
+
+    secret = engine.select_secret_by_name("user")
+    assert secret.id == secret_id and secret.user_id == user_id
+    assert secret.user.name == "user"
+
+    access_token = engine.select_access_token_by_value("a")
+    assert access_token.id == access_token_id
+    assert access_token.secret.user_id == user_id
+    assert engine.select_access_token_by_value("b") is None
+
+
+def test_validity(engine: Engine) -> None:
+    user_id, secret_id, access_token_id = _seed(engine)
+
+    record = engine.select_valid_secret_record_by_name(T0, "user")
+    assert (record.id, record.hash, record.user_id) == (
+        secret_id, "hash", user_id
+    )
+    record = engine.select_valid_access_token_record_by_value(T0, "a")
+    assert (record.id, record.secret_id, record.user_id) == (
+        access_token_id, secret_id, user_id
+    )
+    assert record.expire_ts == T0 + HOUR
+
+    later = T0 + HOUR + datetime.timedelta(microseconds=1)
+    assert engine.select_valid_access_token_record_by_value(later, "a") is None
+    assert engine.select_valid_secret_record_by_name(later, "user")
+
+    # Expiring a user invalidates everything beneath it.
+    with engine.atomic():
+        engine.update_user(T0, engine.select_user_by_name("user"), T0)
+    assert engine.select_valid_secret_record_by_name(T0 + HOUR, "user") is None
+    assert engine.select_valid_access_token_record_by_value(
+        T0 + HOUR, "a"
+    ) is None
+
+
+def test_listings(engine: Engine) -> None:
+    user_id, secret_id, access_token_id = _seed(engine)
+    _seed(engine, "2")
+
+    def ids(rows):
+        return sorted(row.id for row in rows)
+
+    assert ids(engine.select_valid_secrets_by_user(T0, user_id)) == [secret_id]
+    assert ids(engine.select_valid_access_tokens_by_user(T0, user_id)) == [
+        access_token_id
+    ]
+    assert len(list(engine.select_valid_refresh_tokens_by_user(T0, user_id))
+              ) == 1
+    assert len(
+        list(
+            engine.select_valid_refresh_tokens_by_access_token(
+                T0,
+                access_token_id,
+            )
+        )
+    ) == 1
+
+    # Refresh tokens outlive their access token, but are only listed under
+    # the user while it is valid.
+    later = T0 + HOUR + datetime.timedelta(minutes=1)
+    assert not list(engine.select_valid_access_tokens_by_user(later, user_id))
+    assert not list(engine.select_valid_refresh_tokens_by_user(later, user_id))
+    assert len(
+        list(
+            engine.select_valid_refresh_tokens_by_access_token(
+                later,
+                access_token_id,
+            )
+        )
+    ) == 1
+
+    assert engine.select_next_expire_ts_by_user(T0, user_id) == T0 + HOUR
+    assert engine.select_next_expire_ts_by_user(later, user_id) is None
+
+
+def test_versions(engine: Engine) -> None:
+    user_id, _, _ = _seed(engine)
+
+    user = engine.select_user_by_name("user")
+    assert user.version == 1
+    # The secret and the access token each touched the tree. The refresh
+    # token commits with its access token, except in the sharded engine.
+    if isinstance(engine, sharded.ShardedSqliteEngine):
+        assert user.tree_version == 4
+    else:
+        assert user.tree_version == 3
+    tree_version = user.tree_version
+
+    with engine.atomic():
+        user = engine.update_user(T0 + HOUR, user, T0 + 2 * HOUR)
+    assert (user.version, user.tree_version) == (2, tree_version + 1)
+    assert user.modify_ts == T0 + HOUR and user.expire_ts == T0 + 2 * HOUR
+
+    with engine.atomic():
+        secret = engine.update_secret(
+            T0 + HOUR,
+            engine.select_secret_by_name("user"),
+            hash="rehashed",
+        )
+    assert (secret.version, secret.hash) == (2, "rehashed")
+    assert secret.modify_ts == T0 + HOUR
+
+    user = engine.select_user_by_name("user")
+    assert (user.version, user.tree_version) == (2, tree_version + 2)
+    assert engine.select_secret_by_name("user").hash == "rehashed"
+
+
+def test_uniqueness(engine: Engine) -> None:
+    user_id, secret_id, access_token_id = _seed(engine)
+
+    for create in (
+        lambda: engine.create_user(uuid.uuid4(), "user", T0),
+        lambda: engine.
+        create_secret(uuid.uuid4(), "user", "hash", T0, None, user_id),
+        lambda: engine.
+        create_access_token(uuid.uuid4(), "a", T0, T0 + HOUR, secret_id),
+        lambda: engine.create_refresh_token(
+            uuid.uuid4(), "r", T0, T0 + HOUR, access_token_id
+        ),
+    ):
+        with pytest.raises(IntegrityError):
+            with engine.atomic():
+                create()
+
+
+def test_rollback(engine: Engine) -> None:
+    _seed(engine)
+
+    try:
+        with engine.atomic():
+            user_id = uuid.uuid4()
+            engine.create_user(user_id, "other", T0)
+            engine.create_secret(
+                uuid.uuid4(), "other", "hash", T0, None, user_id
+            )
+            engine.update_user(T0, engine.select_user_by_name("user"), T0)
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+
+    assert engine.select_user_by_name("other") is None
+    assert engine.select_secret_by_name("other") is None
+    user = engine.select_user_by_name("user")
+    assert user.expire_ts is None and user.version == 1
+
+
+def test_nested_rollback(engine: Engine) -> None:
+    with engine.atomic():
+        try:
+            with engine.atomic():
+                engine.create_user(uuid.uuid4(), "inner", T0)
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        engine.create_user(uuid.uuid4(), "outer", T0)
+
+    assert engine.select_user_by_name("inner") is None
+    assert engine.select_user_by_name("outer") is not None
+
+
+def test_reap(engine: Engine) -> None:
+    user_id, _, _ = _seed(engine)
+    _seed(engine, "2")
+    with engine.atomic():
+        engine.update_user(T0, engine.select_user_by_name("user"), T0 + HOUR)
+
+    # Only the refresh tokens' expiry has not passed; nothing can go.
+    deleted = engine.reap(T0 + HOUR + datetime.timedelta(minutes=1), 1)
+    assert not any(deleted.values()), deleted
+
+    deleted = engine.reap(T0 + 3 * HOUR, 1)
+    assert deleted["user"] == 1 and deleted["secret"] == 1, deleted
+    assert deleted["accesstoken"] == 2 and deleted["refreshtoken"] == 2, deleted
+    assert engine.select_user_by_name("user") is None
+    assert engine.select_secret_by_name("user") is None
+    assert engine.select_access_token_by_value("a") is None
+    assert engine.select_user_by_name("user2") is not None
+
+    assert not any(engine.reap(T0 + 3 * HOUR, 1).values())
+
+
+def test_export(engine: Engine) -> None:
+    _seed(engine)
+    _seed(engine, "2")
+
+    # Parents come before their children, so the rows can be replayed.
+    kinds = [type(row).__name__ for row in engine.export()]
+    assert kinds == [
+        "User",
+        "User",
+        "Secret",
+        "Secret",
+        "AccessToken",
+        "AccessToken",
+        "RefreshToken",
+        "RefreshToken",
+    ], kinds
+
+
+def test_modified_since(engine: Engine) -> None:
+    user_id, secret_id, _ = _seed(engine)
+    _seed(engine, "2")
+    assert not list(engine.select_modified_since(T0))
+
+    with engine.atomic():
+        engine.update_user(
+            T0 + HOUR,
+            engine.select_user_by_name("user"),
+            T0 + 3 * HOUR,
+        )
+        engine.update_secret(
+            T0 + 2 * HOUR,
+            engine.select_secret_by_name("user"),
+            hash="hash2",
+        )
+
+    modified = sorted(engine.select_modified_since(T0), key=lambda row: row[1])
+    assert modified == [
+        (user_id, T0 + HOUR, T0 + 3 * HOUR),
+        (secret_id, T0 + 2 * HOUR, None),
+    ], modified
+    assert list(engine.select_modified_since(T0 + 2 * HOUR)) == [
+        (secret_id, T0 + 2 * HOUR, None),
+    ]
+
+
+def test_evict_access_tokens(engine: Engine) -> None:
+    user_id, secret_id, _ = _seed(engine)
+    _, other_secret_id, _ = _seed(engine, "2")
+    with engine.atomic():
+        for index in range(1, 4):
+            access_token_id = uuid.uuid4()
+            engine.create_access_token(
+                access_token_id,
+                f"a.{index}",
+                T0 + index * MINUTE,
+                T0 + HOUR,
+                secret_id,
+            )
+            engine.create_refresh_token(
+                uuid.uuid4(),
+                f"r.{index}",
+                T0 + index * MINUTE,
+                T0 + 2 * HOUR,
+                access_token_id,
+            )
+    tree_version = engine.select_user_by_name("user").tree_version
+
+    server_ts = T0 + 10 * MINUTE
+    with engine.atomic():
+        assert engine.evict_access_tokens(server_ts, secret_id, 2) == 2
+    assert engine.evict_access_tokens(server_ts, secret_id, 2) == 0
+    assert engine.evict_access_tokens(server_ts, other_secret_id, 0) == 1
+
+    # The oldest two went, with their refresh tokens, as of server_ts.
+    valid = {
+        access_token.value
+        for access_token in
+        engine.select_valid_access_tokens_by_user(server_ts, user_id)
+    }
+    assert valid == {"a.2", "a.3"}, valid
+    assert {
+        refresh_token.value
+        for refresh_token in
+        engine.select_valid_refresh_tokens_by_user(server_ts, user_id)
+    } == {"r.2", "r.3"}
+    assert engine.select_access_token_by_value("a").expire_ts < server_ts
+    assert engine.select_user_by_name("user").tree_version > tree_version
+
+
+def test_expire_secrets(engine: Engine) -> None:
+    user_id, _, _ = _seed(engine)
+    _, other_secret_id, _ = _seed(engine, "2")
+    ids = [uuid.uuid4() for _ in range(3)]
+    with engine.atomic():
+        engine.create_secret(ids[0], "s.0", "hash", T0, None, user_id)
+        engine.create_secret(ids[1], "s.1", "hash", T0, T0 + HOUR, user_id)
+        engine.create_secret(
+            ids[2], "s.2", "hash", T0, T0 + 3 * HOUR, user_id
+        )
+    tree_version = engine.select_user_by_name("user").tree_version
+
+    server_ts = T0 + MINUTE
+    deadline = T0 + 2 * HOUR
+    with engine.atomic():
+        # Only the user's own secrets change, and not one due sooner.
+        assert engine.expire_secrets(
+            server_ts, user_id, ids + [other_secret_id], deadline
+        ) == 2
+    assert engine.expire_secrets(server_ts, user_id, ids, deadline) == 0
+
+    expected = {
+        "s.0": (deadline, 2),
+        "s.1": (T0 + HOUR, 1),
+        "s.2": (deadline, 2),
+    }
+    for name, (expire_ts, version) in expected.items():
+        secret = engine.select_secret_by_name(name)
+        assert (secret.expire_ts, secret.version) == (expire_ts, version)
+        if version > 1:
+            assert secret.modify_ts == server_ts
+    assert engine.select_secret_by_name("user2").expire_ts is None
+    user = engine.select_user_by_name("user")
+    assert user.tree_version == tree_version + 1
+    assert user.tree_modify_ts == server_ts
+
+
+def test_persistence(engines: Engines) -> None:
+    engine = engines.open()
+    user_id, _, _ = _seed(engine)
+    tree_version = engine.select_user_by_name("user").tree_version
+    with engine.atomic():
+        engine.update_user(T0, engine.select_user_by_name("user"), T0 + HOUR)
+
+    engine = engines.reopen(engine)
+    user = engine.select_user_by_name("user")
+    assert user.id == user_id and user.expire_ts == T0 + HOUR
+    assert user.tree_version == tree_version + 1
+    assert engine.select_valid_access_token_record_by_value(T0, "a")
+
+    _seed(engine, "2")
+    engine.reap(T0 + 3 * HOUR, 10)
+
+    engine = engines.reopen(engine)
+    assert engine.select_user_by_name("user") is None
+    assert engine.select_user_by_name("user2") is not None
+    assert engine.select_secret_by_name("user2").user.name == "user2"
@@ -0,0 +1,103 @@
+"""
+A user's private view is streamed once it outgrows a chunk, its rows
+selected as they are sent, all within one read transaction.
+"""
+
+import datetime
+import json
+import threading
+import uuid
+
+import pytest
+
+from .engines import Engines
+from .context import lobbyist
+from lobbyist.controllers import user
+from lobbyist.library.app import app
+from lobbyist.library.db import db
+from lobbyist.storage.engine import storage
+import lobbyist.views
+
+HOUR = datetime.timedelta(hours=1)
+# Enough access tokens to outgrow stream_chunk_size.
+TOKENS = 600
+HEADERS = {"Accept-Encoding": "identity, gzip"}
+
+
+@pytest.fixture(params=["sqlite", "sharded"])
+def engine(request, tmp_path):
+    engines = Engines(request.param, str(tmp_path))
+    yield engines.open()
+    engines.close()
+
+
+@pytest.fixture
+def client(engine):
+    storage().initialize(engine)
+    return app().test_client()
+
+
+def _create_token(secret_id: uuid.UUID, value: str) -> None:
+    server_ts = datetime.datetime.utcnow()
+    with storage().atomic(write=True):
+        storage().create_access_token(
+            uuid.uuid4(), value, server_ts, server_ts + HOUR, secret_id
+        )
+
+
+@pytest.fixture
+def bearer(client):
+    server_ts = datetime.datetime.utcnow()
+    response = user.create_user(server_ts, "alice", "password", HOUR, HOUR)
+    (token, ) = storage().select_valid_access_tokens_by_user(
+        server_ts,
+        response.user.id,
+    )
+    with storage().atomic(write=True):
+        for index in range(TOKENS):
+            storage().create_access_token(
+                uuid.uuid4(),
+                f"token{index}",
+                server_ts,
+                server_ts + HOUR,
+                token.secret_id,
+            )
+    return {**HEADERS, "Authorization": f"Bearer {token.value}"}, token
+
+
+def test_streamed_in_one_transaction(client, bearer) -> None:
+    headers, token = bearer
+    response = client.get("/user/alice", headers=headers)
+    assert response.status_code == 200
+    assert response.is_streamed
+    body = iter(response.response)
+    chunks = [next(body)]
+    assert db().in_transaction()
+
+    # Committed by another connection while the view streams.
+    writer = threading.Thread(
+        target=_create_token,
+        args=(token.secret_id, "later"),
+    )
+    writer.start()
+    writer.join()
+
+    chunks.extend(body)
+    response.close()
+    assert not db().in_transaction()
+
+    payload = json.loads(b"".join(chunks))
+    values = {token["value"] for token in payload["access_tokens"]}
+    assert len(values) == TOKENS + 1
+    assert "later" not in values
+
+
+def test_closed_mid_stream(client, bearer) -> None:
+    headers, _ = bearer
+    response = client.get("/user/alice", headers=headers)
+    next(iter(response.response))
+    assert db().in_transaction()
+
+    # As when the client goes away.
+    response.close()
+    assert not db().in_transaction()
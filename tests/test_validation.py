@@ -0,0 +1,32 @@
+"""
+Request fields that CBOR can carry but form data cannot.
+"""
+
+import pytest
+
+from .context import lobbyist
+from lobbyist.library import cbor, validation
+from lobbyist.library.app import app
+from lobbyist.library.error import BadRequestError
+
+FIELDS = [
+    ("expire_ts", validation.optional_field_expire_ts),
+    ("access_token_lifetime", validation.optional_field_access_token_lifetime),
+    ("grace_period", validation.optional_field_grace_period),
+]
+VALUES = [float("inf"), float("-inf"), float("nan"), 1e300, 2**63, -2**63]
+
+
+@pytest.mark.parametrize("value", VALUES, ids=repr)
+@pytest.mark.parametrize("key, field", FIELDS, ids=[key for key, _ in FIELDS])
+def test_out_of_range_numbers(key: str, field, value) -> None:
+    with app().test_request_context(
+        "/",
+        method="POST",
+        data=cbor.encode({key: value}),
+        content_type=cbor.MIMETYPE,
+    ):
+        app().preprocess_request()
+        with pytest.raises(BadRequestError) as raised:
+            field(key)
+    assert key in raised.value.context["fields"]
@@ -0,0 +1,164 @@
+"""
+The binary validation protocol: its framing and request decoding, and the
+socket server answering it.
+"""
+
+import datetime
+import socket
+import struct
+
+import pytest
+
+from .context import lobbyist
+from lobbyist.controllers import user
+from lobbyist.library import wire
+from lobbyist.library.config import config
+from lobbyist.storage.engine import storage
+from lobbyist.views.wire import WireServer
+
+HOUR = datetime.timedelta(hours=1)
+
+
+def test_split_frames_keeps_partial_frames() -> None:
+    data = wire.frame(b"one") + wire.frame(b"") + wire.frame(b"three")
+    buffer = bytearray()
+    payloads = []
+    # Byte by byte, so that lengths and payloads arrive split.
+    for index in range(len(data)):
+        buffer += data[index:index + 1]
+        payloads += wire.split_frames(buffer, 16)
+    assert payloads == [b"one", b"", b"three"]
+    assert buffer == bytearray()
+
+    buffer = bytearray(wire.frame(b"one") + wire.frame(b"three")[:6])
+    assert wire.split_frames(buffer, 16) == [b"one"]
+    assert buffer == wire.frame(b"three")[:6]
+
+
+def test_split_frames_refuses_oversized_frames() -> None:
+    assert wire.split_frames(bytearray(wire.frame(b"x" * 16)), 16)
+
+    # Refused on its length alone, before the payload arrives.
+    buffer = bytearray(wire.LENGTH.pack(17))
+    with pytest.raises(wire.ProtocolError):
+        wire.split_frames(buffer, 16)
+
+
+def test_decode_request() -> None:
+    payload = wire.encode_request(7, wire.OP_VALIDATE, ["a", "", "é"])
+    assert wire.decode_request(payload[wire.LENGTH.size:]) == (
+        7,
+        wire.OP_VALIDATE,
+        ["a", "", "é"],
+    )
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        b"",
+        # A header cut short.
+        wire.HEADER.pack(1, wire.OP_VALIDATE, 0)[:-1],
+        # Two tokens announced, one sent.
+        wire.HEADER.pack(1, wire.OP_VALIDATE, 2) + b"\x00\x01a",
+        # A token shorter than its length.
+        wire.HEADER.pack(1, wire.OP_VALIDATE, 1) + b"\x00\x05a",
+        wire.HEADER.pack(1, wire.OP_VALIDATE, 1) + b"\x00\x01\xff",
+        wire.HEADER.pack(1, wire.OP_VALIDATE, 0) + b"\x00",
+    ],
+)
+def test_decode_request_errors(payload: bytes) -> None:
+    with pytest.raises(wire.ProtocolError):
+        wire.decode_request(payload)
+
+
+@pytest.fixture
+def server(engine, tmp_path):
+    storage().initialize(engine)
+    path = str(tmp_path / "wire.sock")
+    server = WireServer(path)
+    server.start()
+    yield path
+    server.stop()
+
+
+@pytest.fixture
+def tokens(server):
+    server_ts = datetime.datetime.utcnow()
+    tokens = []
+    for name in ("alice", "bob"):
+        response = user.create_user(server_ts, name, "password", HOUR, HOUR)
+        (access_token, ) = storage().select_valid_access_tokens_by_user(
+            server_ts,
+            response.user.id,
+        )
+        tokens.append((access_token, response.user.id))
+    return tokens
+
+
+def test_validate(server, tokens) -> None:
+    alice, bob = (token.value for token, _ in tokens)
+    with wire.Client(server) as client:
+        assert client.validate([alice, "nope", bob, alice]) == [
+            True,
+            False,
+            True,
+            True,
+        ]
+        assert client.validate([]) == []
+
+
+def test_pipelining(server, tokens) -> None:
+    alice, bob = (token.value for token, _ in tokens)
+    batches = [[alice], ["nope", bob], [], [bob, alice, "nope"]] * 25
+    with wire.Client(server) as client:
+        assert client.pipeline(wire.OP_VALIDATE, batches) == [
+            [token != "nope" for token in batch] for batch in batches
+        ]
+
+
+def test_introspect(server, tokens) -> None:
+    with wire.Client(server) as client:
+        results = client.introspect(
+            ["nope"] + [token.value for token, _ in tokens]
+        )
+
+    assert results[0] is None
+    for (token, user_id), result in zip(tokens, results[1:]):
+        assert result.id == token.id
+        assert result.user_id == user_id
+        assert result.secret_id == token.secret_id
+        assert result.expire_ts == token.expire_ts
+
+
+def test_batch_over_limit(server, tokens, monkeypatch) -> None:
+    monkeypatch.setattr(config(), "wire_max_batch", 2)
+    alice = tokens[0][0].value
+    with wire.Client(server) as client:
+        with pytest.raises(wire.ProtocolError, match="status 1"):
+            client.validate([alice] * 3)
+        # The connection still answers.
+        assert client.validate([alice] * 2) == [True, True]
+
+
+def test_bad_requests(server) -> None:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(server)
+
+        # An unknown op, then a request that does not decode.
+        connection.sendall(
+            wire.encode_request(3, 99, []) + wire.frame(b"\x00\x00")
+        )
+        data = b""
+        while len(data) < 2 * (wire.LENGTH.size + wire.HEADER.size):
+            data += connection.recv(4096)
+        payloads = wire.split_frames(bytearray(data), 64)
+        assert [
+            wire.decode_response(payload, wire.OP_VALIDATE)
+            for payload in payloads
+        ] == [(3, wire.STATUS_BAD_REQUEST, []),
+              (0, wire.STATUS_BAD_REQUEST, [])]
+
+        # An oversized frame closes the connection.
+        connection.sendall(struct.pack(">I", 2**31))
+        assert connection.recv(4096) == b""